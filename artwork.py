@@ -0,0 +1,196 @@
+import hashlib
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import FileCache
+from logger import Logger
+from mutagen.id3 import ID3
+from mutagen.id3._util import ID3NoHeaderError
+from PyQt6.QtCore import QObject, Qt, pyqtSignal
+from PyQt6.QtGui import QImage, QPixmap
+from settings import ArtworkSettings, LoggerSettings
+
+log = Logger("Artwork", LoggerSettings.log_level)
+
+FRONT_COVER = 3
+
+
+def extract_artwork(path: str) -> bytes | None:
+    """Returns the embedded picture of a file, the front cover if there are several."""
+    try:
+        pictures = ID3(path).getall("APIC")
+    except (ID3NoHeaderError, OSError):
+        return None
+    if not pictures:
+        return None
+    pictures.sort(key=lambda picture: picture.type != FRONT_COVER)
+    return pictures[0].data
+
+
+def thumbnail_path(digest: str, size: int) -> str:
+    return os.path.join(ArtworkSettings.directory, digest[:2], f"{digest}_{size}.png")
+
+
+def create_thumbnails(path: str) -> str | None:
+    """Extracts the artwork of a file and stores it downsized in all thumbnail sizes.
+
+    The thumbnails are addressed by the hash of the image, tracks of the same album
+    share them. Runs in the worker threads of ArtworkLoader.
+
+    Returns:
+        str | None: Hash of the artwork, None if the file has none.
+    """
+    data = extract_artwork(path)
+    if data is None:
+        return None
+    digest = hashlib.sha1(data).hexdigest()
+    missing = [
+        size
+        for size in ArtworkSettings.sizes
+        if not os.path.exists(thumbnail_path(digest, size))
+    ]
+    if not missing:
+        return digest
+    image = QImage.fromData(data)
+    if image.isNull():
+        log.warning(f"Unreadable artwork in {path}")
+        return None
+    os.makedirs(os.path.dirname(thumbnail_path(digest, 0)), exist_ok=True)
+    for size in missing:
+        thumbnail = image.scaled(
+            size,
+            size,
+            Qt.AspectRatioMode.KeepAspectRatio,
+            Qt.TransformationMode.SmoothTransformation,
+        )
+        # Write and rename, so no reader sees half written files. Tracks of the same
+        # album are loaded at the same time, every thread writes its own file and the
+        # last rename wins with the same image
+        target = thumbnail_path(digest, size)
+        handle, temporary = tempfile.mkstemp(".tmp", dir=os.path.dirname(target))
+        os.close(handle)
+        try:
+            if not thumbnail.save(temporary, "PNG"):
+                raise OSError(f"Could not write {target}")
+            os.replace(temporary, target)
+        except BaseException:
+            os.remove(temporary)
+            raise
+    return digest
+
+
+class PixmapCache:
+    """Least recently used QPixmaps, bounded by their size in bytes."""
+
+    def __init__(self, max_bytes: int = ArtworkSettings.memory_cache_bytes) -> None:
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.pixmaps: OrderedDict[tuple[str, int], QPixmap] = OrderedDict()
+
+    def __len__(self):
+        return len(self.pixmaps)
+
+    @staticmethod
+    def cost(pixmap: QPixmap) -> int:
+        return pixmap.width() * pixmap.height() * pixmap.depth() // 8
+
+    def get(self, key: tuple[str, int]) -> QPixmap | None:
+        pixmap = self.pixmaps.get(key)
+        if pixmap is not None:
+            self.pixmaps.move_to_end(key)
+        return pixmap
+
+    def put(self, key: tuple[str, int], pixmap: QPixmap):
+        if key in self.pixmaps:
+            self.bytes -= self.cost(self.pixmaps.pop(key))
+        self.pixmaps[key] = pixmap
+        self.bytes += self.cost(pixmap)
+        while self.bytes > self.max_bytes and len(self.pixmaps) > 1:
+            _, evicted = self.pixmaps.popitem(last=False)
+            self.bytes -= self.cost(evicted)
+
+
+class ArtworkLoader(QObject):
+    """Creates thumbnails in background threads on request and hands them out as
+    QPixmaps. Nothing is done for tracks that are never requested."""
+
+    # Path of the track whose thumbnails are ready
+    loaded = pyqtSignal(str)
+
+    def __init__(self, parent=None, cache: FileCache | None = None) -> None:
+        super().__init__(parent)
+        self.cache = cache or FileCache("artwork")
+        self.pixmaps = PixmapCache()
+        # Path -> hash of its artwork, None for tracks without artwork
+        self.digests: dict[str, str | None] = dict()
+        # Paths submitted to the executor, discarded by its threads
+        self.pending: set[str] = set()
+        self.pending_lock = threading.Lock()
+        # Requests of tracks that were scrolled out of view before their turn are dropped
+        self.wanted: set[str] = set()
+        self.executor = ThreadPoolExecutor(ArtworkSettings.workers)
+
+    def pixmap(self, path: str, size: int) -> QPixmap | None:
+        """Returns the thumbnail if it is ready, otherwise None and it is requested."""
+        if path not in self.digests:
+            self.request(path)
+            return None
+        digest = self.digests[path]
+        if digest is None:
+            return None
+        pixmap = self.pixmaps.get((digest, size))
+        if pixmap is None:
+            pixmap = QPixmap(thumbnail_path(digest, size))
+            if pixmap.isNull():
+                # The thumbnail file was deleted, create it again
+                del self.digests[path]
+                self.request(path)
+                return None
+            self.pixmaps.put((digest, size), pixmap)
+        return pixmap
+
+    def request(self, path: str):
+        self.wanted.add(path)
+        with self.pending_lock:
+            if path in self.pending:
+                return
+            self.pending.add(path)
+        self.executor.submit(self.load, path)
+
+    def set_wanted(self, paths: set[str]):
+        self.wanted = set(paths)
+
+    def load(self, path: str):
+        try:
+            if path not in self.wanted:
+                return
+            try:
+                entry = self.cache.get(path)
+                if entry is None or not self.thumbnails_exist(entry["digest"]):
+                    digest = create_thumbnails(path)
+                    self.cache.set(path, {"digest": digest})
+                else:
+                    digest = entry["digest"]
+            except Exception as e:
+                log.warning(f"Could not load the artwork of {path}: {e}")
+                digest = None
+            self.digests[path] = digest
+        finally:
+            with self.pending_lock:
+                self.pending.discard(path)
+        self.loaded.emit(path)
+
+    @staticmethod
+    def thumbnails_exist(digest: str | None) -> bool:
+        if digest is None:
+            return True
+        return all(
+            os.path.exists(thumbnail_path(digest, size))
+            for size in ArtworkSettings.sizes
+        )
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
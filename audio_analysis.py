@@ -0,0 +1,220 @@
+import multiprocessing
+import os
+import shutil
+import subprocess
+import wave
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import mutagen
+import numpy as np
+from cache import FileCache, file_signature
+from logger import Logger
+from settings import AnalysisSettings, LoggerSettings
+
+log = Logger("AudioAnalysis", LoggerSettings.log_level)
+
+
+class DecodeError(RuntimeError):
+    pass
+
+
+def decode_audio(
+    path: str,
+    sample_rate: int = AnalysisSettings.sample_rate,
+    offset: float | None = None,
+    duration: float | None = None,
+    mono: bool = True,
+) -> np.ndarray:
+    """Decodes an audio file to a float32 signal in the range [-1, 1].
+
+    WAV files are read with the standard library, all other formats are decoded by
+    ffmpeg, which has to be installed.
+
+    Args:
+        path (str): Audio file.
+        sample_rate (int, optional): Sample rate of the returned signal.
+        offset (float, optional): Start of the decoded segment in seconds.
+        duration (float, optional): Length of the decoded segment in seconds.
+        mono (bool, optional): Mixes all channels down. Otherwise the signal has the shape (n_samples, 2).
+
+    Raises:
+        DecodeError: The file could not be decoded.
+    """
+    if path.lower().endswith(".wav"):
+        try:
+            return decode_wav(path, sample_rate, offset, duration, mono)
+        except (wave.Error, EOFError) as e:
+            # Compressed or float WAV files are left to ffmpeg
+            log.debug(f"Falling back to ffmpeg for {path}: {e}")
+    return decode_ffmpeg(path, sample_rate, offset, duration, mono)
+
+
+def channel_count(path: str) -> int:
+    """Number of channels of an audio file, 2 when it can't be read."""
+    if path.lower().endswith(".wav"):
+        try:
+            with wave.open(path, "rb") as file:
+                return file.getnchannels()
+        except (wave.Error, EOFError, OSError):
+            pass
+    try:
+        file = mutagen.File(path)
+        return int(file.info.channels)
+    except (mutagen.MutagenError, OSError, AttributeError, TypeError):
+        return 2
+
+
+def decode_wav(path, sample_rate, offset=None, duration=None, mono=True):
+    with wave.open(path, "rb") as file:
+        width = file.getsampwidth()
+        if width not in (1, 2, 4):
+            raise wave.Error(f"Unsupported sample width {width}")
+        channels = file.getnchannels()
+        source_rate = file.getframerate()
+        if offset:
+            file.setpos(min(int(offset * source_rate), file.getnframes()))
+        n_frames = file.getnframes()
+        if duration is not None:
+            n_frames = int(duration * source_rate)
+        data = file.readframes(n_frames)
+    dtype = {1: np.uint8, 2: np.int16, 4: np.int32}[width]
+    signal = np.frombuffer(data, dtype=dtype).astype(np.float32)
+    if width == 1:
+        signal -= 128
+    signal /= float(2 ** (8 * width - 1))
+    signal = signal[: len(signal) - len(signal) % channels]
+    signal = signal.reshape(-1, channels)
+    if mono:
+        return resample(signal.mean(axis=1), source_rate, sample_rate)
+    if channels == 1:
+        signal = np.repeat(signal, 2, axis=1)
+    return np.stack(
+        [resample(signal[:, i], source_rate, sample_rate) for i in range(2)], axis=1
+    )
+
+
+def resample(signal: np.ndarray, source_rate: int, target_rate: int) -> np.ndarray:
+    if source_rate == target_rate or len(signal) == 0:
+        return signal.astype(np.float32)
+    if target_rate < source_rate:
+        # Box filter against the worst aliasing before decimating
+        width = int(source_rate // target_rate)
+        if width > 1:
+            signal = np.convolve(signal, np.ones(width) / width, mode="same")
+    n = int(len(signal) * target_rate / source_rate)
+    positions = np.arange(n) * (source_rate / target_rate)
+    return np.interp(positions, np.arange(len(signal)), signal).astype(np.float32)
+
+
+def decode_ffmpeg(path, sample_rate, offset=None, duration=None, mono=True):
+    ffmpeg = shutil.which(AnalysisSettings.ffmpeg)
+    if ffmpeg is None:
+        raise DecodeError(f"ffmpeg is needed to decode {path}")
+    command = [ffmpeg, "-v", "error", "-nostdin"]
+    if offset:
+        command += ["-ss", str(offset)]
+    if duration:
+        command += ["-t", str(duration)]
+    channels = 1 if mono else 2
+    command += ["-i", path, "-f", "f32le", "-ac", str(channels)]
+    command += ["-ar", str(sample_rate), "-"]
+    process = subprocess.run(command, capture_output=True)
+    if process.returncode != 0:
+        raise DecodeError(process.stderr.decode(errors="replace").strip())
+    signal = np.frombuffer(process.stdout, dtype=np.float32)
+    return signal if mono else signal[: len(signal) // 2 * 2].reshape(-1, 2)
+
+
+def frames(signal: np.ndarray, frame_size: int, hop: int) -> np.ndarray:
+    """Strided view of the signal as overlapping frames, shape (n_frames, frame_size)."""
+    if len(signal) < frame_size:
+        signal = np.pad(signal, (0, frame_size - len(signal)))
+    return np.lib.stride_tricks.sliding_window_view(signal, frame_size)[::hop]
+
+
+def spectrogram(signal: np.ndarray, frame_size: int, hop: int) -> np.ndarray:
+    """Magnitude spectra of all frames at once, shape (n_frames, frame_size // 2 + 1)."""
+    window = np.hanning(frame_size).astype(np.float32)
+    return np.abs(np.fft.rfft(frames(signal, frame_size, hop) * window, axis=1))
+
+
+def analyze_files(
+    analyzer,
+    paths: list[str],
+    cache: FileCache | None = None,
+    workers: int | None = None,
+    progress=None,
+) -> dict:
+    """Runs an analyzer over many files in a process pool. Files with a valid cache
+    entry are not analyzed again and new results are written to the cache.
+
+    Args:
+        analyzer (Callable[[str], dict]): Module level function taking a path, so it can be sent to the worker processes.
+        paths (list[str]): Files to analyze.
+        cache (FileCache, optional): Cache of the results of this analyzer.
+        workers (int, optional): Number of processes. Defaults to the number of CPUs.
+        progress (Callable[[int, int], None], optional): Called with (done, total) after each file.
+
+    Returns:
+        dict: Maps the paths to their results. Files that failed are left out.
+    """
+    signatures = {path: file_signature(path) for path in paths}
+    missing_files = [path for path, signature in signatures.items() if not signature]
+    for path in missing_files:
+        log.warning(f"File not found: {path}")
+    results = cache.get_many(paths, signatures) if cache else {}
+    todo = [path for path in paths if path not in results and signatures[path]]
+    total = len(paths)
+    if progress:
+        progress(total - len(todo), total)
+    if not todo:
+        return results
+
+    workers = min(workers or os.cpu_count() or 1, len(todo))
+    done = total - len(todo)
+    # Spawn keeps the worker processes independent of the threads of the GUI
+    context = multiprocessing.get_context("spawn")
+    new_results = {}
+    with ProcessPoolExecutor(workers, mp_context=context) as executor:
+        futures = {executor.submit(analyzer, path): path for path in todo}
+        for future in as_completed(futures):
+            path = futures[future]
+            done += 1
+            try:
+                new_results[path] = future.result()
+            except Exception as e:
+                log.warning(f"Analysis of {path} failed: {e}")
+            if cache and len(new_results) >= 100:
+                # Store in batches, so an aborted run keeps most of its work
+                cache.set_many(new_results, signatures)
+                results.update(new_results)
+                new_results = {}
+            if progress:
+                progress(done, total)
+    if cache and new_results:
+        cache.set_many(new_results, signatures)
+    results.update(new_results)
+    return results
+
+
+def result_tags(collection, results: dict, to_tags) -> dict[str, dict[str, str]]:
+    """Tags that analysis results change, of the tracks of a collection. Reads the
+    tracks, so it runs in the GUI thread, the tags are saved in the background.
+
+    Args:
+        collection (TrackCollection): Tracks to update, paths that are not part of it are skipped.
+        results (dict): Maps paths to analysis results.
+        to_tags (Callable[[AudioTrack, dict], dict]): Tags to write for a track and its result, an empty dict skips the track.
+
+    Returns:
+        dict[str, dict[str, str]]: Maps the paths to their new tags.
+    """
+    tags = {}
+    for path, result in results.items():
+        track = collection.by_path.get(path)
+        if track is None:
+            continue
+        new_tags = to_tags(track, result)
+        if new_tags:
+            tags[path] = new_tags
+    return tags
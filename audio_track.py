@@ -1,19 +1,207 @@
-import xml.etree.ElementTree as ET
+import math
+from functools import lru_cache
 
+from beatgrid import BEATGRID_TAG, format_beatgrid, parse_beatgrid
+from cue_points import CUE_TAG, format_cues, parse_cues
 from mutagen.easyid3 import EasyID3
+from mutagen.id3._util import ID3NoHeaderError
+
+TAG_FIELDS = ("title", "artist", "album", "date", "genre", "bpm")
+GENRE_SEPARATOR = " / "
+
+EasyID3.RegisterTextKey("initialkey", "TKEY")
+EasyID3.RegisterTXXXKey(CUE_TAG, CUE_TAG.upper())
+EasyID3.RegisterTXXXKey(BEATGRID_TAG, BEATGRID_TAG.upper())
+
+PITCH_CLASSES = ("C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B")
+FLATS = {"Db": "C#", "Eb": "D#", "Gb": "F#", "Ab": "G#", "Bb": "A#"}
+# Keys in ID3 notation ("Am" is A minor) and their position on the Camelot wheel
+CAMELOT_KEYS = {
+    "B": "1B", "F#": "2B", "C#": "3B", "G#": "4B", "D#": "5B", "A#": "6B",
+    "F": "7B", "C": "8B", "G": "9B", "D": "10B", "A": "11B", "E": "12B",
+    "G#m": "1A", "D#m": "2A", "A#m": "3A", "Fm": "4A", "Cm": "5A", "Gm": "6A",
+    "Dm": "7A", "Am": "8A", "Em": "9A", "Bm": "10A", "F#m": "11A", "C#m": "12A",
+}  # fmt: skip
+KEYS_BY_CAMELOT = {camelot: key for key, camelot in CAMELOT_KEYS.items()}
+
+
+def normalize_key(key: str) -> str:
+    """Brings keys like "A minor", "Amin", "Bbm" or "8A" to ID3 notation ("Am", "A#m")."""
+    key = key.strip()
+    if key.upper() in KEYS_BY_CAMELOT:
+        return KEYS_BY_CAMELOT[key.upper()]
+    if len(key) < 1 or key[0].upper() not in "ABCDEFG":
+        return ""
+    root, rest = key[0].upper(), key[1:]
+    if rest[:1] in ("#", "b"):
+        root, rest = root + rest[0], rest[1:]
+    root = FLATS.get(root, root)
+    minor = rest.strip().lower() in ("m", "min", "minor")
+    if root not in PITCH_CLASSES:
+        return ""
+    return root + ("m" if minor else "")
+
+
+def parse_float(value: str) -> float | None:
+    """Reads numbers from tags like "-3.21 dB" or "0.98"."""
+    try:
+        return float(value.split()[0])
+    except (ValueError, IndexError):
+        return None
+
+
+# Libraries share few distinct keys and genres, caching them speeds up loading
+@lru_cache(maxsize=1024)
+def to_camelot(key: str) -> str:
+    return CAMELOT_KEYS.get(normalize_key(key), "")
+
+
+@lru_cache(maxsize=4096)
+def genre_tokens(genre: str) -> tuple[str, ...]:
+    return tuple(
+        token.strip() for token in genre.split(GENRE_SEPARATOR.strip()) if token.strip()
+    )
+
+
+def split_genres(genre: str) -> list[str]:
+    return list(genre_tokens(genre))
+
+
+@lru_cache(maxsize=4096)
+def normalize_genre(genre: str) -> str:
+    return " ".join(genre.split()).casefold()
 
 
 class AudioTrack(EasyID3):
+    # False for tracks restored from a session snapshot until a tag is accessed
+    frames_loaded = True
+
     def __init__(self, path=None):
-        super().__init__(path)
+        try:
+            super().__init__(path)
+        except ID3NoHeaderError:
+            # Untagged file, start with empty tags so they can be written later
+            super().__init__()
+            self.filename = path
         self.path = path
-        self.title = f"{','.join(self.get('title',[]))}"
-        self.artist = f"{','.join(self.get('artist',[]))}"
-        self.album = f"{','.join(self.get('album',[]))}"
-        self.date = f"{','.join(self.get('date',[]))}"
-        self.genre = f"{','.join(self.get('genre',[]))}"
-        self.bpm = f"{','.join(self.get('bpm',[]))}"
+        self.read_tags()
+
+    @classmethod
+    def from_snapshot(cls, values: list[str]) -> "AudioTrack":
+        """Creates a track from the values of snapshot_values without opening the file.
+        The ID3 frames are only read when a tag is accessed, e.g. before an edit is saved.
+        """
+        path, title, artist, album, date, genre, bpm, key, gain, peak, cues, grid = (
+            values
+        )
+        track = cls.__new__(cls)
+        track.__dict__.update(
+            path=path,
+            frames_loaded=False,
+            title=title,
+            artist=artist,
+            album=album,
+            date=date,
+            genre=genre,
+            bpm=bpm,
+            full_name=f"{artist} - {title}",
+            genres=split_genres(genre) if genre else [],
+            key=key,
+            camelot=to_camelot(key) if key else "",
+            replaygain=float(gain) if gain else None,
+            replaygain_peak=float(peak) if peak else None,
+            cues=parse_cues(cues) if cues else {},
+            beatgrid=parse_beatgrid(grid) if grid else None,
+        )
+        return track
+
+    def snapshot_values(self) -> list[str]:
+        """The path and the tag attributes of the track as strings, see from_snapshot."""
+        return [
+            self.path,
+            *(getattr(self, field) for field in TAG_FIELDS),
+            self.key,
+            "" if self.replaygain is None else repr(self.replaygain),
+            "" if self.replaygain_peak is None else repr(self.replaygain_peak),
+            format_cues(self.cues),
+            format_beatgrid(self.beatgrid),
+        ]
+
+    def load_frames(self):
+        if self.frames_loaded:
+            return
+        self.frames_loaded = True
+        try:
+            EasyID3.__init__(self, self.path)
+        except ID3NoHeaderError:
+            EasyID3.__init__(self)
+            self.filename = self.path
+
+    def reload(self):
+        """Reads the tags from the file again, e.g. after another program changed it."""
+        self.frames_loaded = False
+        self.load_frames()
+        self.read_tags()
+
+    def __getitem__(self, key):
+        self.load_frames()
+        return super().__getitem__(key)
+
+    def __setitem__(self, key, value):
+        self.load_frames()
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self.load_frames()
+        super().__delitem__(key)
+
+    def keys(self):
+        self.load_frames()
+        return super().keys()
+
+    def save(self, *args, **kwargs):
+        self.load_frames()
+        super().save(*args, **kwargs)
+
+    # Tracks are unique by their file, not by equal tags
+    __eq__ = object.__eq__
+    __hash__ = object.__hash__
+
+    def __bool__(self):
+        # Checked often, e.g. "if self.current_track", which must not read the frames
+        return True
+
+    def read_tags(self, tags: dict[str, list[str]] | None = None):
+        """Sets the track attributes from the ID3 frames or from the given tags."""
+        if tags is None:
+            tags = self
+        for field in TAG_FIELDS:
+            setattr(self, field, f"{','.join(tags.get(field,[]))}")
         self.full_name = f"{self.artist} - {self.title}"
+        self.genres = split_genres(self.genre)
+        self.key = f"{','.join(tags.get('initialkey',[]))}"
+        self.camelot = to_camelot(self.key)
+        self.replaygain = parse_float(tags.get("replaygain_track_gain", [""])[0])
+        peak = parse_float(tags.get("replaygain_track_peak", [""])[0])
+        self.replaygain_peak = 20 * math.log10(peak) if peak else None
+        self.cues = parse_cues(tags.get(CUE_TAG, [""])[0])
+        self.beatgrid = parse_beatgrid(tags.get(BEATGRID_TAG, [""])[0])
+
+    def update_tags(self, tags: dict[str, str], save=True):
+        """Writes the given tags to the ID3 frames and refreshes the track attributes.
+
+        Args:
+            tags (dict[str, str]): Maps tag names (e.g. "genre") to their new value. An empty value deletes the tag.
+            save (bool, optional): Writes the changes to the file. Defaults to True.
+        """
+        for field, value in tags.items():
+            if value:
+                self[field] = value
+            elif field in self:
+                del self[field]
+        self.read_tags()
+        if save:
+            self.save()
 
     def get_all_values(self):
         return [
@@ -35,46 +223,22 @@ class AudioTrack(EasyID3):
             "date": self.date,
             "genre": self.genre,
             "bpm": self.bpm,
+            "key": self.key,
         }
 
-    def translate_to_apple_music(self):
-        res = {}
-        for key, value in self.to_dict().items():
-            if key == "path":
-                key = "Location"
-                # value = value.replace(" ", "%20")
-                value = f"file://{value}"
-                # print(value)
-            elif key == "title":
-                key = "Name"
-            elif key == "artist":
-                key = "Artist"
-            elif key == "album":
-                key = "Album"
-            elif key == "date":
-                key = "Year"
-            elif key == "genre":
-                key = "Genre"
-            elif key == "bpm":
-                key = "BPM"
-            res[key] = value
-        return res
-
 
 class TrackCollection:
     def __init__(
-        self, tracks: list[AudioTrack] | list[str] = [], name="collection", parent=False
+        self,
+        tracks: list[AudioTrack] | list[str] = [],
+        name="collection",
+        parent=False,
+        file: str | None = None,
     ) -> None:
         self.name = name
+        # Playlist file the order of the tracks is saved to
+        self.file = file
         self.tracks = []
-        for track in tracks:
-            if isinstance(track, str):
-                track = AudioTrack(track)
-            elif not isinstance(track, AudioTrack):
-                raise TypeError(
-                    "Tracks in the attribute 'tracks' have to be of type AudioTrack or str"
-                )
-            self.tracks.append(track)
         self.by_path: dict[str:AudioTrack] = dict()
         self.by_title: dict[str : list[AudioTrack]] = dict()
         self.by_artist: dict[str : list[AudioTrack]] = dict()
@@ -82,8 +246,23 @@ class TrackCollection:
         self.by_date: dict[str : list[AudioTrack]] = dict()
         self.by_genre: dict[str : list[AudioTrack]] = dict()
         self.by_bpm: dict[int : list[AudioTrack]] = dict()
+        self.by_key: dict[str : list[AudioTrack]] = dict()
+        # Inverted index of the normalized genre tokens, "House / Deep" is found by both
+        self.by_genre_token: dict[str : set[str]] = dict()
         if not parent:
             self.playlists: list[TrackCollection] = dict()
+        self.listeners = []
+        # Counts the changes, see snapshot
+        self.version = 0
+        self.snapshot_tracker = None
+        for track in tracks:
+            if isinstance(track, str):
+                track = AudioTrack(track)
+            elif not isinstance(track, AudioTrack):
+                raise TypeError(
+                    "Tracks in the attribute 'tracks' have to be of type AudioTrack or str"
+                )
+            self.add_track(track)
 
     def __len__(self):
         return len(self.tracks)
@@ -95,9 +274,9 @@ class TrackCollection:
         return "\n".join([track.full_name for track in self.tracks])
 
     def __add__(self, other):
+        # add_track skips known paths, a lookup in by_path instead of a scan of tracks
         for track in other.tracks:
-            if track not in self.tracks:
-                self.add_track(track)
+            self.add_track(track)
         return self
 
     def add_playlist(self, other):
@@ -105,116 +284,184 @@ class TrackCollection:
         self += other
 
     def export_to_apple_music(self, filename):
-        # Create the root element of the XML document
-        root = ET.Element("plist")
-        root.set("version", "1.0")
-        root_dict = ET.SubElement(root, "dict")
-
-        tracks_element = ET.SubElement(root_dict, "key")
-        tracks_element.text = "Tracks"
-        tracks_dict = ET.SubElement(root_dict, "dict")
-
-        # Add each track to the track array as a dict
-        for i, track in enumerate(self.tracks):
-            track_id = ET.SubElement(tracks_dict, "key")
-            track_id.text = str(i)
-
-            track_dict = ET.SubElement(tracks_dict, "dict")
-            track: AudioTrack
-            a_track = track.translate_to_apple_music()
-            a_track["Track ID"] = str(i)
-            for key, value in a_track.items():
-                if value is None or value == "":
-                    continue
-                key_element = ET.SubElement(track_dict, "key")
-                key_element.text = key
-                value: str
-                if value.isnumeric():
-                    value_element = ET.SubElement(track_dict, "integer")
-                else:
-                    value_element = ET.SubElement(track_dict, "string")
-                value_element.text = value
-
-        # Write the XML document to a file
-        tree = ET.ElementTree(root)
-        tree.write(filename, xml_declaration=True, encoding="utf-8")
+        # Imported here, exporters builds on this module
+        from exporters import export
+
+        export("apple_music", filename, self, self.playlists.values())
+
+    def add_listener(self, fnc):
+        """Registers a callback that is called with (event, track) whenever a track is
+        added ("add"), removed ("remove") or its tags change ("update"). Reordering
+        the tracks is a single "reorder" event with None as track."""
+        self.listeners.append(fnc)
+
+    def remove_listener(self, fnc):
+        if fnc in self.listeners:
+            self.listeners.remove(fnc)
+
+    def notify(self, event: str, track: AudioTrack):
+        self.version += 1
+        for fnc in self.listeners:
+            fnc(event, track)
+
+    def snapshot(self):
+        """Immutable version of the tracks and indexes for readers in other threads,
+        only the changes since the previous snapshot are copied. Has to be called from
+        the thread that changes the collection, see snapshots.SnapshotTracker."""
+        return self.get_snapshot_tracker().take()
+
+    def snapshot_job(self):
+        """Returns a function that returns a snapshot when called from another thread.
+        The first snapshot reads every track, so it is only created by the function."""
+        tracker = self.get_snapshot_tracker()
+        if tracker.snapshot is None:
+            return tracker.begin()
+        snapshot = tracker.take()
+        return lambda: snapshot
+
+    def get_snapshot_tracker(self):
+        # Imported here, snapshots builds on this module
+        from snapshots import SnapshotTracker
+
+        if self.snapshot_tracker is None:
+            self.snapshot_tracker = SnapshotTracker(self)
+        return self.snapshot_tracker
+
+    def indexes(self) -> list[tuple[str, dict]]:
+        return [
+            ("title", self.by_title),
+            ("artist", self.by_artist),
+            ("album", self.by_album),
+            ("date", self.by_date),
+            ("genre", self.by_genre),
+            ("bpm", self.by_bpm),
+            ("key", self.by_key),
+        ]
+
+    def index_track(self, track: AudioTrack):
+        for field, _dict in self.indexes():
+            _dict.setdefault(getattr(track, field), []).append(track)
+        for token in track.genres:
+            self.by_genre_token.setdefault(normalize_genre(token), set()).add(
+                track.path
+            )
+
+    def unindex_track(self, track: AudioTrack):
+        for field, _dict in self.indexes():
+            key = getattr(track, field)
+            if key in _dict and track in _dict[key]:
+                _dict[key].remove(track)
+                if not _dict[key]:
+                    del _dict[key]
+        for token in track.genres:
+            token = normalize_genre(token)
+            paths = self.by_genre_token.get(token)
+            if paths is None:
+                continue
+            paths.discard(track.path)
+            if not paths:
+                del self.by_genre_token[token]
 
     def add_track(self, track: AudioTrack):
         if track.path in self.by_path:
             return
         self.by_path[track.path] = track
         self.tracks.append(track)
-        for i, data in enumerate(
-            zip(
-                [*track.get_all_values()],
-                [
-                    1,
-                    self.by_title,
-                    self.by_artist,
-                    self.by_album,
-                    self.by_date,
-                    self.by_genre,
-                    self.by_bpm,
-                ],
-            ),
-        ):
-            if i == 0:
-                continue
-            key, _dict = data
-            if key not in _dict:
-                _dict[key] = []
-            _dict[key].append(track)
+        self.index_track(track)
+        self.notify("add", track)
+
+    def insert_track(self, index: int, track: AudioTrack):
+        if track.path in self.by_path:
+            return
+        self.by_path[track.path] = track
+        self.tracks.insert(index, track)
+        self.index_track(track)
+        self.notify("add", track)
 
     def remove_track(self, track):
         if track.path not in self.by_path:
             return
-        if track not in self.tracks:
-            return
+        track = self.by_path.pop(track.path)
         self.tracks.remove(track)
-        for key, _dict in zip(
-            [*track.get_all_values()],
-            [
-                [],
-                self.by_title,
-                self.by_artist,
-                self.by_album,
-                self.by_date,
-                self.by_genre,
-                self.by_bpm,
-            ],
-        ):
-            if track in dict[key]:
-                _dict[key].remove(track)
+        self.unindex_track(track)
+        self.notify("remove", track)
+
+    def remove_tracks(self, tracks):
+        """Removes many tracks with one pass over the tracks instead of one per track."""
+        removed = [
+            self.by_path.pop(track.path)
+            for track in tracks
+            if track.path in self.by_path
+        ]
+        if not removed:
+            return
+        removed_ids = {id(track) for track in removed}
+        self.tracks = [track for track in self.tracks if id(track) not in removed_ids]
+        for track in removed:
+            self.unindex_track(track)
+            self.notify("remove", track)
+
+    def update_track_tags(self, track: AudioTrack, tags: dict[str, str], save=True):
+        """Writes new tags to a track of the collection and keeps the indexes up to date.
+
+        Args:
+            track (AudioTrack): Track of this collection.
+            tags (dict[str, str]): Maps tag names to their new value.
+            save (bool, optional): Writes the changes to the file. Defaults to True.
+        """
+        if self.by_path.get(track.path) is not track:
+            track.update_tags(tags, save)
+            return
+        self.unindex_track(track)
+        track.update_tags(tags, save)
+        self.index_track(track)
+        self.notify("update", track)
 
-    def init_dicts(self):
-        for track in self.tracks:
-            if track.path not in self.by_path:
-                self.by_path[track.path] = track
-            if track.title not in self.by_title:
-                self.by_title[track.title] = []
-            if track.artist not in self.by_album:
-                self.by_artist[track.artist] = []
-            if track.album not in self.by_album:
-                self.by_album[track.album] = []
-            if track.date not in self.by_date:
-                self.by_date[track.date] = []
-            if track.genre not in self.by_genre:
-                self.by_genre[track.genre] = []
-            if track.bpm not in self.by_bpm:
-                self.by_bpm[track.bpm] = []
-            for key, _dict in zip(
-                [*track.get_all_values()],
-                [
-                    [],
-                    self.by_title,
-                    self.by_artist,
-                    self.by_album,
-                    self.by_date,
-                    self.by_genre,
-                    self.by_bpm,
-                ],
-            ):
-                _dict[key].append(track)
+    def reload_track(self, track: AudioTrack):
+        """Reads the tags of a track of the collection from its file again."""
+        if self.by_path.get(track.path) is not track:
+            track.reload()
+            return
+        self.unindex_track(track)
+        track.reload()
+        self.index_track(track)
+        self.notify("update", track)
+
+    def reorder(self, order: list[int]):
+        """Arranges the tracks in the given order of their current indexes."""
+        if sorted(order) != list(range(len(self.tracks))):
+            raise ValueError("The order has to contain every track index exactly once")
+        self.tracks = [self.tracks[i] for i in order]
+        self.notify("reorder", None)
+
+    def move_tracks(self, indexes: list[int], destination: int) -> int:
+        """Moves the tracks at the indexes in front of the track at destination in
+        one step, keeping their relative order.
+
+        Args:
+            indexes (list[int]): Indexes of the tracks to move, in any order.
+            destination (int): Index before which the tracks are inserted, len(self) appends them.
+
+        Returns:
+            int: New index of the first moved track.
+        """
+        moved = sorted(set(indexes))
+        moving = set(moved)
+        rest = [i for i in range(len(self.tracks)) if i not in moving]
+        # The destination shifts by the moved tracks that were in front of it
+        position = destination - sum(1 for i in moved if i < destination)
+        self.reorder(rest[:position] + moved + rest[position:])
+        return position
+
+    def save_playlist(self, filename: str | None = None):
+        """Writes the tracks in their order to an m3u playlist, by default to self.file."""
+        filename = filename or self.file
+        if filename is None:
+            raise ValueError(f"The collection {self.name} has no playlist file")
+        with open(filename, "w") as f:
+            f.write("#EXTM3U\n")
+            for track in self.tracks:
+                f.write(f"#EXTINF:-1,{track.full_name}\n{track.path}\n")
 
     def get_track_by_path(self, path: str) -> tuple[int, AudioTrack]:
         track = self.by_path[path]
@@ -238,3 +485,35 @@ class TrackCollection:
 
     def get_tracks_by_bpm(self, bpm: int) -> list[AudioTrack]:
         return self.by_bpm[bpm]
+
+    def get_tracks_by_key(self, key: str) -> list[AudioTrack]:
+        return self.by_key[key]
+
+    def get_paths_by_genre_token(self, genre: str) -> set[str]:
+        return self.by_genre_token.get(normalize_genre(genre), set())
+
+    def query_genres(self, all_of=(), any_of=(), none_of=()) -> set[str]:
+        """Boolean genre query on the genre token index.
+
+        Args:
+            all_of (Iterable[str], optional): The track has every one of these genres (AND).
+            any_of (Iterable[str], optional): The track has at least one of these genres (OR).
+            none_of (Iterable[str], optional): The track has none of these genres (NOT).
+
+        Returns:
+            set[str]: Paths of the matching tracks.
+        """
+        if all_of:
+            # Intersect starting with the smallest set to keep the work minimal
+            sets = sorted((self.get_paths_by_genre_token(g) for g in all_of), key=len)
+            paths = sets[0].intersection(*sets[1:])
+        elif any_of:
+            paths = set()
+        else:
+            paths = set(self.by_path)
+        if any_of:
+            union = set().union(*(self.get_paths_by_genre_token(g) for g in any_of))
+            paths = paths & union if all_of else union
+        for genre in none_of:
+            paths -= self.get_paths_by_genre_token(genre)
+        return paths
@@ -0,0 +1,216 @@
+import numpy as np
+from audio_analysis import analyze_files, decode_audio, spectrogram
+from cache import FileCache, open_cache
+from logger import Logger
+from settings import BeatgridSettings, LoggerSettings
+
+log = Logger("Beatgrid", LoggerSettings.log_level)
+
+# ID3 TXXX frame with the grid, e.g. "372.15;480.000" (first downbeat and beat interval in ms)
+BEATGRID_TAG = "djmp_beatgrid"
+FRAME_SIZE = 1024
+HOP = 128
+# Frequencies below it carry the kick drums and bass lines that mark the downbeats
+BASS_FREQUENCY = 200.0
+# Multiples of a beat interval whose autocorrelation is summed
+HARMONICS = 4
+
+
+class Beatgrid:
+    """Beats of a track with a constant tempo, the first one starts a bar."""
+
+    def __init__(
+        self,
+        first_beat: float,
+        interval: float,
+        beats_per_bar: int = BeatgridSettings.beats_per_bar,
+    ) -> None:
+        # Position of the first downbeat and length of a beat in ms
+        self.first_beat = first_beat
+        self.interval = interval
+        self.beats_per_bar = beats_per_bar
+
+    def __repr__(self) -> str:
+        return f"Beatgrid({self.first_beat:.2f}, {self.interval:.3f})"
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Beatgrid) and str(self) == str(other)
+
+    def __str__(self) -> str:
+        return format_beatgrid(self)
+
+    @property
+    def bpm(self) -> float:
+        return 60000 / self.interval
+
+    def snap(self, position: int, bar: bool = False) -> int:
+        """Nearest beat or bar to a position in ms, never before the start of the track."""
+        step = self.interval * (self.beats_per_bar if bar else 1)
+        snapped = self.first_beat + round((position - self.first_beat) / step) * step
+        if snapped < 0:
+            snapped += step
+        return int(round(snapped))
+
+
+def parse_beatgrid(text: str) -> Beatgrid | None:
+    try:
+        first_beat, interval = map(float, text.split(";"))
+    except ValueError:
+        return None
+    if interval <= 0:
+        return None
+    return Beatgrid(first_beat, interval)
+
+
+def format_beatgrid(beatgrid: Beatgrid | None) -> str:
+    if beatgrid is None:
+        return ""
+    return f"{beatgrid.first_beat:.2f};{beatgrid.interval:.3f}"
+
+
+def onset_envelopes(signal: np.ndarray, sample_rate: int) -> tuple[np.ndarray, ...]:
+    """Spectral flux of all frequencies and of the bass, one value per hop.
+
+    The log magnitudes of successive frames are subtracted and only the rises are
+    summed, so the envelopes peak where notes and drums start.
+    """
+    magnitudes = np.log1p(100 * spectrogram(signal, FRAME_SIZE, HOP))
+    rises = np.maximum(np.diff(magnitudes, axis=0, prepend=magnitudes[:1]), 0)
+    bass_bins = int(BASS_FREQUENCY * FRAME_SIZE / sample_rate) + 1
+    envelopes = []
+    for flux in (rises.sum(axis=1), rises[:, :bass_bins].sum(axis=1)):
+        # Only the rises above the local average, so loud passages do not dominate
+        window = max(int(0.5 * sample_rate / HOP), 1)
+        local_mean = np.convolve(flux, np.ones(window) / window, mode="same")
+        envelopes.append(np.maximum(flux - local_mean, 0))
+    return tuple(envelopes)
+
+
+def estimate_interval(
+    envelope: np.ndarray,
+    frame_rate: float,
+    min_bpm: float = BeatgridSettings.min_bpm,
+    max_bpm: float = BeatgridSettings.max_bpm,
+) -> float:
+    """Beat interval in frames of the tempo in the range whose multiples have the
+    strongest autocorrelation.
+
+    Summing the autocorrelation at the first multiples of a lag prefers the beat over
+    lags that only fit a part of the beats, e.g. the off-beat hi-hats at 2/3 of the
+    tempo. The range spans one octave, so doubled and halved tempos do not compete.
+    """
+    n = len(envelope)
+    centered = envelope - envelope.mean()
+    spectrum = np.fft.rfft(centered, 2 * n)
+    autocorrelation = np.fft.irfft(np.abs(spectrum) ** 2)[:n]
+    shortest = int(60 * frame_rate / max_bpm)
+    longest = int(60 * frame_rate / min_bpm) + 1
+    if HARMONICS * (longest + 1) >= n:
+        return 0.0
+    # The multiples of a lag fall between frames, the maximum around them is taken
+    peaks = np.maximum.reduce([np.roll(autocorrelation, shift) for shift in (-1, 0, 1)])
+    lags = np.arange(shortest, longest + 1)
+    scores = sum(peaks[lags * multiple] for multiple in range(1, HARMONICS + 1))
+    lag = int(lags[np.argmax(scores)])
+    # Parabola through the peak and its neighbours for a lag between two frames
+    left, peak, right = autocorrelation[lag - 1 : lag + 2]
+    curvature = left - 2 * peak + right
+    offset = 0.5 * (left - right) / curvature if curvature < 0 else 0.0
+    return lag + float(np.clip(offset, -0.5, 0.5))
+
+
+def periodicity(envelope: np.ndarray, intervals: np.ndarray) -> np.ndarray:
+    """Correlation of the envelope with a sinusoid of every interval at once. Its
+    magnitude tells how well onsets repeat with the interval, its angle where they are.
+    """
+    frames = np.arange(len(envelope))
+    return np.exp(-2j * np.pi * frames[None, :] / intervals[:, None]) @ envelope
+
+
+def refine_interval(envelope: np.ndarray, interval: float) -> float:
+    """Small errors of the interval add up over hundreds of beats, so the interval is
+    searched for the strongest periodicity of the whole envelope nearby."""
+    candidates = interval * (1 + np.linspace(-0.01, 0.01, 81))
+    for _ in range(2):
+        best = int(np.argmax(np.abs(periodicity(envelope, candidates))))
+        step = candidates[1] - candidates[0]
+        candidates = candidates[best] + np.linspace(-step, step, 41)
+    return float(candidates[20])
+
+
+def beat_phase(envelope: np.ndarray, interval: float) -> tuple[float, float]:
+    """Position of the first beat in frames and the confidence of the grid in [0, 1]."""
+    component = periodicity(envelope, np.array([interval]))[0]
+    phase = (-np.angle(component) / (2 * np.pi) * interval) % interval
+    return float(phase), float(np.abs(component) / (envelope.sum() + 1e-12))
+
+
+def find_downbeat(
+    bass_envelope: np.ndarray,
+    interval: float,
+    phase: float,
+    beats_per_bar: int = BeatgridSettings.beats_per_bar,
+) -> float:
+    """The beat with the strongest bass onsets on average starts the bars, returns the
+    position of the first downbeat in frames."""
+    beats = np.arange(phase, len(bass_envelope) - 1, interval)
+    if len(beats) < beats_per_bar:
+        return phase
+    strengths = np.interp(beats, np.arange(len(bass_envelope)), bass_envelope)
+    usable = len(strengths) // beats_per_bar * beats_per_bar
+    bars = strengths[:usable].reshape(-1, beats_per_bar).mean(axis=0)
+    return phase + int(np.argmax(bars)) * interval
+
+
+def estimate_beatgrid(signal: np.ndarray, sample_rate: int) -> dict:
+    envelope, bass_envelope = onset_envelopes(signal, sample_rate)
+    frame_rate = sample_rate / HOP
+    interval = estimate_interval(envelope, frame_rate)
+    if interval <= 0 or not envelope.any():
+        return {"first_beat": 0.0, "interval": 0.0, "bpm": 0.0, "confidence": 0.0}
+    interval = refine_interval(envelope, interval)
+    phase, confidence = beat_phase(envelope, interval)
+    if bass_envelope.any():
+        # Kick drums mark the beats, hi-hats often play between them
+        phase, _ = beat_phase(bass_envelope, interval)
+    downbeat = find_downbeat(bass_envelope, interval, phase)
+    # A frame covers the samples from t * HOP on, the flux rises most once an onset
+    # reaches the last quarter of the window, measured with synthetic kick drums
+    offset = 0.75 * FRAME_SIZE / HOP
+    first_beat = (downbeat + offset) % (interval * BeatgridSettings.beats_per_bar)
+    interval_ms = interval / frame_rate * 1000
+    return {
+        "first_beat": first_beat / frame_rate * 1000,
+        "interval": interval_ms,
+        "bpm": 60000 / interval_ms,
+        "confidence": confidence,
+    }
+
+
+def detect_beatgrid(path: str) -> dict:
+    """Analyzes the beatgrid of an audio file. Runs in the worker processes of analyze_beatgrids."""
+    sample_rate = BeatgridSettings.sample_rate
+    signal = decode_audio(path, sample_rate, duration=BeatgridSettings.max_duration)
+    return estimate_beatgrid(signal, sample_rate)
+
+
+def analyze_beatgrids(
+    paths: list[str], workers: int | None = None, cache: FileCache | None = None
+) -> dict[str, dict]:
+    """Detects the beatgrids of many files in parallel, every file is analyzed only once.
+
+    Returns:
+        dict[str, dict]: Maps the paths to {"first_beat", "interval", "bpm", "confidence"}.
+    """
+    with open_cache("beatgrid", cache) as cache:
+        return analyze_files(detect_beatgrid, paths, cache, workers)
+
+
+def beatgrid_tags(track, result: dict) -> dict:
+    """The beatgrid in its tag, see audio_analysis.result_tags."""
+    if result["interval"] <= 0:
+        return {}
+    beatgrid = Beatgrid(result["first_beat"], result["interval"])
+    if beatgrid == track.beatgrid:
+        return {}
+    return {BEATGRID_TAG: format_beatgrid(beatgrid)}
@@ -0,0 +1,108 @@
+#! python3
+"""Benchmark of the library exporters.
+
+Exports a synthetic library with cues and playlists with every exporter one after
+the other and then with all of them at once from snapshots, like the player does,
+and reports the tracks per second, the file sizes and the peak memory of an export.
+
+    python benchmarks/bench_export.py --tracks 100000 --playlists 50
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from audio_track import AudioTrack, TrackCollection  # noqa: E402
+from exporters import EXPORTERS, export  # noqa: E402
+
+WORDS = ["deep", "night", "house", "sun", "acid", "city", "love", "dub", "bass", "moon"]
+GENRES = ["House", "Techno", "Disco", "Drum & Bass", "Ambient", "Deep House"]
+KEYS = ["Am", "C", "Em", "G", "Dm", "F", "Bm", "D"]
+
+
+def synthetic_library(count: int, playlists: int) -> TrackCollection:
+    rng = np.random.default_rng(0)
+    tracks = []
+    for i in range(count):
+        cue = int(rng.integers(1000, 60000))
+        tracks.append(
+            AudioTrack.from_snapshot(
+                [
+                    f"/music/{GENRES[i % len(GENRES)]}/track_{i}.mp3",
+                    " ".join(rng.choice(WORDS, 2)).title(),
+                    f"Artist {i % 997}",
+                    f"Album {i % 211}",
+                    str(1990 + i % 35),
+                    GENRES[i % len(GENRES)],
+                    str(int(rng.integers(90, 175))),
+                    str(rng.choice(KEYS)),
+                    "",
+                    "",
+                    f"1:{cue};2:{cue + 30000}-{cue + 45000}",
+                    "",
+                ]
+            )
+        )
+    library = TrackCollection(tracks)
+    for i in range(playlists):
+        indexes = rng.choice(count, min(count, 100), replace=False)
+        name = f"Set {i}"
+        library.playlists[name] = TrackCollection(
+            [tracks[index] for index in indexes], name=name, parent=True
+        )
+    return library
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tracks", type=int, default=100000)
+    parser.add_argument("--playlists", type=int, default=50)
+    args = parser.parse_args()
+
+    library = synthetic_library(args.tracks, args.playlists)
+    playlists = list(library.playlists.values())
+    directory = tempfile.mkdtemp()
+    paths = {name: os.path.join(directory, name) for name in EXPORTERS}
+
+    for name, path in paths.items():
+        start = time.perf_counter()
+        export(name, path, library, playlists)
+        elapsed = time.perf_counter() - start
+        print(
+            f"{name}: {args.tracks / elapsed:.0f} tracks/s, {elapsed:.2f} s, "
+            f"{os.path.getsize(path) / 1e6:.1f} MB"
+        )
+
+    start = time.perf_counter()
+    snapshot = library.snapshot()
+    snapshots = [playlist.snapshot() for playlist in playlists]
+    print(f"Snapshots in {time.perf_counter() - start:.2f} s")
+    start = time.perf_counter()
+    with ThreadPoolExecutor(len(paths)) as executor:
+        for name, path in paths.items():
+            executor.submit(export, name, path, snapshot, snapshots)
+    elapsed = time.perf_counter() - start
+    print(f"All {len(paths)} exports at once from snapshots: {elapsed:.2f} s")
+
+    # The ids of the tracks are the only memory that grows with the library
+    name = "rekordbox"
+    tracemalloc.start()
+    export(name, paths[name], snapshot, snapshots)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"Peak memory of the {name} export: {peak / 1e6:.1f} MB")
+    for path in paths.values():
+        os.remove(path)
+    os.rmdir(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+#! python3
+"""Throughput benchmark of the key detection.
+
+Synthesizes chord progressions in random keys as WAV files, analyzes them in the
+process pool and reports files per second, the speed relative to real time and the
+share of correctly detected keys. A second run shows the costs of cache hits.
+
+    python benchmarks/bench_key_detection.py --files 64 --duration 60 --workers 8
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import wave
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cache import FileCache  # noqa: E402
+from key_detection import analyze_keys, key_names  # noqa: E402
+
+SAMPLE_RATE = 44100
+MAJOR_CHORDS = [(0, 4, 7), (5, 9, 12), (7, 11, 14), (0, 4, 7)]  # I IV V I
+MINOR_CHORDS = [(0, 3, 7), (5, 8, 12), (7, 10, 14), (0, 3, 7)]  # i iv v i
+
+
+def synthesize(tonic: int, minor: bool, duration: float) -> np.ndarray:
+    chords = MINOR_CHORDS if minor else MAJOR_CHORDS
+    chord_length = 2.0
+    t = np.arange(int(chord_length * SAMPLE_RATE)) / SAMPLE_RATE
+    envelope = np.exp(-t * 1.5)
+    segments = []
+    for i in range(int(duration / chord_length)):
+        segment = np.zeros_like(t)
+        for interval in chords[i % len(chords)]:
+            frequency = 220.0 * 2 ** ((tonic - 9 + interval) / 12)
+            for harmonic in (1, 2, 3):
+                segment += np.sin(2 * np.pi * frequency * harmonic * t) / harmonic
+        segments.append(segment * envelope)
+    signal = np.concatenate(segments)
+    return (signal / np.abs(signal).max() * 0.8 * 32767).astype(np.int16)
+
+
+def write_wav(path: str, signal: np.ndarray):
+    with wave.open(path, "wb") as file:
+        file.setnchannels(1)
+        file.setsampwidth(2)
+        file.setframerate(SAMPLE_RATE)
+        file.writeframes(signal.tobytes())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=60.0)
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as directory:
+        expected = {}
+        for i in range(args.files):
+            index = int(rng.integers(24))
+            path = os.path.join(directory, f"track_{i}.wav")
+            write_wav(path, synthesize(index % 12, index >= 12, args.duration))
+            expected[path] = key_names()[index]
+
+        cache = FileCache("key", os.path.join(directory, "cache.sqlite"))
+        start = time.perf_counter()
+        results = analyze_keys(list(expected), args.workers, cache)
+        elapsed = time.perf_counter() - start
+        correct = sum(results[p]["key"] == key for p, key in expected.items())
+        audio_seconds = args.files * args.duration
+        print(f"Analyzed {len(results)} files in {elapsed:.2f} s")
+        print(f"  {len(results) / elapsed:.1f} files/s")
+        print(f"  {audio_seconds / elapsed:.0f}x real time")
+        print(f"  {correct}/{len(expected)} keys correct")
+
+        start = time.perf_counter()
+        analyze_keys(list(expected), args.workers, cache)
+        elapsed = time.perf_counter() - start
+        print(f"Cached run: {elapsed * 1000:.1f} ms")
+        cache.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+#! python3
+"""Load test of the remote control API.
+
+Serves a synthetic library, connects many WebSocket clients at once that send a mix
+of searches, BPM range queries and player commands, and reports the latency
+percentiles and the requests per second. Commands are answered in the server thread
+here, in the player they wait for the GUI thread.
+
+    python benchmarks/bench_remote.py --tracks 50000 --clients 100 --requests 50
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+import urllib.request
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from audio_track import AudioTrack, TrackCollection  # noqa: E402
+from remote import ImmediateExecutor, RemoteClient, RemoteServer  # noqa: E402
+
+WORDS = ["deep", "night", "house", "sun", "acid", "city", "love", "dub", "bass", "moon"]
+GENRES = ["House", "Techno", "Disco", "Drum & Bass", "Ambient", "Deep House"]
+KEYS = ["Am", "C", "Em", "G", "Dm", "F", "Bm", "D"]
+
+
+def synthetic_library(count: int) -> TrackCollection:
+    rng = np.random.default_rng(0)
+    # Rows of from_snapshot come from snapshot_values, so they follow its columns
+    template = AudioTrack()
+    tracks = []
+    for i in range(count):
+        title = " ".join(rng.choice(WORDS, 2))
+        template.__dict__.update(
+            path=f"/music/track_{i}.mp3",
+            title=title.title(),
+            artist=f"Artist {i % 997}",
+            album=f"Album {i % 211}",
+            date=str(1990 + i % 35),
+            genre=str(rng.choice(GENRES)),
+            bpm=str(int(rng.integers(90, 175))),
+            key=str(rng.choice(KEYS)),
+        )
+        tracks.append(AudioTrack.from_snapshot(template.snapshot_values()))
+    return TrackCollection(tracks)
+
+
+def handle_command(method: str, params: dict) -> dict:
+    return {"method": method, "playing": method == "play"}
+
+
+async def run_client(port: int, requests: int, rng, latencies: list):
+    client = await RemoteClient.connect(port=port)
+    for _ in range(requests):
+        choice = rng.random()
+        if choice < 0.5:
+            method, params = "search", {"text": str(rng.choice(WORDS)), "limit": 50}
+        elif choice < 0.8:
+            low = int(rng.integers(90, 170))
+            method, params = "bpm_range", {"low": low, "high": low + 4, "limit": 50}
+        else:
+            method, params = "play", {}
+        start = time.perf_counter()
+        await client.request(method, **params)
+        latencies.append(time.perf_counter() - start)
+    await client.close()
+
+
+async def run_clients(port: int, clients: int, requests: int) -> list[float]:
+    latencies = []
+    await asyncio.gather(
+        *(
+            run_client(port, requests, np.random.default_rng(i), latencies)
+            for i in range(clients)
+        )
+    )
+    return latencies
+
+
+def http_request(port: int, method: str, params: dict) -> dict:
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{port}/api",
+        json.dumps({"id": 1, "method": method, "params": params}).encode(),
+        {"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(request) as response:
+        return json.load(response)
+
+
+def report(name: str, latencies: list[float], elapsed: float):
+    milliseconds = np.array(latencies) * 1000
+    p50, p90, p99 = np.percentile(milliseconds, [50, 90, 99])
+    print(f"{name}: {len(latencies)} requests in {elapsed:.2f} s")
+    print(f"  {len(latencies) / elapsed:.0f} requests/s")
+    print(
+        f"  p50 {p50:.2f} ms, p90 {p90:.2f} ms, p99 {p99:.2f} ms, "
+        f"max {milliseconds.max():.2f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--tracks", type=int, default=20000)
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=50)
+    args = parser.parse_args()
+
+    library = synthetic_library(args.tracks)
+    server = RemoteServer(ImmediateExecutor(handle_command), port=0)
+    server.start()
+    start = time.perf_counter()
+    server.publish(library.snapshot())
+    print(f"Published {args.tracks} tracks in {time.perf_counter() - start:.2f} s")
+
+    # Warms up the server thread before the clients are timed
+    http_request(server.port, "search", {"text": "warm up"})
+    start = time.perf_counter()
+    latencies = asyncio.run(run_clients(server.port, args.clients, args.requests))
+    report(f"{args.clients} WebSocket clients", latencies, time.perf_counter() - start)
+
+    latencies = []
+    start = time.perf_counter()
+    for i in range(200):
+        request_start = time.perf_counter()
+        http_request(server.port, "bpm_range", {"low": 120, "high": 124, "limit": 50})
+        latencies.append(time.perf_counter() - request_start)
+    report("HTTP", latencies, time.perf_counter() - start)
+    server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from settings import IOSettings
+
+
+def file_signature(path: str) -> tuple[int, int] | None:
+    """Size and modification time of a file, None if it does not exist."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+@contextmanager
+def open_cache(namespace: str, cache: "FileCache | None" = None):
+    """The given cache, or a new one of the namespace that is closed afterwards."""
+    if cache is not None:
+        yield cache
+        return
+    cache = FileCache(namespace)
+    try:
+        yield cache
+    finally:
+        cache.close()
+
+
+class FileCache:
+    """Persistent cache of per file results. An entry is only valid as long as the
+    size and modification time of the file match the ones stored with it, so edited
+    files are analyzed again without any bookkeeping by the caller.
+
+    Every namespace (e.g. "key" or "loudness") is a table of the same SQLite database.
+    """
+
+    def __init__(self, namespace: str, path: str = IOSettings.cache_file) -> None:
+        if not namespace.isidentifier():
+            raise ValueError(f"Invalid cache namespace: {namespace}")
+        self.namespace = namespace
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            f"CREATE TABLE IF NOT EXISTS {namespace} "
+            "(path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, value TEXT)"
+        )
+        self.connection.commit()
+
+    def __contains__(self, path: str) -> bool:
+        return self.get(path) is not None
+
+    def get(self, path: str, signature: tuple[int, int] | None = None):
+        return self.get_many([path], {path: signature} if signature else None).get(path)
+
+    def get_many(
+        self, paths: list[str], signatures: dict[str, tuple[int, int]] | None = None
+    ) -> dict:
+        """Returns the valid entries of the given paths, stale and missing ones are left out.
+
+        Args:
+            paths (list[str]): Files to look up.
+            signatures (dict[str, tuple[int, int]], optional): Known (size, mtime_ns) of the files. Missing ones are read from disk.
+        """
+        signatures = signatures or {}
+        results = {}
+        with self.lock:
+            for i in range(0, len(paths), 500):
+                chunk = paths[i : i + 500]
+                rows = self.connection.execute(
+                    f"SELECT path, size, mtime_ns, value FROM {self.namespace} "
+                    f"WHERE path IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+                for path, size, mtime_ns, value in rows:
+                    signature = signatures.get(path) or file_signature(path)
+                    if signature == (size, mtime_ns):
+                        results[path] = json.loads(value)
+        return results
+
+    def get_stored(self, paths: list[str] | None = None) -> dict:
+        """Returns the stored entries without checking the files, e.g. for offline drives."""
+        with self.lock:
+            rows = self.connection.execute(
+                f"SELECT path, value FROM {self.namespace}"
+            ).fetchall()
+        if paths is not None:
+            paths = set(paths)
+            rows = [row for row in rows if row[0] in paths]
+        return {path: json.loads(value) for path, value in rows}
+
+    def set(self, path: str, value, signature: tuple[int, int] | None = None):
+        self.set_many({path: value}, {path: signature} if signature else None)
+
+    def set_many(
+        self, values: dict, signatures: dict[str, tuple[int, int]] | None = None
+    ):
+        signatures = signatures or {}
+        rows = []
+        for path, value in values.items():
+            signature = signatures.get(path) or file_signature(path)
+            if signature is None:
+                continue
+            rows.append((path, *signature, json.dumps(value)))
+        with self.lock:
+            self.connection.executemany(
+                f"INSERT OR REPLACE INTO {self.namespace} VALUES (?, ?, ?, ?)", rows
+            )
+            self.connection.commit()
+
+    def delete(self, path: str):
+        with self.lock:
+            self.connection.execute(
+                f"DELETE FROM {self.namespace} WHERE path = ?", (path,)
+            )
+            self.connection.commit()
+
+    def clear(self):
+        with self.lock:
+            self.connection.execute(f"DELETE FROM {self.namespace}")
+            self.connection.commit()
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,509 @@
+#! python3
+"""Command line interface for batch library operations without the Qt user interface.
+
+Examples:
+    python cli.py scan ~/Music --format json
+    python cli.py untagged ~/Music --workers 16
+    python cli.py query ~/Music --genre House --not-genre Deep --bpm-min 120
+    python cli.py tag ~/Music/track.mp3 --set genre="Tech House" --set bpm=126
+    python cli.py export ~/Music ~/Desktop/set.m3u --apple-music library.xml
+    python cli.py export ~/Music ~/Sets/*.m3u --rekordbox rb.xml --traktor collection.nml
+    python cli.py sync ~/Sets/friday.m3u ~/Sets/warmup.m3u --target /media/usb
+    python cli.py check ~/Music --format csv
+    python cli.py infer ~/Music --format csv > proposals.csv
+    python cli.py infer ~/Music --apply --accept proposals.csv
+    python cli.py history --days 7 --counts
+    python cli.py history --session -1 --m3u ~/Sets/last_gig.m3u
+"""
+
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import exporters
+import health
+import history as play_history
+import inference
+import sync as drive_sync
+import utility
+from audio_track import TAG_FIELDS, AudioTrack, TrackCollection
+from logger import Logger
+from settings import InferenceSettings, IOSettings, SyncSettings
+from smart_crates import SmartCrate
+
+log = Logger("CLI", logging.WARNING)
+
+OUTPUT_FORMATS = ("text", "json", "jsonl", "csv")
+
+
+def collect_files(sources: list[str]) -> list[str]:
+    """Resolves directories, playlists and single files to a list of unique audio files.
+
+    Args:
+        sources (list[str]): Paths to directories, .m3u playlists or audio files.
+
+    Returns:
+        list[str]: Absolute paths of the audio files in the order they were found.
+    """
+    all_files = {}
+    for source in sources:
+        if os.path.isdir(source):
+            files = utility.get_audio_files(source)
+        elif source.lower().endswith((".m3u", ".m3u8")):
+            files = [os.path.abspath(file) for file in utility.openPlaylist(source)]
+        elif os.path.isfile(source):
+            files = [os.path.abspath(source)]
+        else:
+            log.warning(f"Skipping unknown source: {source}")
+            continue
+        for file in files:
+            all_files[file] = None
+    return list(all_files)
+
+
+def load_tracks(files: list[str], workers=None) -> tuple[list[AudioTrack], bool]:
+    """Reads the files, the ones that cannot be read are logged and skipped.
+
+    Returns:
+        tuple[list[AudioTrack], bool]: The tracks and whether a file failed.
+    """
+    tracks, errors = utility.try_load_tracks(files, workers)
+    for path, error in errors.items():
+        log.error(f"Could not read {path}: {error}")
+    return tracks, bool(errors)
+
+
+def load_collection(sources: list[str], workers=None) -> tuple[TrackCollection, bool]:
+    tracks, failed = load_tracks(collect_files(sources), workers)
+    return TrackCollection(tracks), failed
+
+
+def write_rows(rows: list[dict], output_format: str, stream=sys.stdout):
+    if output_format == "json":
+        json.dump(rows, stream, indent=2, ensure_ascii=False)
+        stream.write("\n")
+    elif output_format == "jsonl":
+        for row in rows:
+            stream.write(json.dumps(row, ensure_ascii=False) + "\n")
+    elif output_format == "csv":
+        # Rows may differ, e.g. error rows of tag only have a path and the error
+        fieldnames = {field: None for row in rows for field in row}
+        writer = csv.DictWriter(
+            stream, fieldnames=list(fieldnames) or ["path", *TAG_FIELDS], restval=""
+        )
+        writer.writeheader()
+        writer.writerows(rows)
+    else:
+        for row in rows:
+            stream.write("\t".join(str(value) for value in row.values()) + "\n")
+
+
+def parse_bpm(bpm: str) -> float | None:
+    try:
+        return float(bpm)
+    except ValueError:
+        return None
+
+
+def filter_tracks(tracks: TrackCollection, args) -> list[AudioTrack]:
+    paths = tracks.query_genres(args.genre, args.any_genre, args.not_genre)
+    if args.rules:
+        crate = SmartCrate.parse("query", ";".join(args.rules))
+        paths &= crate.evaluate(tracks)
+    selected = []
+    for track in tracks:
+        if track.path not in paths:
+            continue
+        if args.artist and args.artist.lower() not in track.artist.lower():
+            continue
+        if args.title and args.title.lower() not in track.title.lower():
+            continue
+        if args.date and not track.date.startswith(args.date):
+            continue
+        if args.bpm_min is not None or args.bpm_max is not None:
+            bpm = parse_bpm(track.bpm)
+            if bpm is None:
+                continue
+            if args.bpm_min is not None and bpm < args.bpm_min:
+                continue
+            if args.bpm_max is not None and bpm > args.bpm_max:
+                continue
+        selected.append(track)
+    return selected
+
+
+def scan(args):
+    tracks, failed = load_collection(args.sources, args.workers)
+    write_rows([track.to_dict() for track in tracks], args.format)
+    return 1 if failed else 0
+
+
+def untagged(args):
+    all_files = collect_files(args.sources)
+    files, errors = utility.filter_files_by_genre(all_files, args.workers)
+    for path, error in errors.items():
+        log.error(f"Could not read {path}: {error}")
+    write_rows([{"path": file} for file in files], args.format)
+    return 1 if errors else 0
+
+
+def query(args):
+    tracks, failed = load_collection(args.sources, args.workers)
+    try:
+        selected = filter_tracks(tracks, args)
+    except ValueError as e:
+        log.error(str(e))
+        return 2
+    write_rows([track.to_dict() for track in selected], args.format)
+    return 1 if failed else 0
+
+
+def parse_assignments(assignments: list[str]) -> dict[str, str]:
+    tags = {}
+    for assignment in assignments:
+        field, separator, value = assignment.partition("=")
+        if not separator or field not in AudioTrack.valid_keys:
+            raise ValueError(f"Invalid tag assignment: {assignment}")
+        tags[field] = value
+    return tags
+
+
+def tag(args):
+    try:
+        tags = parse_assignments(args.set)
+    except ValueError as e:
+        log.error(str(e))
+        return 2
+
+    def write_tags(file):
+        try:
+            track = AudioTrack(file)
+            track.update_tags(tags)
+            return {**track.to_dict(), "error": ""}
+        except Exception as e:
+            log.warning(f"Could not tag {file}: {e}")
+            return {"path": file, "error": str(e) or type(e).__name__}
+
+    with ThreadPoolExecutor(args.workers) as executor:
+        rows = list(executor.map(write_tags, collect_files(args.sources)))
+    write_rows(rows, args.format)
+    return 1 if any(row["error"] for row in rows) else 0
+
+
+def export(args):
+    targets = {
+        name: getattr(args, name)
+        for name in exporters.EXPORTERS
+        if getattr(args, name, None)
+    }
+    if not targets:
+        log.error("Choose at least one target, e.g. --rekordbox FILE")
+        return 2
+    library, failed = load_collection(args.sources, args.workers)
+    # Every playlist source becomes a playlist of the export
+    playlists = [
+        TrackCollection(
+            [
+                library.by_path[path]
+                for path in collect_files([source])
+                if path in library.by_path
+            ],
+            name=os.path.splitext(os.path.basename(source))[0],
+            parent=True,
+        )
+        for source in args.sources
+        if source.lower().endswith((".m3u", ".m3u8"))
+    ]
+    # The exports only read the library, so they run at the same time
+    with ThreadPoolExecutor(len(targets)) as executor:
+        counts = {
+            name: executor.submit(exporters.export, name, path, library, playlists)
+            for name, path in targets.items()
+        }
+        rows = [
+            {"format": name, "exported": count.result(), "target": targets[name]}
+            for name, count in counts.items()
+        ]
+    write_rows(rows, args.format)
+    return 1 if failed else 0
+
+
+def sync(args):
+    playlists, failed = [], False
+    for source in args.sources:
+        files = collect_files([source])
+        name = os.path.splitext(os.path.basename(os.path.normpath(source)))[0]
+        tracks, source_failed = load_tracks(files, args.workers)
+        failed = failed or source_failed
+        playlists.append(TrackCollection(tracks, name=name, parent=True))
+    report = drive_sync.sync_playlists(
+        playlists,
+        args.target,
+        workers=args.workers or SyncSettings.workers,
+        checksum=args.checksum,
+        verify=not args.no_verify,
+    )
+    write_rows([report.to_dict()], args.format)
+    for path, error in report.failed.items():
+        log.error(f"{path}: {error}")
+    return 1 if report.failed or failed else 0
+
+
+def check(args):
+    results = health.check_files(collect_files(args.sources), args.workers)
+    rows = [
+        {
+            "path": path,
+            "status": result["status"],
+            "problems": "; ".join(result["problems"]),
+        }
+        for path, result in results.items()
+        if args.all or result["status"] != health.OK
+    ]
+    write_rows(rows, args.format)
+    log.info(f"Checked {len(results)} files: {health.summarize(results)}")
+    return 1 if health.broken_paths(results) else 0
+
+
+def proposal_rows(proposals: dict[str, dict[str, str]]) -> list[dict]:
+    """One row per file with a column for every proposed field, empty if unchanged."""
+    fields = sorted({field for tags in proposals.values() for field in tags})
+    return [
+        {"path": path, **{field: tags.get(field, "") for field in fields}}
+        for path, tags in proposals.items()
+    ]
+
+
+def read_proposals(file: str) -> dict[str, dict[str, str]]:
+    """Reads proposals written by infer as json, jsonl or csv, e.g. after removing rows."""
+    with open(file, encoding="utf-8", newline="") as f:
+        if file.lower().endswith(".csv"):
+            rows = list(csv.DictReader(f))
+        elif file.lower().endswith(".json"):
+            rows = json.load(f)
+        else:
+            rows = [json.loads(line) for line in f if line.strip()]
+    return {
+        row["path"]: {
+            field: value for field, value in row.items() if field != "path" and value
+        }
+        for row in rows
+    }
+
+
+def infer(args):
+    files = collect_files(args.sources)
+    failed = False
+    if args.accept:
+        try:
+            accepted = read_proposals(args.accept)
+        except (OSError, ValueError, KeyError) as e:
+            log.error(f"Could not read the proposals {args.accept}: {e}")
+            return 2
+        proposals = {path: accepted[path] for path in files if accepted.get(path)}
+    else:
+        try:
+            inferrer = inference.PathInferrer(
+                args.patterns or InferenceSettings.file_patterns,
+                args.folder_patterns or InferenceSettings.folder_patterns,
+            )
+        except ValueError as e:
+            log.error(str(e))
+            return 2
+        tracks, failed = load_tracks(files, args.workers)
+        proposals = inferrer.propose(
+            [inference.track_tags(track, inferrer.fields) for track in tracks],
+            args.overwrite,
+        )
+    if not args.apply:
+        write_rows(proposal_rows(proposals), args.format)
+        return 1 if failed else 0
+    errors = inference.write_tags(proposals, args.workers or InferenceSettings.workers)
+    rows = [
+        {**row, "error": errors.get(row["path"], "")}
+        for row in proposal_rows(proposals)
+    ]
+    write_rows(rows, args.format)
+    return 1 if errors or failed else 0
+
+
+def history(args):
+    plays = play_history.PlayHistory(args.history)
+    if args.session is not None:
+        session = args.session
+        if session < 0:
+            # Counted from the last session with plays
+            sessions = plays.sessions()
+            session = sessions[session] if len(sessions) >= -session else -1
+        rows = [
+            {"path": path, "start": start, "played": played}
+            for path, start, played in plays.session_plays(session)
+        ]
+        if args.m3u:
+            TrackCollection(
+                [AudioTrack(row["path"]) for row in rows if os.path.isfile(row["path"])]
+            ).save_playlist(args.m3u)
+    else:
+        since = None if args.days is None else time.time() - args.days * 86400
+        if args.counts:
+            counts = plays.play_counts(since)
+            rows = [
+                {"path": path, "plays": count}
+                for path, count in sorted(counts.items(), key=lambda item: -item[1])
+            ]
+        else:
+            rows = [{"path": path} for path in sorted(plays.played_since(since or 0))]
+    plays.close()
+    write_rows(rows, args.format)
+    return 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description="Batch operations on a DJ music library."
+    )
+    parser.add_argument("-v", "--verbose", action="store_true")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def add_command(name, fnc, help):
+        subparser = subparsers.add_parser(name, help=help)
+        subparser.add_argument(
+            "sources", nargs="+", help="Directories, .m3u playlists or audio files"
+        )
+        subparser.add_argument(
+            "-w", "--workers", type=int, default=None, help="Number of worker threads"
+        )
+        subparser.add_argument("-f", "--format", choices=OUTPUT_FORMATS, default="text")
+        subparser.set_defaults(fnc=fnc)
+        return subparser
+
+    add_command("scan", scan, "List all tracks with their tags")
+    add_command("untagged", untagged, "List all tracks without a genre")
+
+    query_parser = add_command("query", query, "List tracks matching all filters")
+    query_parser.add_argument(
+        "--genre", action="append", default=[], help="Genre the track has (AND)"
+    )
+    query_parser.add_argument(
+        "--any-genre", action="append", default=[], help="One of these genres (OR)"
+    )
+    query_parser.add_argument(
+        "--not-genre", action="append", default=[], help="Genre the track lacks (NOT)"
+    )
+    query_parser.add_argument("--artist", help="Part of the artist name")
+    query_parser.add_argument("--title", help="Part of the track title")
+    query_parser.add_argument("--date", help="Prefix of the date, e.g. a year")
+    query_parser.add_argument("--bpm-min", type=float)
+    query_parser.add_argument("--bpm-max", type=float)
+    query_parser.add_argument(
+        "--rule",
+        dest="rules",
+        action="append",
+        default=[],
+        help='Smart crate rule, e.g. "bpm between 120 128" or "genre is_empty"',
+    )
+
+    tag_parser = add_command("tag", tag, "Write tags to tracks")
+    tag_parser.add_argument(
+        "--set",
+        action="append",
+        required=True,
+        metavar="FIELD=VALUE",
+        help="Tag to write, an empty value deletes the tag. Can be repeated.",
+    )
+
+    export_parser = add_command("export", export, "Export tracks to other software")
+    for name, exporter in exporters.EXPORTERS.items():
+        export_parser.add_argument(
+            f"--{name.replace('_', '-')}",
+            dest=name,
+            metavar="FILE",
+            help=f"Target {exporter.description} file",
+        )
+
+    sync_parser = add_command(
+        "sync", sync, "Copy playlists to a drive, every source becomes a playlist"
+    )
+    sync_parser.add_argument(
+        "--target", required=True, metavar="DIR", help="Root directory of the drive"
+    )
+    sync_parser.add_argument(
+        "--checksum",
+        action="store_true",
+        help="Compare the content of files with the same size and modification time",
+    )
+    sync_parser.add_argument(
+        "--no-verify", action="store_true", help="Do not read the copies back"
+    )
+
+    check_parser = add_command(
+        "check", check, "Find missing, unreadable and corrupt files"
+    )
+    check_parser.add_argument(
+        "--all", action="store_true", help="List the intact files as well"
+    )
+
+    infer_parser = add_command(
+        "infer", infer, "Propose tags from file and folder names, e.g. Artist - Title"
+    )
+    infer_parser.add_argument(
+        "--pattern",
+        dest="patterns",
+        action="append",
+        default=[],
+        help='File name pattern, e.g. "{track} {artist} - {title}". Can be repeated.',
+    )
+    infer_parser.add_argument(
+        "--folder-pattern",
+        dest="folder_patterns",
+        action="append",
+        default=[],
+        help='Pattern of the last folders, e.g. "{label}/{year}". Can be repeated.',
+    )
+    infer_parser.add_argument(
+        "--overwrite", action="store_true", help="Replace tags that are already set"
+    )
+    infer_parser.add_argument(
+        "--apply", action="store_true", help="Write the proposed tags to the files"
+    )
+    infer_parser.add_argument(
+        "--accept",
+        metavar="FILE",
+        help="Apply the proposals of a previous run instead, as json, jsonl or csv",
+    )
+
+    history_parser = subparsers.add_parser("history", help="List played tracks")
+    history_parser.add_argument("--history", default=IOSettings.history_file)
+    history_parser.add_argument("--days", type=float, help="Only the last days")
+    history_parser.add_argument(
+        "--counts", action="store_true", help="Number of plays per track"
+    )
+    history_parser.add_argument(
+        "--session",
+        type=int,
+        help="Plays of a session in their order, -1 is the last session",
+    )
+    history_parser.add_argument(
+        "--m3u", metavar="FILE", help="Write the plays of the session to a playlist"
+    )
+    history_parser.add_argument(
+        "-f", "--format", choices=OUTPUT_FORMATS, default="text"
+    )
+    history_parser.set_defaults(fnc=history)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.verbose:
+        log.setLevel(logging.DEBUG)
+    return args.fnc(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,79 @@
+from logger import Logger
+from settings import LoggerSettings
+
+log = Logger("CuePoints", LoggerSettings.log_level)
+
+MAX_CUES = 8
+# ID3 TXXX frame with the cues, e.g. "1:15230;2:61000-76000" (positions in ms)
+CUE_TAG = "djmp_cues"
+
+
+class CuePoint:
+    def __init__(self, index: int, position: int, loop_end: int | None = None):
+        if not 1 <= index <= MAX_CUES:
+            raise ValueError(f"Cue index has to be between 1 and {MAX_CUES}")
+        self.index = index
+        self.position = int(position)
+        self.loop_end = int(loop_end) if loop_end is not None else None
+
+    def __repr__(self) -> str:
+        return f"CuePoint({self.index}, {self.position}, {self.loop_end})"
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, CuePoint) and self.to_list() == other.to_list()
+
+    @property
+    def is_loop(self) -> bool:
+        return self.loop_end is not None and self.loop_end > self.position
+
+    def to_list(self) -> list:
+        return [self.index, self.position, self.loop_end]
+
+    @classmethod
+    def from_list(cls, data: list) -> "CuePoint":
+        return cls(*data)
+
+
+def parse_cues(text: str) -> dict[int, CuePoint]:
+    cues = {}
+    for entry in text.split(";"):
+        index, _, positions = entry.partition(":")
+        start, _, end = positions.partition("-")
+        try:
+            cue = CuePoint(int(index), int(start), int(end) if end else None)
+        except ValueError:
+            continue
+        cues[cue.index] = cue
+    return cues
+
+
+def format_cues(cues: dict[int, CuePoint]) -> str:
+    return ";".join(
+        f"{cue.index}:{cue.position}" + (f"-{cue.loop_end}" if cue.is_loop else "")
+        for cue in sorted(cues.values(), key=lambda cue: cue.index)
+    )
+
+
+class CueStore:
+    """Keeps the cues of the tracks in their tags. Whole collections get their cues
+    from the session snapshot and exports from the tracks, nothing opens the files."""
+
+    def set_cue(
+        self,
+        collection,
+        track,
+        index: int,
+        position: int,
+        loop_end: int | None = None,
+    ) -> CuePoint:
+        cue = CuePoint(index, position, loop_end)
+        track.cues[index] = cue
+        self.save(collection, track)
+        return cue
+
+    def remove_cue(self, collection, track, index: int):
+        if track.cues.pop(index, None) is not None:
+            self.save(collection, track)
+
+    def save(self, collection, track):
+        collection.update_track_tags(track, {CUE_TAG: format_cues(track.cues)})
@@ -0,0 +1,242 @@
+import os
+
+import numpy as np
+from audio_analysis import analyze_files, decode_audio, spectrogram
+from cache import FileCache, file_signature
+from logger import Logger
+from settings import EnergySettings, IOSettings, LoggerSettings
+
+log = Logger("Energy", LoggerSettings.log_level)
+
+FRAME_SIZE = 1024
+HOP = 512
+# Loudness range mapped to 0-255, quieter blocks are 0
+MIN_DB = -40.0
+# Mean onset strength per frame that is mapped to 255, reached by busy drum patterns
+MAX_FLUX = 0.2
+
+
+def quantize(values: np.ndarray, low: float, high: float) -> np.ndarray:
+    return np.round(np.clip((values - low) / (high - low), 0, 1) * 255).astype(np.uint8)
+
+
+def energy_curves(signal: np.ndarray, sample_rate: int) -> np.ndarray:
+    """Loudness and spectral flux of every block of the signal, shape (n_blocks, 2).
+
+    Both are quantized to uint8, so a track of five minutes takes 600 bytes. The flux
+    measures how much new is going on, e.g. drums and fills, the loudness how dense
+    the mix is.
+    """
+    block = int(EnergySettings.block_seconds * sample_rate)
+    n_blocks = len(signal) // block
+    if n_blocks == 0:
+        return np.zeros((0, 2), np.uint8)
+    blocks = signal[: n_blocks * block].reshape(n_blocks, block)
+    rms = np.sqrt(np.mean(blocks.astype(np.float64) ** 2, axis=1))
+    loudness = 20 * np.log10(rms + 1e-10)
+
+    magnitudes = np.log1p(100 * spectrogram(signal, FRAME_SIZE, HOP))
+    rises = np.maximum(np.diff(magnitudes, axis=0, prepend=magnitudes[:1]), 0)
+    flux = rises.mean(axis=1)
+    # Only the rises above the average of the last second are onsets, noise and
+    # sustained sounds rise about equally in every frame
+    window = max(int(sample_rate / HOP), 1)
+    flux = np.maximum(flux - np.convolve(flux, np.ones(window) / window, "same"), 0)
+    # Mean flux of the frames that start in each block
+    starts = np.arange(n_blocks) * block // HOP
+    counts = np.diff(np.append(starts, len(flux)))
+    block_flux = np.add.reduceat(flux, starts) / np.maximum(counts, 1)
+    return np.stack(
+        [quantize(loudness, MIN_DB, 0.0), quantize(block_flux, 0.0, MAX_FLUX)], axis=1
+    )
+
+
+def combined_energy(curves: np.ndarray) -> np.ndarray:
+    """One energy value in [0, 255] per block from the loudness and flux curves."""
+    weight = EnergySettings.flux_weight
+    return (1 - weight) * curves[:, 0] + weight * curves[:, 1]
+
+
+def energy_rating(curves: np.ndarray) -> int:
+    """Energy of a track from 1 to 10. The upper quartile of the blocks counts, so
+    breakdowns and intros do not lower the rating of a banger."""
+    if not len(curves):
+        return 0
+    energy = np.percentile(combined_energy(curves), 75)
+    return int(np.clip(round(1 + 9 * energy / 255), 1, 10))
+
+
+def measure_energy(path: str) -> dict:
+    """Energy curves of an audio file. Runs in the worker processes of analyze_energy."""
+    sample_rate = EnergySettings.sample_rate
+    curves = energy_curves(decode_audio(path, sample_rate), sample_rate)
+    return {"curves": curves.tobytes(), "rating": energy_rating(curves)}
+
+
+class EnergyStore:
+    """Energy curves of the analyzed tracks.
+
+    The curves of all tracks are appended to one binary file, which is memory-mapped,
+    so a curve is a slice of it without copying or parsing. The position of each curve
+    and the rating are kept in the file cache, which drops them once the file changes.
+    Curves of changed tracks stay in the binary file unused until it is compacted.
+    """
+
+    def __init__(
+        self, path: str = IOSettings.energy_file, cache: FileCache | None = None
+    ) -> None:
+        self.path = path
+        self.cache = cache or FileCache("energy")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.data = None
+        # Path -> {"offset", "blocks", "rating"}, loaded on first use or by loaded
+        self.entries: dict[str, dict] | None = None
+
+    def get_entries(self) -> dict[str, dict]:
+        if self.entries is None:
+            self.loaded(self.load())
+        return self.entries
+
+    def defer_loading(self):
+        """Uses only the entries added from now on until loaded is called, e.g. while
+        load runs in a worker thread."""
+        if self.entries is None:
+            self.entries = dict()
+
+    def load(self) -> dict[str, dict]:
+        """Reads the entries of the files that did not change since they were measured.
+        Only reads, so it can run in a worker thread, see loaded."""
+        paths = list(self.cache.get_stored())
+        return self.cache.get_many(paths)
+
+    def loaded(self, entries: dict[str, dict]):
+        """Takes the entries of load, the ones added in the meantime are newer. The
+        binary file is compacted if most of it are curves of changed files."""
+        self.entries = {**entries, **(self.entries or {})}
+        size = os.path.getsize(self.path) if os.path.exists(self.path) else 0
+        used = sum(2 * entry["blocks"] for entry in self.entries.values())
+        if size and size - used > EnergySettings.max_unused_share * size:
+            self.compact()
+
+    def compact(self):
+        """Rewrites the binary file with only the curves of the entries. Entries of
+        files that are offline are dropped as well and measured again later."""
+        data = self.mapped()
+        entries = dict()
+        signatures = {path: file_signature(path) for path in self.entries}
+        temporary = self.path + ".tmp"
+        with open(temporary, "wb") as f:
+            for path, entry in self.entries.items():
+                if not signatures[path]:
+                    continue
+                start = entry["offset"]
+                entries[path] = {**entry, "offset": f.tell()}
+                f.write(data[start : start + 2 * entry["blocks"]].tobytes())
+        del data
+        self.data = None
+        # Without entries a crash in between only costs measuring the tracks again
+        self.cache.clear()
+        os.replace(temporary, self.path)
+        self.cache.set_many(entries, signatures)
+        log.info(f"Compacted the energy curves to {len(entries)} tracks")
+        self.entries = entries
+
+    def mapped(self) -> np.ndarray:
+        if self.data is None:
+            if not os.path.exists(self.path) or not os.path.getsize(self.path):
+                return np.zeros(0, np.uint8)
+            self.data = np.memmap(self.path, np.uint8, "r")
+        return self.data
+
+    def __contains__(self, path: str) -> bool:
+        return path in self.get_entries()
+
+    def rating(self, path: str) -> int | None:
+        entry = self.get_entries().get(path)
+        return None if entry is None else entry["rating"]
+
+    def ratings(self) -> dict[str, int]:
+        return {path: entry["rating"] for path, entry in self.get_entries().items()}
+
+    def curves(self, path: str) -> np.ndarray | None:
+        """Loudness and flux curves of a track, shape (n_blocks, 2)."""
+        entry = self.get_entries().get(path)
+        if entry is None:
+            return None
+        start = entry["offset"]
+        return self.mapped()[start : start + 2 * entry["blocks"]].reshape(-1, 2)
+
+    def playlist_energy(self, tracks) -> tuple[np.ndarray, list[int]]:
+        """Combined energy of the tracks one after the other.
+
+        Returns:
+            tuple[np.ndarray, list[int]]: Energy per block and the first block of every track. Tracks without curves take no blocks.
+        """
+        parts, starts, length = [], [], 0
+        for track in tracks:
+            starts.append(length)
+            curves = self.curves(track.path)
+            if curves is None:
+                continue
+            parts.append(combined_energy(curves))
+            length += len(curves)
+        energy = np.concatenate(parts) if parts else np.zeros(0)
+        return energy, starts
+
+    def add(
+        self,
+        results: dict[str, dict],
+        signatures: dict[str, tuple[int, int]] | None = None,
+    ):
+        """Appends the curves of measure_energy results and indexes them."""
+        signatures = signatures or {}
+        signatures = {
+            path: signatures.get(path) or file_signature(path) for path in results
+        }
+        # Curves of files that are gone could never be found again
+        results = {path: result for path, result in results.items() if signatures[path]}
+        if not results:
+            return
+        entries = dict()
+        with open(self.path, "ab") as f:
+            offset = f.tell()
+            for path, result in results.items():
+                f.write(result["curves"])
+                entries[path] = {
+                    "offset": offset,
+                    "blocks": len(result["curves"]) // 2,
+                    "rating": result["rating"],
+                }
+                offset += len(result["curves"])
+        self.cache.set_many(entries, signatures)
+        self.get_entries().update(entries)
+        # Mapped again with the new length on the next access
+        self.data = None
+
+    def measure(self, paths: list[str], workers: int | None = None) -> dict[str, dict]:
+        """Measures the tracks without valid curves in the process pool. Only reads
+        the cache, so it can run in a worker thread while the curves are shown.
+
+        Returns:
+            dict[str, dict]: measure_energy results of the measured tracks, see add.
+        """
+        signatures = {path: file_signature(path) for path in paths}
+        valid = self.cache.get_many(paths, signatures)
+        todo = [path for path in paths if path not in valid and signatures[path]]
+        if not todo:
+            return {}
+        log.info(f"Measuring the energy of {len(todo)} tracks")
+        return analyze_files(measure_energy, todo, None, workers)
+
+
+def analyze_energy(
+    paths: list[str], workers: int | None = None, store: EnergyStore | None = None
+) -> dict[str, int]:
+    """Measures the energy of many files in parallel, every file is measured only once.
+
+    Returns:
+        dict[str, int]: Ratings of the given tracks that have curves.
+    """
+    store = store or EnergyStore()
+    store.add(store.measure(paths, workers))
+    return {path: store.rating(path) for path in paths if path in store}
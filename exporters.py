@@ -0,0 +1,353 @@
+import ntpath
+import os
+from abc import ABC, abstractmethod
+from urllib.parse import quote
+
+from audio_track import PITCH_CLASSES, normalize_key, parse_float
+from cue_points import CuePoint, parse_cues
+from logger import Logger
+from settings import ExportSettings, LoggerSettings
+
+log = Logger("Exporters", LoggerSettings.log_level)
+
+# Characters that are not allowed in XML 1.0, not even escaped. They are dropped,
+# e.g. control characters of tags written by broken taggers.
+INVALID_XML = dict.fromkeys(
+    [*range(0x00, 0x09), 0x0B, 0x0C, *range(0x0E, 0x20), *range(0xD800, 0xE000)]
+    + [0xFFFE, 0xFFFF]
+)
+# Characters escaped in XML text and attribute values. One translate call is much
+# faster than xml.sax.saxutils, which replaces every character on its own.
+TEXT_ESCAPES = str.maketrans({**INVALID_XML, "&": "&amp;", "<": "&lt;", ">": "&gt;"})
+ATTRIBUTE_ESCAPES = str.maketrans(
+    {
+        **INVALID_XML,
+        "&": "&amp;",
+        "<": "&lt;",
+        ">": "&gt;",
+        '"': "&quot;",
+        "\n": "&#10;",
+        "\r": "&#13;",
+        "\t": "&#9;",
+    }
+)
+# Name -> exporter class, see register_exporter
+EXPORTERS: dict[str, type["Exporter"]] = dict()
+
+
+def register_exporter(cls: type["Exporter"]) -> type["Exporter"]:
+    EXPORTERS[cls.name] = cls
+    return cls
+
+
+def attributes(**values) -> str:
+    """XML attributes of the values that are not None, e.g. ' Name="A &amp; B"'."""
+    return "".join(
+        f' {name}="{str(value).translate(ATTRIBUTE_ESCAPES)}"'
+        for name, value in values.items()
+        if value is not None
+    )
+
+
+def file_url(path: str) -> str:
+    path = path.replace("\\", "/")
+    if not path.startswith("/"):
+        # Windows paths like C:/Music
+        path = "/" + path
+    # The colon of drive letters stays, C%3A is not found by the DJ programs
+    return "file://localhost" + quote(path, safe="/:")
+
+
+def track_cues(track) -> list[CuePoint]:
+    """Cues of an AudioTrack or of a snapshots.TrackRecord in the order of their index."""
+    cues = track.cues
+    if isinstance(cues, str):
+        cues = parse_cues(cues)
+    return sorted(cues.values(), key=lambda cue: cue.index)
+
+
+def year(date: str) -> str | None:
+    return date[:4] if date[:4].isdigit() else None
+
+
+class Exporter(ABC):
+    """Writes a library and its playlists to the file format of another program.
+
+    The tracks are written one at a time while they are read, so an export only holds
+    the ids of the tracks in memory. The library and the playlists are AudioTracks in
+    TrackCollections or their CollectionSnapshots, snapshots can be exported from any
+    thread while the library changes.
+    """
+
+    name = ""
+    description = ""
+    extension = ""
+
+    def __init__(self, stream) -> None:
+        self.stream = stream
+        # Path -> id of the track in the export
+        self.ids: dict[str, int] = dict()
+
+    def tracks(self, library, playlists: list):
+        """The tracks of the library and the ones that are only in playlists."""
+        yield from library
+        for playlist in playlists:
+            for track in playlist:
+                if track.path not in library.by_path:
+                    yield track
+
+    def count(self, library, playlists: list) -> int:
+        extra = {
+            track.path
+            for playlist in playlists
+            for track in playlist
+            if track.path not in library.by_path
+        }
+        return len(library) + len(extra)
+
+    @abstractmethod
+    def write(self, library, playlists: list):
+        """Writes the whole export to the stream."""
+
+
+@register_exporter
+class AppleMusicExporter(Exporter):
+    name = "apple_music"
+    description = "Apple Music XML"
+    extension = ".xml"
+
+    def value(self, key: str, value: str, integer: bool = False):
+        kind = "integer" if integer else "string"
+        self.stream.write(
+            f"\t\t\t<key>{key}</key><{kind}>{value.translate(TEXT_ESCAPES)}</{kind}>\n"
+        )
+
+    def write(self, library, playlists: list):
+        write = self.stream.write
+        write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        write(
+            '<!DOCTYPE plist PUBLIC "-//Apple Computer//DTD PLIST 1.0//EN" '
+            '"http://www.apple.com/DTDs/PropertyList-1.0.dtd">\n'
+        )
+        write('<plist version="1.0">\n<dict>\n\t<key>Tracks</key>\n\t<dict>\n')
+        for track in self.tracks(library, playlists):
+            if track.path in self.ids:
+                continue
+            track_id = self.ids[track.path] = len(self.ids) + 1
+            write(f"\t\t<key>{track_id}</key>\n\t\t<dict>\n")
+            self.value("Track ID", str(track_id), integer=True)
+            for key, value in (
+                ("Name", track.title),
+                ("Artist", track.artist),
+                ("Album", track.album),
+                ("Genre", track.genre),
+            ):
+                if value:
+                    self.value(key, value)
+            if year(track.date):
+                self.value("Year", year(track.date), integer=True)
+            bpm = parse_float(track.bpm)
+            if bpm:
+                self.value("BPM", str(round(bpm)), integer=True)
+            self.value("Location", file_url(track.path))
+            write("\t\t</dict>\n")
+        write("\t</dict>\n\t<key>Playlists</key>\n\t<array>\n")
+        for playlist in playlists:
+            write("\t\t<dict>\n")
+            self.value("Name", playlist.name)
+            write("\t\t\t<key>Playlist Items</key>\n\t\t\t<array>\n")
+            for track in playlist:
+                write(
+                    f"\t\t\t\t<dict><key>Track ID</key>"
+                    f"<integer>{self.ids[track.path]}</integer></dict>\n"
+                )
+            write("\t\t\t</array>\n\t\t</dict>\n")
+        write("\t</array>\n</dict>\n</plist>\n")
+
+
+@register_exporter
+class RekordboxExporter(Exporter):
+    name = "rekordbox"
+    description = "Rekordbox XML"
+    extension = ".xml"
+
+    def write(self, library, playlists: list):
+        write = self.stream.write
+        write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        write('<DJ_PLAYLISTS Version="1.0.0">\n')
+        write('  <PRODUCT Name="Dj_musicplayer" Version="1.0" Company=""/>\n')
+        write(f'  <COLLECTION Entries="{self.count(library, playlists)}">\n')
+        for track in self.tracks(library, playlists):
+            if track.path in self.ids:
+                continue
+            track_id = self.ids[track.path] = len(self.ids) + 1
+            bpm = parse_float(track.bpm)
+            write(
+                "    <TRACK"
+                + attributes(
+                    TrackID=track_id,
+                    Name=track.title,
+                    Artist=track.artist,
+                    Album=track.album,
+                    Genre=track.genre,
+                    Year=year(track.date),
+                    AverageBpm=f"{bpm:.2f}" if bpm else None,
+                    Tonality=normalize_key(track.key) or None,
+                    Location=file_url(track.path),
+                )
+            )
+            cues = track_cues(track)
+            if not cues:
+                write("/>\n")
+                continue
+            write(">\n")
+            for cue in cues:
+                # Hot cues are numbered from 0, loops have type 4 and an end
+                write(
+                    "      <POSITION_MARK"
+                    + attributes(
+                        Name="",
+                        Type=4 if cue.is_loop else 0,
+                        Start=f"{cue.position / 1000:.3f}",
+                        End=f"{cue.loop_end / 1000:.3f}" if cue.is_loop else None,
+                        Num=cue.index - 1,
+                    )
+                    + "/>\n"
+                )
+            write("    </TRACK>\n")
+        write("  </COLLECTION>\n  <PLAYLISTS>\n")
+        write(f'    <NODE Type="0" Name="ROOT" Count="{len(playlists)}">\n')
+        for playlist in playlists:
+            write(
+                "      <NODE"
+                + attributes(
+                    Name=playlist.name, Type=1, KeyType=0, Entries=len(playlist)
+                )
+                + ">\n"
+            )
+            for track in playlist:
+                write(f'        <TRACK Key="{self.ids[track.path]}"/>\n')
+            write("      </NODE>\n")
+        write("    </NODE>\n  </PLAYLISTS>\n</DJ_PLAYLISTS>\n")
+
+
+def traktor_location(path: str) -> tuple[str, str, str]:
+    """Volume, directory and file name of a path in Traktor notation, where "/:"
+    separates the folders. Like on macOS, POSIX paths are on the drive named after
+    /Volumes or else on the system drive."""
+    # Drives of Windows paths also when exporting them on another system
+    volume, rest = ntpath.splitdrive(path)
+    if not volume:
+        parts = rest.replace("\\", "/").split("/")
+        if len(parts) > 3 and parts[:2] == ["", "Volumes"]:
+            volume, rest = parts[2], "/".join(parts[3:])
+        else:
+            volume = ExportSettings.traktor_system_volume
+    folders = [folder for folder in rest.replace("\\", "/").split("/") if folder]
+    file = folders.pop() if folders else ""
+    return volume, "".join(f"/:{folder}" for folder in folders) + "/:", file
+
+
+def traktor_key(key: str) -> int | None:
+    """Traktor numbers the major keys from C (0) to B (11) and the minor keys from Cm
+    (12) to Bm (23)."""
+    key = normalize_key(key)
+    if not key:
+        return None
+    minor = key.endswith("m")
+    return PITCH_CLASSES.index(key[:-1] if minor else key) + (12 if minor else 0)
+
+
+@register_exporter
+class TraktorExporter(Exporter):
+    name = "traktor"
+    description = "Traktor NML"
+    extension = ".nml"
+
+    def write(self, library, playlists: list):
+        write = self.stream.write
+        write('<?xml version="1.0" encoding="UTF-8" standalone="no" ?>\n')
+        write('<NML VERSION="19"><HEAD COMPANY="www.native-instruments.com" ')
+        write('PROGRAM="Traktor"></HEAD>\n')
+        write(f'<COLLECTION ENTRIES="{self.count(library, playlists)}">\n')
+        for track in self.tracks(library, playlists):
+            if track.path in self.ids:
+                continue
+            self.ids[track.path] = len(self.ids) + 1
+            volume, folders, file = traktor_location(track.path)
+            write(f"<ENTRY{attributes(TITLE=track.title, ARTIST=track.artist)}>\n")
+            write(f"<LOCATION{attributes(DIR=folders, FILE=file, VOLUME=volume)}>")
+            write("</LOCATION>\n")
+            if track.album:
+                write(f"<ALBUM{attributes(TITLE=track.album)}></ALBUM>\n")
+            write(
+                f"<INFO{attributes(GENRE=track.genre or None, KEY=track.key or None)}>"
+                "</INFO>\n"
+            )
+            bpm = parse_float(track.bpm)
+            if bpm:
+                write(f'<TEMPO BPM="{bpm:.6f}" BPM_QUALITY="100.000000"></TEMPO>\n')
+            key = traktor_key(track.key)
+            if key is not None:
+                write(f'<MUSICAL_KEY VALUE="{key}"></MUSICAL_KEY>\n')
+            for order, cue in enumerate(track_cues(track)):
+                # Cues have type 0, loops type 5 with their length, in ms
+                length = cue.loop_end - cue.position if cue.is_loop else 0
+                write(
+                    "<CUE_V2"
+                    + attributes(
+                        NAME="n.n.",
+                        DISPL_ORDER=order,
+                        TYPE=5 if cue.is_loop else 0,
+                        START=f"{cue.position:.6f}",
+                        LEN=f"{length:.6f}",
+                        REPEATS=-1,
+                        HOTCUE=cue.index - 1,
+                    )
+                    + "></CUE_V2>\n"
+                )
+            write("</ENTRY>\n")
+        write("</COLLECTION>\n<PLAYLISTS>\n")
+        write('<NODE TYPE="FOLDER" NAME="$ROOT">')
+        write(f'<SUBNODES COUNT="{len(playlists)}">\n')
+        for playlist in playlists:
+            write(f'<NODE{attributes(TYPE="PLAYLIST", NAME=playlist.name)}>')
+            write(f'<PLAYLIST ENTRIES="{len(playlist)}" TYPE="LIST">\n')
+            for track in playlist:
+                key = "".join(traktor_location(track.path))
+                write(
+                    '<ENTRY><PRIMARYKEY TYPE="TRACK"'
+                    f"{attributes(KEY=key)}></PRIMARYKEY></ENTRY>\n"
+                )
+            write("</PLAYLIST></NODE>\n")
+        write("</SUBNODES></NODE>\n</PLAYLISTS>\n</NML>\n")
+
+
+def export(name: str, path: str, library, playlists: list = ()) -> int:
+    """Writes the library and the playlists with the exporter of the name.
+
+    Returns:
+        int: Number of exported tracks.
+
+    Raises:
+        ValueError: There is no exporter of the name.
+    """
+    if name not in EXPORTERS:
+        raise ValueError(f"Unknown exporter {name}, choose one of {list(EXPORTERS)}")
+    playlists = list(playlists)
+    # Written to a temporary file, so an interrupted export leaves the old one intact
+    try:
+        with open(
+            f"{path}.tmp", "w", encoding="utf-8", buffering=1024 * 1024
+        ) as stream:
+            exporter = EXPORTERS[name](stream)
+            exporter.write(library, playlists)
+        os.replace(f"{path}.tmp", path)
+    except BaseException:
+        try:
+            os.remove(f"{path}.tmp")
+        except OSError:
+            pass
+        raise
+    log.info(f"Exported {len(exporter.ids)} tracks to {path}")
+    return len(exporter.ids)
@@ -0,0 +1,214 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import FileCache, file_signature, open_cache
+from logger import Logger
+from settings import HealthSettings, LoggerSettings
+
+log = Logger("Health", LoggerSettings.log_level)
+
+OK = "ok"
+MISSING = "missing"
+UNREADABLE = "unreadable"
+CORRUPT = "corrupt"
+
+# Bitrates in kbit/s by (MPEG version 1, layer) and (MPEG version 2/2.5, layer)
+BITRATES = {
+    (1, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (1, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (1, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (2, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (2, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (2, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}  # fmt: skip
+# Sample rates by the version bits of the frame header, 1 is reserved
+SAMPLE_RATES = {
+    3: (44100, 48000, 32000),
+    2: (22050, 24000, 16000),
+    0: (11025, 12000, 8000),
+}
+# Longest possible MPEG audio frame, MPEG 2.5 layer 2 at 160 kbit/s and 8 kHz
+MAX_FRAME_LENGTH = 2881
+
+
+def frame_length(header: bytes) -> int | None:
+    """Length in bytes of the MPEG audio frame starting with the 4 byte header,
+    None if the bytes are no valid frame header."""
+    if len(header) < 4 or header[0] != 0xFF or header[1] & 0xE0 != 0xE0:
+        return None
+    version_bits = (header[1] >> 3) & 3
+    layer = 4 - ((header[1] >> 1) & 3)
+    bitrate_index = header[2] >> 4
+    sample_rate_index = (header[2] >> 2) & 3
+    padding = (header[2] >> 1) & 1
+    if version_bits == 1 or layer == 4 or sample_rate_index == 3:
+        return None
+    if bitrate_index in (0, 15):
+        # Free format streams are too rare to be worth the effort
+        return None
+    version = 1 if version_bits == 3 else 2
+    bitrate = BITRATES[(version, layer)][bitrate_index] * 1000
+    sample_rate = SAMPLE_RATES[version_bits][sample_rate_index]
+    if layer == 1:
+        return (12 * bitrate // sample_rate + padding) * 4
+    if layer == 3 and version == 2:
+        return 72 * bitrate // sample_rate + padding
+    return 144 * bitrate // sample_rate + padding
+
+
+def find_frames(data: bytes, start: int = 0) -> int | None:
+    """Position of the first frame in data that is followed by another frame, so
+    random 0xFF bytes in the audio data are not mistaken for a frame."""
+    position = data.find(b"\xff", start)
+    while position != -1:
+        length = frame_length(data[position : position + 4])
+        if length and frame_length(data[position + length : position + length + 4]):
+            return position
+        position = data.find(b"\xff", position + 1)
+    return None
+
+
+def id3_size(header: bytes) -> int:
+    """Size of the ID3v2 tag at the start of a file, 0 if there is none."""
+    if len(header) < 10 or header[:3] != b"ID3":
+        return 0
+    # The size is a 28 bit "syncsafe" integer, 7 bits per byte
+    size = 0
+    for byte in header[6:10]:
+        size = (size << 7) | (byte & 0x7F)
+    footer = 10 if header[5] & 0x10 else 0
+    return 10 + size + footer
+
+
+def check_mp3(f, size: int) -> list[str]:
+    problems = []
+    audio_start = id3_size(f.read(10))
+    if audio_start >= size:
+        return ["The ID3 tag is longer than the file"]
+    audio_end = size
+    if size >= 128:
+        # ID3v1 tag at the end of the file
+        f.seek(size - 128)
+        if f.read(3) == b"TAG":
+            audio_end = size - 128
+    f.seek(audio_start)
+    head = f.read(HealthSettings.header_search_bytes)
+    first = find_frames(head)
+    if first is None:
+        return ["No MPEG audio frames after the header"]
+    audio_start += first
+    # Windows spread over the audio data have to contain valid frames. Files that
+    # were cut off, zero filled or overwritten fail at the damaged positions.
+    window = 2 * MAX_FRAME_LENGTH + 4
+    span = audio_end - audio_start - window
+    samples = HealthSettings.samples if span > 0 else 0
+    for i in range(samples):
+        offset = audio_start + span * i // max(samples - 1, 1)
+        f.seek(offset)
+        if find_frames(f.read(window)) is None:
+            problems.append(f"No MPEG audio frames at byte {offset}")
+    return problems
+
+
+def check_wav(f, size: int) -> list[str]:
+    header = f.read(12)
+    if header[:4] != b"RIFF" or header[8:12] != b"WAVE":
+        return ["No RIFF/WAVE header"]
+    position = 12
+    found_format = False
+    while position + 8 <= size:
+        f.seek(position)
+        chunk = f.read(8)
+        chunk_id, chunk_size = chunk[:4], int.from_bytes(chunk[4:8], "little")
+        if chunk_id == b"fmt ":
+            found_format = True
+        elif chunk_id == b"data":
+            if not found_format:
+                return ["The data chunk is in front of the format chunk"]
+            if position + 8 + chunk_size > size:
+                missing = position + 8 + chunk_size - size
+                return [f"The audio data is truncated by {missing} bytes"]
+            return []
+        # Chunks are padded to an even length
+        position += 8 + chunk_size + (chunk_size & 1)
+    return ["No data chunk"]
+
+
+def check_file(path: str) -> dict:
+    """Checks whether a file exists, is readable and looks like intact audio. Only
+    the headers and some samples of the audio data are read, nothing is decoded.
+
+    Returns:
+        dict: {"status": "ok" | "missing" | "unreadable" | "corrupt", "problems": [...]}
+    """
+    try:
+        size = os.stat(path).st_size
+    except FileNotFoundError:
+        return {"status": MISSING, "problems": ["The file does not exist"]}
+    except OSError as e:
+        return {"status": UNREADABLE, "problems": [str(e)]}
+    if size == 0:
+        return {"status": CORRUPT, "problems": ["The file is empty"]}
+    try:
+        with open(path, "rb") as f:
+            if path.lower().endswith(".mp3"):
+                problems = check_mp3(f, size)
+            elif path.lower().endswith(".wav"):
+                problems = check_wav(f, size)
+            else:
+                f.read(1)
+                problems = []
+    except OSError as e:
+        return {"status": UNREADABLE, "problems": [str(e)]}
+    return {"status": CORRUPT if problems else OK, "problems": problems}
+
+
+def check_files(
+    paths: list[str],
+    workers: int | None = HealthSettings.workers,
+    cache: FileCache | None = None,
+    progress=None,
+) -> dict[str, dict]:
+    """Checks many files in a thread pool. Results of unchanged files are taken from
+    the cache, so a recheck only reads the files that were added or modified.
+
+    Returns:
+        dict[str, dict]: Maps every path to the result of check_file.
+    """
+    with open_cache("health", cache) as cache:
+        signatures = {path: file_signature(path) for path in paths}
+        results = cache.get_many(
+            [path for path, signature in signatures.items() if signature], signatures
+        )
+        todo = [path for path in paths if path not in results]
+        if progress:
+            progress(len(paths) - len(todo), len(paths))
+        new_results = {}
+        done = len(paths) - len(todo)
+        with ThreadPoolExecutor(workers) as executor:
+            for path, result in zip(todo, executor.map(check_file, todo)):
+                new_results[path] = result
+                if result["status"] != OK:
+                    log.warning(f"{result['status']}: {path} {result['problems']}")
+                done += 1
+                if progress:
+                    progress(done, len(paths))
+        # Missing files have no signature and are checked again every time
+        cache.set_many(
+            {path: result for path, result in new_results.items() if signatures[path]},
+            signatures,
+        )
+    results.update(new_results)
+    return results
+
+
+def summarize(results: dict[str, dict]) -> dict[str, int]:
+    counts = {status: 0 for status in (OK, MISSING, UNREADABLE, CORRUPT)}
+    for result in results.values():
+        counts[result["status"]] += 1
+    return counts
+
+
+def broken_paths(results: dict[str, dict]) -> set[str]:
+    """Paths of all files that are not OK, the filter of the "Broken" view."""
+    return {path for path, result in results.items() if result["status"] != OK}
@@ -0,0 +1,271 @@
+import os
+import struct
+import time
+
+import numpy as np
+from logger import Logger
+from settings import HistorySettings, IOSettings, LoggerSettings
+
+log = Logger("History", LoggerSettings.log_level)
+
+# Start in ms since the epoch, track id, session id and the milliseconds played
+RECORD = np.dtype(
+    [("start", "<i8"), ("track", "<u4"), ("session", "<u4"), ("played", "<u4")],
+    align=False,
+)
+CHECKPOINT_MAGIC = b"DJHIST01"
+# Magic bytes, number of records, tracks and sessions the checkpoint covers
+CHECKPOINT_PREFIX = struct.Struct("<8sQII")
+
+
+class PlayHistory:
+    """Append-only log of the played tracks.
+
+    Every play is a fixed-size record of 20 bytes in the history file, the paths are
+    numbered in the order they were first played and appended to a second file. Records
+    are written in the order of their start, so queries by time and by session are
+    binary searches on the start and session columns.
+
+    Play counts are kept up to date in memory. Every checkpoint_interval records they
+    are written to a checkpoint together with the first record of every session, so
+    opening the history only reads the records after the last checkpoint.
+    """
+
+    def __init__(
+        self,
+        path: str = IOSettings.history_file,
+        checkpoint_interval: int = HistorySettings.checkpoint_interval,
+    ) -> None:
+        self.path = path
+        self.paths_file = f"{path}.paths"
+        self.checkpoint_file = f"{path}.idx"
+        self.checkpoint_interval = checkpoint_interval
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.paths: list[str] = []
+        self.track_ids: dict[str, int] = dict()
+        self.load_paths()
+        # Appended records are written to a buffer that doubles when it is full
+        self.length = 0
+        self.buffer = self.load_records()
+        self.counts = np.zeros(0, dtype=np.int64)
+        # Index of the first record of every session, sessions are numbered from 0
+        self.session_starts = np.zeros(0, dtype=np.int64)
+        self.load_checkpoint()
+        self.session = len(self.session_starts)
+        self.file = open(self.path, "ab")
+        self.paths_out = open(self.paths_file, "a", encoding="utf-8")
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def records(self) -> np.ndarray:
+        return self.buffer[: self.length]
+
+    def load_paths(self):
+        if not os.path.exists(self.paths_file):
+            return
+        with open(self.paths_file, encoding="utf-8") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    # Line of an interrupted write
+                    break
+                self.track_ids[line[:-1]] = len(self.paths)
+                self.paths.append(line[:-1])
+
+    def load_records(self) -> np.ndarray:
+        if not os.path.exists(self.path):
+            return np.zeros(0, dtype=RECORD)
+        with open(self.path, "rb") as f:
+            data = f.read()
+        records = np.frombuffer(
+            data, dtype=RECORD, count=len(data) // RECORD.itemsize
+        ).copy()
+        # An interrupted write leaves a partial record or one whose path is missing
+        invalid = np.flatnonzero(records["track"] >= len(self.paths))
+        complete = invalid[0] if len(invalid) else len(records)
+        if complete * RECORD.itemsize != len(data):
+            log.warning(f"Dropping interrupted records of the history {self.path}")
+            with open(self.path, "r+b") as f:
+                f.truncate(complete * RECORD.itemsize)
+        self.length = int(complete)
+        return records
+
+    def load_checkpoint(self):
+        """Reads the counts of the last checkpoint and adds the records after it."""
+        covered = 0
+        try:
+            with open(self.checkpoint_file, "rb") as f:
+                data = f.read()
+            magic, covered, tracks, sessions = CHECKPOINT_PREFIX.unpack_from(data)
+            offset = CHECKPOINT_PREFIX.size
+            counts = np.frombuffer(data, np.int64, tracks, offset)
+            session_starts = np.frombuffer(
+                data, np.int64, sessions, offset + 8 * tracks
+            )
+            if magic != CHECKPOINT_MAGIC or covered > self.length:
+                raise ValueError("The checkpoint does not match the history")
+            self.counts = counts.copy()
+            self.session_starts = session_starts.copy()
+        except FileNotFoundError:
+            covered = 0
+        except (struct.error, ValueError) as e:
+            log.warning(f"Rebuilding the history index: {e}")
+            covered = 0
+        self.index_records(self.records[covered:])
+
+    def index_records(self, records: np.ndarray):
+        if not len(records):
+            return
+        counts = np.bincount(records["track"], minlength=len(self.paths))
+        counts[: len(self.counts)] += self.counts
+        self.counts = counts
+        first = self.length - len(records)
+        sessions = records["session"]
+        # Records of a session are contiguous, its first record starts a new run
+        new = np.flatnonzero(np.diff(sessions, prepend=-1) != 0)
+        new = new[sessions[new] >= len(self.session_starts)]
+        self.session_starts = np.concatenate(
+            [self.session_starts, first + new.astype(np.int64)]
+        )
+
+    def write_checkpoint(self):
+        data = (
+            CHECKPOINT_PREFIX.pack(
+                CHECKPOINT_MAGIC,
+                self.length,
+                len(self.counts),
+                len(self.session_starts),
+            )
+            + self.counts.astype("<i8").tobytes()
+            + self.session_starts.astype("<i8").tobytes()
+        )
+        with open(f"{self.checkpoint_file}.tmp", "wb") as f:
+            f.write(data)
+        os.replace(f"{self.checkpoint_file}.tmp", self.checkpoint_file)
+
+    def track_id(self, path: str) -> int:
+        track_id = self.track_ids.get(path)
+        if track_id is None:
+            track_id = self.track_ids[path] = len(self.paths)
+            self.paths.append(path)
+            self.paths_out.write(path + "\n")
+            self.paths_out.flush()
+        return track_id
+
+    def record(self, path: str, start: float, played: float):
+        """Appends a play of the current session.
+
+        Args:
+            start (float): Start of the play in seconds since the epoch.
+            played (float): Seconds the track was played.
+        """
+        start_ms = int(start * 1000)
+        if len(self.records) and start_ms < self.records["start"][-1]:
+            # Keeps the records sorted, e.g. after the clock was set back
+            start_ms = int(self.records["start"][-1])
+        record = np.array(
+            [(start_ms, self.track_id(path), self.session, int(played * 1000))],
+            dtype=RECORD,
+        )
+        self.file.write(record.tobytes())
+        self.file.flush()
+        if self.length == len(self.buffer):
+            self.buffer = np.resize(self.buffer, max(2 * self.length, 64))
+        self.buffer[self.length] = record[0]
+        self.length += 1
+        self.index_records(record)
+        if self.length % self.checkpoint_interval == 0:
+            self.write_checkpoint()
+
+    def played_since(self, since: float) -> set[str]:
+        """Paths of the tracks played since a time in seconds since the epoch."""
+        first = np.searchsorted(self.records["start"], int(since * 1000))
+        return {self.paths[i] for i in np.unique(self.records["track"][first:])}
+
+    def played_in_last_days(self, days: float) -> set[str]:
+        return self.played_since(time.time() - days * 86400)
+
+    def play_counts(self, since: float | None = None) -> dict[str, int]:
+        """Number of plays per path, optionally only of the plays since a time."""
+        if since is None:
+            counts = self.counts
+        else:
+            first = np.searchsorted(self.records["start"], int(since * 1000))
+            counts = np.bincount(self.records["track"][first:])
+        return {self.paths[i]: int(counts[i]) for i in np.flatnonzero(counts)}
+
+    def sessions(self) -> list[int]:
+        """Ids of the sessions with plays, the oldest first."""
+        return self.records["session"][self.session_starts].tolist()
+
+    def session_plays(self, session: int) -> list[tuple[str, float, float]]:
+        """(Path, start, seconds played) of the plays of a session in their order."""
+        ids = self.records["session"][self.session_starts]
+        position = np.searchsorted(ids, max(session, 0))
+        if position == len(ids) or ids[position] != session:
+            return []
+        first = self.session_starts[position]
+        last = (
+            self.session_starts[position + 1]
+            if position + 1 < len(self.session_starts)
+            else self.length
+        )
+        records = self.records[first:last]
+        return [
+            (self.paths[track], start / 1000, played / 1000)
+            for track, start, played in zip(
+                records["track"].tolist(),
+                records["start"].tolist(),
+                records["played"].tolist(),
+            )
+        ]
+
+    def close(self):
+        self.file.close()
+        self.paths_out.close()
+
+
+class PlayTracker:
+    """Measures how long the current track is played, pauses do not count."""
+
+    def __init__(
+        self, history: PlayHistory, min_played: float = HistorySettings.min_played
+    ) -> None:
+        self.history = history
+        self.min_played = min_played
+        self.path = None
+        # Wall clock time of the first play of the track
+        self.start = None
+        self.played = 0.0
+        # Monotonic time since the track plays, None while it is paused
+        self.resumed = None
+
+    def play(self, path: str):
+        if path != self.path:
+            self.finish()
+            self.path = path
+        if self.start is None:
+            self.start = time.time()
+        if self.resumed is None:
+            self.resumed = time.monotonic()
+
+    def pause(self):
+        if self.resumed is not None:
+            self.played += time.monotonic() - self.resumed
+            self.resumed = None
+
+    def finish(self) -> bool:
+        """Records the play of the current track if it played long enough.
+
+        Returns:
+            bool: Whether a play was recorded.
+        """
+        self.pause()
+        recorded = self.path is not None and self.played >= self.min_played
+        if recorded:
+            self.history.record(self.path, self.start, self.played)
+        self.path = None
+        self.start = None
+        self.played = 0.0
+        return recorded
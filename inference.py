@@ -0,0 +1,188 @@
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from audio_track import TAG_FIELDS, AudioTrack
+from logger import Logger
+from mutagen import MutagenError
+from mutagen.easyid3 import EasyID3
+from mutagen.id3._util import ID3NoHeaderError
+from settings import InferenceSettings, LoggerSettings
+
+log = Logger("Inference", LoggerSettings.log_level)
+
+FIELD_ALIASES = {"track": "tracknumber", "label": "organization", "year": "date"}
+# Fields that only match a narrow format, so the parts around them are unambiguous
+FIELD_REGEXES = {"tracknumber": r"\d{1,3}", "date": r"(?:19|20)\d\d"}
+PLACEHOLDER = re.compile(r"\{(\*|\w+)\}")
+
+
+def compile_pattern(pattern: str) -> re.Pattern:
+    """Regular expression of a pattern like "{artist} - {title}".
+
+    Raises:
+        ValueError: The pattern has an unknown or repeated placeholder.
+    """
+    parts, fields, end = [], set(), 0
+    for match in PLACEHOLDER.finditer(pattern):
+        parts.append(re.escape(pattern[end : match.start()]))
+        end = match.end()
+        name = match.group(1)
+        if name == "*":
+            parts.append(".+?")
+            continue
+        field = FIELD_ALIASES.get(name, name)
+        if field not in AudioTrack.valid_keys or field in fields:
+            raise ValueError(f"Invalid placeholder {{{name}}} in pattern: {pattern}")
+        fields.add(field)
+        parts.append(f"(?P<{field}>{FIELD_REGEXES.get(field, '.+?')})")
+    parts.append(re.escape(pattern[end:]))
+    return re.compile("".join(parts), re.IGNORECASE)
+
+
+def track_tags(track, fields) -> dict[str, str]:
+    """Path and current values of the fields of a track, the input of propose.
+
+    Takes AudioTracks or snapshots.TrackRecords. Fields that are no attributes of the
+    track are read from the file unless the frames of the track are loaded, so the
+    frames of live tracks are never loaded from a worker thread.
+    """
+    tags = {"path": track.path}
+    extra = [field for field in fields if field not in TAG_FIELDS]
+    frames = track if getattr(track, "frames_loaded", False) else None
+    if extra and frames is None:
+        try:
+            frames = EasyID3(track.path)
+        except ID3NoHeaderError:
+            frames = {}
+        except (MutagenError, OSError) as e:
+            log.warning(f"Could not read the tags of {track.path}: {e}")
+            frames = {}
+    for field in fields:
+        if field in TAG_FIELDS:
+            tags[field] = getattr(track, field)
+        else:
+            tags[field] = ",".join(frames.get(field, []))
+    return tags
+
+
+def clean_value(value: str) -> str:
+    return " ".join(value.replace("_", " ").split())
+
+
+def match_patterns(patterns: list[re.Pattern], text: str) -> dict[str, str]:
+    for pattern in patterns:
+        match = pattern.fullmatch(text)
+        if match is None:
+            continue
+        tags = {field: clean_value(value) for field, value in match.groupdict().items()}
+        if all(tags.values()):
+            return tags
+    return {}
+
+
+class PathInferrer:
+    """Infers tags from the names of files and of the folders they are in.
+
+    The tags of a folder are inferred once for all of its files, a collection of 50k
+    files spread over a few thousand folders takes well under a second.
+    """
+
+    def __init__(
+        self,
+        file_patterns=InferenceSettings.file_patterns,
+        folder_patterns=InferenceSettings.folder_patterns,
+    ) -> None:
+        self.file_patterns = [compile_pattern(pattern) for pattern in file_patterns]
+        # Grouped by the number of folders they span, the most folders first
+        self.folder_patterns: list[tuple[int, re.Pattern]] = sorted(
+            (
+                (pattern.count("/") + 1, compile_pattern(pattern))
+                for pattern in folder_patterns
+            ),
+            key=lambda item: -item[0],
+        )
+        self.folders: dict[str, dict[str, str]] = dict()
+        # Fields the patterns can fill, see track_tags
+        self.fields = {
+            field
+            for pattern in self.file_patterns
+            + [pattern for _, pattern in self.folder_patterns]
+            for field in pattern.groupindex
+        }
+
+    def infer_folder(self, directory: str) -> dict[str, str]:
+        tags = self.folders.get(directory)
+        if tags is None:
+            names = os.path.normpath(directory).replace("\\", "/").split("/")
+            tags = {}
+            for depth, pattern in self.folder_patterns:
+                if depth > len(names):
+                    continue
+                tags = match_patterns([pattern], "/".join(names[-depth:]))
+                if tags:
+                    break
+            self.folders[directory] = tags
+        return tags
+
+    def infer(self, path: str) -> dict[str, str]:
+        """Tags of the path, the file name wins over its folders."""
+        directory, name = os.path.split(path)
+        stem = os.path.splitext(name)[0]
+        return {
+            **self.infer_folder(directory),
+            **match_patterns(self.file_patterns, stem),
+        }
+
+    def propose(self, tracks, overwrite: bool = False) -> dict[str, dict[str, str]]:
+        """New tags of every track the paths tell more about.
+
+        Args:
+            tracks (Iterable[dict[str, str]]): Path and current tags of the tracks, see track_tags.
+            overwrite (bool, optional): Replace tags that are set. Defaults to only filling empty tags.
+
+        Returns:
+            dict[str, dict[str, str]]: Maps the paths to the tags that would change.
+        """
+        proposals = {}
+        for track in tracks:
+            tags = {}
+            for field, value in self.infer(track["path"]).items():
+                current = track.get(field, "")
+                if current != value and (overwrite or not current):
+                    tags[field] = value
+            if tags:
+                proposals[track["path"]] = tags
+        return proposals
+
+
+# Path -> lock of saving its tags. Writes of different analyses to one file must not
+# overlap, the later one would drop the tags of the other
+FILE_LOCKS: dict[str, threading.Lock] = dict()
+
+
+def write_tag(path: str, tags: dict[str, str]) -> str:
+    """Writes tags to a file, returns the error or an empty string."""
+    try:
+        with FILE_LOCKS.setdefault(path, threading.Lock()):
+            AudioTrack(path).update_tags(tags)
+    except Exception as e:
+        log.warning(f"Could not tag {path}: {e}")
+        return str(e)
+    return ""
+
+
+def write_tags(
+    proposals: dict[str, dict[str, str]], workers: int = InferenceSettings.workers
+) -> dict[str, str]:
+    """Writes the tags to the files in parallel threads, saving is mostly waiting on
+    the disk. Only touches the files, tracks in memory are updated by the caller.
+
+    Returns:
+        dict[str, str]: Errors of the files that could not be tagged.
+    """
+    paths = list(proposals)
+    with ThreadPoolExecutor(workers) as executor:
+        errors = executor.map(write_tag, paths, [proposals[path] for path in paths])
+        return {path: error for path, error in zip(paths, errors) if error}
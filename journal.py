@@ -0,0 +1,252 @@
+import json
+import os
+
+from audio_track import AudioTrack, TrackCollection
+from logger import Logger
+from settings import IOSettings, JournalSettings, LoggerSettings
+
+log = Logger("Journal", LoggerSettings.log_level)
+
+
+def tag_values(track: AudioTrack, fields) -> dict[str, str]:
+    """Current values of the given tags of a track, "" for missing ones."""
+    return {field: track[field][0] if field in track else "" for field in fields}
+
+
+def tags_command(path: str, before: dict, after: dict) -> dict | None:
+    """Command of a tag edit that only contains the changed tags, None if nothing changed."""
+    changed = [field for field in after if before.get(field, "") != after[field]]
+    if not changed:
+        return None
+    return {
+        "op": "tags",
+        "path": path,
+        "before": {field: before.get(field, "") for field in changed},
+        "after": {field: after[field] for field in changed},
+    }
+
+
+def tags_batch_command(commands: list[dict | None]) -> dict | None:
+    """One command of the tag edits of many tracks, e.g. of a bulk tagging, that is
+    undone in one step. None if nothing changed."""
+    commands = [command for command in commands if command is not None]
+    if not commands:
+        return None
+    return {"op": "tags_batch", "commands": commands}
+
+
+def playlist_key(collection: TrackCollection) -> str:
+    return collection.file or collection.name
+
+
+def encode_order(order: list[int]) -> list[list[int]]:
+    """Stores a new order of the tracks as runs [first old index, length]. Moving a
+    block of tracks are at most four runs, no matter how long the playlist is."""
+    runs = []
+    for index in order:
+        if runs and runs[-1][0] + runs[-1][1] == index:
+            runs[-1][1] += 1
+        else:
+            runs.append([index, 1])
+    return runs
+
+
+def decode_order(runs: list[list[int]]) -> list[int]:
+    return [index for start, length in runs for index in range(start, start + length)]
+
+
+def invert_order(order: list[int]) -> list[int]:
+    inverse = [0] * len(order)
+    for new_index, old_index in enumerate(order):
+        inverse[old_index] = new_index
+    return inverse
+
+
+def insert_command(collection: TrackCollection, indexes: list[int]) -> dict:
+    """Command of tracks that were inserted at the given indexes."""
+    return {
+        "op": "insert",
+        "playlist": playlist_key(collection),
+        "indexes": sorted(indexes),
+        "paths": [collection[index].path for index in sorted(indexes)],
+    }
+
+
+def remove_command(collection: TrackCollection, indexes: list[int]) -> dict:
+    """Command of tracks that are about to be removed from the given indexes."""
+    command = insert_command(collection, indexes)
+    command["op"] = "remove"
+    return command
+
+
+def reorder_command(collection: TrackCollection, order: list[int]) -> dict:
+    return {
+        "op": "reorder",
+        "playlist": playlist_key(collection),
+        "runs": encode_order(order),
+    }
+
+
+def apply_tags_command(collection: TrackCollection, command: dict, undo: bool):
+    track = collection.by_path.get(command["path"]) or AudioTrack(command["path"])
+    collection.update_track_tags(track, command["before" if undo else "after"])
+
+
+def apply_playlist_command(
+    collection: TrackCollection,
+    command: dict,
+    undo: bool,
+    library: TrackCollection | None = None,
+):
+    """Applies a "reorder", "insert" or "remove" command to a playlist.
+
+    Args:
+        library (TrackCollection, optional): Inserted tracks are taken from it if it has them, instead of reading their tags again.
+    """
+    op = command["op"]
+    if op == "reorder":
+        order = decode_order(command["runs"])
+        collection.reorder(invert_order(order) if undo else order)
+        return
+    # Removing is undone by inserting and the other way around
+    if (op == "remove") != undo:
+        for path in command["paths"]:
+            if path in collection.by_path:
+                collection.remove_track(collection.by_path[path])
+    else:
+        for index, path in zip(command["indexes"], command["paths"]):
+            track = library.by_path.get(path) if library is not None else None
+            collection.insert_track(index, track or AudioTrack(path))
+
+
+class Journal:
+    """Append-only log of the edits of the user that can be undone and redone.
+
+    Every edit is a command with the minimal information to apply and revert it,
+    e.g. {"op": "tags", "path": ..., "before": {"genre": "House"}, "after": {...}}.
+    The file holds one JSON line per command and a marker line per undo and redo,
+    so every step appends a few bytes. Once the file has three times as many lines
+    as commands are kept, it is rewritten with the kept commands only.
+
+    What a command does is up to the handler registered for its "op", which is
+    called with the command and whether it is undone.
+    """
+
+    def __init__(
+        self,
+        path: str = IOSettings.journal_file,
+        max_entries: int = JournalSettings.max_entries,
+    ) -> None:
+        self.path = path
+        self.max_entries = max_entries
+        self.commands: list[dict] = []
+        # The commands before this position are applied, the ones after it can be redone
+        self.position = 0
+        self.lines = 0
+        self.handlers = dict()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.load()
+        self.file = open(path, "a")
+
+    def __len__(self):
+        return len(self.commands)
+
+    def register(self, op: str, fnc):
+        self.handlers[op] = fnc
+
+    def can_undo(self) -> bool:
+        return self.position > 0
+
+    def can_redo(self) -> bool:
+        return self.position < len(self.commands)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            for line in f:
+                self.lines += 1
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Line of an interrupted write
+                    log.warning(f"Skipping a broken line of the journal {self.path}")
+                    continue
+                if "do" in entry:
+                    self.push(entry["do"])
+                elif "undo" in entry and self.can_undo():
+                    self.position -= 1
+                elif "redo" in entry and self.can_redo():
+                    self.position += 1
+
+    def push(self, command: dict):
+        del self.commands[self.position :]
+        self.commands.append(command)
+        self.position += 1
+        if len(self.commands) > 2 * self.max_entries:
+            # Dropping in bulk keeps appending O(1) on average
+            drop = len(self.commands) - self.max_entries
+            del self.commands[:drop]
+            self.position -= drop
+
+    def record(self, command: dict | None):
+        """Adds an edit that was already applied, the edits that could be redone are dropped."""
+        if command is None:
+            return
+        self.push(command)
+        self.write({"do": command})
+
+    def undo(self) -> dict | None:
+        if not self.can_undo():
+            return None
+        command = self.commands[self.position - 1]
+        self.position -= 1
+        self.apply(command, undo=True)
+        self.write({"undo": 1})
+        return command
+
+    def redo(self) -> dict | None:
+        if not self.can_redo():
+            return None
+        command = self.commands[self.position]
+        self.position += 1
+        self.apply(command, undo=False)
+        self.write({"redo": 1})
+        return command
+
+    def apply(self, command: dict, undo: bool):
+        handler = self.handlers.get(command["op"])
+        if handler is None:
+            log.error(f"No handler for the journal command {command['op']}")
+            return
+        try:
+            handler(command, undo)
+        except Exception as e:
+            # A command that cannot be applied, e.g. of a deleted file, is skipped
+            log.error(f"Could not {'undo' if undo else 'redo'} {command}: {e}")
+
+    def write(self, entry: dict):
+        self.file.write(json.dumps(entry, separators=(",", ":")) + "\n")
+        self.file.flush()
+        self.lines += 1
+        if self.lines > 3 * self.max_entries:
+            self.compact()
+
+    def compact(self):
+        """Rewrites the file with the last max_entries commands and the undo markers
+        of the commands that can be redone."""
+        drop = max(len(self.commands) - self.max_entries, 0)
+        del self.commands[:drop]
+        self.position = max(self.position - drop, 0)
+        entries = [{"do": command} for command in self.commands]
+        entries += [{"undo": 1}] * (len(self.commands) - self.position)
+        self.file.close()
+        with open(f"{self.path}.tmp", "w") as f:
+            for entry in entries:
+                f.write(json.dumps(entry, separators=(",", ":")) + "\n")
+        os.replace(f"{self.path}.tmp", self.path)
+        self.lines = len(entries)
+        self.file = open(self.path, "a")
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,112 @@
+import mutagen
+import numpy as np
+from audio_analysis import analyze_files, decode_audio, spectrogram
+from audio_track import PITCH_CLASSES, AudioTrack, to_camelot
+from cache import FileCache, open_cache
+from logger import Logger
+from settings import AnalysisSettings, LoggerSettings
+
+log = Logger("KeyDetection", LoggerSettings.log_level)
+
+# Krumhansl-Kessler key profiles, starting at the tonic
+MAJOR_PROFILE = np.array(
+    [6.35, 2.23, 3.48, 2.33, 4.38, 4.09, 2.52, 5.19, 2.39, 3.66, 2.29, 2.88]
+)
+MINOR_PROFILE = np.array(
+    [6.33, 2.68, 3.52, 5.38, 2.60, 3.53, 2.54, 4.75, 3.98, 2.69, 3.34, 3.17]
+)
+FRAME_SIZE = 4096
+HOP = 2048
+MIN_FREQUENCY = 55.0
+MAX_FREQUENCY = 2000.0
+# Only the middle of a track is analyzed, intros and outros are often atonal
+MAX_DURATION = 180.0
+
+
+def key_names() -> list[str]:
+    return [*PITCH_CLASSES, *(f"{pitch}m" for pitch in PITCH_CLASSES)]
+
+
+def key_profiles() -> np.ndarray:
+    """The 24 major and minor profiles rotated to every tonic and z-normalized, shape (24, 12)."""
+    profiles = np.array(
+        [np.roll(MAJOR_PROFILE, tonic) for tonic in range(12)]
+        + [np.roll(MINOR_PROFILE, tonic) for tonic in range(12)]
+    )
+    profiles -= profiles.mean(axis=1, keepdims=True)
+    return profiles / np.linalg.norm(profiles, axis=1, keepdims=True)
+
+
+def chroma_filter(sample_rate: int, frame_size: int = FRAME_SIZE) -> np.ndarray:
+    """Matrix that maps the FFT bins to the 12 pitch classes, shape (n_bins, 12)."""
+    frequencies = np.fft.rfftfreq(frame_size, 1 / sample_rate)
+    valid = (frequencies >= MIN_FREQUENCY) & (frequencies <= MAX_FREQUENCY)
+    mapping = np.zeros((len(frequencies), 12), dtype=np.float32)
+    midi = 69 + 12 * np.log2(frequencies[valid] / 440.0)
+    mapping[np.flatnonzero(valid), np.round(midi).astype(int) % 12] = 1.0
+    return mapping
+
+
+def chroma(signal: np.ndarray, sample_rate: int) -> np.ndarray:
+    """Average pitch class energy of the signal, normalized to a sum of 1."""
+    power = spectrogram(signal, FRAME_SIZE, HOP) ** 2
+    frame_chroma = power @ chroma_filter(sample_rate)
+    # Normalize each frame, so loud passages do not dominate the result
+    frame_chroma /= frame_chroma.sum(axis=1, keepdims=True) + 1e-12
+    total = frame_chroma.mean(axis=0)
+    return total / (total.sum() + 1e-12)
+
+
+def estimate_key(chroma_vector: np.ndarray) -> tuple[str, float]:
+    """Correlates a chroma vector with all key profiles.
+
+    Returns:
+        tuple[str, float]: Key in ID3 notation and the correlation of the best profile.
+    """
+    centered = chroma_vector - chroma_vector.mean()
+    norm = np.linalg.norm(centered)
+    if norm == 0:
+        return "", 0.0
+    scores = key_profiles() @ (centered / norm)
+    best = int(np.argmax(scores))
+    return key_names()[best], float(scores[best])
+
+
+def detect_key(path: str) -> dict:
+    """Analyzes the key of an audio file. Runs in the worker processes of analyze_keys."""
+    sample_rate = AnalysisSettings.key_sample_rate
+    offset = duration = None
+    try:
+        audio = mutagen.File(path)
+    except mutagen.MutagenError:
+        audio = None
+    if audio is not None and audio.info.length > MAX_DURATION:
+        # Only the middle is decoded, the rest of a long track would be dropped
+        offset = (audio.info.length - MAX_DURATION) / 2
+        duration = MAX_DURATION
+    signal = decode_audio(path, sample_rate, offset, duration)
+    # Without a known length the whole file is decoded
+    excess = len(signal) - int(MAX_DURATION * sample_rate)
+    if excess > 0:
+        signal = signal[excess // 2 : excess // 2 + int(MAX_DURATION * sample_rate)]
+    key, confidence = estimate_key(chroma(signal, sample_rate))
+    return {"key": key, "camelot": to_camelot(key), "confidence": confidence}
+
+
+def analyze_keys(
+    paths: list[str], workers: int | None = None, cache: FileCache | None = None
+) -> dict[str, dict]:
+    """Detects the keys of many files in parallel, every file is analyzed only once.
+
+    Returns:
+        dict[str, dict]: Maps the paths to {"key", "camelot", "confidence"}.
+    """
+    with open_cache("key", cache) as cache:
+        return analyze_files(detect_key, paths, cache, workers)
+
+
+def key_tags(track: AudioTrack, result: dict) -> dict:
+    """The detected key as ID3 initialkey, see audio_analysis.result_tags."""
+    if not result["key"] or track.key == result["key"]:
+        return {}
+    return {"initialkey": result["key"]}
@@ -0,0 +1,250 @@
+import hashlib
+import json
+import os
+
+import session
+import utility
+from audio_track import AudioTrack, TrackCollection
+from logger import Logger
+from settings import IOSettings, LoggerSettings
+
+log = Logger("Library", LoggerSettings.log_level)
+
+
+class LibraryRoot:
+    """A folder of the library, e.g. on a NAS or a USB drive, with its own index.
+
+    The index is a session snapshot of the tracks in the folder, so the tracks of an
+    unplugged drive are still known and can be browsed.
+    """
+
+    def __init__(self, path: str, index_dir: str = IOSettings.roots_dir) -> None:
+        self.path = os.path.abspath(path)
+        self.name = os.path.basename(self.path.rstrip(os.sep)) or self.path
+        digest = hashlib.sha1(self.path.encode("utf-8")).hexdigest()[:16]
+        self.index_file = os.path.join(index_dir, f"{digest}.bin")
+        self.collection = TrackCollection(name=self.name)
+        self.online = self.is_mounted()
+        # Tags of its tracks changed since the index was saved
+        self.dirty = False
+        # Path -> error of the files the last scan could not read, retried on the next
+        self.failed: dict[str, str] = dict()
+
+    def __repr__(self) -> str:
+        return f"LibraryRoot({self.path!r})"
+
+    def is_mounted(self) -> bool:
+        return os.path.isdir(self.path)
+
+    def contains(self, path: str) -> bool:
+        return path.startswith(self.path.rstrip(os.sep) + os.sep)
+
+    def load_index(self) -> session.Session | None:
+        """Tracks and file signatures of the last scan, None if there was none."""
+        try:
+            return session.load_session(self.index_file)
+        except FileNotFoundError:
+            return None
+        except (OSError, session.SnapshotError) as e:
+            log.warning(f"Could not read the index of {self.path}: {e}")
+            return None
+
+    def save_index(self, signatures: dict[str, tuple[int, int]] | None = None):
+        session.save_session(
+            session.Session(self.collection), self.index_file, signatures
+        )
+        self.dirty = False
+
+    def scan(
+        self, workers: int | None = None
+    ) -> tuple[TrackCollection, list[str], dict[str, str]]:
+        """Reads the tracks in the folder and saves them as index. Only new and changed
+        files are opened, the others are taken from the last index. Files that cannot
+        be read are skipped and left out of the index, so the next scan tries again.
+        Runs in a worker thread, the collection of the root is replaced by
+        FederatedLibrary.attach.
+
+        Returns:
+            tuple[TrackCollection, list[str], dict[str, str]]: Tracks of the folder, the paths of the files that were read and the errors of the ones that failed.
+        """
+        indexed = self.load_index()
+        files = utility.get_audio_files(self.path)
+        signatures = {path: session.stat_signature(path) for path in files}
+        known = dict()
+        if indexed is not None:
+            known = {
+                path: track
+                for path, track in indexed.library.by_path.items()
+                if indexed.signatures.get(path) == signatures.get(path)
+            }
+        read = [path for path in files if path not in known]
+        loaded, failed = utility.try_load_tracks(read, workers)
+        loaded = {track.path: track for track in loaded}
+        for path, error in failed.items():
+            log.warning(f"Skipping {path}: {error}")
+            del signatures[path]
+        tracks = [
+            known.get(path) or loaded[path] for path in files if path not in failed
+        ]
+        log.info(
+            f"Scanned {len(files)} files of {self.path}, {len(read)} new or changed, "
+            f"{len(failed)} unreadable"
+        )
+        collection = TrackCollection(tracks, name=self.name)
+        session.save_session(session.Session(collection), self.index_file, signatures)
+        return collection, [path for path in read if path not in failed], failed
+
+
+class FederatedLibrary:
+    """Roots of the library on several drives, the library is the union of their
+    tracks and the tracks that were opened from elsewhere.
+
+    Unmounting a drive does not change the library, the tracks of the root are only
+    marked as unavailable until it is mounted again.
+    """
+
+    def __init__(
+        self,
+        roots_file: str = IOSettings.roots_file,
+        index_dir: str = IOSettings.roots_dir,
+    ) -> None:
+        self.roots_file = roots_file
+        self.index_dir = index_dir
+        self.roots: dict[str, LibraryRoot] = dict()
+        try:
+            with open(roots_file, encoding="utf-8") as f:
+                paths = json.load(f)
+        except FileNotFoundError:
+            paths = []
+        except (OSError, json.JSONDecodeError) as e:
+            log.warning(f"Could not read the library roots {roots_file}: {e}")
+            paths = []
+        for path in paths:
+            root = LibraryRoot(path, index_dir)
+            self.roots[root.path] = root
+
+    def __iter__(self):
+        return iter(self.roots.values())
+
+    def __len__(self):
+        return len(self.roots)
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.roots_file), exist_ok=True)
+        with open(self.roots_file, "w", encoding="utf-8") as f:
+            json.dump(list(self.roots), f, indent=2)
+
+    def add_root(self, path: str) -> LibraryRoot:
+        root = LibraryRoot(path, self.index_dir)
+        self.roots.setdefault(root.path, root)
+        self.save()
+        return self.roots[root.path]
+
+    def remove_root(self, root: LibraryRoot):
+        self.roots.pop(root.path, None)
+        self.save()
+        if os.path.exists(root.index_file):
+            os.remove(root.index_file)
+
+    def root_of(self, path: str) -> LibraryRoot | None:
+        """Root that contains the path, the innermost one if roots are nested."""
+        roots = [root for root in self.roots.values() if root.contains(path)]
+        return max(roots, key=lambda root: len(root.path), default=None)
+
+    def load_indexes(self) -> dict[str, list[AudioTrack]]:
+        """Tracks of the index of every root. Creates the tracks without opening the
+        files, meant to run in a worker thread before attach."""
+        indexes = dict()
+        for root in list(self.roots.values()):
+            indexed = root.load_index()
+            if indexed is not None:
+                indexes[root.path] = indexed.library.tracks
+        return indexes
+
+    def attach(
+        self,
+        root: LibraryRoot,
+        tracks: list[AudioTrack],
+        library: TrackCollection,
+        changed: list[str] = (),
+    ):
+        """Makes the tracks the ones of the root and adds them to the library. Tracks
+        the library already has are shared, so an edit shows in both.
+
+        Args:
+            changed (list[str], optional): Paths of files that changed, their shared tracks are read again.
+        """
+        previous = root.collection
+        tracks = [library.by_path.get(track.path) or track for track in tracks]
+        root.collection = TrackCollection(tracks, name=root.name)
+        for path in changed:
+            track = library.by_path.get(path)
+            if track is not None:
+                library.reload_track(track)
+        library += root.collection
+        # Files that were deleted since the last scan
+        self.remove_from_library(
+            [track for track in previous if track.path not in root.collection.by_path],
+            library,
+        )
+
+    def detach(self, root: LibraryRoot, library: TrackCollection):
+        """Removes the tracks of the root from the library, e.g. when it is removed."""
+        self.remove_from_library(list(root.collection), library, root)
+        root.collection = TrackCollection(name=root.name)
+
+    def remove_from_library(
+        self,
+        tracks: list[AudioTrack],
+        library: TrackCollection,
+        removed_root: LibraryRoot | None = None,
+    ):
+        """Removes the tracks from the library, except for the ones of a playlist or of
+        another root."""
+        if not tracks:
+            return
+        kept = set()
+        for playlist in library.playlists.values():
+            kept.update(playlist.by_path)
+        for root in self.roots.values():
+            if root is not removed_root:
+                kept.update(root.collection.by_path)
+        library.remove_tracks([track for track in tracks if track.path not in kept])
+
+    def check_mounts(self) -> list[LibraryRoot]:
+        """Updates which roots are mounted, only checks the root folders.
+
+        Returns:
+            list[LibraryRoot]: Roots that were mounted or unmounted since the last check.
+        """
+        changed = []
+        for root in self.roots.values():
+            online = root.is_mounted()
+            if online != root.online:
+                root.online = online
+                changed.append(root)
+                log.info(f"{root.path} is {'online' if online else 'offline'}")
+        return changed
+
+    def unavailable_paths(self) -> set[str]:
+        """Paths of the tracks of the roots that are not mounted."""
+        paths = set()
+        for root in self.roots.values():
+            if not root.online:
+                paths.update(root.collection.by_path)
+        return paths
+
+    def on_library_changed(self, event: str, track: AudioTrack | None):
+        # Tag edits are saved to the index of the root on exit, see save_indexes
+        if event == "update" and track is not None:
+            root = self.root_of(track.path)
+            if root is not None:
+                root.dirty = True
+
+    def save_indexes(self):
+        for root in self.roots.values():
+            if root.dirty and root.online:
+                try:
+                    root.save_index()
+                except OSError as e:
+                    log.error(f"Could not save the index of {root.path}: {e}")
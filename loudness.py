@@ -0,0 +1,174 @@
+import numpy as np
+from audio_analysis import analyze_files, channel_count, decode_audio
+from audio_track import AudioTrack
+from cache import FileCache, open_cache
+from logger import Logger
+from settings import AnalysisSettings, LoggerSettings
+
+log = Logger("Loudness", LoggerSettings.log_level)
+
+SAMPLE_RATE = 48000
+# K-weighting of ITU-R BS.1770 at 48 kHz: high shelf followed by a high pass
+SHELF = ([1.53512485958697, -2.69169618940638, 1.19839281085285],
+         [1.0, -1.69065929318241, 0.73248077421585])  # fmt: skip
+HIGH_PASS = ([1.0, -2.0, 1.0], [1.0, -1.99004745483398, 0.99007225036621])
+# Both filters have decayed far below -120 dB after this many samples
+IMPULSE_LENGTH = 8192
+FFT_SIZE = 2**16
+BLOCKS_PER_BATCH = 16
+BLOCK_SECONDS = 0.4
+STEP_SECONDS = 0.1
+ABSOLUTE_GATE = -70.0
+RELATIVE_GATE = -10.0
+OVERSAMPLING = 4
+# ReplayGain 2.0 stores the gain relative to this loudness
+REPLAYGAIN_REFERENCE = -18.0
+
+
+def biquad_response(b, a, n_fft: int) -> np.ndarray:
+    z = np.exp(-1j * np.pi * np.arange(n_fft // 2 + 1) / (n_fft // 2))
+    return np.polyval(b[::-1], z) / np.polyval(a[::-1], z)
+
+
+def k_weighting_impulse() -> np.ndarray:
+    n_fft = 4 * IMPULSE_LENGTH
+    response = biquad_response(*SHELF, n_fft) * biquad_response(*HIGH_PASS, n_fft)
+    return np.fft.irfft(response, n_fft)[:IMPULSE_LENGTH]
+
+
+def k_weight(signal: np.ndarray) -> np.ndarray:
+    """Applies the K-weighting to all channels with a blockwise FFT convolution.
+
+    Args:
+        signal (np.ndarray): Shape (n_samples, n_channels).
+    """
+    impulse_spectrum = np.fft.rfft(k_weighting_impulse(), FFT_SIZE)
+    block = FFT_SIZE - IMPULSE_LENGTH + 1
+    n_samples, n_channels = signal.shape
+    n_blocks = -(-n_samples // block)
+    padded = np.zeros((n_channels, n_blocks * block), dtype=np.float32)
+    padded[:, :n_samples] = signal.T
+    blocks = padded.reshape(n_channels, n_blocks, block)
+    output = np.zeros((n_channels, n_blocks + 1, block), dtype=np.float32)
+    # Batches of blocks of all channels are filtered at once, bounding the memory
+    for start in range(0, n_blocks, BLOCKS_PER_BATCH):
+        batch = blocks[:, start : start + BLOCKS_PER_BATCH]
+        filtered = np.fft.irfft(np.fft.rfft(batch, FFT_SIZE) * impulse_spectrum)
+        end = start + batch.shape[1]
+        output[:, start:end] += filtered[:, :, :block]
+        # Overlap-add the tails of the blocks onto their successors
+        output[:, start + 1 : end + 1, : FFT_SIZE - block] += filtered[:, :, block:]
+    return output.reshape(n_channels, -1)[:, :n_samples].T
+
+
+def integrated_loudness(signal: np.ndarray, sample_rate: int = SAMPLE_RATE) -> float:
+    """Gated integrated loudness in LUFS of a signal with the shape (n_samples, n_channels)."""
+    weighted = k_weight(signal)
+    step = int(STEP_SECONDS * sample_rate)
+    steps_per_block = int(round(BLOCK_SECONDS / STEP_SECONDS))
+    n_steps = len(weighted) // step
+    if n_steps < steps_per_block:
+        return float("-inf")
+    # Mean square of every 100 ms step, summed over the channels
+    energy = (weighted[: n_steps * step] ** 2).reshape(n_steps, step, -1)
+    step_power = energy.mean(axis=1).sum(axis=1)
+    # 400 ms blocks with 75 % overlap are the mean of four consecutive steps
+    cumulative = np.concatenate([[0.0], np.cumsum(step_power)])
+    block_power = (
+        cumulative[steps_per_block:] - cumulative[:-steps_per_block]
+    ) / steps_per_block
+    block_loudness = -0.691 + 10 * np.log10(block_power + 1e-20)
+    gated = block_power[block_loudness > ABSOLUTE_GATE]
+    if len(gated) == 0:
+        return float("-inf")
+    relative_gate = -0.691 + 10 * np.log10(gated.mean()) + RELATIVE_GATE
+    gated = block_power[
+        (block_loudness > ABSOLUTE_GATE) & (block_loudness > relative_gate)
+    ]
+    return float(-0.691 + 10 * np.log10(gated.mean()))
+
+
+def true_peak(signal: np.ndarray) -> float:
+    """Peak in dBTP after 4x oversampling.
+
+    Args:
+        signal (np.ndarray): Shape (n_samples, n_channels).
+    """
+    block = 2**15
+    margin = 64
+    n_samples, n_channels = signal.shape
+    n_blocks = -(-n_samples // block)
+    padded = np.zeros((n_channels, n_blocks * block + 2 * margin), np.float32)
+    padded[:, margin : margin + n_samples] = signal.T
+    # Overlapping windows, so the interpolation at the block edges is not distorted
+    windows = np.lib.stride_tricks.sliding_window_view(
+        padded, block + 2 * margin, axis=1
+    )[:, ::block]
+    size = (block + 2 * margin) * OVERSAMPLING
+    peak = float(np.abs(signal).max()) if n_samples else 0.0
+    for start in range(0, n_blocks, BLOCKS_PER_BATCH):
+        spectrum = np.fft.rfft(windows[:, start : start + BLOCKS_PER_BATCH])
+        upsampled = np.fft.irfft(spectrum, size) * OVERSAMPLING
+        core = upsampled[..., margin * OVERSAMPLING : -margin * OVERSAMPLING]
+        peak = max(peak, float(np.abs(core).max()))
+    return float(20 * np.log10(peak + 1e-20))
+
+
+def measure_loudness(path: str) -> dict:
+    """Integrated loudness and true peak of a file. Runs in the worker processes."""
+    # BS.1770 weights every channel, duplicating a mono file would read 3 dB too loud
+    if channel_count(path) == 1:
+        signal = decode_audio(path, SAMPLE_RATE)[:, np.newaxis]
+    else:
+        signal = decode_audio(path, SAMPLE_RATE, mono=False)
+    return {"lufs": integrated_loudness(signal), "true_peak": true_peak(signal)}
+
+
+def analyze_loudness(
+    paths: list[str], workers: int | None = None, cache: FileCache | None = None
+) -> dict[str, dict]:
+    """Measures the loudness of many files in parallel, every file is measured only once.
+
+    Returns:
+        dict[str, dict]: Maps the paths to {"lufs", "true_peak"}.
+    """
+    with open_cache("loudness", cache) as cache:
+        return analyze_files(measure_loudness, paths, cache, workers)
+
+
+def loudness_tags(track: AudioTrack, result: dict) -> dict:
+    """The measurement as ReplayGain 2.0 track gain and peak, see
+    audio_analysis.result_tags."""
+    if not np.isfinite(result["lufs"]):
+        return {}
+    gain = REPLAYGAIN_REFERENCE - result["lufs"]
+    if track.replaygain is not None and abs(track.replaygain - gain) < 0.01:
+        return {}
+    return {
+        "replaygain_track_gain": f"{gain:.2f} dB",
+        "replaygain_track_peak": f"{10 ** (result['true_peak'] / 20):.6f}",
+    }
+
+
+def playback_gain(
+    track: AudioTrack,
+    target: float = AnalysisSettings.target_loudness,
+    cache: FileCache | None = None,
+) -> float:
+    """Gain in dB that brings the track to the target loudness without clipping its
+    true peak. Only tags and the cache are read, the audio is not decoded.
+    Tracks that were never measured get no gain."""
+    if track.replaygain is not None:
+        lufs = REPLAYGAIN_REFERENCE - track.replaygain
+        peak = track.replaygain_peak
+    else:
+        with open_cache("loudness", cache) as cache:
+            result = cache.get(track.path)
+        if result is None or not np.isfinite(result["lufs"]):
+            return 0.0
+        lufs = result["lufs"]
+        peak = result["true_peak"]
+    gain = target - lufs
+    if peak is not None:
+        gain = min(gain, -peak)
+    return float(gain)
@@ -1,12 +1,39 @@
 #! python3
+import time
+
+start = time.perf_counter()
+
+import argparse
+
+from logger import Logger
+from PyQt6.QtCore import QTimer
 from PyQt6.QtWidgets import QApplication
-from settings import UISettings
+from settings import LoggerSettings, UISettings
 from ui import UI
 
+log = Logger("Main", LoggerSettings.log_level)
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="DJ music player")
+    parser.add_argument(
+        "--fresh", action="store_true", help="Start without restoring the last session"
+    )
+    parser.add_argument(
+        "--remote",
+        action="store_true",
+        help="Serve the control API on localhost, see remote.py",
+    )
+    args = parser.parse_args()
     app = QApplication([])
     settings = UISettings()
+    settings.restore_session = not args.fresh
+    settings.remote_control = args.remote
     ui = UI(settings)
+    # Runs once the window is shown and handles events
+    QTimer.singleShot(
+        0,
+        lambda: log.info(f"Interactive after {time.perf_counter() - start:.2f} s"),
+    )
     app.exec()
 
     exit()
@@ -0,0 +1,98 @@
+import time
+
+from logger import Logger
+from PyQt6.QtCore import QObject, QUrl, pyqtSignal
+from settings import LoggerSettings
+
+log = Logger("Player", LoggerSettings.log_level)
+
+
+class DeferredPlayer(QObject):
+    """Stand-in for QMediaPlayer that imports and creates the multimedia stack on the
+    first play. Starting the audio backend takes long and is not needed to browse the
+    library, so until then the source, position and volume are only stored.
+    """
+
+    positionChanged = pyqtSignal("qint64")
+    sourceChanged = pyqtSignal(QUrl)
+    # The media of the source is ready, its position can be set
+    loaded = pyqtSignal()
+
+    def __init__(self, parent=None) -> None:
+        super().__init__(parent)
+        self.player = None
+        self.audio_output = None
+        self.source = QUrl()
+        self.pending_position = 0
+        self.volume = 1.0
+
+    def is_initialized(self) -> bool:
+        return self.player is not None
+
+    def ensure_player(self):
+        if self.player is not None:
+            return self.player
+        start = time.perf_counter()
+        from PyQt6.QtMultimedia import QAudioOutput, QMediaPlayer
+
+        self.audio_output = QAudioOutput(self)
+        self.audio_output.setVolume(self.volume)
+        self.player = QMediaPlayer(self)
+        self.player.setAudioOutput(self.audio_output)
+        self.player.positionChanged.connect(self.positionChanged)
+        self.player.sourceChanged.connect(self.sourceChanged)
+        self.player.mediaStatusChanged.connect(self.on_media_status_changed)
+        if not self.source.isEmpty():
+            self.player.setSource(self.source)
+        log.info(f"Started the multimedia stack in {time.perf_counter() - start:.2f} s")
+        return self.player
+
+    def on_media_status_changed(self, status):
+        if status != self.player.MediaStatus.LoadedMedia:
+            return
+        if self.pending_position:
+            self.player.setPosition(self.pending_position)
+            self.pending_position = 0
+        self.loaded.emit()
+
+    def setSource(self, source: QUrl):
+        self.source = source
+        self.pending_position = 0
+        if self.player is not None:
+            self.player.setSource(source)
+            return
+        self.sourceChanged.emit(source)
+        self.loaded.emit()
+
+    def play(self):
+        self.ensure_player().play()
+
+    def pause(self):
+        if self.player is not None:
+            self.player.pause()
+
+    def stop(self):
+        if self.player is not None:
+            self.player.stop()
+
+    def isPlaying(self) -> bool:
+        return self.player is not None and self.player.isPlaying()
+
+    def position(self) -> int:
+        if self.player is None or self.pending_position:
+            return self.pending_position
+        return self.player.position()
+
+    def setPosition(self, position: int):
+        if self.player is None:
+            self.pending_position = position
+        else:
+            self.player.setPosition(position)
+
+    def duration(self) -> int:
+        return self.player.duration() if self.player is not None else 0
+
+    def setVolume(self, volume: float):
+        self.volume = volume
+        if self.audio_output is not None:
+            self.audio_output.setVolume(volume)
@@ -0,0 +1,258 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from audio_analysis import DecodeError, decode_audio
+from energy import combined_energy
+from logger import Logger
+from PyQt6.QtCore import QObject, pyqtSignal
+from settings import EnergySettings, IOSettings, LoggerSettings, PreviewSettings
+
+log = Logger("Preview", LoggerSettings.log_level)
+
+
+def find_drop(curves: np.ndarray, block_seconds: float = EnergySettings.block_seconds):
+    """Seconds of the drop in energy curves of energy.energy_curves, the block after
+    which the energy rises the most. None if it never rises clearly.
+
+    The mean energy of the blocks after is compared to the blocks before, so single
+    loud hits and gradual build ups do not count.
+    """
+    span = max(int(PreviewSettings.drop_window / block_seconds), 1)
+    energy = combined_energy(curves)
+    if len(energy) < 2 * span:
+        return None
+    sums = np.concatenate([[0.0], np.cumsum(energy)])
+    starts = np.arange(span, len(energy) - span + 1)
+    before = (sums[starts] - sums[starts - span]) / span
+    after = (sums[starts + span] - sums[starts]) / span
+    rises = after - before
+    best = int(np.argmax(rises))
+    if rises[best] < PreviewSettings.min_drop_rise:
+        return None
+    return float(starts[best] * block_seconds)
+
+
+def preview_start(curves: np.ndarray | None) -> float:
+    """Seconds where the preview of a track starts, shortly before its drop or at the
+    offset of the settings if it has no energy curves or no clear drop."""
+    drop = find_drop(curves) if curves is not None else None
+    if drop is None:
+        return PreviewSettings.offset
+    return max(drop - PreviewSettings.pre_roll, 0.0)
+
+
+def to_pcm(signal: np.ndarray) -> np.ndarray:
+    """Stereo int16 samples of a float signal in [-1, 1], shape (n_samples, 2)."""
+    if signal.ndim == 1:
+        signal = np.repeat(signal[:, None], 2, axis=1)
+    return np.round(np.clip(signal, -1.0, 1.0) * 32767).astype(np.int16)
+
+
+class PreviewCache:
+    """Decoded preview segments of the recently wanted tracks.
+
+    The segments are stereo int16 PCM in a fixed number of equally sized slots of one
+    memory-mapped file, so the cache never grows beyond it and the OS decides which of
+    it stays in memory. The least recently used segment gives its slot to a new one.
+    Slots are written by the worker threads of PreviewLoader, the index is locked.
+    """
+
+    def __init__(
+        self,
+        path: str = IOSettings.preview_file,
+        slots: int = PreviewSettings.slots,
+        seconds: float = PreviewSettings.segment_seconds,
+        sample_rate: int = PreviewSettings.sample_rate,
+    ) -> None:
+        self.path = path
+        self.sample_rate = sample_rate
+        self.slot_samples = int(seconds * sample_rate)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Starts empty, the segments depend on the files and the energy curves
+        self.data = np.memmap(path, np.int16, "w+", shape=(slots, self.slot_samples, 2))
+        # Path -> (slot, number of samples, start in ms), least recently used first
+        self.index: OrderedDict[str, tuple[int, int, int]] = OrderedDict()
+        self.free = list(range(slots - 1, -1, -1))
+        self.lock = threading.Lock()
+
+    def __contains__(self, path: str) -> bool:
+        return path in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, path: str) -> tuple[bytes, int] | None:
+        """PCM of the segment and its start in ms, None if it is not cached."""
+        with self.lock:
+            entry = self.index.get(path)
+            if entry is None:
+                return None
+            self.index.move_to_end(path)
+            slot, samples, start = entry
+            # Copied, the slot may be given to another track while the preview plays
+            return self.data[slot, :samples].tobytes(), start
+
+    def put(self, path: str, signal: np.ndarray, start: int):
+        """Stores a decoded segment, longer ones are cut to the slot size."""
+        pcm = to_pcm(signal[: self.slot_samples])
+        with self.lock:
+            if path in self.index:
+                slot = self.index.pop(path)[0]
+            elif self.free:
+                slot = self.free.pop()
+            else:
+                _, (slot, _, _) = self.index.popitem(last=False)
+            self.data[slot, : len(pcm)] = pcm
+            self.index[path] = (slot, len(pcm), start)
+
+    def close(self):
+        del self.data
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def decode_segment(path: str, start: float) -> tuple[np.ndarray, float]:
+    """Decodes the preview segment of a file, from the beginning if the file ends
+    before the start.
+
+    Returns:
+        tuple[np.ndarray, float]: Stereo signal and its start in seconds.
+    """
+    seconds = PreviewSettings.segment_seconds
+    rate = PreviewSettings.sample_rate
+    signal = decode_audio(path, rate, start, seconds, mono=False)
+    if len(signal) < rate and start > 0:
+        start = 0.0
+        signal = decode_audio(path, rate, None, seconds, mono=False)
+    return signal, start
+
+
+class PreviewLoader(QObject):
+    """Decodes preview segments in background threads into a PreviewCache.
+
+    Like the artwork, only the wanted tracks are decoded, requests of tracks that were
+    scrolled out of view before their turn are dropped.
+    """
+
+    # Path of the track whose segment is ready
+    loaded = pyqtSignal(str)
+
+    def __init__(self, parent=None, cache: PreviewCache | None = None) -> None:
+        super().__init__(parent)
+        self.cache = PreviewCache() if cache is None else cache
+        # Paths submitted to the executor, discarded by its threads
+        self.pending: set[str] = set()
+        self.pending_lock = threading.Lock()
+        self.wanted: set[str] = set()
+        self.executor = ThreadPoolExecutor(PreviewSettings.workers)
+
+    def request(self, path: str, start: float):
+        """Decodes the segment from start seconds, unless it is cached or pending."""
+        self.wanted.add(path)
+        with self.pending_lock:
+            if path in self.cache or path in self.pending:
+                return
+            self.pending.add(path)
+        self.executor.submit(self.load, path, start)
+
+    def set_wanted(self, paths: set[str]):
+        self.wanted = set(paths)
+
+    def load(self, path: str, start: float):
+        try:
+            if path not in self.wanted:
+                return
+            signal, start = decode_segment(path, start)
+            self.cache.put(path, signal, int(start * 1000))
+        except (DecodeError, OSError) as e:
+            log.warning(f"Could not decode a preview of {path}: {e}")
+            return
+        except Exception as e:
+            # Not raised further, nobody waits for the future of the executor
+            log.error(f"Preview of {path} failed: {type(e).__name__}: {e}")
+            return
+        finally:
+            # Also after errors, otherwise the track would never be requested again
+            with self.pending_lock:
+                self.pending.discard(path)
+        self.loaded.emit(path)
+
+    def shutdown(self):
+        # Waits for the segments being decoded, they write to the file
+        self.executor.shutdown(wait=True, cancel_futures=True)
+        self.cache.close()
+
+
+class PreviewPlayer(QObject):
+    """Plays preview segments on their own audio output, e.g. the headphones of a DJ
+    controller, without touching the main player. The output is opened on the first
+    preview, like the DeferredPlayer the multimedia stack is only imported then."""
+
+    # Path of the track whose preview started or stopped
+    started = pyqtSignal(str)
+    stopped = pyqtSignal(str)
+
+    def __init__(
+        self, parent=None, device: str = PreviewSettings.output_device
+    ) -> None:
+        super().__init__(parent)
+        self.device = device
+        self.sink = None
+        self.buffer = None
+        self.path = None
+
+    def ensure_sink(self):
+        if self.sink is not None:
+            return self.sink
+        from PyQt6.QtMultimedia import QAudioFormat, QAudioSink, QMediaDevices
+
+        output = QMediaDevices.defaultAudioOutput()
+        for candidate in QMediaDevices.audioOutputs():
+            if self.device and self.device.lower() in candidate.description().lower():
+                output = candidate
+                break
+        audio_format = QAudioFormat()
+        audio_format.setSampleRate(PreviewSettings.sample_rate)
+        audio_format.setChannelCount(2)
+        audio_format.setSampleFormat(QAudioFormat.SampleFormat.Int16)
+        self.sink = QAudioSink(output, audio_format, self)
+        self.sink.stateChanged.connect(self.on_state_changed)
+        log.info(f"Previews play on {output.description()}")
+        return self.sink
+
+    def play(self, path: str, pcm: bytes, volume: float = 1.0):
+        from PyQt6.QtCore import QBuffer, QByteArray, QIODevice
+
+        self.stop()
+        sink = self.ensure_sink()
+        self.buffer = QBuffer(self)
+        self.buffer.setData(QByteArray(pcm))
+        self.buffer.open(QIODevice.OpenModeFlag.ReadOnly)
+        sink.setVolume(min(volume, 1.0))
+        self.path = path
+        sink.start(self.buffer)
+        self.started.emit(path)
+
+    def stop(self):
+        if self.path is None:
+            return
+        path, self.path = self.path, None
+        self.sink.stop()
+        self.buffer.close()
+        self.buffer = None
+        self.stopped.emit(path)
+
+    def is_playing(self, path: str | None = None) -> bool:
+        return self.path is not None and (path is None or path == self.path)
+
+    def on_state_changed(self, state):
+        from PyQt6.QtMultimedia import QAudio
+
+        # The end of the segment
+        if state == QAudio.State.IdleState:
+            self.stop()
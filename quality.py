@@ -0,0 +1,136 @@
+import mutagen
+import numpy as np
+from audio_analysis import DecodeError, analyze_files, decode_audio, spectrogram
+from cache import FileCache, open_cache
+from logger import Logger
+from settings import LoggerSettings, QualitySettings
+
+log = Logger("Quality", LoggerSettings.log_level)
+
+FRAME_SIZE = 4096
+# The level is compared to the median level of this band
+REFERENCE_BAND = (1000.0, 5000.0)
+SMOOTHING_HZ = 200.0
+# Half width of the band the level has to fall off within at a lowpass cutoff
+CLIFF_HALF_WIDTH_HZ = 500.0
+# Lowest cutoff in Hz a file of at least this bitrate in kbit/s is expected to have.
+# Encoders lowpass lower bitrates harder, e.g. LAME cuts 128 kbit/s at 17 kHz.
+MIN_CUTOFFS = ((1000, 19500), (320, 19000), (256, 18500), (192, 17000), (128, 15000))
+
+
+def average_spectrum(signals: list[np.ndarray]) -> np.ndarray:
+    """Mean power spectrum of all frames of the signals, shape (FRAME_SIZE // 2 + 1,)."""
+    spectra = [
+        (spectrogram(signal, FRAME_SIZE, FRAME_SIZE) ** 2).mean(axis=0)
+        for signal in signals
+        if len(signal) >= FRAME_SIZE
+    ]
+    if not spectra:
+        raise DecodeError("Not enough audio to analyze")
+    return np.mean(spectra, axis=0)
+
+
+def estimate_cutoff(
+    power: np.ndarray,
+    sample_rate: int,
+    drop_db: float = QualitySettings.cutoff_drop_db,
+    cliff_db: float = QualitySettings.cliff_db,
+) -> tuple[float, bool]:
+    """Finds the highest frequency whose level is at most drop_db below the reference
+    band. Lossy encoders remove everything above their lowpass, so their spectrum
+    falls off a cliff there, while the highs of music fade out gradually.
+
+    Returns:
+        tuple[float, bool]: Cutoff in Hz and whether the level falls by at least cliff_db around it.
+    """
+    frequencies = np.fft.rfftfreq(FRAME_SIZE, 1 / sample_rate)
+    resolution = frequencies[1]
+    width = max(int(SMOOTHING_HZ / resolution), 1)
+    smoothed = np.convolve(power, np.ones(width) / width, mode="same")
+    level = 10 * np.log10(smoothed + 1e-20)
+    low, high = REFERENCE_BAND
+    reference = np.median(level[(frequencies >= low) & (frequencies <= high)])
+    above = np.flatnonzero(level > reference - drop_db)
+    if len(above) == 0:
+        return 0.0, False
+    cutoff = int(above[-1])
+    half_width = int(CLIFF_HALF_WIDTH_HZ / resolution)
+    if cutoff + half_width >= len(level):
+        # The spectrum reaches up to the Nyquist frequency
+        return float(frequencies[cutoff]), False
+    fall = level[max(cutoff - half_width, 0)] - level[cutoff + half_width]
+    return float(frequencies[cutoff]), bool(fall >= cliff_db)
+
+
+def min_cutoff(bitrate: int, sample_rate: int) -> float:
+    """Lowest plausible cutoff of a file with the given bitrate in kbit/s."""
+    for min_bitrate, cutoff in MIN_CUTOFFS:
+        if bitrate >= min_bitrate:
+            # Files with low sample rates cannot contain such high frequencies
+            return min(cutoff, sample_rate / 2 - 1000)
+    return 0.0
+
+
+def source_bitrate(cutoff: float) -> int:
+    """Highest bitrate whose encoders cut off at or below this frequency."""
+    for min_bitrate, min_frequency in MIN_CUTOFFS[1:]:
+        if cutoff >= min_frequency:
+            return min_bitrate
+    return MIN_CUTOFFS[-1][0]
+
+
+def analyze_quality(path: str) -> dict:
+    """Estimates the frequency cutoff of a file from a few decoded windows and flags
+    files whose cutoff is too low for their bitrate, e.g. 320 kbit/s files that were
+    transcoded from 128 kbit/s. Runs in the worker processes.
+
+    Returns:
+        dict: {"cutoff": Hz, "sharp": bool, "bitrate": kbit/s, "source_bitrate": kbit/s or None, "suspect": bool}
+    """
+    audio = mutagen.File(path)
+    if audio is None:
+        raise DecodeError(f"Unknown file format: {path}")
+    info = audio.info
+    sample_rate = info.sample_rate
+    bitrate = int(info.bitrate / 1000)
+    windows = QualitySettings.windows
+    duration = QualitySettings.window_seconds
+    # Spread the windows over the track, leaving out intro and outro
+    usable = max(info.length - duration, 0.0)
+    offsets = [usable * (i + 1) / (windows + 1) for i in range(windows)]
+    signals = [decode_audio(path, sample_rate, offset, duration) for offset in offsets]
+    cutoff, sharp = estimate_cutoff(average_spectrum(signals), sample_rate)
+    suspect = sharp and cutoff < min_cutoff(bitrate, sample_rate)
+    return {
+        "cutoff": cutoff,
+        "sharp": sharp,
+        "bitrate": bitrate,
+        "source_bitrate": source_bitrate(cutoff) if sharp else None,
+        "suspect": suspect,
+    }
+
+
+def analyze_qualities(
+    paths: list[str], workers: int | None = None, cache: FileCache | None = None
+) -> dict[str, dict]:
+    """Analyzes the quality of many files in parallel, every file is analyzed only once.
+
+    Returns:
+        dict[str, dict]: Maps the paths to the results of analyze_quality.
+    """
+    with open_cache("quality", cache) as cache:
+        return analyze_files(analyze_quality, paths, cache, workers)
+
+
+def suspect_paths(results: dict[str, dict]) -> set[str]:
+    return {path for path, result in results.items() if result["suspect"]}
+
+
+def quality_label(result: dict | None) -> str:
+    """Text of the quality column, e.g. "16.0 kHz, ~128 kbps" for suspect files."""
+    if result is None:
+        return ""
+    label = f"{result['cutoff'] / 1000:.1f} kHz"
+    if result["suspect"]:
+        label += f", ~{result['source_bitrate']} kbps"
+    return label
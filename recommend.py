@@ -0,0 +1,199 @@
+import math
+import zlib
+
+import numpy as np
+from audio_track import AudioTrack, TrackCollection, normalize_genre, parse_float
+from logger import Logger
+from loudness import REPLAYGAIN_REFERENCE
+from settings import LoggerSettings, RecommendationSettings
+
+log = Logger("Recommend", LoggerSettings.log_level)
+
+GENRE_DIMENSIONS = 32
+# Blocks of the feature vector: name, number of columns and weight in the distance
+BLOCKS = (
+    ("bpm", 1, RecommendationSettings.bpm_weight),
+    ("key", 3, RecommendationSettings.key_weight),
+    ("genre", GENRE_DIMENSIONS, RecommendationSettings.genre_weight),
+    ("year", 1, RecommendationSettings.year_weight),
+    ("loudness", 1, RecommendationSettings.loudness_weight),
+)
+# Squared distance of a block if one of the tracks lacks it, e.g. has no BPM tag
+MISSING_DISTANCE = 1.0
+
+
+def block_slices() -> dict[str, slice]:
+    slices = {}
+    start = 0
+    for name, size, _ in BLOCKS:
+        slices[name] = slice(start, start + size)
+        start += size
+    return slices
+
+
+SLICES = block_slices()
+DIMENSIONS = sum(size for _, size, _ in BLOCKS)
+
+
+def genre_column(token: str) -> int:
+    # crc32 instead of hash(), which differs between processes
+    return zlib.crc32(normalize_genre(token).encode()) % GENRE_DIMENSIONS
+
+
+def track_features(track: AudioTrack) -> tuple[np.ndarray, np.ndarray]:
+    """Feature vector of a track and which of its blocks are known.
+
+    The blocks are scaled so that a distance of 1 is a noticeable difference: 4 %
+    tempo, one step on the Camelot wheel, 5 years or 3 dB of loudness. Genres are
+    hashed to a fixed number of columns and normalized to unit length.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: Features of shape (DIMENSIONS,) and a bool per block.
+    """
+    features = np.zeros(DIMENSIONS, dtype=np.float32)
+    known = np.zeros(len(BLOCKS), dtype=bool)
+    bpm = parse_float(track.bpm)
+    if bpm and bpm > 0:
+        features[SLICES["bpm"]] = math.log2(bpm) / math.log2(1.04)
+        known[0] = True
+    if track.camelot:
+        # Neighbours on the wheel and the relative key are about one step apart
+        angle = 2 * math.pi * int(track.camelot[:-1]) / 12
+        radius = 1 / (2 * math.sin(math.pi / 12))
+        features[SLICES["key"]] = (
+            radius * math.cos(angle),
+            radius * math.sin(angle),
+            track.camelot[-1] == "B",
+        )
+        known[1] = True
+    if track.genres:
+        genres = features[SLICES["genre"]]
+        for token in track.genres:
+            genres[genre_column(token)] = 1.0
+        genres /= np.linalg.norm(genres)
+        known[2] = True
+    year = track.date[:4]
+    if year.isdigit():
+        features[SLICES["year"]] = int(year) / 5
+        known[3] = True
+    if track.replaygain is not None:
+        features[SLICES["loudness"]] = (REPLAYGAIN_REFERENCE - track.replaygain) / 3
+        known[4] = True
+    return features, known
+
+
+class RecommendationIndex:
+    """Feature matrix of the tracks of a collection for similarity queries.
+
+    The matrix is kept up to date by listening to the collection: added and changed
+    tracks only compute their own row. Rows of removed tracks are marked as free
+    and reused, so the matrix never has to be rebuilt.
+
+    To build the index in another thread, pass a snapshot of the collection as
+    tracks and apply the changes since the snapshot with catch_up afterwards.
+    """
+
+    def __init__(self, collection: TrackCollection, tracks=None) -> None:
+        self.collection = collection
+        if tracks is None:
+            tracks = collection
+        capacity = max(len(tracks), 64)
+        self.features = np.zeros((capacity, DIMENSIONS), dtype=np.float32)
+        self.known = np.zeros((capacity, len(BLOCKS)), dtype=bool)
+        self.alive = np.zeros(capacity, dtype=bool)
+        self.paths: list[str | None] = [None] * capacity
+        self.rows: dict[str, int] = dict()
+        self.free_rows: list[int] = []
+        self.size = 0
+        for track in tracks:
+            self.set_track(track)
+        collection.add_listener(self.on_collection_changed)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def catch_up(self, built_from, snapshot):
+        """Applies the changes between two snapshots of the collection."""
+        for path in snapshot.by_path.changed_keys(built_from.by_path):
+            track = snapshot.by_path.get(path)
+            if track is None:
+                self.remove_path(path)
+            else:
+                self.set_track(track)
+
+    def detach(self):
+        self.collection.remove_listener(self.on_collection_changed)
+
+    def grow(self):
+        capacity = 2 * len(self.alive)
+        for name in ("features", "known", "alive"):
+            array = getattr(self, name)
+            grown = np.zeros((capacity, *array.shape[1:]), dtype=array.dtype)
+            grown[: len(array)] = array
+            setattr(self, name, grown)
+        self.paths.extend([None] * (capacity - len(self.paths)))
+
+    def set_track(self, track: AudioTrack):
+        row = self.rows.get(track.path)
+        if row is None:
+            if self.free_rows:
+                row = self.free_rows.pop()
+            else:
+                if self.size == len(self.alive):
+                    self.grow()
+                row = self.size
+                self.size += 1
+            self.rows[track.path] = row
+            self.paths[row] = track.path
+            self.alive[row] = True
+        self.features[row], self.known[row] = track_features(track)
+
+    def remove_path(self, path: str):
+        row = self.rows.pop(path, None)
+        if row is None:
+            return
+        self.alive[row] = False
+        self.paths[row] = None
+        self.free_rows.append(row)
+
+    def on_collection_changed(self, event: str, track: AudioTrack):
+        if event in ("add", "update"):
+            self.set_track(track)
+        elif event == "remove":
+            self.remove_path(track.path)
+
+    def distances(self, track: AudioTrack) -> np.ndarray:
+        """Weighted squared distances of all rows to the track, inf for free rows."""
+        features, known = track_features(track)
+        n = self.size
+        total = np.zeros(n, dtype=np.float32)
+        for b, (name, _, weight) in enumerate(BLOCKS):
+            if not known[b]:
+                total += weight * MISSING_DISTANCE
+                continue
+            difference = self.features[:n, SLICES[name]] - features[SLICES[name]]
+            squared = np.einsum("ij,ij->i", difference, difference)
+            total += weight * np.where(self.known[:n, b], squared, MISSING_DISTANCE)
+        total[~self.alive[:n]] = np.inf
+        return total
+
+    def similar(
+        self, track: AudioTrack, k: int = RecommendationSettings.count, exclude=()
+    ) -> list[tuple[str, float]]:
+        """The k most similar tracks, the track itself and the paths in exclude left out.
+
+        Returns:
+            list[tuple[str, float]]: Paths and their distances, the most similar first.
+        """
+        distances = self.distances(track)
+        for path in (track.path, *exclude):
+            row = self.rows.get(path)
+            if row is not None:
+                distances[row] = np.inf
+        k = min(k, int(np.isfinite(distances).sum()))
+        if k <= 0:
+            return []
+        # Only the k best rows are sorted
+        best = np.argpartition(distances, k - 1)[:k]
+        best = best[np.argsort(distances[best], kind="stable")]
+        return [(self.paths[row], float(distances[row])) for row in best]
@@ -0,0 +1,574 @@
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import struct
+import threading
+import time
+from concurrent.futures import Future
+from typing import NamedTuple
+from urllib.parse import urlsplit
+
+from logger import Logger
+from settings import LoggerSettings, RemoteSettings
+from smart_crates import Rule
+from snapshots import CollectionSnapshot
+
+log = Logger("Remote", LoggerSettings.log_level)
+
+# Appended to the client key of a WebSocket handshake, see RFC 6455
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+CONTINUATION, TEXT, BINARY, CLOSE, PING, PONG = 0x0, 0x1, 0x2, 0x8, 0x9, 0xA
+# Close status codes, see RFC 6455 section 7.4.1
+INVALID_PAYLOAD, MESSAGE_TOO_BIG = 1007, 1009
+# Tag attributes of the tracks in responses and events
+TRACK_FIELDS = (
+    "path",
+    "title",
+    "artist",
+    "album",
+    "date",
+    "genre",
+    "bpm",
+    "key",
+    "camelot",
+)
+# Methods that control the player, they run in the GUI thread
+COMMANDS = ("status", "load", "play", "pause", "stop", "seek", "next", "previous")
+LOCAL_HOSTS = ("localhost", "127.0.0.1", "::1")
+
+
+class RemoteError(Exception):
+    """A request that cannot be answered, sent to the client as error message."""
+
+
+class Published(NamedTuple):
+    """Snapshots queries read, replaced as a whole by RemoteServer.publish."""
+
+    library: "CollectionSnapshot"
+    playlists: dict
+    # Path and lower case artist, title, album and genre of every track
+    search_texts: list[tuple[str, str]]
+
+
+def track_info(track) -> dict:
+    """JSON-ready tags of an AudioTrack or a snapshots.TrackRecord."""
+    return {field: getattr(track, field) for field in TRACK_FIELDS}
+
+
+def accept_key(key: str) -> str:
+    digest = hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()
+    return base64.b64encode(digest).decode()
+
+
+def encode_frame(opcode: int, payload: bytes, mask: bool = False) -> bytes:
+    """One final WebSocket frame. Clients have to mask their frames, servers must not."""
+    length = len(payload)
+    if length < 126:
+        header = struct.pack("!BB", 0x80 | opcode, (0x80 if mask else 0) | length)
+    elif length < 1 << 16:
+        header = struct.pack("!BBH", 0x80 | opcode, (0x80 if mask else 0) | 126, length)
+    else:
+        header = struct.pack("!BBQ", 0x80 | opcode, (0x80 if mask else 0) | 127, length)
+    if not mask:
+        return header + payload
+    key = os.urandom(4)
+    return header + key + apply_mask(payload, key)
+
+
+def apply_mask(payload: bytes, key: bytes) -> bytes:
+    # XOR with the repeated key, done on one big integer instead of byte by byte
+    repeated = (key * (len(payload) // 4 + 1))[: len(payload)]
+    masked = int.from_bytes(payload, "little") ^ int.from_bytes(repeated, "little")
+    return masked.to_bytes(len(payload), "little")
+
+
+async def read_frame(
+    reader: asyncio.StreamReader, max_bytes: int = RemoteSettings.max_message_bytes
+) -> tuple[bool, int, bytes]:
+    """Reads one frame.
+
+    Returns:
+        tuple[bool, int, bytes]: Whether it is the final frame of a message, its opcode and the unmasked payload.
+    """
+    first, second = await reader.readexactly(2)
+    length = second & 0x7F
+    if length == 126:
+        (length,) = struct.unpack("!H", await reader.readexactly(2))
+    elif length == 127:
+        (length,) = struct.unpack("!Q", await reader.readexactly(8))
+    if length > max_bytes:
+        raise RemoteError(f"Frames are limited to {max_bytes} bytes")
+    key = await reader.readexactly(4) if second & 0x80 else None
+    payload = await reader.readexactly(length)
+    if key is not None:
+        payload = apply_mask(payload, key)
+    return bool(first & 0x80), first & 0x0F, payload
+
+
+class WebSocket:
+    """Text messages over a WebSocket connection, pings are answered automatically."""
+
+    def __init__(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        client: bool = False,
+    ) -> None:
+        self.reader = reader
+        self.writer = writer
+        # Frames of clients are masked
+        self.client = client
+        self.closed = False
+
+    async def receive(self) -> str | None:
+        """The next text message, None once the connection is closed."""
+        message = b""
+        while not self.closed:
+            try:
+                final, opcode, payload = await read_frame(self.reader)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                self.closed = True
+                return None
+            if opcode == CLOSE:
+                await self.close()
+                return None
+            if opcode == PING:
+                await self.send_frame(PONG, payload)
+                continue
+            if opcode == PONG:
+                continue
+            message += payload
+            if len(message) > RemoteSettings.max_message_bytes:
+                raise RemoteError("Message too large")
+            if final:
+                return message.decode("utf-8")
+        return None
+
+    async def send_frame(self, opcode: int, payload: bytes):
+        self.writer.write(encode_frame(opcode, payload, mask=self.client))
+        await self.writer.drain()
+
+    async def send(self, text: str):
+        await self.send_frame(TEXT, text.encode("utf-8"))
+
+    async def close(self, code: int | None = None, reason: str = ""):
+        """Sends a close frame, with a status code like 1009 (message too big) if given."""
+        if self.closed:
+            return
+        self.closed = True
+        payload = b"" if code is None else struct.pack("!H", code) + reason.encode()
+        try:
+            await self.send_frame(CLOSE, payload)
+        except ConnectionError:
+            pass
+        self.writer.close()
+
+
+async def read_http_request(reader: asyncio.StreamReader) -> tuple[str, str, dict]:
+    """Request line and headers of an HTTP request, header names in lower case."""
+    head = await reader.readuntil(b"\r\n\r\n")
+    if len(head) > RemoteSettings.max_header_bytes:
+        raise RemoteError("Request header too large")
+    request_line, *header_lines = head.decode("latin-1").split("\r\n")
+    method, target, _ = request_line.split(" ", 2)
+    headers = dict()
+    for line in header_lines:
+        if ":" in line:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+    return method, target, headers
+
+
+def is_local_origin(headers: dict) -> bool:
+    """Browsers send the origin of the page. Only local pages may control the player,
+    scripts and controllers send no origin."""
+    origin = headers.get("origin")
+    if origin is None:
+        return True
+    return urlsplit(origin).hostname in LOCAL_HOSTS
+
+
+class RemoteServer:
+    """Control API on localhost, served by an asyncio event loop in its own thread so
+    the Qt event loop never waits for a client.
+
+    WebSocket clients connect to /ws and send {"id": 1, "method": "search", "params":
+    {...}}, the answer is {"id": 1, "result": ...} or {"id": 1, "error": "..."}.
+    Events are pushed as {"event": "track", "data": {...}}. The same requests can be
+    sent as the body of POST /api.
+
+    Queries read the snapshots of the library given to publish. Commands are passed
+    to the executor, whose submit(method, params) returns a concurrent.futures.Future.
+    """
+
+    def __init__(
+        self,
+        executor=None,
+        host: str = RemoteSettings.host,
+        port: int = RemoteSettings.port,
+    ) -> None:
+        self.executor = executor
+        self.host = host
+        self.port = port
+        self.published: Published | None = None
+        self.loop: asyncio.AbstractEventLoop | None = None
+        self.server = None
+        self.thread = None
+        self.clients: set[asyncio.Queue] = set()
+        self.started = threading.Event()
+        self.queries = {
+            "search": self.search,
+            "bpm_range": self.bpm_range,
+            "playlists": self.list_playlists,
+            "playlist": self.playlist,
+            "track": self.track,
+        }
+
+    def start(self):
+        """Starts the server thread and waits until the port is open."""
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        self.started.wait()
+        if self.server is None:
+            raise OSError(f"Could not open the remote control port {self.port}")
+
+    def run(self):
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.server = self.loop.run_until_complete(
+                asyncio.start_server(self.handle_connection, self.host, self.port)
+            )
+        except OSError as e:
+            log.error(f"Could not start the remote control: {e}")
+            self.started.set()
+            return
+        # Port 0 picks a free port
+        self.port = self.server.sockets[0].getsockname()[1]
+        log.info(f"Remote control listening on {self.host}:{self.port}")
+        self.started.set()
+        self.loop.run_forever()
+        self.loop.close()
+
+    def stop(self):
+        if self.loop is None or self.server is None:
+            return
+
+        async def shutdown():
+            self.server.close()
+            for queue in list(self.clients):
+                queue.put_nowait(None)
+            await asyncio.sleep(0)
+            self.loop.stop()
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self.loop)
+        self.thread.join(timeout=5)
+
+    def publish(self, library, playlists: dict | None = None):
+        """Makes snapshots of the library and playlists the ones queries read. The
+        search texts and the BPM index are prepared in the calling thread, e.g. a
+        worker thread, and swapped in at once."""
+        search_texts = [
+            (
+                track.path,
+                f"{track.artist} {track.title} {track.album} {track.genre}".casefold(),
+            )
+            for track in library
+        ]
+        library.index("bpm")
+        self.published = Published(library, dict(playlists or {}), search_texts)
+
+    def broadcast(self, event: str, data):
+        """Pushes an event to all WebSocket clients, can be called from any thread."""
+        if self.loop is None or not self.clients:
+            return
+        message = json.dumps({"event": event, "data": data})
+        self.loop.call_soon_threadsafe(self.queue_event, message)
+
+    def queue_event(self, message: str):
+        for queue in self.clients:
+            if queue.full():
+                # A slow client misses events instead of slowing down the others
+                continue
+            queue.put_nowait(message)
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    method, target, headers = await read_http_request(reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    return
+                if not is_local_origin(headers):
+                    await self.respond(writer, 403, {"error": "Forbidden origin"})
+                    return
+                path = urlsplit(target).path
+                if path == "/ws" and headers.get("upgrade", "").lower() == "websocket":
+                    await self.serve_websocket(reader, writer, headers)
+                    return
+                if method == "POST" and path == "/api":
+                    keep_alive = await self.serve_http(reader, writer, headers)
+                    if not keep_alive:
+                        return
+                    continue
+                await self.respond(writer, 404, {"error": "Not found"})
+                return
+        except (RemoteError, ValueError, asyncio.LimitOverrunError) as e:
+            await self.respond(writer, 400, {"error": str(e)})
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status: int, body: dict, keep_alive=False):
+        data = json.dumps(body).encode("utf-8")
+        reason = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found"}
+        writer.write(
+            (
+                f"HTTP/1.1 {status} {reason.get(status, '')}\r\n"
+                "Content-Type: application/json\r\n"
+                f"Content-Length: {len(data)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+            ).encode("latin-1")
+            + data
+        )
+        await writer.drain()
+
+    async def serve_http(self, reader, writer, headers: dict) -> bool:
+        # A JSON content type makes browsers ask for permission first, which is never given
+        if not headers.get("content-type", "").startswith("application/json"):
+            await self.respond(writer, 400, {"error": "Expected application/json"})
+            return False
+        length = int(headers.get("content-length", 0))
+        if length > RemoteSettings.max_message_bytes:
+            raise RemoteError("Request too large")
+        body = await reader.readexactly(length)
+        keep_alive = headers.get("connection", "").lower() != "close"
+        await self.respond(writer, 200, await self.answer(body), keep_alive)
+        return keep_alive
+
+    async def serve_websocket(self, reader, writer, headers: dict):
+        key = headers.get("sec-websocket-key")
+        if not key:
+            raise RemoteError("Missing Sec-WebSocket-Key")
+        writer.write(
+            (
+                "HTTP/1.1 101 Switching Protocols\r\n"
+                "Upgrade: websocket\r\n"
+                "Connection: Upgrade\r\n"
+                f"Sec-WebSocket-Accept: {accept_key(key)}\r\n\r\n"
+            ).encode("latin-1")
+        )
+        await writer.drain()
+        websocket = WebSocket(reader, writer)
+        queue = asyncio.Queue(RemoteSettings.client_queue_size)
+        self.clients.add(queue)
+        sender = asyncio.ensure_future(self.send_messages(websocket, queue))
+        requests = set()
+        try:
+            while (message := await websocket.receive()) is not None:
+                # Requests are answered concurrently, a slow command does not hold up queries
+                task = asyncio.ensure_future(self.answer_into(message, queue))
+                requests.add(task)
+                task.add_done_callback(requests.discard)
+        except (RemoteError, UnicodeDecodeError) as e:
+            # The connection is upgraded, it is closed with a status instead of HTTP 400
+            log.warning(f"Closing a WebSocket connection: {e}")
+            await websocket.close(
+                MESSAGE_TOO_BIG if isinstance(e, RemoteError) else INVALID_PAYLOAD
+            )
+        finally:
+            self.clients.discard(queue)
+            for task in requests:
+                task.cancel()
+            sender.cancel()
+            await websocket.close()
+
+    async def send_messages(self, websocket: WebSocket, queue: asyncio.Queue):
+        while (message := await queue.get()) is not None:
+            try:
+                await websocket.send(message)
+            except ConnectionError:
+                return
+        await websocket.close()
+
+    async def answer_into(self, message: str, queue: asyncio.Queue):
+        # Answers wait for space in the queue, only events are dropped
+        await queue.put(json.dumps(await self.answer(message)))
+
+    async def answer(self, message: str | bytes) -> dict:
+        request_id = None
+        try:
+            request = json.loads(message)
+            if not isinstance(request, dict):
+                raise RemoteError("Requests are JSON objects")
+            request_id = request.get("id")
+            params = request.get("params") or {}
+            result = await self.dispatch(request.get("method"), params)
+        except (RemoteError, KeyError, TypeError, ValueError) as e:
+            return {"id": request_id, "error": str(e) or type(e).__name__}
+        except Exception as e:
+            # Any failing command gets an answer, the client would wait for it forever
+            log.error(f"Request {request_id} failed: {type(e).__name__}: {e}")
+            return {"id": request_id, "error": f"{type(e).__name__}: {e}"}
+        return {"id": request_id, "result": result}
+
+    async def dispatch(self, method: str, params: dict):
+        if method in self.queries:
+            published = self.published
+            if published is None:
+                raise RemoteError("The library is not loaded yet")
+            return self.queries[method](published, **params)
+        if method in COMMANDS:
+            if self.executor is None:
+                raise RemoteError("The player cannot be controlled")
+            return await asyncio.wrap_future(self.executor.submit(method, params))
+        raise RemoteError(f"Unknown method {method}")
+
+    def search(
+        self,
+        published: Published,
+        text: str,
+        limit: int = RemoteSettings.result_limit,
+    ) -> list:
+        """Tracks whose artist, title, album or genre contain all words of text."""
+        words = text.casefold().split()
+        results = []
+        for path, search_text in published.search_texts:
+            if all(word in search_text for word in words):
+                results.append(track_info(published.library.by_path[path]))
+                if len(results) >= limit:
+                    break
+        return results
+
+    def bpm_range(
+        self,
+        published: Published,
+        low: float,
+        high: float,
+        limit: int = RemoteSettings.result_limit,
+    ) -> list:
+        predicate = Rule("bpm", "between", (str(low), str(high))).predicate
+        paths = []
+        for bpm, tracks in published.library.index("bpm").items():
+            if predicate(bpm):
+                paths.extend(track.path for track in tracks)
+        paths.sort()
+        return [track_info(published.library.by_path[path]) for path in paths[:limit]]
+
+    def list_playlists(self, published: Published) -> list:
+        return [
+            {"name": name, "length": len(playlist)}
+            for name, playlist in published.playlists.items()
+        ]
+
+    def playlist(self, published: Published, name: str) -> list:
+        if name not in published.playlists:
+            raise RemoteError(f"Unknown playlist {name}")
+        return [track_info(track) for track in published.playlists[name]]
+
+    def track(self, published: Published, path: str) -> dict:
+        if path not in published.library.by_path:
+            raise RemoteError(f"Unknown track {path}")
+        return track_info(published.library.by_path[path])
+
+
+class ImmediateExecutor:
+    """Runs commands right away in the server thread, for servers without a GUI."""
+
+    def __init__(self, handler) -> None:
+        self.handler = handler
+
+    def submit(self, method: str, params: dict) -> Future:
+        future = Future()
+        try:
+            future.set_result(self.handler(method, params))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+
+class RemoteClient:
+    """WebSocket client of the control API for scripts, e.g.
+
+    client = await RemoteClient.connect()
+    tracks = await client.request("search", text="deep house")
+    """
+
+    def __init__(self, websocket: WebSocket) -> None:
+        self.websocket = websocket
+        self.next_id = 0
+        self.pending: dict[int, asyncio.Future] = dict()
+        self.events: asyncio.Queue = asyncio.Queue()
+        self.receiver = asyncio.ensure_future(self.receive())
+
+    @classmethod
+    async def connect(
+        cls, host: str = RemoteSettings.host, port: int = RemoteSettings.port
+    ) -> "RemoteClient":
+        reader, writer = await asyncio.open_connection(host, port)
+        key = base64.b64encode(os.urandom(16)).decode()
+        writer.write(
+            (
+                "GET /ws HTTP/1.1\r\n"
+                f"Host: {host}:{port}\r\n"
+                "Upgrade: websocket\r\n"
+                "Connection: Upgrade\r\n"
+                f"Sec-WebSocket-Key: {key}\r\n"
+                "Sec-WebSocket-Version: 13\r\n\r\n"
+            ).encode("latin-1")
+        )
+        await writer.drain()
+        status = (await reader.readuntil(b"\r\n\r\n")).split(b"\r\n")[0]
+        if b" 101 " not in status:
+            writer.close()
+            raise RemoteError(f"Handshake failed: {status.decode('latin-1')}")
+        return cls(WebSocket(reader, writer, client=True))
+
+    async def receive(self):
+        while (message := await self.websocket.receive()) is not None:
+            data = json.loads(message)
+            if "event" in data:
+                await self.events.put(data)
+                continue
+            future = self.pending.pop(data.get("id"), None)
+            if future is None or future.done():
+                continue
+            if "error" in data:
+                future.set_exception(RemoteError(data["error"]))
+            else:
+                future.set_result(data["result"])
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("The connection was closed"))
+
+    async def request(self, method: str, **params):
+        self.next_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self.pending[self.next_id] = future
+        await self.websocket.send(
+            json.dumps({"id": self.next_id, "method": method, "params": params})
+        )
+        return await future
+
+    async def next_event(self, timeout: float | None = None) -> dict:
+        return await asyncio.wait_for(self.events.get(), timeout)
+
+    async def close(self):
+        await self.websocket.close()
+        self.receiver.cancel()
+
+
+def position_throttle(interval: float = RemoteSettings.position_interval):
+    """Returns a function that is True at most once per interval, for position events."""
+    last = [0.0]
+
+    def due() -> bool:
+        now = time.monotonic()
+        if now - last[0] < interval:
+            return False
+        last[0] = now
+        return True
+
+    return due
@@ -0,0 +1,143 @@
+import math
+import time
+
+import numpy as np
+from audio_track import AudioTrack, parse_float
+from logger import Logger
+from settings import LoggerSettings, SequencingSettings
+
+log = Logger("Sequencing", LoggerSettings.log_level)
+
+
+def track_arrays(tracks: list[AudioTrack]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """log2 of the BPM, Camelot number and Camelot letter ("B" is 1) of the tracks,
+    NaN where a track lacks the tag."""
+    bpms = np.full(len(tracks), np.nan)
+    numbers = np.full(len(tracks), np.nan)
+    letters = np.full(len(tracks), np.nan)
+    for i, track in enumerate(tracks):
+        bpm = parse_float(track.bpm)
+        if bpm and bpm > 0:
+            bpms[i] = math.log2(bpm)
+        if track.camelot:
+            numbers[i] = int(track.camelot[:-1])
+            letters[i] = track.camelot[-1] == "B"
+    return bpms, numbers, letters
+
+
+def transition_costs(
+    tracks: list[AudioTrack],
+    bpm_weight: float = SequencingSettings.bpm_weight,
+    key_weight: float = SequencingSettings.key_weight,
+) -> np.ndarray:
+    """Cost of playing track j after track i for all pairs, shape (n, n).
+
+    A BPM jump costs bpm_weight per 4 % of tempo change. Harmonic mixes (same key,
+    one step on the Camelot wheel or the relative key) are free, every further step
+    costs key_weight. Missing tags cost SequencingSettings.missing_cost.
+    """
+    bpms, numbers, letters = track_arrays(tracks)
+    bpm_cost = np.abs(bpms[:, None] - bpms[None, :]) / math.log2(1.04)
+    steps = np.abs(numbers[:, None] - numbers[None, :])
+    steps = np.minimum(steps, 12 - steps)
+    mode_change = np.abs(letters[:, None] - letters[None, :])
+    key_cost = np.maximum(steps + mode_change - 1, 0)
+    costs = bpm_weight * np.nan_to_num(bpm_cost, nan=SequencingSettings.missing_cost)
+    costs += key_weight * np.nan_to_num(key_cost, nan=SequencingSettings.missing_cost)
+    np.fill_diagonal(costs, 0.0)
+    return costs
+
+
+def nearest_neighbour(costs: np.ndarray, start: int, end: int | None) -> list[int]:
+    """Greedy path from start that always continues with the cheapest unused track."""
+    n = len(costs)
+    used = np.zeros(n, dtype=bool)
+    used[start] = True
+    if end is not None:
+        used[end] = True
+    path = [start]
+    for _ in range(n - used.sum()):
+        candidates = np.where(used, np.inf, costs[path[-1]])
+        following = int(np.argmin(candidates))
+        used[following] = True
+        path.append(following)
+    if end is not None and end != start:
+        path.append(end)
+    return path
+
+
+def two_opt(costs: np.ndarray, path: list[int], max_seconds: float) -> list[int]:
+    """Reverses segments of the path as long as that makes it cheaper. The first and
+    last element stay in place. Costs have to be symmetric.
+
+    For every start of a segment the gains of all its possible ends are computed at
+    once, a pass over the path is O(n) NumPy operations.
+    """
+    path = np.array(path)
+    n = len(path)
+    deadline = time.perf_counter() + max_seconds
+    improved = True
+    while improved and time.perf_counter() < deadline:
+        improved = False
+        for i in range(1, n - 2):
+            # Reversing path[i:j+1] replaces the edges (i-1, i) and (j, j+1)
+            # by (i-1, j) and (i, j+1)
+            before, first = path[i - 1], path[i]
+            ends = path[i + 1 : n - 1]
+            afters = path[i + 2 : n]
+            gain = (
+                costs[before, first]
+                + costs[ends, afters]
+                - costs[before, ends]
+                - costs[first, afters]
+            )
+            best = int(np.argmax(gain))
+            if gain[best] > 1e-9:
+                j = i + 1 + best
+                path[i : j + 1] = path[i : j + 1][::-1].copy()
+                improved = True
+    return path.tolist()
+
+
+def sequence(
+    tracks: list[AudioTrack],
+    opener: int | None = None,
+    closer: int | None = None,
+    max_seconds: float = SequencingSettings.max_seconds,
+) -> list[int]:
+    """Orders tracks for smooth BPM and key transitions.
+
+    Args:
+        tracks (list[AudioTrack]): Tracks of a playlist.
+        opener (int, optional): Index of the track that has to stay first.
+        closer (int, optional): Index of the track that has to stay last.
+        max_seconds (float, optional): Time limit of the optimization.
+
+    Returns:
+        list[int]: New order as indexes into tracks, for TrackCollection.reorder.
+    """
+    n = len(tracks)
+    if opener is not None and opener == closer:
+        raise ValueError("The opener and the closer have to be different tracks")
+    if n < 3:
+        return list(range(n))
+    costs = transition_costs(tracks)
+    # A free end is a virtual track that is free to reach from and to every track,
+    # so both ends of the path are fixed for the optimization
+    virtual = n
+    costs = np.pad(costs, ((0, 1), (0, 1)))
+    start = virtual if opener is None else opener
+    end = virtual if closer is None else closer
+    if start == virtual:
+        path = nearest_neighbour(costs[:n, :n], 1 if closer == 0 else 0, closer)
+        path = [virtual, *path]
+    else:
+        path = nearest_neighbour(costs[:n, :n], start, closer)
+    if end == virtual:
+        path.append(virtual)
+    path = two_opt(costs, path, max_seconds)
+    order = [index for index in path if index != virtual]
+    before = costs[np.arange(n - 1), np.arange(1, n)].sum()
+    after = costs[order[:-1], order[1:]].sum()
+    log.info(f"Sequenced {n} tracks, transition cost {before:.1f} -> {after:.1f}")
+    return order
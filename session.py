@@ -0,0 +1,243 @@
+import json
+import mmap
+import os
+import struct
+import time
+
+import numpy as np
+from audio_track import AudioTrack, TrackCollection
+from logger import Logger
+from settings import IOSettings, LoggerSettings
+from utility import openPlaylist, paused_gc
+
+log = Logger("Session", LoggerSettings.log_level)
+
+MAGIC = b"DJSNAP02"
+# Magic bytes and the length of the JSON header that follows them
+PREFIX = struct.Struct("<8sI")
+# Size and modification time of files that did not exist when the snapshot was saved
+MISSING_SIGNATURE = (-1, -1)
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+class Session:
+    """The library, its playlists, the focused collection and the current track of
+    the last run of the player."""
+
+    def __init__(
+        self,
+        library: TrackCollection,
+        focused: TrackCollection | None = None,
+        current_path: str | None = None,
+        signatures: dict[str, tuple[int, int]] | None = None,
+    ) -> None:
+        self.library = library
+        # None is the library itself
+        self.focused = focused
+        self.current_path = current_path
+        # Path -> (size, mtime_ns) when the snapshot was saved
+        self.signatures = signatures or dict()
+
+
+def file_mtime(path: str | None) -> int:
+    if path is None:
+        return -1
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return -1
+
+
+def stat_signature(path: str) -> tuple[int, int]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return MISSING_SIGNATURE
+    return stat.st_size, stat.st_mtime_ns
+
+
+def padded_length(length: int) -> int:
+    # Sections start at multiples of 8 bytes, so their arrays are aligned
+    return length + (-length % 8)
+
+
+def padded(data: bytes) -> bytes:
+    return data + bytes(padded_length(len(data)) - len(data))
+
+
+def save_session(
+    session: Session,
+    path: str = IOSettings.session_file,
+    signatures: dict[str, tuple[int, int]] | None = None,
+):
+    """Writes the session as binary snapshot.
+
+    The file consists of a small JSON header, the size and modification time of every
+    track as int64 array, the tag values of all tracks as one block of NUL separated
+    UTF-8 strings and the track indexes of every collection as int32 arrays.
+
+    Args:
+        signatures (dict, optional): Known (size, mtime_ns) of files, the others are read with os.stat.
+    """
+    start = time.perf_counter()
+    library = session.library
+    tracks = list(library.tracks)
+    index = {track.path: i for i, track in enumerate(tracks)}
+    collections = list(library.playlists.values())
+    if session.focused is not None and session.focused not in collections:
+        collections.append(session.focused)
+    for collection in collections:
+        for track in collection:
+            if track.path not in index:
+                index[track.path] = len(tracks)
+                tracks.append(track)
+
+    signatures = signatures or dict()
+    signature_array = np.array(
+        [signatures.get(track.path) or stat_signature(track.path) for track in tracks],
+        dtype=np.int64,
+    ).reshape(-1, 2)
+    strings = "\0".join(
+        value.replace("\0", "") for track in tracks for value in track.snapshot_values()
+    ).encode("utf-8")
+    sections = [signature_array.tobytes(), strings]
+    collection_headers = []
+    for collection in collections:
+        indexes = np.array([index[track.path] for track in collection], dtype=np.int32)
+        sections.append(indexes.tobytes())
+        collection_headers.append(
+            {
+                "name": collection.name,
+                "file": collection.file,
+                "file_mtime_ns": file_mtime(collection.file),
+                "playlist": collection.name in library.playlists,
+                "focused": collection is session.focused,
+                "length": len(collection),
+            }
+        )
+    header = {
+        "tracks": len(tracks),
+        "library_tracks": len(library),
+        "current_path": session.current_path,
+        "collections": collection_headers,
+        "section_lengths": [len(section) for section in sections],
+    }
+    header_bytes = json.dumps(header).encode("utf-8")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f"{path}.tmp", "wb") as f:
+        f.write(PREFIX.pack(MAGIC, len(header_bytes)))
+        f.write(bytes(-PREFIX.size % 8))
+        f.write(padded(header_bytes))
+        for section in sections:
+            f.write(padded(section))
+    os.replace(f"{path}.tmp", path)
+    log.info(
+        f"Saved the session with {len(tracks)} tracks in {time.perf_counter() - start:.2f} s"
+    )
+
+
+def load_session(path: str = IOSettings.session_file) -> Session:
+    """Restores a session from its snapshot without opening the audio files.
+
+    Playlists whose file changed since the snapshot are read from the file again.
+    Changes of the audio files are found by changed_paths.
+
+    Raises:
+        SnapshotError: The file is no valid snapshot.
+        OSError: The file cannot be read.
+    """
+    start = time.perf_counter()
+    with paused_gc():
+        return read_session(path, start)
+
+
+def read_session(path: str, start: float) -> Session:
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        if len(mm) < PREFIX.size:
+            raise SnapshotError(f"{path} is truncated")
+        magic, header_length = PREFIX.unpack_from(mm)
+        if magic != MAGIC:
+            raise SnapshotError(f"{path} is no session snapshot of this version")
+        offset = PREFIX.size + (-PREFIX.size % 8)
+        try:
+            header = json.loads(bytes(mm[offset : offset + header_length]))
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            raise SnapshotError(f"{path} has a broken header: {e}") from e
+        offset += padded_length(header_length)
+        if offset + sum(map(padded_length, header["section_lengths"])) > len(mm):
+            raise SnapshotError(f"{path} is truncated")
+        n = header["tracks"]
+        lengths = iter(header["section_lengths"])
+        length = next(lengths)
+        signatures = np.frombuffer(mm, np.int64, 2 * n, offset).reshape(n, 2).tolist()
+        offset += padded_length(length)
+        length = next(lengths)
+        strings = mm[offset : offset + length].decode("utf-8").split("\0")
+        offset += padded_length(length)
+        collection_indexes = []
+        for collection, length in zip(header["collections"], lengths):
+            # Converted right away, the mmap cannot be closed while arrays use it
+            collection_indexes.append(
+                np.frombuffer(mm, np.int32, collection["length"], offset).tolist()
+            )
+            offset += padded_length(length)
+
+    # Every track has the same number of values, see AudioTrack.snapshot_values
+    width = len(strings) // max(n, 1)
+    if n and len(strings) != n * width:
+        raise SnapshotError(f"{path} has broken track values")
+    tracks = [
+        AudioTrack.from_snapshot(strings[i : i + width])
+        for i in range(0, n * width, width)
+    ]
+    library = TrackCollection(tracks[: header["library_tracks"]])
+    focused = None
+    for collection, indexes in zip(header["collections"], collection_indexes):
+        members = [tracks[i] for i in indexes]
+        file = collection["file"]
+        if file is not None and file_mtime(file) != collection["file_mtime_ns"]:
+            members = playlist_tracks(file, library)
+        playlist = TrackCollection(
+            members, name=collection["name"], parent=True, file=file
+        )
+        if collection["playlist"]:
+            library.playlists[playlist.name] = playlist
+        if collection["focused"]:
+            focused = playlist
+    log.info(
+        f"Loaded the session with {n} tracks in {time.perf_counter() - start:.2f} s"
+    )
+    return Session(
+        library,
+        focused,
+        header["current_path"],
+        {track.path: tuple(signature) for track, signature in zip(tracks, signatures)},
+    )
+
+
+def playlist_tracks(file: str, library: TrackCollection) -> list[AudioTrack]:
+    """Tracks of a playlist file, the ones of the library are reused."""
+    log.info(f"The playlist {file} changed since the last session")
+    try:
+        paths = openPlaylist(file)
+    except OSError as e:
+        log.warning(f"Could not read the playlist {file}: {e}")
+        return []
+    return [
+        library.by_path.get(path) or AudioTrack(path)
+        for path in paths
+        if path in library.by_path or os.path.isfile(path)
+    ]
+
+
+def changed_paths(signatures: dict[str, tuple[int, int]]) -> list[str]:
+    """Paths whose size or modification time differ from the snapshot. Reads only the
+    file system metadata, meant to run in a background thread after the start."""
+    return [
+        path
+        for path, signature in signatures.items()
+        if stat_signature(path) != tuple(signature)
+    ]
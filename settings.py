@@ -7,10 +7,196 @@ class UISettings:
         self.window_title = "ID3 Tagedit"
         self.screen_width = 800
         self.screen_height = 600
+        # Restore the library and playlists of the last run from its snapshot
+        self.restore_session = True
+        # Serve the control API of remote.RemoteServer on localhost
+        self.remote_control = False
+
+
+class TableSettings:
+    # Rows added to the track table at once, larger collections are filled in
+    # batches between events so the window stays responsive
+    batch_size = 2000
 
 
 class IOSettings:
     wd = os.path.abspath(os.path.dirname(__file__))
+    # DJMP_CACHE_DIR moves the session and the caches, e.g. for the tests
+    cache_dir = os.environ.get("DJMP_CACHE_DIR") or os.path.join(wd, "cache")
+    cache_file = os.path.join(cache_dir, "cache.sqlite")
+    journal_file = os.path.join(cache_dir, "journal.jsonl")
+    smart_crates_file = os.path.join(cache_dir, "smart_crates.json")
+    session_file = os.path.join(cache_dir, "session.bin")
+    history_file = os.path.join(cache_dir, "history.bin")
+    energy_file = os.path.join(cache_dir, "energy.bin")
+    # Folders of the library and their indexes, see library.FederatedLibrary
+    roots_file = os.path.join(cache_dir, "roots.json")
+    roots_dir = os.path.join(cache_dir, "roots")
+    preview_file = os.path.join(cache_dir, "preview.pcm")
+
+
+class AnalysisSettings:
+    ffmpeg = "ffmpeg"
+    sample_rate = 22050
+    # Key detection only needs the frequencies up to a few kHz
+    key_sample_rate = 11025
+    # Loudness in LUFS all tracks are brought to during playback
+    target_loudness = -14.0
+
+
+class BeatgridSettings:
+    # Onsets of drums are still clear at this rate
+    sample_rate = 11025
+    # Only the start of a track is analyzed, the grid assumes a constant tempo
+    max_duration = 240.0
+    # One octave, tempos outside are detected doubled or halved
+    min_bpm = 88.0
+    max_bpm = 176.0
+    beats_per_bar = 4
+
+
+class EnergySettings:
+    sample_rate = 11025
+    # Length of the blocks the energy curves have one value for
+    block_seconds = 1.0
+    # Share of the spectral flux in the combined energy, the rest is the loudness
+    flux_weight = 0.5
+    # Share of unused curves in the binary file above which it is compacted
+    max_unused_share = 0.5
+
+
+class PreviewSettings:
+    sample_rate = 44100
+    segment_seconds = 12.0
+    # Segments kept at once, 12 s of 16 bit stereo at 44.1 kHz take 2 MB each
+    slots = 48
+    # Start of the preview of tracks without energy curves or a clear drop
+    offset = 60.0
+    # Seconds before the drop the preview starts
+    pre_roll = 2.0
+    # Seconds of mean energy before and after a block that a drop is found from
+    drop_window = 8.0
+    # Rise of the combined energy, from 0 to 255, that counts as a drop
+    min_drop_rise = 30.0
+    # Rows above and below the visible ones whose previews are decoded in advance
+    prefetch_rows = 10
+    workers = 2
+    # Part of the name of the audio output for previews, e.g. "Headphones", the
+    # default output if empty or not found
+    output_device = ""
+
+
+class ArtworkSettings:
+    directory = os.path.join(IOSettings.cache_dir, "artwork")
+    # Edge lengths of the thumbnails in pixels
+    sizes = (32, 128)
+    table_size = 32
+    memory_cache_bytes = 64 * 1024 * 1024
+    workers = 4
+
+
+class ExportSettings:
+    # Volume of the paths that are not on a drive in /Volumes, Traktor names the
+    # system drive of macOS after it
+    traktor_system_volume = "Macintosh HD"
+
+
+class SyncSettings:
+    # Directory on the target drive the tracks are copied to
+    music_directory = "Music"
+    chunk_size = 4 * 1024 * 1024
+    workers = 4
+
+
+class HealthSettings:
+    # Number of positions in the audio data of an MP3 that are checked for frames
+    samples = 32
+    # Junk in front of the first frame that is tolerated
+    header_search_bytes = 64 * 1024
+    workers = 8
+
+
+class QualitySettings:
+    # Decoded windows per track and their length in seconds
+    windows = 6
+    window_seconds = 5.0
+    # The cutoff is where the level falls this far below the level of the mids
+    cutoff_drop_db = 60.0
+    # Fall of the level within 1 kHz around the cutoff that marks an encoder lowpass
+    cliff_db = 20.0
+
+
+class RecommendationSettings:
+    # Number of suggested tracks
+    count = 20
+    # Weights of the features in the similarity, see recommend.track_features
+    bpm_weight = 1.0
+    key_weight = 0.5
+    genre_weight = 4.0
+    year_weight = 0.25
+    loudness_weight = 0.25
+
+
+class SequencingSettings:
+    # Cost of a transition per 4 % of tempo change and per step on the Camelot wheel
+    bpm_weight = 1.0
+    key_weight = 1.0
+    # Cost of a transition from or to a track without BPM or key
+    missing_cost = 2.0
+    max_seconds = 1.0
+
+
+class JournalSettings:
+    # Number of edits that can be undone
+    max_entries = 1000
+
+
+class LibrarySettings:
+    # Seconds between the checks which roots of the library are mounted
+    mount_check_interval = 2.0
+
+
+class InferenceSettings:
+    # Patterns of file names without the extension, the first that matches is used.
+    # Placeholders are tag names or their aliases track, label and year, {*} skips a part.
+    file_patterns = (
+        "{track} - {artist} - {title}",
+        "{track}. {artist} - {title}",
+        "{track} - {title}",
+        "{track}. {title}",
+        "{artist} - {title}",
+        "{title}",
+    )
+    # Patterns of the last folders of a path, separated by "/"
+    folder_patterns = (
+        "{artist} - {album} ({year})",
+        "{year} - {album}",
+        "{label}/{year}",
+    )
+    workers = 8
+
+
+class HistorySettings:
+    # Plays between two checkpoints of the play counts
+    checkpoint_interval = 1000
+    # Tracks played shorter than this many seconds are not recorded
+    min_played = 30.0
+    # Tracks played within this many days count as recently played
+    recent_days = 1.0
+
+
+class RemoteSettings:
+    # Only local clients can reach the control API
+    host = "127.0.0.1"
+    port = 8765
+    # Minimum seconds between two position events
+    position_interval = 0.25
+    # Messages waiting for a client, events are dropped for clients that fall behind
+    client_queue_size = 100
+    max_message_bytes = 1024 * 1024
+    max_header_bytes = 16 * 1024
+    # Tracks returned by a query at most
+    result_limit = 500
 
 
 class LoggerSettings:
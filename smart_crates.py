@@ -0,0 +1,263 @@
+import json
+import os
+
+from audio_track import (
+    AudioTrack,
+    TrackCollection,
+    normalize_genre,
+    split_genres,
+    to_camelot,
+)
+from logger import Logger
+from settings import IOSettings, LoggerSettings
+
+log = Logger("SmartCrates", LoggerSettings.log_level)
+
+FIELDS = ("title", "artist", "album", "date", "genre", "bpm", "key")
+OPERATORS = ("is", "is_empty", "contains", "between", ">=", "<=")
+
+
+def to_number(value: str) -> float | None:
+    """Converts tag values like "126", "125.5" or "2021-03-12" to a number."""
+    value = value.strip()
+    if len(value) >= 4 and value[:4].isdigit() and not value.isdigit():
+        # Dates are compared by their year
+        value = value[:4]
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+class Rule:
+    def __init__(self, field: str, operator: str, value=None) -> None:
+        if field not in FIELDS:
+            raise ValueError(f"Unknown field '{field}', choose one of {FIELDS}")
+        if operator not in OPERATORS:
+            raise ValueError(
+                f"Unknown operator '{operator}', choose one of {OPERATORS}"
+            )
+        self.field = field
+        self.operator = operator
+        self.value = value
+        self.predicate = self.compile()
+
+    def __str__(self) -> str:
+        if self.operator == "is_empty":
+            return f"{self.field} is_empty"
+        if self.operator == "between":
+            return f"{self.field} between {self.value[0]} {self.value[1]}"
+        return f"{self.field} {self.operator} {self.value}"
+
+    @classmethod
+    def parse(cls, text: str) -> "Rule":
+        """Parses a rule like "genre is_empty", "bpm between 120 128", "date >= 2020" or "artist contains Daft Punk"."""
+        parts = text.split(maxsplit=2)
+        if len(parts) < 2:
+            raise ValueError(f"Invalid rule: '{text}'")
+        field, operator = parts[0].lower(), parts[1].lower()
+        value = parts[2] if len(parts) == 3 else None
+        if operator == "between":
+            if value is None or len(value.split()) != 2:
+                raise ValueError(f"'between' needs two values: '{text}'")
+            value = tuple(value.split())
+        elif operator != "is_empty" and value is None:
+            raise ValueError(f"Missing value: '{text}'")
+        return cls(field, operator, value)
+
+    def to_dict(self) -> dict:
+        return {"field": self.field, "operator": self.operator, "value": self.value}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Rule":
+        value = data.get("value")
+        if isinstance(value, list):
+            value = tuple(value)
+        return cls(data["field"], data["operator"], value)
+
+    def compile(self):
+        """Returns a predicate on a single tag value of the rule's field."""
+        if self.operator == "is_empty":
+            return lambda key: key == ""
+        if self.operator == "is":
+            if self.field == "genre":
+                genre = normalize_genre(self.value)
+                return lambda key: genre in map(normalize_genre, split_genres(key))
+            if self.field == "key" and to_camelot(self.value):
+                # "8A", "Am" and "A minor" are the same key
+                camelot = to_camelot(self.value)
+                return lambda key: to_camelot(key) == camelot
+            value = self.value.lower()
+            return lambda key: key.lower() == value
+        if self.operator == "contains":
+            value = self.value.lower()
+            return lambda key: value in key.lower()
+
+        values = self.value if self.operator == "between" else [self.value]
+        numbers = [to_number(str(value)) for value in values]
+        if None in numbers:
+            raise ValueError(
+                f"'{self.operator}' needs numeric values, got {self.value}"
+            )
+        if self.operator == "between":
+            low, high = sorted(numbers)
+        elif self.operator == ">=":
+            low, high = numbers[0], float("inf")
+        else:
+            low, high = float("-inf"), numbers[0]
+
+        def in_range(key):
+            number = to_number(key)
+            return number is not None and low <= number <= high
+
+        return in_range
+
+    def evaluate(self, collection: TrackCollection) -> set[str]:
+        """Returns the paths of all matching tracks. Only the distinct values of the
+        collection index are tested, so the costs scale with the number of distinct tags.
+        A genre is looked up in the genre token index, costing only its tracks.
+        """
+        if self.field == "genre" and self.operator == "is":
+            # Copied, the index changes with the collection
+            return set(collection.get_paths_by_genre_token(self.value))
+        index = dict(collection.indexes())[self.field]
+        paths = set()
+        for key, tracks in index.items():
+            if self.predicate(key):
+                paths.update(track.path for track in tracks)
+        return paths
+
+    def matches(self, track: AudioTrack) -> bool:
+        return self.predicate(getattr(track, self.field))
+
+
+class SmartCrate:
+    """A playlist defined by rules that keeps its members up to date when tracks of the
+    collection are added, removed or retagged."""
+
+    def __init__(self, name: str, rules: list[Rule], match_all=True) -> None:
+        self.name = name
+        self.rules = rules
+        self.match_all = match_all
+        self.collection = None
+        self.members: dict[str, AudioTrack] = dict()
+
+    def __len__(self):
+        return len(self.members)
+
+    def __str__(self) -> str:
+        joiner = " and " if self.match_all else " or "
+        return joiner.join(str(rule) for rule in self.rules)
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "match_all": self.match_all,
+            "rules": [rule.to_dict() for rule in self.rules],
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "SmartCrate":
+        return cls(
+            data["name"],
+            [Rule.from_dict(rule) for rule in data["rules"]],
+            data.get("match_all", True),
+        )
+
+    @classmethod
+    def parse(cls, name: str, text: str, match_all=True) -> "SmartCrate":
+        """Creates a crate from rules separated by ";", e.g. "genre is_empty; bpm between 120 128"."""
+        rules = [Rule.parse(rule) for rule in text.split(";") if rule.strip()]
+        if not rules:
+            raise ValueError("A smart crate needs at least one rule")
+        return cls(name, rules, match_all)
+
+    def matches(self, track: AudioTrack) -> bool:
+        if self.match_all:
+            return all(rule.matches(track) for rule in self.rules)
+        return any(rule.matches(track) for rule in self.rules)
+
+    def evaluate(self, collection: TrackCollection) -> set[str]:
+        results = [rule.evaluate(collection) for rule in self.rules]
+        if not results:
+            return set()
+        if self.match_all:
+            return set.intersection(*results)
+        return set.union(*results)
+
+    def attach(self, collection: TrackCollection):
+        """Evaluates the crate against the collection and follows its changes."""
+        self.detach()
+        self.collection = collection
+        paths = self.evaluate(collection)
+        self.members = {
+            path: collection.by_path[path]
+            for path in collection.by_path
+            if path in paths
+        }
+        collection.add_listener(self.on_collection_changed)
+
+    def detach(self):
+        if self.collection is not None:
+            self.collection.remove_listener(self.on_collection_changed)
+        self.collection = None
+
+    def on_collection_changed(self, event: str, track: AudioTrack):
+        if event == "reorder":
+            return
+        if event != "remove" and self.matches(track):
+            self.members[track.path] = track
+        else:
+            self.members.pop(track.path, None)
+
+    def to_collection(self) -> TrackCollection:
+        return TrackCollection(list(self.members.values()), name=self.name, parent=True)
+
+
+class SmartCrateStore:
+    def __init__(self, path: str = IOSettings.smart_crates_file) -> None:
+        self.path = path
+        self.crates: dict[str, SmartCrate] = dict()
+
+    def __iter__(self):
+        return iter(self.crates.values())
+
+    def __getitem__(self, name: str) -> SmartCrate:
+        return self.crates[name]
+
+    def load(self):
+        try:
+            with open(self.path, "r") as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            return
+        for crate_data in data:
+            try:
+                crate = SmartCrate.from_dict(crate_data)
+            except (KeyError, ValueError) as e:
+                log.warning(f"Skipping invalid smart crate {crate_data}: {e}")
+                continue
+            self.crates[crate.name] = crate
+
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as file:
+            json.dump([crate.to_dict() for crate in self], file, indent=2)
+        os.replace(tmp, self.path)
+
+    def add(self, crate: SmartCrate):
+        if crate.name in self.crates:
+            self.crates[crate.name].detach()
+        self.crates[crate.name] = crate
+        self.save()
+
+    def remove(self, name: str):
+        crate = self.crates.pop(name, None)
+        if crate is not None:
+            crate.detach()
+            self.save()
+
+    def attach(self, collection: TrackCollection):
+        for crate in self:
+            crate.attach(collection)
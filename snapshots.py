@@ -0,0 +1,560 @@
+import threading
+from collections.abc import Mapping
+from typing import NamedTuple
+
+from audio_track import AudioTrack, TrackCollection, normalize_genre
+from cue_points import format_cues
+from logger import Logger
+from settings import LoggerSettings
+from utility import paused_gc
+
+log = Logger("Snapshots", LoggerSettings.log_level)
+
+BITS = 5
+MASK = (1 << BITS) - 1
+HASH_BITS = 64
+# Paths per chunk of the track order, appending copies only the last chunk
+CHUNK_SIZE = 256
+MISSING = object()
+# Indexed fields, like TrackCollection.indexes
+FIELDS = ("title", "artist", "album", "date", "genre", "bpm", "key")
+# Name of the index of the normalized genre tokens
+GENRE_TOKENS = "genre_tokens"
+
+
+class Node:
+    """Inner node of a PersistentMap, maps 5 bits of the key hashes to children.
+
+    Nodes are shared between versions of a map and never change, except for the
+    nodes a MapEditor created itself (owner), which it may change in place.
+    """
+
+    __slots__ = ("children", "owner")
+
+    def __init__(self, children: dict, owner=None) -> None:
+        # Slot -> Node, Bucket or leaf tuple (hash, key, value)
+        self.children = children
+        self.owner = owner
+
+
+class Bucket:
+    """Leaves of different keys with the same hash."""
+
+    __slots__ = ("leaves",)
+
+    def __init__(self, leaves: tuple) -> None:
+        self.leaves = leaves
+
+
+def key_hash(key) -> int:
+    return hash(key) & ((1 << HASH_BITS) - 1)
+
+
+def editable(node: Node, owner) -> Node:
+    if owner is not None and node.owner is owner:
+        return node
+    return Node(dict(node.children), owner)
+
+
+def merge_leaves(first: tuple, second: tuple, shift: int, owner) -> Node | Bucket:
+    if shift >= HASH_BITS:
+        return Bucket((first, second))
+    first_slot = (first[0] >> shift) & MASK
+    second_slot = (second[0] >> shift) & MASK
+    if first_slot == second_slot:
+        return Node(
+            {first_slot: merge_leaves(first, second, shift + BITS, owner)}, owner
+        )
+    return Node({first_slot: first, second_slot: second}, owner)
+
+
+def lookup(node: Node, h: int, key, default):
+    shift = 0
+    while True:
+        child = node.children.get((h >> shift) & MASK)
+        if child is None:
+            return default
+        if type(child) is Node:
+            node = child
+            shift += BITS
+        elif type(child) is Bucket:
+            for _, leaf_key, value in child.leaves:
+                if leaf_key == key:
+                    return value
+            return default
+        elif child[0] == h and child[1] == key:
+            return child[2]
+        else:
+            return default
+
+
+def assoc(node: Node, shift: int, h: int, key, value, owner) -> tuple[Node, bool]:
+    """Node with the key set to value, shares all untouched children.
+
+    Returns:
+        tuple[Node, bool]: The new node and whether the key was added.
+    """
+    slot = (h >> shift) & MASK
+    child = node.children.get(slot)
+    leaf = (h, key, value)
+    if child is None:
+        new_child, added = leaf, True
+    elif type(child) is Node:
+        new_child, added = assoc(child, shift + BITS, h, key, value, owner)
+        if new_child is child:
+            # Changed in place, so this node belongs to the editor as well
+            return node, added
+    elif type(child) is Bucket:
+        leaves = tuple(other for other in child.leaves if other[1] != key)
+        added = len(leaves) == len(child.leaves)
+        new_child = Bucket((*leaves, leaf))
+    elif child[0] == h and child[1] == key:
+        if child[2] is value:
+            return node, False
+        new_child, added = leaf, False
+    else:
+        new_child, added = merge_leaves(child, leaf, shift + BITS, owner), True
+    node = editable(node, owner)
+    node.children[slot] = new_child
+    return node, added
+
+
+def dissoc(node: Node, shift: int, h: int, key, owner) -> tuple[Node, bool]:
+    """Node without the key, shares all untouched children.
+
+    Returns:
+        tuple[Node, bool]: The new node and whether the key was removed.
+    """
+    slot = (h >> shift) & MASK
+    child = node.children.get(slot)
+    if child is None:
+        return node, False
+    if type(child) is Node:
+        new_child, removed = dissoc(child, shift + BITS, h, key, owner)
+        if not removed:
+            return node, False
+        if new_child is child and new_child.children:
+            return node, True
+    elif type(child) is Bucket:
+        leaves = tuple(other for other in child.leaves if other[1] != key)
+        if len(leaves) == len(child.leaves):
+            return node, False
+        new_child = Bucket(leaves) if len(leaves) > 1 else leaves[0]
+    elif child[0] == h and child[1] == key:
+        new_child = None
+    else:
+        return node, False
+    node = editable(node, owner)
+    if new_child is None or (type(new_child) is Node and not new_child.children):
+        del node.children[slot]
+    else:
+        node.children[slot] = new_child
+    return node, True
+
+
+def build_node(leaves: list[tuple], shift: int) -> Node:
+    groups = dict()
+    for leaf in leaves:
+        groups.setdefault((leaf[0] >> shift) & MASK, []).append(leaf)
+    children = dict()
+    for slot, group in groups.items():
+        if len(group) == 1:
+            children[slot] = group[0]
+        elif shift + BITS >= HASH_BITS:
+            # All hash bits are used up, the keys have the same hash
+            children[slot] = Bucket(tuple(group))
+        else:
+            children[slot] = build_node(group, shift + BITS)
+    return Node(children)
+
+
+def iter_leaves(child):
+    if type(child) is Node:
+        for grandchild in child.children.values():
+            yield from iter_leaves(grandchild)
+    elif type(child) is Bucket:
+        yield from child.leaves
+    else:
+        yield child
+
+
+def changed_keys(first, second, keys: set):
+    """Adds the keys whose values differ between two children, skips shared ones."""
+    if first is second:
+        return
+    if type(first) is Node and type(second) is Node:
+        for slot in first.children.keys() | second.children.keys():
+            changed_keys(first.children.get(slot), second.children.get(slot), keys)
+        return
+    first_items = {key: value for _, key, value in iter_leaves(first or Bucket(()))}
+    second_items = {key: value for _, key, value in iter_leaves(second or Bucket(()))}
+    for key in first_items.keys() | second_items.keys():
+        if first_items.get(key, MISSING) is not second_items.get(key, MISSING):
+            keys.add(key)
+
+
+class PersistentMap(Mapping):
+    """Immutable hash array mapped trie. set and delete return a new map in
+    O(log n) that shares all untouched nodes with this one, so old versions stay
+    valid and can be read from other threads without locks.
+    """
+
+    __slots__ = ("root", "size")
+
+    def __init__(self, root: Node | None = None, size: int = 0) -> None:
+        self.root = root if root is not None else Node({})
+        self.size = size
+
+    @classmethod
+    def from_items(cls, items) -> "PersistentMap":
+        """Builds the trie in one pass, much faster than setting the keys one by one."""
+        unique = dict(items)
+        leaves = [(key_hash(key), key, value) for key, value in unique.items()]
+        return cls(build_node(leaves, 0), len(leaves))
+
+    def __getitem__(self, key):
+        value = lookup(self.root, key_hash(key), key, MISSING)
+        if value is MISSING:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        return lookup(self.root, key_hash(key), key, default)
+
+    def __contains__(self, key) -> bool:
+        return lookup(self.root, key_hash(key), key, MISSING) is not MISSING
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __iter__(self):
+        for _, key, _ in iter_leaves(self.root):
+            yield key
+
+    def items(self) -> list[tuple]:
+        return [(key, value) for _, key, value in iter_leaves(self.root)]
+
+    def values(self) -> list:
+        return [value for _, _, value in iter_leaves(self.root)]
+
+    def set(self, key, value) -> "PersistentMap":
+        root, added = assoc(self.root, 0, key_hash(key), key, value, None)
+        if root is self.root:
+            return self
+        return PersistentMap(root, self.size + added)
+
+    def delete(self, key) -> "PersistentMap":
+        """Map without the key, the map itself if it lacks the key."""
+        root, removed = dissoc(self.root, 0, key_hash(key), key, None)
+        return PersistentMap(root, self.size - 1) if removed else self
+
+    def edit(self) -> "MapEditor":
+        return MapEditor(self)
+
+    def changed_keys(self, other: "PersistentMap") -> set:
+        """Keys that were added, removed or got another value between the maps.
+        Subtrees both maps share are skipped, so this is O(changes) for versions of
+        the same map."""
+        keys = set()
+        changed_keys(self.root, other.root, keys)
+        return keys
+
+
+class MapEditor:
+    """Applies many changes to a PersistentMap at once. Nodes the editor copied are
+    changed in place by its later changes instead of being copied again."""
+
+    def __init__(self, base: PersistentMap) -> None:
+        self.owner = object()
+        self.root = base.root
+        self.size = base.size
+
+    def get(self, key, default=None):
+        return lookup(self.root, key_hash(key), key, default)
+
+    def set(self, key, value):
+        self.root, added = assoc(self.root, 0, key_hash(key), key, value, self.owner)
+        self.size += added
+
+    def delete(self, key):
+        self.root, removed = dissoc(self.root, 0, key_hash(key), key, self.owner)
+        self.size -= removed
+
+    def finish(self) -> PersistentMap:
+        # The nodes now belong to the map, later changes have to copy them
+        self.owner = object()
+        return PersistentMap(self.root, self.size)
+
+
+class TrackRecord(NamedTuple):
+    """Immutable copy of the tag attributes of an AudioTrack. Reads like the track,
+    e.g. for smart crate rules, recommendations or exports."""
+
+    path: str
+    title: str
+    artist: str
+    album: str
+    date: str
+    genre: str
+    bpm: str
+    key: str
+    camelot: str
+    genres: tuple[str, ...]
+    replaygain: float | None
+    replaygain_peak: float | None
+    # Formatted like the cue tag, see cue_points.parse_cues
+    cues: str
+
+    @property
+    def full_name(self) -> str:
+        return f"{self.artist} - {self.title}"
+
+    @classmethod
+    def from_track(cls, track: AudioTrack) -> "TrackRecord":
+        return cls(
+            track.path,
+            track.title,
+            track.artist,
+            track.album,
+            track.date,
+            track.genre,
+            track.bpm,
+            track.key,
+            track.camelot,
+            tuple(track.genres),
+            track.replaygain,
+            track.replaygain_peak,
+            format_cues(track.cues),
+        )
+
+
+class CollectionSnapshot:
+    """Immutable version of a TrackCollection and its indexes, safe to read from
+    worker threads while the collection changes. Offers the reading part of the
+    TrackCollection interface with TrackRecords instead of AudioTracks.
+
+    The indexes are built on their first use. Once built, the following snapshots
+    of the collection keep them up to date with the changes.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        version: int,
+        chunks: tuple[tuple[str, ...], ...],
+        by_path: PersistentMap,
+        indexes: dict[str, PersistentMap],
+    ) -> None:
+        self.name = name
+        self.version = version
+        # Paths in the order of the collection, all chunks but the last are full
+        self.chunks = chunks
+        self.length = (len(chunks) - 1) * CHUNK_SIZE + len(chunks[-1]) if chunks else 0
+        self.by_path = by_path
+        # Field -> tag value -> record -> True like TrackCollection.indexes, and
+        # GENRE_TOKENS -> normalized genre token -> path -> True
+        self.built_indexes = indexes
+
+    def __len__(self) -> int:
+        return self.length
+
+    def __getitem__(self, index: int) -> TrackRecord:
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError("snapshot index out of range")
+        return self.by_path[self.chunks[index // CHUNK_SIZE][index % CHUNK_SIZE]]
+
+    def __iter__(self):
+        for path in self.paths():
+            yield self.by_path[path]
+
+    def paths(self):
+        for chunk in self.chunks:
+            yield from chunk
+
+    def index(self, name: str) -> PersistentMap:
+        index = self.built_indexes.get(name)
+        if index is None:
+            # Threads building the same index at once get equal results
+            index = build_index(self.by_path.values(), name)
+            self.built_indexes[name] = index
+        return index
+
+    def indexes(self) -> list[tuple[str, PersistentMap]]:
+        return [(field, self.index(field)) for field in FIELDS]
+
+    def get_paths_by_genre_token(self, genre: str) -> set[str]:
+        return set(self.index(GENRE_TOKENS).get(normalize_genre(genre), ()))
+
+    # Only reads by_path and get_paths_by_genre_token, which both classes offer
+    query_genres = TrackCollection.query_genres
+
+
+def index_entries(record: TrackRecord, name: str) -> list[tuple]:
+    """(Key, entry) pairs of a record in an index."""
+    if name == GENRE_TOKENS:
+        return [(normalize_genre(token), record.path) for token in record.genres]
+    return [(getattr(record, name), record)]
+
+
+def build_index(records: list[TrackRecord], name: str) -> PersistentMap:
+    groups = dict()
+    for record in records:
+        for key, entry in index_entries(record, name):
+            groups.setdefault(key, []).append(entry)
+    return PersistentMap.from_items(
+        (key, PersistentMap.from_items((entry, True) for entry in entries))
+        for key, entries in groups.items()
+    )
+
+
+def chunked(paths: list[str]) -> tuple[tuple[str, ...], ...]:
+    return tuple(
+        tuple(paths[i : i + CHUNK_SIZE]) for i in range(0, len(paths), CHUNK_SIZE)
+    )
+
+
+class SnapshotTracker:
+    """Creates snapshots of a collection. Listens to the collection and applies only
+    the tracks that changed since the previous snapshot, unchanged records and index
+    nodes are shared between the snapshots.
+
+    Appending tracks extends the last chunk of the order, other changes of the order
+    (insert, remove, reorder) copy the paths into new chunks, which is O(n) but only
+    moves references.
+    """
+
+    def __init__(self, collection: TrackCollection) -> None:
+        self.collection = collection
+        self.snapshot: CollectionSnapshot | None = None
+        # Path -> changed track, None for removed tracks
+        self.changed: dict[str, AudioTrack | None] = dict()
+        self.appended: list[str] = []
+        self.order_changed = False
+        # Guards self.snapshot against a first snapshot built in another thread
+        self.lock = threading.Lock()
+        self.pending = None
+        collection.add_listener(self.on_collection_changed)
+
+    def detach(self):
+        self.collection.remove_listener(self.on_collection_changed)
+
+    def on_collection_changed(self, event: str, track: AudioTrack):
+        if event == "reorder":
+            self.order_changed = True
+            return
+        self.changed[track.path] = None if event == "remove" else track
+        tracks = self.collection.tracks
+        if event == "add" and tracks and tracks[-1] is track:
+            self.appended.append(track.path)
+        elif event != "update":
+            self.order_changed = True
+
+    def take(self) -> CollectionSnapshot:
+        """Snapshot of the current state, has to be called from the thread that
+        changes the collection."""
+        with paused_gc():
+            if self.snapshot is None:
+                return self.begin()()
+            if self.snapshot.version == self.collection.version:
+                return self.snapshot
+            return self.update(self.snapshot)
+
+    def begin(self):
+        """Returns a function that creates a full snapshot from the current tracks,
+        e.g. in a worker thread for the first snapshot of a large collection.
+
+        Tracks that change meanwhile are read again by the next take, so a record the
+        worker read during a change is replaced then.
+        """
+        tracks = list(self.collection.tracks)
+        name, version = self.collection.name, self.collection.version
+        self.reset_changes()
+        token = self.pending = object()
+
+        def build() -> CollectionSnapshot:
+            snapshot = CollectionSnapshot(
+                name,
+                version,
+                chunked([track.path for track in tracks]),
+                PersistentMap.from_items(
+                    (track.path, TrackRecord.from_track(track)) for track in tracks
+                ),
+                dict(),
+            )
+            with self.lock:
+                # A take or another begin since then tracked the changes from there
+                if self.snapshot is None and self.pending is token:
+                    self.snapshot = snapshot
+            return snapshot
+
+        return build
+
+    def update(self, previous: CollectionSnapshot) -> CollectionSnapshot:
+        by_path = previous.by_path.edit()
+        # Copied at once, worker threads may add indexes to the previous snapshot
+        editors = {
+            name: index.edit() for name, index in dict(previous.built_indexes).items()
+        }
+        # (Index name, key) -> editor of the inner map, each is edited once
+        inner: dict[tuple[str, object], MapEditor] = dict()
+
+        def entries(name: str, key) -> MapEditor:
+            if (name, key) not in inner:
+                inner[name, key] = editors[name].get(key, PersistentMap()).edit()
+            return inner[name, key]
+
+        for path, track in self.changed.items():
+            old = by_path.get(path)
+            if old is not None:
+                for name in editors:
+                    for key, entry in index_entries(old, name):
+                        entries(name, key).delete(entry)
+            if track is None:
+                by_path.delete(path)
+                continue
+            record = TrackRecord.from_track(track)
+            by_path.set(path, record)
+            for name in editors:
+                for key, entry in index_entries(record, name):
+                    entries(name, key).set(entry, True)
+        for (name, key), editor in inner.items():
+            entries_map = editor.finish()
+            if len(entries_map):
+                editors[name].set(key, entries_map)
+            else:
+                editors[name].delete(key)
+
+        if self.order_changed:
+            chunks = chunked([track.path for track in self.collection.tracks])
+        elif self.appended:
+            last = list(previous.chunks[-1]) if previous.chunks else []
+            if len(last) == CHUNK_SIZE:
+                last = []
+                kept = previous.chunks
+            else:
+                kept = previous.chunks[:-1]
+            chunks = kept + chunked(last + self.appended)
+        else:
+            chunks = previous.chunks
+        log.debug(f"Applied {len(self.changed)} changes to the snapshot")
+        return self.store(
+            chunks,
+            by_path.finish(),
+            {name: editor.finish() for name, editor in editors.items()},
+        )
+
+    def store(self, chunks, by_path, indexes) -> CollectionSnapshot:
+        snapshot = CollectionSnapshot(
+            self.collection.name, self.collection.version, chunks, by_path, indexes
+        )
+        with self.lock:
+            self.snapshot = snapshot
+        self.reset_changes()
+        return snapshot
+
+    def reset_changes(self):
+        self.changed = dict()
+        self.appended = []
+        self.order_changed = False
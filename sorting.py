@@ -0,0 +1,154 @@
+from bisect import bisect_right
+
+from audio_track import AudioTrack, TrackCollection, parse_float
+from logger import Logger
+from settings import LoggerSettings
+
+log = Logger("Sorting", LoggerSettings.log_level)
+
+SORT_FIELDS = ("title", "artist", "album", "date", "genre", "bpm", "key")
+
+
+def text_key(value: str) -> tuple:
+    # Empty values are sorted behind all others
+    return (not value, value.casefold())
+
+
+def bpm_key(value: str) -> tuple:
+    bpm = parse_float(value)
+    return (bpm is None, bpm or 0.0)
+
+
+def camelot_key(camelot: str) -> tuple:
+    """Sorts by the position on the Camelot wheel, "2A" before "10A"."""
+    if not camelot:
+        return (True, 0, "")
+    return (False, int(camelot[:-1]), camelot[-1])
+
+
+def sort_key(field: str, track: AudioTrack) -> tuple:
+    """Typed and normalized key of a track to sort by the given field."""
+    if field == "bpm":
+        return bpm_key(track.bpm)
+    if field == "key":
+        return camelot_key(track.camelot)
+    return text_key(getattr(track, field))
+
+
+class Descending:
+    """Reverses the order of a key inside a tuple of keys."""
+
+    __slots__ = ("value",)
+
+    def __init__(self, value) -> None:
+        self.value = value
+
+    def __lt__(self, other: "Descending") -> bool:
+        return other.value < self.value
+
+    def __eq__(self, other: "Descending") -> bool:
+        return self.value == other.value
+
+
+def directed(key: tuple, descending: bool) -> tuple:
+    """Reverses the order of a key, empty values stay behind all others."""
+    if descending:
+        return (key[0], Descending(key[1:]))
+    return key
+
+
+class SortIndex:
+    """Sort keys and sort orders of the tracks of a collection.
+
+    The keys of a field are computed once, when the field is sorted by for the first
+    time, and kept up to date by listening to the collection. Permutations are cached
+    per sort order, added tracks are inserted into them without sorting again.
+
+    A sort order is a tuple of (field, descending) pairs, the first pair has the highest
+    priority. Tracks with equal keys keep their order in the collection.
+    """
+
+    def __init__(self, collection: TrackCollection) -> None:
+        self.collection = collection
+        self.keys: dict[str, list[tuple]] = dict()
+        self.permutations: dict[tuple[tuple[str, bool], ...], list[int]] = dict()
+        # Path -> index in the collection
+        self.positions: dict[str, int] | None = None
+        collection.add_listener(self.on_collection_changed)
+
+    def detach(self):
+        self.collection.remove_listener(self.on_collection_changed)
+
+    def field_keys(self, field: str) -> list[tuple]:
+        if field not in SORT_FIELDS:
+            raise ValueError(f"Unknown field '{field}', choose one of {SORT_FIELDS}")
+        keys = self.keys.get(field)
+        if keys is None:
+            keys = [sort_key(field, track) for track in self.collection.tracks]
+            self.keys[field] = keys
+        return keys
+
+    def permutation(self, order: tuple[tuple[str, bool], ...]) -> list[int]:
+        """Returns the indexes of the tracks of the collection in the given order.
+        The returned list is cached and must not be modified."""
+        order = tuple(order)
+        permutation = self.permutations.get(order)
+        if permutation is None:
+            permutation = list(range(len(self.collection)))
+            # Python's sort is stable, sorting by the fields from the lowest to the
+            # highest priority sorts by all of them
+            for field, descending in reversed(order):
+                keys = self.field_keys(field)
+                if descending:
+                    permutation.sort(key=lambda i: directed(keys[i], True))
+                else:
+                    permutation.sort(key=keys.__getitem__)
+            self.permutations[order] = permutation
+        return permutation
+
+    def composite_key(self, order: tuple[tuple[str, bool], ...]):
+        keys = [(self.field_keys(field), descending) for field, descending in order]
+
+        def key(index: int) -> tuple:
+            return tuple(
+                directed(field_keys[index], descending)
+                for field_keys, descending in keys
+            )
+
+        return key
+
+    def clear(self):
+        self.keys.clear()
+        self.permutations.clear()
+        self.positions = None
+
+    def on_collection_changed(self, event: str, track: AudioTrack):
+        if event == "add" and self.collection.tracks[-1] is not track:
+            # Inserted in front of other tracks, their indexes shift
+            self.clear()
+        elif event == "add":
+            index = len(self.collection) - 1
+            for field, keys in self.keys.items():
+                keys.append(sort_key(field, track))
+            if self.positions is not None:
+                self.positions[track.path] = index
+            # The new track is behind all tracks with equal keys, as a stable sort would put it
+            for order, permutation in self.permutations.items():
+                key = self.composite_key(order)
+                permutation.insert(
+                    bisect_right(permutation, key(index), key=key), index
+                )
+        elif event == "update":
+            if self.positions is None:
+                self.positions = {
+                    path: i for i, path in enumerate(t.path for t in self.collection)
+                }
+            index = self.positions.get(track.path)
+            if index is None:
+                return
+            for field, keys in self.keys.items():
+                keys[index] = sort_key(field, track)
+            self.permutations.clear()
+        else:
+            # Removing and reordering shifts the indexes of the tracks
+            self.clear()
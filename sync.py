@@ -0,0 +1,234 @@
+import hashlib
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from audio_track import TrackCollection
+from logger import Logger
+from settings import LoggerSettings, SyncSettings
+
+log = Logger("Sync", LoggerSettings.log_level)
+
+# FAT32, the usual file system of USB sticks, stores modification times in 2 s steps
+MTIME_TOLERANCE_NS = 2_000_000_000
+INVALID_CHARACTERS = re.compile(r'[<>:"/\\|?*\x00-\x1f]')
+
+
+def safe_name(name: str) -> str:
+    """File name that is valid on FAT32 and exFAT drives."""
+    return INVALID_CHARACTERS.sub("_", name).strip(" .") or "_"
+
+
+def target_names(paths: list[str]) -> dict[str, str]:
+    """Names of the files in the music directory of the target.
+
+    Files keep their name. Files with the same name from different directories get
+    a short hash of their source path, independent of the order of the playlists.
+    """
+    by_name: dict[str, list[str]] = dict()
+    for path in paths:
+        by_name.setdefault(safe_name(os.path.basename(path)).casefold(), []).append(
+            path
+        )
+    names = {}
+    for same_name in by_name.values():
+        for path in same_name:
+            name = safe_name(os.path.basename(path))
+            if len(same_name) > 1:
+                stem, extension = os.path.splitext(name)
+                digest = hashlib.sha1(path.encode()).hexdigest()[:8]
+                name = f"{stem} ({digest}){extension}"
+            names[path] = name
+    return names
+
+
+def playlist_names(playlists: list[TrackCollection]) -> list[str]:
+    """Names of the m3u files of the playlists. Playlists whose names are the same on
+    the drive, e.g. "A/B" and "A_B", get a number like "A_B (2)"."""
+    names, taken = [], set()
+    for collection in playlists:
+        name = stem = safe_name(collection.name)
+        number = 2
+        # The file systems of the drives ignore the case
+        while name.casefold() in taken:
+            name = f"{stem} ({number})"
+            number += 1
+        taken.add(name.casefold())
+        names.append(name)
+    return names
+
+
+def file_digest(path: str, chunk_size: int = SyncSettings.chunk_size) -> str:
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def is_up_to_date(source: os.stat_result, target_path: str) -> bool:
+    try:
+        target = os.stat(target_path)
+    except OSError:
+        return False
+    return (
+        source.st_size == target.st_size
+        and abs(source.st_mtime_ns - target.st_mtime_ns) <= MTIME_TOLERANCE_NS
+    )
+
+
+def copy_file(
+    source: str, target: str, chunk_size: int = SyncSettings.chunk_size
+) -> str:
+    """Copies a file in chunks, so only one chunk per worker is in memory. The copy
+    gets the modification time of the source and appears only once it is complete.
+
+    Returns:
+        str: SHA-1 of the copied data.
+    """
+    digest = hashlib.sha1()
+    partial = f"{target}.part"
+    try:
+        with open(source, "rb") as src, open(partial, "wb") as dst:
+            while chunk := src.read(chunk_size):
+                digest.update(chunk)
+                dst.write(chunk)
+            dst.flush()
+            os.fsync(dst.fileno())
+        stat = os.stat(source)
+        os.utime(partial, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        os.replace(partial, target)
+    except BaseException:
+        # E.g. a full drive, the partial copy would take its space until the next sync
+        try:
+            os.remove(partial)
+        except OSError:
+            pass
+        raise
+    return digest.hexdigest()
+
+
+class SyncReport:
+    def __init__(self) -> None:
+        self.copied = 0
+        self.skipped = 0
+        self.failed: dict[str, str] = dict()
+        self.bytes_copied = 0
+        self.seconds = 0.0
+        self.playlists: list[str] = []
+
+    @property
+    def throughput(self) -> float:
+        """Copied MB per second."""
+        return self.bytes_copied / 1e6 / self.seconds if self.seconds else 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "copied": self.copied,
+            "skipped": self.skipped,
+            "failed": len(self.failed),
+            "megabytes": round(self.bytes_copied / 1e6, 1),
+            "seconds": round(self.seconds, 2),
+            "mb_per_second": round(self.throughput, 1),
+            "playlists": len(self.playlists),
+        }
+
+    def __str__(self) -> str:
+        return (
+            f"{self.copied} copied, {self.skipped} up to date, {len(self.failed)} failed, "
+            f"{self.bytes_copied / 1e6:.1f} MB in {self.seconds:.1f} s "
+            f"({self.throughput:.1f} MB/s)"
+        )
+
+
+def sync_file(
+    source: str, target: str, checksum: bool, verify: bool
+) -> tuple[bool, int]:
+    """Brings one file up to date. Runs in the worker threads of sync_playlists.
+
+    Returns:
+        tuple[bool, int]: Whether the file was copied and the number of copied bytes.
+    """
+    stat = os.stat(source)
+    if is_up_to_date(stat, target):
+        if not checksum or file_digest(source) == file_digest(target):
+            return False, 0
+    digest = copy_file(source, target)
+    if verify and file_digest(target) != digest:
+        os.remove(target)
+        raise OSError("The copy differs from the source")
+    return True, stat.st_size
+
+
+def write_playlist(
+    collection: TrackCollection, filename: str, names: dict[str, str]
+) -> str:
+    """Writes an m3u playlist with paths relative to the target directory."""
+    with open(filename, "w", encoding="utf-8") as f:
+        f.write("#EXTM3U\n")
+        for track in collection:
+            if track.path not in names:
+                continue
+            relative = f"{SyncSettings.music_directory}/{names[track.path]}"
+            f.write(f"#EXTINF:-1,{track.full_name}\n{relative}\n")
+    return filename
+
+
+def sync_playlists(
+    playlists: list[TrackCollection],
+    target_dir: str,
+    workers: int | None = SyncSettings.workers,
+    checksum: bool = False,
+    verify: bool = True,
+    progress=None,
+) -> SyncReport:
+    """Copies the tracks of the playlists to a drive and writes the playlists for it.
+
+    Only files that are missing on the target or differ in size or modification time
+    are copied, so syncing an unchanged export only stats the files.
+
+    Args:
+        playlists (list[TrackCollection]): Playlists to sync, snapshots of them when called from another thread.
+        target_dir (str): Root directory of the drive, the tracks are copied to its subdirectory SyncSettings.music_directory.
+        workers (int, optional): Number of parallel copies.
+        checksum (bool, optional): Compares the content of files with matching size and modification time as well.
+        verify (bool, optional): Reads every copy back and compares it to the source.
+        progress (callable, optional): Called with (done, total) after every file.
+    """
+    start = time.perf_counter()
+    report = SyncReport()
+    paths = list(dict.fromkeys(track.path for pl in playlists for track in pl))
+    names = target_names(paths)
+    music_dir = os.path.join(target_dir, SyncSettings.music_directory)
+    os.makedirs(music_dir, exist_ok=True)
+
+    def run(path):
+        target = os.path.join(music_dir, names[path])
+        try:
+            copied, size = sync_file(path, target, checksum, verify)
+        except OSError as e:
+            return path, False, 0, str(e)
+        return path, copied, size, None
+
+    with ThreadPoolExecutor(workers) as executor:
+        results = executor.map(run, paths)
+        for done, (path, copied, size, error) in enumerate(results, 1):
+            if error is not None:
+                log.warning(f"Could not sync {path}: {error}")
+                report.failed[path] = error
+                del names[path]
+            elif copied:
+                report.copied += 1
+                report.bytes_copied += size
+            else:
+                report.skipped += 1
+            if progress is not None:
+                progress(done, len(paths))
+
+    for collection, name in zip(playlists, playlist_names(playlists)):
+        filename = os.path.join(target_dir, f"{name}.m3u")
+        report.playlists.append(write_playlist(collection, filename, names))
+    report.seconds = time.perf_counter() - start
+    log.info(f"Synced {len(playlists)} playlists to {target_dir}: {report}")
+    return report
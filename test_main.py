@@ -1,10 +1,71 @@
 #! python3
 import os
+import asyncio
+import io
+import json
+import plistlib
+import shutil
+import tempfile
 import unittest
+import unittest.mock
+import urllib.error
+import urllib.request
+import wave
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
+from itertools import permutations
 
-from audio_track import TrackCollection
+# The session, journal, history and caches of the player are left alone, the modules
+# read the paths when they are imported
+TEST_CACHE_DIR = tempfile.mkdtemp()
+os.environ["DJMP_CACHE_DIR"] = TEST_CACHE_DIR
+
+import cli
+import numpy as np
+from artwork import PixmapCache, create_thumbnails, thumbnail_path
+from audio_analysis import decode_audio, result_tags
+from audio_track import AudioTrack, TrackCollection, to_camelot
+from beatgrid import Beatgrid, estimate_beatgrid, parse_beatgrid
+from cache import FileCache
+from exporters import Exporter, export, file_url, traktor_location
+from energy import EnergyStore, energy_curves, energy_rating
+from history import PlayHistory, PlayTracker
+from inference import PathInferrer, compile_pattern, track_tags
+from health import CORRUPT, MISSING, OK, broken_paths, check_file, check_files
+from mutagen.id3 import APIC, ID3
+from PyQt6.QtCore import QBuffer, QByteArray, QIODevice
+from PyQt6.QtGui import QImage, QPixmap
 from PyQt6.QtWidgets import QApplication
-from settings import IOSettings, UISettings
+from settings import ArtworkSettings, IOSettings, RemoteSettings, UISettings
+from cue_points import CuePoint, format_cues, parse_cues
+from journal import (
+    Journal,
+    apply_playlist_command,
+    decode_order,
+    encode_order,
+    reorder_command,
+    tags_batch_command,
+    tags_command,
+)
+from library import FederatedLibrary
+from key_detection import MINOR_PROFILE, chroma, detect_key, estimate_key, key_tags
+from loudness import integrated_loudness, measure_loudness, playback_gain
+from preview import PreviewCache, PreviewLoader, find_drop, preview_start
+from quality import analyze_quality, average_spectrum, estimate_cutoff
+from recommend import RecommendationIndex
+from remote import ImmediateExecutor, RemoteClient, RemoteError, RemoteServer
+from sequencing import sequence, transition_costs
+from session import (
+    Session,
+    SnapshotError,
+    changed_paths,
+    load_session,
+    save_session,
+)
+from smart_crates import Rule, SmartCrate
+from snapshots import PersistentMap, TrackRecord
+from sorting import SortIndex
+from sync import copy_file, sync_playlists, target_names
 from ui import UI
 
 TEST_PLAYLIST = os.path.join(IOSettings.wd, "static", "tracks", "playlists", "test.m3u")
@@ -34,5 +95,1332 @@ class TestUI(unittest.TestCase):
         del self.app
 
 
+def tearDownModule():
+    shutil.rmtree(TEST_CACHE_DIR, ignore_errors=True)
+
+
+def make_track(path, **tags):
+    track = AudioTrack()
+    track.path = path
+    track.update_tags(tags, save=False)
+    return track
+
+
+class TestArtwork(unittest.TestCase):
+    def setUp(self):
+        self.app = QApplication.instance() or QApplication([])
+        self.directory = tempfile.mkdtemp()
+        self.thumbnails = ArtworkSettings.directory
+        ArtworkSettings.directory = os.path.join(self.directory, "artwork")
+
+    def tearDown(self):
+        ArtworkSettings.directory = self.thumbnails
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_pixmap_cache_evicts_least_recently_used(self):
+        pixmap = QPixmap(16, 16)
+        cache = PixmapCache(max_bytes=2 * PixmapCache.cost(pixmap))
+        cache.put(("a", 16), pixmap)
+        cache.put(("b", 16), QPixmap(16, 16))
+        cache.get(("a", 16))
+        cache.put(("c", 16), QPixmap(16, 16))
+        self.assertEqual(list(cache.pixmaps), [("a", 16), ("c", 16)])
+        self.assertEqual(cache.bytes, 2 * PixmapCache.cost(pixmap))
+
+    def tracks_with_artwork(self, count: int) -> list[str]:
+        image = QImage(300, 300, QImage.Format.Format_RGB32)
+        image.fill(0xFF8000)
+        data = QByteArray()
+        buffer = QBuffer(data)
+        buffer.open(QIODevice.OpenModeFlag.WriteOnly)
+        image.save(buffer, "PNG")
+        paths = []
+        for i in range(count):
+            path = os.path.join(self.directory, f"{i}.mp3")
+            tags = ID3()
+            tags.add(APIC(encoding=3, mime="image/png", type=3, data=bytes(data)))
+            tags.save(path)
+            paths.append(path)
+        return paths
+
+    def test_tracks_with_the_same_artwork_share_thumbnails(self):
+        paths = self.tracks_with_artwork(2)
+        digest = create_thumbnails(paths[0])
+        self.assertEqual(create_thumbnails(paths[1]), digest)
+        thumbnails = os.listdir(os.path.dirname(thumbnail_path(digest, 0)))
+        self.assertEqual(len(thumbnails), len(ArtworkSettings.sizes))
+        self.assertEqual(QImage(thumbnail_path(digest, 32)).width(), 32)
+        untagged = os.path.join(self.directory, "untagged.mp3")
+        open(untagged, "wb").close()
+        self.assertIsNone(create_thumbnails(untagged))
+
+    def test_tracks_of_one_album_load_at_the_same_time(self):
+        paths = self.tracks_with_artwork(8)
+        for _ in range(5):
+            shutil.rmtree(ArtworkSettings.directory, ignore_errors=True)
+            with ThreadPoolExecutor(8) as executor:
+                digests = set(executor.map(create_thumbnails, paths))
+            self.assertEqual(len(digests), 1)
+            digest = digests.pop()
+            thumbnails = os.listdir(os.path.dirname(thumbnail_path(digest, 0)))
+            self.assertEqual(len(thumbnails), len(ArtworkSettings.sizes))
+
+
+class TestSmartCrates(unittest.TestCase):
+    def setUp(self):
+        self.collection = TrackCollection(
+            [
+                make_track("a.mp3", genre="House", bpm="124", date="2021"),
+                make_track("b.mp3", genre="Techno", bpm="130", date="2022"),
+                make_track("c.mp3", bpm="122", date="2019-05-01"),
+            ]
+        )
+
+    def test_evaluate_rules(self):
+        crate = SmartCrate.parse("crate", "bpm between 120 128; date >= 2020")
+        self.assertEqual(crate.evaluate(self.collection), {"a.mp3"})
+        crate = SmartCrate.parse("crate", "genre is_empty")
+        self.assertEqual(crate.evaluate(self.collection), {"c.mp3"})
+
+    def test_keys_match_in_any_notation(self):
+        self.collection.add_track(make_track("d.mp3", initialkey="Am"))
+        self.collection.add_track(make_track("e.mp3", initialkey="A minor"))
+        for value in ("8A", "Am", "a minor"):
+            crate = SmartCrate.parse("crate", f"key is {value}")
+            self.assertEqual(crate.evaluate(self.collection), {"d.mp3", "e.mp3"})
+
+    def test_incremental_update(self):
+        crate = SmartCrate.parse("crate", "genre is_empty")
+        crate.attach(self.collection)
+        track = self.collection.by_path["c.mp3"]
+        self.collection.update_track_tags(track, {"genre": "House"}, save=False)
+        self.assertEqual(len(crate), 0)
+        self.collection.add_track(make_track("d.mp3"))
+        self.assertEqual(list(crate.members), ["d.mp3"])
+
+
+class TestGenreIndex(unittest.TestCase):
+    def setUp(self):
+        self.collection = TrackCollection(
+            [
+                make_track("a.mp3", genre="House / Deep"),
+                make_track("b.mp3", genre="Deep / House"),
+                make_track("c.mp3", genre="Tech House"),
+            ]
+        )
+
+    def test_tokens_are_order_independent(self):
+        self.assertEqual(
+            self.collection.query_genres(all_of=["house", "DEEP"]), {"a.mp3", "b.mp3"}
+        )
+
+    def test_genre_rule_reads_the_token_index(self):
+        rule = Rule("genre", "is", "deep")
+        self.assertEqual(rule.evaluate(self.collection), {"a.mp3", "b.mp3"})
+        self.assertEqual(rule.evaluate(self.collection.snapshot()), {"a.mp3", "b.mp3"})
+        # The result is not the index itself
+        rule.evaluate(self.collection).clear()
+        self.assertEqual(rule.evaluate(self.collection), {"a.mp3", "b.mp3"})
+
+    def test_boolean_query(self):
+        self.assertEqual(
+            self.collection.query_genres(any_of=["House", "Tech House"]),
+            {"a.mp3", "b.mp3", "c.mp3"},
+        )
+        self.assertEqual(self.collection.query_genres(none_of=["Deep"]), {"c.mp3"})
+
+    def test_index_follows_retag(self):
+        track = self.collection.by_path["c.mp3"]
+        self.collection.update_track_tags(track, {"genre": "Deep"}, save=False)
+        self.assertEqual(self.collection.get_paths_by_genre_token("Tech House"), set())
+        self.assertIn("c.mp3", self.collection.get_paths_by_genre_token("deep"))
+
+
+class TestReorder(unittest.TestCase):
+    def setUp(self):
+        self.collection = TrackCollection(
+            [make_track(f"{i}.mp3", title=str(i)) for i in range(6)]
+        )
+
+    def titles(self):
+        return [track.title for track in self.collection]
+
+    def test_move_selection_down(self):
+        position = self.collection.move_tracks([4, 0, 2], 4)
+        self.assertEqual(position, 2)
+        self.assertEqual(self.titles(), ["1", "3", "0", "2", "4", "5"])
+
+    def test_move_to_end(self):
+        self.collection.move_tracks([1, 2], len(self.collection))
+        self.assertEqual(self.titles(), ["0", "3", "4", "5", "1", "2"])
+
+    def test_save_playlist(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        path = os.path.join(directory, "test_reorder.m3u")
+        self.collection.move_tracks([5], 0)
+        self.collection.save_playlist(path)
+        with open(path) as f:
+            paths = [line.strip() for line in f if not line.startswith("#")]
+        self.assertEqual(paths, [track.path for track in self.collection])
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "test_journal.jsonl")
+        self.values = []
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def open(self, max_entries=10):
+        journal = Journal(self.path, max_entries)
+        journal.register(
+            "set",
+            lambda command, undo: self.values.append(
+                command["before" if undo else "after"]
+            ),
+        )
+        return journal
+
+    def test_undo_redo_survive_restart(self):
+        journal = self.open()
+        for i in range(3):
+            journal.record({"op": "set", "before": i, "after": i + 1})
+        journal.undo()
+        journal.undo()
+        journal.redo()
+        journal.close()
+        journal = self.open()
+        self.assertEqual((len(journal), journal.position), (3, 2))
+        journal.undo()
+        self.assertEqual(self.values, [2, 1, 2, 1])
+        # A new edit drops the edits that could be redone
+        journal.record({"op": "set", "before": 1, "after": 5})
+        self.assertFalse(journal.can_redo())
+        journal.close()
+
+    def test_compaction(self):
+        journal = self.open(max_entries=10)
+        for i in range(100):
+            journal.record({"op": "set", "before": i, "after": i + 1})
+        journal.close()
+        with open(self.path) as f:
+            self.assertLessEqual(len(f.readlines()), 30)
+        journal = self.open(max_entries=10)
+        self.assertEqual(journal.undo()["after"], 100)
+        journal.close()
+
+    def test_batch_of_tag_edits(self):
+        command = tags_batch_command(
+            [
+                tags_command("a.mp3", {"genre": ""}, {"genre": "House"}),
+                tags_command("b.mp3", {"genre": "Techno"}, {"genre": "Techno"}),
+            ]
+        )
+        self.assertEqual([tags["path"] for tags in command["commands"]], ["a.mp3"])
+        self.assertIsNone(tags_batch_command([None]))
+
+    def test_reorder_is_undone(self):
+        collection = TrackCollection([make_track(f"{i}.mp3") for i in range(1000)])
+        paths = [track.path for track in collection]
+        order = list(range(1000))
+        order[10:10] = order[500:600]
+        del order[600:700]
+        command = reorder_command(collection, order)
+        self.assertEqual(len(command["runs"]), 4)
+        self.assertEqual(decode_order(encode_order(order)), order)
+        apply_playlist_command(collection, command, undo=False)
+        self.assertEqual(collection[10].path, "500.mp3")
+        apply_playlist_command(collection, command, undo=True)
+        self.assertEqual([track.path for track in collection], paths)
+
+
+class TestSorting(unittest.TestCase):
+    def setUp(self):
+        self.collection = TrackCollection(
+            [
+                make_track("a.mp3", genre="House", bpm="124"),
+                make_track("b.mp3", genre="Deep", bpm="120"),
+                make_track("c.mp3", genre="house", bpm="128"),
+                make_track("d.mp3", genre="Deep", bpm="9"),
+                make_track("e.mp3", bpm="130"),
+            ]
+        )
+        self.index = SortIndex(self.collection)
+
+    def paths(self, order):
+        return [self.collection[i].path for i in self.index.permutation(order)]
+
+    def test_numeric_and_empty_values(self):
+        self.assertEqual(
+            self.paths([("bpm", False)]), ["d.mp3", "b.mp3", "a.mp3", "c.mp3", "e.mp3"]
+        )
+        self.assertEqual(
+            self.paths([("genre", False)]),
+            ["b.mp3", "d.mp3", "a.mp3", "c.mp3", "e.mp3"],
+        )
+
+    def test_multi_column_with_insert(self):
+        order = [("genre", False), ("bpm", True)]
+        self.assertEqual(
+            self.paths(order), ["b.mp3", "d.mp3", "c.mp3", "a.mp3", "e.mp3"]
+        )
+        self.collection.add_track(make_track("f.mp3", genre="DEEP", bpm="120"))
+        self.assertEqual(
+            self.paths(order), ["b.mp3", "f.mp3", "d.mp3", "c.mp3", "a.mp3", "e.mp3"]
+        )
+
+    def test_descending_keeps_empty_values_last(self):
+        order = [("genre", True)]
+        self.assertEqual(
+            self.paths(order), ["a.mp3", "c.mp3", "b.mp3", "d.mp3", "e.mp3"]
+        )
+        self.collection.add_track(make_track("f.mp3", bpm="1"))
+        self.collection.add_track(make_track("g.mp3", genre="Techno"))
+        self.assertEqual(
+            self.paths(order),
+            ["g.mp3", "a.mp3", "c.mp3", "b.mp3", "d.mp3", "e.mp3", "f.mp3"],
+        )
+
+
+class TestRecommendations(unittest.TestCase):
+    def setUp(self):
+        self.tracks = [
+            make_track("a.mp3", bpm="124", initialkey="Am", genre="House", date="2020"),
+            make_track("b.mp3", bpm="125", initialkey="Em", genre="House", date="2019"),
+            make_track("c.mp3", bpm="174", initialkey="F#", genre="Drum & Bass"),
+            make_track("d.mp3", bpm="126", initialkey="C", genre="House / Deep"),
+        ]
+        self.collection = TrackCollection(self.tracks)
+        self.index = RecommendationIndex(self.collection)
+
+    def test_similar(self):
+        paths = [path for path, _ in self.index.similar(self.tracks[0], k=3)]
+        self.assertEqual(paths, ["b.mp3", "d.mp3", "c.mp3"])
+        paths = [
+            path
+            for path, _ in self.index.similar(self.tracks[0], k=1, exclude={"b.mp3"})
+        ]
+        self.assertEqual(paths, ["d.mp3"])
+
+    def test_follows_the_collection(self):
+        self.collection.update_track_tags(
+            self.tracks[2],
+            {"bpm": "124", "initialkey": "Am", "genre": "House", "date": "2020"},
+            save=False,
+        )
+        self.collection.remove_track(self.tracks[1])
+        self.collection.add_track(make_track("e.mp3", bpm="124", genre="House"))
+        paths = [path for path, _ in self.index.similar(self.tracks[0])]
+        self.assertEqual(paths[0], "c.mp3")
+        self.assertNotIn("b.mp3", paths)
+        self.assertEqual(len(paths), 3)
+
+    def test_built_from_a_snapshot(self):
+        snapshot = self.collection.snapshot()
+        index = RecommendationIndex(self.collection, snapshot)
+        self.collection.remove_track(self.tracks[1])
+        index.catch_up(snapshot, self.collection.snapshot())
+        paths = [path for path, _ in index.similar(self.tracks[0])]
+        self.assertEqual(paths, ["d.mp3", "c.mp3"])
+
+
+class CollidingKey:
+    def __init__(self, value: int) -> None:
+        self.value = value
+
+    def __hash__(self) -> int:
+        return self.value % 3
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, CollidingKey) and other.value == self.value
+
+
+class TestSnapshots(unittest.TestCase):
+    def setUp(self):
+        self.tracks = [
+            make_track("a.mp3", bpm="124", genre="House", date="2020"),
+            make_track("b.mp3", bpm="130", genre="Techno / Deep"),
+            make_track("c.mp3", bpm="122", genre="House / Deep"),
+        ]
+        self.collection = TrackCollection(self.tracks)
+
+    def test_persistent_map(self):
+        random = np.random.default_rng(1)
+        for make_key in (int, str, CollidingKey):
+            expected, versions = dict(), []
+            mapping = PersistentMap()
+            for step in range(2000):
+                key = make_key(int(random.integers(100)))
+                if random.random() < 0.6:
+                    mapping = mapping.set(key, step)
+                    expected[key] = step
+                else:
+                    mapping = mapping.delete(key)
+                    expected.pop(key, None)
+                if step % 200 == 0:
+                    versions.append((mapping, dict(expected)))
+            deleted = set(map(make_key, range(0, 100, 2)))
+            editor = mapping.edit()
+            for key in deleted:
+                editor.delete(key)
+            edited = editor.finish()
+            self.assertEqual(dict(mapping.items()), expected)
+            self.assertEqual(len(mapping), len(expected))
+            for version, contents in versions:
+                self.assertEqual(dict(version.items()), contents)
+            self.assertEqual(edited.changed_keys(mapping), deleted & set(expected))
+
+    def test_snapshots_do_not_change(self):
+        first = self.collection.snapshot()
+        self.assertEqual(first.query_genres(all_of={"deep"}), {"b.mp3", "c.mp3"})
+        self.collection.update_track_tags(self.tracks[0], {"genre": "Deep"}, save=False)
+        self.collection.remove_track(self.tracks[1])
+        self.collection.add_track(make_track("d.mp3", bpm="126", genre="House"))
+        second = self.collection.snapshot()
+
+        self.assertEqual([track.path for track in first], ["a.mp3", "b.mp3", "c.mp3"])
+        self.assertEqual(first.by_path["a.mp3"].genre, "House")
+        self.assertEqual(first.query_genres(all_of={"deep"}), {"b.mp3", "c.mp3"})
+        self.assertEqual([track.path for track in second], ["a.mp3", "c.mp3", "d.mp3"])
+        self.assertEqual(second.query_genres(all_of={"deep"}), {"a.mp3", "c.mp3"})
+        self.assertEqual(
+            second.by_path.changed_keys(first.by_path), {"a.mp3", "b.mp3", "d.mp3"}
+        )
+        # Unchanged tracks are shared, not copied
+        self.assertIs(second.by_path["c.mp3"], first.by_path["c.mp3"])
+        self.assertIs(self.collection.snapshot(), second)
+        crate = SmartCrate.parse("crate", "bpm between 120 126")
+        self.assertEqual(crate.evaluate(second), crate.evaluate(self.collection))
+
+    def test_first_snapshot_in_another_thread(self):
+        job = self.collection.snapshot_job()
+        self.collection.update_track_tags(self.tracks[2], {"bpm": "140"}, save=False)
+        built = job()
+        self.assertIs(self.collection.snapshot_tracker.snapshot, built)
+        latest = self.collection.snapshot()
+        self.assertEqual(latest.by_path.changed_keys(built.by_path), {"c.mp3"})
+        self.assertEqual(latest[-1].bpm, "140")
+
+
+class TestRemote(unittest.TestCase):
+    def setUp(self):
+        self.collection = TrackCollection(
+            [
+                make_track("a.mp3", artist="Moon", title="Deep Night", bpm="124"),
+                make_track("b.mp3", artist="Sun", title="Acid Day", bpm="130"),
+                make_track("c.mp3", artist="Moon", title="Dub", bpm="122"),
+            ]
+        )
+        self.commands = []
+
+        def handle_command(method, params):
+            self.commands.append((method, params))
+            if method == "load" and params["path"] not in self.collection.by_path:
+                raise RemoteError(f"Unknown track {params['path']}")
+            if method == "play":
+                raise RuntimeError("No audio output")
+            return {"method": method}
+
+        self.server = RemoteServer(ImmediateExecutor(handle_command), port=0)
+        self.server.start()
+        playlist = TrackCollection(self.collection.tracks[:2], name="Set")
+        self.server.publish(self.collection.snapshot(), {"Set": playlist.snapshot()})
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_websocket_requests(self):
+        async def session():
+            client = await RemoteClient.connect(port=self.server.port)
+            searched, in_range, playlist = await asyncio.gather(
+                client.request("search", text="moon"),
+                client.request("bpm_range", low=123, high=131),
+                client.request("playlist", name="Set"),
+            )
+            loaded = await client.request("load", path="c.mp3")
+            with self.assertRaises(RemoteError):
+                await client.request("load", path="missing.mp3")
+            # Unexpected errors of commands are answered as well
+            with self.assertRaisesRegex(RemoteError, "No audio output"):
+                await asyncio.wait_for(client.request("play"), 5)
+            self.server.broadcast("track", {"path": "c.mp3"})
+            event = await client.next_event(timeout=5)
+            await client.close()
+            return searched, in_range, playlist, loaded, event
+
+        searched, in_range, playlist, loaded, event = asyncio.run(session())
+        self.assertEqual([track["path"] for track in searched], ["a.mp3", "c.mp3"])
+        self.assertEqual([track["path"] for track in in_range], ["a.mp3", "b.mp3"])
+        self.assertEqual(
+            [track["title"] for track in playlist], ["Deep Night", "Acid Day"]
+        )
+        self.assertEqual(loaded, {"method": "load"})
+        self.assertEqual(event, {"event": "track", "data": {"path": "c.mp3"}})
+
+    def test_too_large_websocket_message_closes_connection(self):
+        async def session():
+            client = await RemoteClient.connect(port=self.server.port)
+            text = "x" * (RemoteSettings.max_message_bytes + 1)
+            with self.assertRaises(ConnectionError):
+                await asyncio.wait_for(client.request("search", text=text), 5)
+            await client.close()
+
+        asyncio.run(session())
+
+    def test_http_requests(self):
+        def post(body, headers):
+            request = urllib.request.Request(
+                f"http://127.0.0.1:{self.server.port}/api",
+                json.dumps(body).encode(),
+                {"Content-Type": "application/json", **headers},
+            )
+            with urllib.request.urlopen(request) as response:
+                return json.load(response)
+
+        answer = post({"id": 7, "method": "track", "params": {"path": "b.mp3"}}, {})
+        self.assertEqual(answer["id"], 7)
+        self.assertEqual(answer["result"]["artist"], "Sun")
+        answer = post({"id": 8, "method": "unknown"}, {})
+        self.assertIn("error", answer)
+        with self.assertRaises(urllib.error.HTTPError) as context:
+            post({"id": 9, "method": "play"}, {"Origin": "https://example.com"})
+        self.assertEqual(context.exception.code, 403)
+        self.assertEqual(self.commands, [])
+
+
+class TestLibrary(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.drive = os.path.join(self.directory, "drive")
+        os.makedirs(self.drive)
+        for name in ("a.mp3", "b.mp3"):
+            open(os.path.join(self.drive, name), "wb").close()
+        self.roots_file = os.path.join(self.directory, "roots.json")
+        self.index_dir = os.path.join(self.directory, "roots")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_scan_and_rescan(self):
+        roots = FederatedLibrary(self.roots_file, self.index_dir)
+        root = roots.add_root(self.drive)
+        library = TrackCollection()
+        collection, read, failed = root.scan()
+        roots.attach(root, collection.tracks, library, read)
+        self.assertEqual((len(library), failed), (2, {}))
+
+        os.remove(os.path.join(self.drive, "a.mp3"))
+        open(os.path.join(self.drive, "c.mp3"), "wb").close()
+        corrupt = os.path.join(self.drive, "corrupt.mp3")
+        with open(corrupt, "wb") as f:
+            f.write(b"ID3\x04\x00\x00\x7f\x7f\x7f\x7fgarbage")
+        collection, read, failed = root.scan()
+        self.assertEqual(read, [os.path.join(self.drive, "c.mp3")])
+        # Skipped and left out of the index, so the next scan reads it again
+        self.assertEqual(list(failed), [corrupt])
+        self.assertEqual(root.scan()[2].keys(), {corrupt})
+        roots.attach(root, collection.tracks, library, read)
+        self.assertEqual(
+            sorted(os.path.basename(path) for path in library.by_path),
+            ["b.mp3", "c.mp3"],
+        )
+
+        # The index of the root is found again by the next run
+        indexes = FederatedLibrary(self.roots_file, self.index_dir).load_indexes()
+        self.assertEqual(len(indexes[root.path]), 2)
+
+    def test_unmounted_root_stays_browsable(self):
+        roots = FederatedLibrary(self.roots_file, self.index_dir)
+        root = roots.add_root(self.drive)
+        library = TrackCollection()
+        roots.attach(root, root.scan()[0].tracks, library)
+        self.assertEqual(roots.check_mounts(), [])
+
+        os.rename(self.drive, self.drive + "_unplugged")
+        self.assertEqual(roots.check_mounts(), [root])
+        self.assertEqual(roots.unavailable_paths(), set(library.by_path))
+        self.assertEqual(len(library), 2)
+
+        os.rename(self.drive + "_unplugged", self.drive)
+        self.assertEqual(roots.check_mounts(), [root])
+        self.assertEqual(roots.unavailable_paths(), set())
+
+    def test_remove_root_keeps_playlist_tracks(self):
+        roots = FederatedLibrary(self.roots_file, self.index_dir)
+        root = roots.add_root(self.drive)
+        library = TrackCollection()
+        roots.attach(root, root.scan()[0].tracks, library)
+        kept = library[0]
+        library.playlists["set"] = TrackCollection([kept], name="set", parent=True)
+        roots.detach(root, library)
+        roots.remove_root(root)
+        self.assertEqual(list(library), [kept])
+        self.assertEqual(len(FederatedLibrary(self.roots_file, self.index_dir)), 0)
+
+
+class TestExporters(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.library = TrackCollection(
+            [
+                make_track(
+                    "/music/a & b.mp3",
+                    title="A & B",
+                    artist="Artist",
+                    date="2019-05-01",
+                    bpm="126",
+                    initialkey="Am",
+                    djmp_cues="1:15230;2:61000-76000",
+                ),
+                make_track("/music/c.mp3", title="C\x01\x1b[0m"),
+            ]
+        )
+        self.playlists = [
+            TrackCollection(
+                [self.library[1], make_track("/elsewhere/d.mp3")],
+                name="Set",
+                parent=True,
+            )
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def export(self, name: str) -> str:
+        path = os.path.join(self.directory, name)
+        self.assertEqual(export(name, path, self.library, self.playlists), 3)
+        return path
+
+    def test_apple_music(self):
+        with open(self.export("apple_music"), "rb") as f:
+            plist = plistlib.load(f)
+        first = plist["Tracks"]["1"]
+        self.assertEqual(first["Name"], "A & B")
+        self.assertEqual((first["BPM"], first["Year"]), (126, 2019))
+        self.assertEqual(first["Location"], "file://localhost/music/a%20%26%20b.mp3")
+        # Control characters are not allowed in XML
+        self.assertEqual(plist["Tracks"]["2"]["Name"], "C[0m")
+        items = plist["Playlists"][0]["Playlist Items"]
+        self.assertEqual([item["Track ID"] for item in items], [2, 3])
+
+    def test_rekordbox(self):
+        root = ET.parse(self.export("rekordbox")).getroot()
+        collection = root.find("COLLECTION")
+        self.assertEqual(collection.get("Entries"), "3")
+        track = collection.find("TRACK")
+        self.assertEqual(
+            (track.get("AverageBpm"), track.get("Tonality")), ("126.00", "Am")
+        )
+        marks = [
+            (mark.get("Type"), mark.get("Start"), mark.get("End"), mark.get("Num"))
+            for mark in track
+        ]
+        self.assertEqual(
+            marks, [("0", "15.230", None, "0"), ("4", "61.000", "76.000", "1")]
+        )
+        playlist = root.find("PLAYLISTS/NODE/NODE")
+        self.assertEqual(playlist.get("Name"), "Set")
+        self.assertEqual([entry.get("Key") for entry in playlist], ["2", "3"])
+
+    def test_traktor(self):
+        root = ET.parse(self.export("traktor")).getroot()
+        entry = root.find("COLLECTION/ENTRY")
+        location = entry.find("LOCATION")
+        self.assertEqual(
+            (location.get("VOLUME"), location.get("DIR"), location.get("FILE")),
+            ("Macintosh HD", "/:music/:", "a & b.mp3"),
+        )
+        self.assertEqual(entry.find("MUSICAL_KEY").get("VALUE"), "21")
+        loop = entry.findall("CUE_V2")[1]
+        self.assertEqual((loop.get("TYPE"), loop.get("LEN")), ("5", "15000.000000"))
+        keys = [key.get("KEY") for key in root.iter("PRIMARYKEY")]
+        self.assertEqual(
+            keys, ["Macintosh HD/:music/:c.mp3", "Macintosh HD/:elsewhere/:d.mp3"]
+        )
+        self.assertEqual(
+            traktor_location("/Volumes/USB/Music/a.mp3"), ("USB", "/:Music/:", "a.mp3")
+        )
+        self.assertEqual(
+            traktor_location("C:\\Music\\a.mp3"), ("C:", "/:Music/:", "a.mp3")
+        )
+
+    def test_windows_paths(self):
+        self.assertEqual(
+            file_url("C:\\Music\\a b.mp3"), "file://localhost/C:/Music/a%20b.mp3"
+        )
+
+    def test_failed_export_leaves_no_temporary_file(self):
+        path = os.path.join(self.directory, "broken.xml")
+        with self.assertRaises(AttributeError):
+            export("apple_music", path, [object()])
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_exporters_implement_write(self):
+        with self.assertRaises(TypeError):
+            Exporter(io.StringIO())
+
+    def test_snapshot_exports_the_same(self):
+        path = self.export("rekordbox")
+        with open(path, "rb") as f:
+            expected = f.read()
+        export(
+            "rekordbox",
+            path,
+            self.library.snapshot(),
+            [playlist.snapshot() for playlist in self.playlists],
+        )
+        with open(path, "rb") as f:
+            self.assertEqual(f.read(), expected)
+
+
+class TestSequencing(unittest.TestCase):
+    def setUp(self):
+        bpms = [126, 120, 130, 122, 128, 124]
+        self.tracks = [
+            make_track(f"{bpm}.mp3", bpm=str(bpm), initialkey="Am") for bpm in bpms
+        ]
+
+    def bpms(self, order):
+        return [int(self.tracks[i].bpm) for i in order]
+
+    def test_smooth_tempo(self):
+        bpms = self.bpms(sequence(self.tracks))
+        self.assertIn(
+            bpms, ([120, 122, 124, 126, 128, 130], [130, 128, 126, 124, 122, 120])
+        )
+
+    def test_opener_and_closer_stay(self):
+        order = sequence(self.tracks, opener=0, closer=2)
+        self.assertEqual((order[0], order[-1]), (0, 2))
+        costs = transition_costs(self.tracks)
+
+        def cost(order):
+            return sum(costs[a, b] for a, b in zip(order, order[1:]))
+
+        best = min(cost([0, *middle, 2]) for middle in permutations([1, 3, 4, 5]))
+        self.assertAlmostEqual(cost(order), best)
+
+    def test_undo_restores_the_order(self):
+        playlist = TrackCollection(self.tracks, name="Set", parent=True)
+        order = sequence(playlist.tracks)
+        playlist.reorder(order)
+        apply_playlist_command(playlist, reorder_command(playlist, order), undo=True)
+        self.assertEqual(playlist.tracks, self.tracks)
+
+
+class TestCLI(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_unreadable_files_are_skipped(self):
+        corrupt = os.path.join(self.directory, "corrupt.mp3")
+        with open(corrupt, "wb") as f:
+            # ID3 header with an impossible size
+            f.write(b"ID3\x04\x00\x00\x7f\x7f\x7f\x7fgarbage")
+        target = os.path.join(self.directory, "rekordbox.xml")
+        self.assertEqual(cli.main(["export", self.directory, "--rekordbox", target]), 1)
+        self.assertTrue(os.path.exists(target))
+        self.assertEqual(cli.main(["scan", self.directory]), 1)
+        self.assertEqual(cli.main(["untagged", self.directory]), 1)
+
+    def test_csv_of_rows_with_different_fields(self):
+        stream = io.StringIO()
+        rows = [
+            {"path": "a.mp3", "error": "unreadable"},
+            {"path": "b.mp3", "title": "B"},
+        ]
+        cli.write_rows(rows, "csv", stream)
+        self.assertEqual(
+            stream.getvalue().splitlines(),
+            ["path,error,title", "a.mp3,unreadable,", "b.mp3,,B"],
+        )
+
+
+class TestSync(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.tracks = []
+        for name in ("a/x.mp3", "b/x.mp3", "b/y.mp3"):
+            path = os.path.join(self.directory, "source", name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(os.urandom(1000))
+            self.tracks.append(make_track(path, title=name))
+        self.playlist = TrackCollection(self.tracks, name="Set", parent=True)
+        self.target = os.path.join(self.directory, "target")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_names_are_unique(self):
+        names = target_names([track.path for track in self.tracks])
+        self.assertEqual(len(set(names.values())), 3)
+        self.assertEqual(names[self.tracks[2].path], "y.mp3")
+
+    def test_only_changed_files_are_copied(self):
+        report = sync_playlists([self.playlist], self.target)
+        self.assertEqual((report.copied, report.skipped), (3, 0))
+        # Same size and modification time, only the checksum finds the change
+        stat = os.stat(self.tracks[2].path)
+        with open(self.tracks[2].path, "r+b") as f:
+            f.write(b"changed")
+        os.utime(self.tracks[2].path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        report = sync_playlists([self.playlist], self.target)
+        self.assertEqual((report.copied, report.skipped), (0, 3))
+        report = sync_playlists([self.playlist], self.target, checksum=True)
+        self.assertEqual((report.copied, report.skipped), (1, 2))
+        with open(os.path.join(self.target, "Set.m3u")) as f:
+            paths = [line.strip() for line in f if not line.startswith("#")]
+        self.assertEqual(paths[2], "Music/y.mp3")
+        self.assertTrue(
+            all(os.path.isfile(os.path.join(self.target, path)) for path in paths)
+        )
+
+    def test_playlists_with_the_same_file_name(self):
+        playlists = [
+            TrackCollection(self.tracks[:1], name="A/B", parent=True),
+            TrackCollection(self.tracks[1:], name="a_b", parent=True),
+        ]
+        report = sync_playlists(playlists, self.target)
+        self.assertEqual(
+            [os.path.basename(path) for path in report.playlists],
+            ["A_B.m3u", "a_b (2).m3u"],
+        )
+
+    def test_failed_copy_leaves_no_partial_file(self):
+        os.makedirs(self.target)
+        target = os.path.join(self.target, "x.mp3")
+        with unittest.mock.patch("os.fsync", side_effect=OSError("Drive is full")):
+            with self.assertRaises(OSError):
+                copy_file(self.tracks[0].path, target)
+        self.assertEqual(os.listdir(self.target), [])
+
+
+class TestSession(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.paths = []
+        for i, genre in enumerate(["House / Deep", "Techno"]):
+            path = os.path.join(self.directory, f"{i}.mp3")
+            with open(path, "wb") as f:
+                f.write(os.urandom(1000))
+            make_track(path, title=f"Track {i}", genre=genre, initialkey="Am").save(
+                path
+            )
+            self.paths.append(path)
+        self.library = TrackCollection(self.paths)
+        self.playlist = TrackCollection(
+            self.library.tracks[::-1],
+            name="Set",
+            parent=True,
+            file=os.path.join(self.directory, "Set.m3u"),
+        )
+        self.playlist.save_playlist()
+        self.library.playlists["Set"] = self.playlist
+        self.snapshot = os.path.join(self.directory, "session.bin")
+        save_session(Session(self.library, self.playlist, self.paths[1]), self.snapshot)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_round_trip(self):
+        restored = load_session(self.snapshot)
+        self.assertEqual(
+            [track.snapshot_values() for track in restored.library],
+            [track.snapshot_values() for track in self.library],
+        )
+        self.assertEqual(
+            restored.library.query_genres(all_of={"deep"}), {self.paths[0]}
+        )
+        self.assertEqual(restored.focused.name, "Set")
+        self.assertIs(restored.library.playlists["Set"], restored.focused)
+        self.assertEqual([track.path for track in restored.focused], self.paths[::-1])
+        self.assertEqual(restored.current_path, self.paths[1])
+        # The files are only read when their frames are needed
+        track = restored.library[0]
+        self.assertFalse(track.frames_loaded)
+        self.assertEqual(track["title"], ["Track 0"])
+        self.assertTrue(track.frames_loaded)
+
+    def test_changes_since_the_snapshot(self):
+        AudioTrack(self.paths[0]).update_tags({"title": "Edited"})
+        self.playlist.reorder([1, 0])
+        self.playlist.save_playlist()
+        os.utime(self.playlist.file, ns=(0, 0))
+        restored = load_session(self.snapshot)
+        self.assertEqual([track.path for track in restored.focused], self.paths)
+        self.assertEqual(changed_paths(restored.signatures), [self.paths[0]])
+        track = restored.library[0]
+        restored.library.reload_track(track)
+        self.assertEqual(restored.library.by_title["Edited"], [track])
+
+    def test_broken_snapshot(self):
+        with open(self.snapshot, "r+b") as f:
+            f.write(b"garbage!")
+        with self.assertRaises(SnapshotError):
+            load_session(self.snapshot)
+
+
+class TestHistory(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "history.bin")
+        self.history = PlayHistory(self.path, checkpoint_interval=4)
+        for session, plays in enumerate([["a", "b", "a"], ["c", "a"], ["b"]]):
+            self.history.session = session
+            for i, path in enumerate(plays):
+                self.history.record(path, 1000 * session + 10 * i, 5.5)
+
+    def tearDown(self):
+        self.history.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_queries(self):
+        self.assertEqual(self.history.play_counts(), {"a": 3, "b": 2, "c": 1})
+        self.assertEqual(self.history.play_counts(since=1000), {"a": 1, "b": 1, "c": 1})
+        self.assertEqual(self.history.played_since(1010), {"a", "b"})
+        self.assertEqual(self.history.sessions(), [0, 1, 2])
+        self.assertEqual(
+            self.history.session_plays(1), [("c", 1000.0, 5.5), ("a", 1010.0, 5.5)]
+        )
+        self.assertEqual(self.history.session_plays(5), [])
+
+    def test_reopen_after_checkpoint_and_interruption(self):
+        self.history.close()
+        with open(self.path, "ab") as f:
+            f.write(b"\0" * 7)
+        self.history = PlayHistory(self.path, checkpoint_interval=4)
+        self.assertEqual(len(self.history), 6)
+        self.assertEqual(self.history.session, 3)
+        self.assertEqual(self.history.play_counts(), {"a": 3, "b": 2, "c": 1})
+        self.history.record("c", 3000, 1.0)
+        self.assertEqual(self.history.session_plays(3), [("c", 3000.0, 1.0)])
+        self.assertEqual(self.history.play_counts()["c"], 2)
+
+    def test_tracker(self):
+        tracker = PlayTracker(self.history, min_played=0.0)
+        tracker.play("d")
+        tracker.pause()
+        tracker.play("d")
+        self.assertTrue(tracker.finish())
+        self.assertFalse(tracker.finish())
+        self.assertEqual(self.history.play_counts()["d"], 1)
+        tracker.min_played = 60.0
+        tracker.play("e")
+        tracker.play("d")
+        self.assertNotIn("e", self.history.play_counts())
+
+
+class TestHealth(unittest.TestCase):
+    # MPEG 1 layer 3 frame at 128 kbit/s and 44.1 kHz, 417 bytes without sync bytes
+    FRAME = b"\xff\xfb\x90\x64" + bytes(range(1, 200)) * 2 + bytes(15)
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = FileCache("health", os.path.join(self.directory, "cache.db"))
+
+    def tearDown(self):
+        self.cache.connection.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def write(self, name: str, data: bytes) -> str:
+        path = os.path.join(self.directory, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        return path
+
+    def test_check_file(self):
+        intact = self.write("intact.mp3", self.FRAME * 500)
+        damaged = self.FRAME * 200 + bytes(100 * len(self.FRAME)) + self.FRAME * 200
+        self.assertEqual(check_file(intact)["status"], OK)
+        self.assertEqual(
+            check_file(self.write("damaged.mp3", damaged))["status"], CORRUPT
+        )
+        self.assertEqual(check_file(self.write("empty.mp3", b""))["status"], CORRUPT)
+        self.assertEqual(check_file(intact + ".missing")["status"], MISSING)
+
+    def test_recheck_reads_changed_files_only(self):
+        paths = [self.write(f"{i}.mp3", self.FRAME * 50) for i in range(3)]
+        results = check_files(paths, cache=self.cache)
+        self.assertEqual(broken_paths(results), set())
+        with open(paths[1], "r+b") as f:
+            f.write(bytes(len(self.FRAME) * 50))
+        checked = []
+        results = check_files(
+            paths, cache=self.cache, progress=lambda done, total: checked.append(done)
+        )
+        self.assertEqual(broken_paths(results), {paths[1]})
+        # Two results came from the cache, one file was read again
+        self.assertEqual(checked, [2, 3])
+
+
+class TestInference(unittest.TestCase):
+    def test_file_and_folder_names(self):
+        inferrer = PathInferrer()
+        self.assertEqual(
+            inferrer.infer(
+                "/music/Drumcode/2019/01 - Adam Beyer - Your Mind (Remix).mp3"
+            ),
+            {
+                "organization": "Drumcode",
+                "date": "2019",
+                "tracknumber": "01",
+                "artist": "Adam Beyer",
+                "title": "Your Mind (Remix)",
+            },
+        )
+        self.assertEqual(
+            inferrer.infer("/music/Moderat - II (2013)/Bad_Kingdom.mp3"),
+            {
+                "artist": "Moderat",
+                "album": "II",
+                "date": "2013",
+                "title": "Bad Kingdom",
+            },
+        )
+        self.assertEqual(
+            inferrer.infer("/music/808 State - Pacific State.mp3"),
+            {"artist": "808 State", "title": "Pacific State"},
+        )
+        with self.assertRaises(ValueError):
+            compile_pattern("{artist} - {colour}")
+
+    def test_only_empty_tags_are_proposed(self):
+        inferrer = PathInferrer(["{artist} - {title}"], [])
+        tagged = make_track("/music/Artist - Title.mp3", artist="Other", title="Title")
+        untagged = make_track("/music/Artist - Name.mp3")
+        # Snapshots of the tracks, as the UI passes them to its worker thread
+        rows = [
+            track_tags(TrackRecord.from_track(track), inferrer.fields)
+            for track in (tagged, untagged)
+        ]
+        proposals = inferrer.propose(rows)
+        self.assertEqual(
+            proposals, {untagged.path: {"artist": "Artist", "title": "Name"}}
+        )
+        proposals = inferrer.propose(rows[:1], overwrite=True)
+        self.assertEqual(proposals, {tagged.path: {"artist": "Artist"}})
+
+    def test_fields_without_attribute_are_read_from_frames(self):
+        inferrer = PathInferrer(["{label} - {title}"], [])
+        self.assertEqual(inferrer.fields, {"organization", "title"})
+        track = make_track("/music/Warp - Title.mp3", organization="Warp")
+        self.assertEqual(
+            track_tags(track, inferrer.fields),
+            {"path": track.path, "organization": "Warp", "title": ""},
+        )
+
+
+class TestKeyDetection(unittest.TestCase):
+    def test_camelot(self):
+        self.assertEqual(to_camelot("Am"), "8A")
+        self.assertEqual(to_camelot("Bb minor"), "3A")
+        self.assertEqual(to_camelot("Db"), "3B")
+        self.assertEqual(to_camelot("unknown"), "")
+
+    def test_estimate_key_from_profile(self):
+        # The minor profile rotated to D is D minor
+        key, _ = estimate_key(np.roll(MINOR_PROFILE, 2))
+        self.assertEqual(key, "Dm")
+
+    def test_chroma_of_a_major_triad(self):
+        sample_rate = 11025
+        t = np.arange(sample_rate * 5) / sample_rate
+        signal = sum(np.sin(2 * np.pi * f * t) for f in (261.63, 329.63, 392.0))
+        key, _ = estimate_key(chroma(signal.astype(np.float32), sample_rate))
+        self.assertEqual(key, "C")
+
+    def test_result_tags_of_changed_tracks(self):
+        collection = TrackCollection(
+            [make_track("a.mp3", initialkey="Am"), make_track("b.mp3")]
+        )
+        results = {
+            path: {"key": "Am", "camelot": "8A", "confidence": 1.0}
+            for path in ("a.mp3", "b.mp3", "missing.mp3")
+        }
+        self.assertEqual(
+            result_tags(collection, results, key_tags),
+            {"b.mp3": {"initialkey": "Am"}},
+        )
+
+    def test_only_the_middle_of_long_tracks_is_decoded(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        path = os.path.join(directory, "long.wav")
+        sample_rate = 11025
+        t = np.arange(sample_rate * 10) / sample_rate
+        chord = sum(np.sin(2 * np.pi * f * t) for f in (261.63, 329.63, 392.0))
+        with wave.open(path, "wb") as f:
+            f.setnchannels(1)
+            f.setsampwidth(2)
+            f.setframerate(sample_rate)
+            for _ in range(20):
+                f.writeframes((chord * 8000).astype(np.int16).tobytes())
+        with unittest.mock.patch(
+            "key_detection.decode_audio", wraps=decode_audio
+        ) as decode:
+            self.assertEqual(detect_key(path)["key"], "C")
+        offset, duration = decode.call_args.args[2:4]
+        self.assertAlmostEqual(offset, 10.0)
+        self.assertEqual(duration, 180.0)
+
+
+class TestBeatgrid(unittest.TestCase):
+    def test_snap(self):
+        grid = Beatgrid(first_beat=250.0, interval=500.0)
+        self.assertEqual(grid.snap(1010), 1250)
+        self.assertEqual(grid.snap(1300, bar=True), 2250)
+        self.assertEqual(grid.snap(-100), 250)
+        self.assertEqual(grid.snap(-100, bar=True), 250)
+        self.assertEqual(parse_beatgrid(str(grid)), grid)
+        self.assertIsNone(parse_beatgrid("broken"))
+
+    def test_kicks_with_off_beat_hats(self):
+        sample_rate, bpm, first_downbeat = 11025, 125.0, 0.37
+        rng = np.random.default_rng(0)
+        signal = rng.normal(0, 0.02, sample_rate * 60).astype(np.float32)
+        t = np.arange(int(0.1 * sample_rate)) / sample_rate
+        kick = np.sin(2 * np.pi * 55 * t) * np.exp(-30 * t)
+        hat = rng.normal(0, 0.3, len(t)) * np.exp(-200 * t)
+        interval = 60 / bpm
+        for beat in range(int((60 - first_downbeat) / interval) - 1):
+            start = int((first_downbeat + beat * interval) * sample_rate)
+            # Accented downbeats, every beat has a kick and an off-beat hi-hat
+            signal[start : start + len(t)] += kick * (1.0 if beat % 4 == 0 else 0.4)
+            off_beat = start + int(interval / 2 * sample_rate)
+            signal[off_beat : off_beat + len(t)] += hat
+        result = estimate_beatgrid(signal, sample_rate)
+        self.assertAlmostEqual(result["bpm"], bpm, delta=0.05)
+        self.assertAlmostEqual(result["first_beat"], first_downbeat * 1000, delta=15)
+
+
+class TestEnergy(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = FileCache("energy", os.path.join(self.directory, "cache.db"))
+        self.store = EnergyStore(os.path.join(self.directory, "energy.bin"), self.cache)
+
+    def tearDown(self):
+        self.cache.connection.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def kicks(self, level: float, seconds: int = 20) -> np.ndarray:
+        sample_rate = 11025
+        signal = np.zeros(sample_rate * seconds, np.float32)
+        t = np.arange(int(0.1 * sample_rate)) / sample_rate
+        kick = level * np.sin(2 * np.pi * 55 * t) * np.exp(-30 * t)
+        for start in range(0, len(signal) - len(t), sample_rate // 2):
+            signal[start : start + len(t)] += kick
+        return signal
+
+    def test_loud_drums_rate_higher(self):
+        quiet = energy_curves(self.kicks(0.05), 11025)
+        loud = energy_curves(self.kicks(0.9), 11025)
+        self.assertEqual(quiet.shape, (20, 2))
+        self.assertEqual(quiet.dtype, np.uint8)
+        self.assertLess(energy_rating(quiet), energy_rating(loud))
+        self.assertEqual(energy_rating(np.zeros((0, 2), np.uint8)), 0)
+
+    def test_store_concatenates_curves(self):
+        a, b = (os.path.join(self.directory, name) for name in ("a.mp3", "b.mp3"))
+        for path in (a, b):
+            with open(path, "wb") as f:
+                f.write(b"audio")
+        first = energy_curves(self.kicks(0.9, 10), 11025)
+        second = energy_curves(self.kicks(0.2, 5), 11025)
+        self.store.add({a: {"curves": first.tobytes(), "rating": 7}})
+        self.store.add(
+            {
+                b: {"curves": second.tobytes(), "rating": 3},
+                "missing.mp3": {"curves": second.tobytes(), "rating": 3},
+            }
+        )
+        np.testing.assert_array_equal(self.store.curves(b), second)
+        self.assertEqual(self.store.ratings(), {a: 7, b: 3})
+
+        # Stored entries are found again by a new store
+        store = EnergyStore(self.store.path, self.cache)
+        tracks = [make_track(path) for path in (b, "missing.mp3", a)]
+        energy, starts = store.playlist_energy(tracks)
+        self.assertEqual(len(energy), 15)
+        self.assertEqual(starts, [0, 5, 5])
+
+    def test_store_drops_changed_files_and_compacts(self):
+        a, b = (os.path.join(self.directory, name) for name in ("a.mp3", "b.mp3"))
+        for path in (a, b):
+            with open(path, "wb") as f:
+                f.write(b"audio")
+        first = energy_curves(self.kicks(0.9, 10), 11025)
+        second = energy_curves(self.kicks(0.2, 5), 11025)
+        self.store.add(
+            {
+                a: {"curves": first.tobytes(), "rating": 7},
+                b: {"curves": second.tobytes(), "rating": 3},
+            }
+        )
+        with open(a, "ab") as f:
+            f.write(b" edited")
+
+        # The curves of a take two thirds of the file, which is compacted
+        store = EnergyStore(self.store.path, self.cache)
+        self.assertEqual(store.ratings(), {b: 3})
+        self.assertEqual(os.path.getsize(store.path), second.nbytes)
+        np.testing.assert_array_equal(store.curves(b), second)
+        store = EnergyStore(self.store.path, self.cache)
+        np.testing.assert_array_equal(store.curves(b), second)
+
+
+class TestPreview(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_drop_is_the_largest_rise(self):
+        curves = np.full((120, 2), 60, np.uint8)
+        curves[40:48] = 20  # breakdown
+        curves[48:] = 220  # drop
+        self.assertEqual(find_drop(curves, 1.0), 48.0)
+        self.assertEqual(preview_start(curves), 46.0)
+        # No clear drop, the preview starts at the offset of the settings
+        flat = np.full((120, 2), 100, np.uint8)
+        self.assertIsNone(find_drop(flat, 1.0))
+        self.assertEqual(preview_start(flat), preview_start(None))
+
+    def test_cache_evicts_least_recently_used(self):
+        cache = PreviewCache(os.path.join(self.directory, "preview.pcm"), 2, 1.0, 100)
+        signal = np.linspace(-1, 1, 150, dtype=np.float32)
+        cache.put("a", signal, 1000)
+        cache.put("b", signal[:50], 0)
+        pcm, start = cache.get("a")
+        self.assertEqual((len(pcm), start), (100 * 2 * 2, 1000))
+        cache.put("c", signal, 0)
+        self.assertEqual(sorted(cache.index), ["a", "c"])
+        self.assertEqual(os.path.getsize(cache.path), 2 * 100 * 2 * 2)
+        cache.close()
+
+    def test_loader_decodes_segment(self):
+        path = os.path.join(self.directory, "short.wav")
+        with wave.open(path, "wb") as f:
+            f.setnchannels(2)
+            f.setsampwidth(2)
+            f.setframerate(44100)
+            f.writeframes(np.full(44100 * 4 * 2, 16384, np.int16).tobytes())
+        cache = PreviewCache(os.path.join(self.directory, "preview.pcm"), 4)
+        loader = PreviewLoader(cache=cache)
+        loaded = []
+        loader.loaded.connect(loaded.append)
+        # Shorter than the offset, the preview starts at the beginning
+        loader.wanted.add(path)
+        loader.load(path, 60.0)
+        self.assertEqual(loaded, [path])
+        pcm, start = cache.get(path)
+        self.assertEqual((len(pcm), start), (44100 * 4 * 4, 0))
+        # Tracks that were scrolled away are not decoded
+        loader.set_wanted(set())
+        loader.load("missing.wav", 0.0)
+        self.assertNotIn("missing.wav", cache)
+        # Unexpected errors do not leave the track pending, it can be requested again
+        loader.set_wanted({path})
+        with unittest.mock.patch("preview.decode_segment", side_effect=ValueError):
+            loader.pending.add("other.wav")
+            loader.wanted.add("other.wav")
+            loader.load("other.wav", 0.0)
+        self.assertEqual(loader.pending, set())
+        loader.shutdown()
+
+
+class TestLoudness(unittest.TestCase):
+    def test_sine_in_one_channel(self):
+        # BS.1770: a full scale 997 Hz sine in one channel is -3.01 LUFS
+        t = np.arange(48000 * 10) / 48000
+        sine = np.sin(2 * np.pi * 997 * t).astype(np.float32)
+        signal = np.stack([sine, np.zeros_like(sine)], axis=1)
+        self.assertAlmostEqual(integrated_loudness(signal), -3.01, places=1)
+
+    def test_mono_file_is_one_channel(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        path = os.path.join(directory, "mono.wav")
+        t = np.arange(48000 * 10) / 48000
+        sine = np.sin(2 * np.pi * 997 * t)
+        with wave.open(path, "wb") as f:
+            f.setnchannels(1)
+            f.setsampwidth(2)
+            f.setframerate(48000)
+            f.writeframes((sine * 32767).astype(np.int16).tobytes())
+        self.assertAlmostEqual(measure_loudness(path)["lufs"], -3.01, places=1)
+
+    def test_playback_gain_respects_true_peak(self):
+        track = make_track(
+            "quiet.mp3",
+            replaygain_track_gain="6.00 dB",
+            replaygain_track_peak="0.5",
+        )
+        # -24 LUFS would need +10 dB to reach -14 LUFS, but the peak allows only ~6 dB
+        self.assertAlmostEqual(playback_gain(track, target=-14.0), 6.02, places=2)
+
+
+class TestQuality(unittest.TestCase):
+    SAMPLE_RATE = 44100
+
+    def noise(self, cutoff=None, seconds=20):
+        # Noise falling off towards the highs like music, lowpassed like an MP3 encoder
+        n = self.SAMPLE_RATE * seconds
+        spectrum = np.fft.rfft(np.random.default_rng(0).standard_normal(n))
+        frequencies = np.fft.rfftfreq(n, 1 / self.SAMPLE_RATE)
+        spectrum /= np.sqrt(np.maximum(frequencies, 20))
+        if cutoff is not None:
+            spectrum[frequencies > cutoff] = 0
+        signal = np.fft.irfft(spectrum, n)
+        return (0.5 * signal / np.abs(signal).max()).astype(np.float32)
+
+    def test_cutoff(self):
+        cutoff, sharp = estimate_cutoff(
+            average_spectrum([self.noise(16000)]), self.SAMPLE_RATE
+        )
+        self.assertAlmostEqual(cutoff, 16000, delta=300)
+        self.assertTrue(sharp)
+        cutoff, sharp = estimate_cutoff(
+            average_spectrum([self.noise()]), self.SAMPLE_RATE
+        )
+        self.assertGreater(cutoff, 21000)
+        self.assertFalse(sharp)
+
+    def test_lossless_file_from_lossy_source_is_suspect(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        path = os.path.join(directory, "test_quality.wav")
+        with wave.open(path, "wb") as f:
+            f.setnchannels(1)
+            f.setsampwidth(2)
+            f.setframerate(self.SAMPLE_RATE)
+            f.writeframes((self.noise(16000) * 32767).astype(np.int16).tobytes())
+        result = analyze_quality(path)
+        self.assertTrue(result["suspect"])
+        self.assertEqual(result["source_bitrate"], 128)
+
+
+class TestCuePoints(unittest.TestCase):
+    def test_round_trip(self):
+        cues = {1: CuePoint(1, 15230), 2: CuePoint(2, 61000, 76000)}
+        self.assertEqual(format_cues(cues), "1:15230;2:61000-76000")
+        self.assertEqual(parse_cues(format_cues(cues)), cues)
+
+    def test_invalid_entries_are_skipped(self):
+        self.assertEqual(list(parse_cues("9:100;x:1;3:200")), [3])
+
+    def test_cues_are_read_from_tags(self):
+        track = make_track("a.mp3", djmp_cues="4:1000-5000")
+        self.assertTrue(track.cues[4].is_loop)
+
+
 if __name__ == "__main__":
     unittest.main(verbosity=2)
@@ -1,17 +1,57 @@
 import copy
-import glob
 import logging
 import os
 import platform
 import traceback
 
+import audio_analysis
+import beatgrid
+import energy
+import exporters
+import health
+import history
+import inference
+import key_detection
+import library
+import loudness
+import preview
+import quality
+import remote
+import sequencing
+import session
+import sync
 import utility
-from audio_track import AudioTrack, TrackCollection
+from audio_track import GENRE_SEPARATOR, AudioTrack, TrackCollection, split_genres
+from cache import FileCache, open_cache
+from cue_points import CUE_TAG, MAX_CUES, CueStore
+from journal import (
+    Journal,
+    apply_playlist_command,
+    apply_tags_command,
+    insert_command,
+    playlist_key,
+    remove_command,
+    reorder_command,
+    tag_values,
+    tags_batch_command,
+    tags_command,
+)
 from logger import Logger
+from player import DeferredPlayer
+from recommend import RecommendationIndex
+from mutagen import MutagenError
 from mutagen.easyid3 import EasyID3
 from PyQt6.QtCore import QDir, QSize, Qt, QTime, QTimer, QUrl
-from PyQt6.QtGui import QAction, QFont, QIcon, QKeySequence, QMovie, QPixmap
-from PyQt6.QtMultimedia import QAudioOutput, QMediaPlayer
+from PyQt6.QtGui import (
+    QAction,
+    QActionGroup,
+    QColor,
+    QFont,
+    QIcon,
+    QKeySequence,
+    QMovie,
+    QPixmap,
+)
 from PyQt6.QtWidgets import (
     QApplication,
     QFileDialog,
@@ -19,6 +59,8 @@ from PyQt6.QtWidgets import (
     QHBoxLayout,
     QInputDialog,
     QLabel,
+    QListWidget,
+    QListWidgetItem,
     QMainWindow,
     QMessageBox,
     QPushButton,
@@ -27,8 +69,24 @@ from PyQt6.QtWidgets import (
     QVBoxLayout,
     QWidget,
 )
-from settings import LoggerSettings, UISettings
-from widgets import LimitedGridLayout, RemovableButton, TabWidget, TrackTable
+from settings import (
+    HealthSettings,
+    HistorySettings,
+    LibrarySettings,
+    LoggerSettings,
+    PreviewSettings,
+    UISettings,
+)
+from smart_crates import Rule, SmartCrate, SmartCrateStore
+from widgets import (
+    BackgroundTask,
+    CommandBridge,
+    EnergyCurve,
+    LimitedGridLayout,
+    RemovableButton,
+    TabWidget,
+    TrackTable,
+)
 
 log = Logger("UI", LoggerSettings.log_level)
 
@@ -44,10 +102,8 @@ class UI(QMainWindow):
         self.setWindowTitle("Music Player")
         self.showFullScreen()
 
-        self.audio_output = QAudioOutput()
-        self.media_player = QMediaPlayer(self)
-        self.media_player.setAudioOutput(self.audio_output)
-        self.media_player.setPosition(0)
+        # The multimedia stack is started on the first play
+        self.media_player = DeferredPlayer(self)
 
         # Define Theme
         self.setPalette(QApplication.style().standardPalette())
@@ -58,8 +114,38 @@ class UI(QMainWindow):
         self.collection = TrackCollection()
         self.focused_collection = self.collection
         self.current_track = None
+        self.background_tasks = set()
+        # Results of the last health check per path, see health.check_file. Results
+        # of earlier runs are read from the cache in the background
+        self.health_results: dict[str, dict] = dict()
+        self.health_cache = FileCache("health")
+        # Quality results of earlier runs, read like the health results
+        self.quality_cache = FileCache("quality")
+        # Names of the active filters of Tools, see table_filter_paths
+        self.table_filters: set[str] = set()
+        # Path -> (size, mtime_ns) of the tracks when the session was saved
+        self.session_signatures: dict[str, tuple[int, int]] = dict()
+        # Control API on localhost, see init_remote
+        self.remote_server: remote.RemoteServer | None = None
+        restored = self.restore_session() if ui_settings.restore_session else None
+        self.library_roots = library.FederatedLibrary()
+        self.collection.add_listener(self.library_roots.on_library_changed)
+        self.init_journal()
+        self.play_history = history.PlayHistory()
+        self.play_tracker = history.PlayTracker(self.play_history)
         self.widget_init()
         self.init_menubar()
+        if restored is not None:
+            self.show_session(restored)
+        self.load_health_results()
+        self.load_quality_results()
+        if len(self.library_roots):
+            self.run_in_background(
+                self.library_roots.load_indexes,
+                on_finished=self.on_library_indexes_loaded,
+            )
+        if ui_settings.remote_control:
+            self.init_remote()
 
         self.show()
 
@@ -77,12 +163,15 @@ class UI(QMainWindow):
         # Create Tag labels
         self.track_label = QLabel("Track Name")
         self.bpm_label = QLabel("BPM")
+        self.key_label = QLabel("Key")
         self.genre_label = QLabel("Genre")
         self.date_label = QLabel("Date")
+        self.cue_label = QLabel("Cues")
         self.path_label = QLabel("Path")
 
         # Track_table
         self.track_table = TrackTable(parent_window=self)
+        self.track_table.filled.connect(self.on_track_table_filled)
 
         ###### Utility Widget
         self.utilities_one = TabWidget()
@@ -90,6 +179,8 @@ class UI(QMainWindow):
 
         # Genre Buttons
         self.genre_buttons_mode = "set"
+        self.genre_filter_include = set()
+        self.genre_filter_exclude = set()
         self.genre_buttons_tab = QVBoxLayout()
         self.genre_buttons = LimitedGridLayout(max_columns=5)
         plus_button = QPushButton("Add Genre Button +")
@@ -105,10 +196,59 @@ class UI(QMainWindow):
         plus_button = QPushButton("New Playlist +")
         plus_button.clicked.connect(self.create_playlist)
         self.playlist_buttons_tab.addWidget(plus_button)
+        smart_crate_button = QPushButton("New Smart Crate +")
+        smart_crate_button.clicked.connect(self.create_smart_crate)
+        self.playlist_buttons_tab.addWidget(smart_crate_button)
         self.playlist_buttons_tab.addStretch(1)
         self.playlist_buttons_tab.addLayout(self.playlist_buttons)
         self.utilities_one.add_tab("Playlists", self.playlist_buttons_tab)
 
+        # Folders of the library on the drives, see library.FederatedLibrary
+        self.library_tab = QVBoxLayout()
+        self.roots_list = QListWidget()
+        self.roots_list.itemActivated.connect(self.on_library_root_activated)
+        self.library_tab.addWidget(self.roots_list)
+        root_buttons = QHBoxLayout()
+        for text, fnc in (
+            ("Add Folder +", self.add_library_root),
+            ("Rescan", self.rescan_library_root),
+            ("Remove", self.remove_library_root),
+        ):
+            button = QPushButton(text)
+            button.clicked.connect(fnc)
+            root_buttons.addWidget(button)
+        self.library_tab.addLayout(root_buttons)
+        self.utilities_one.add_tab("Library", self.library_tab)
+        self.update_roots_list()
+        # Checks only the root folders, so a mounted drive shows up within seconds
+        self.mount_timer = QTimer(self)
+        self.mount_timer.setInterval(int(LibrarySettings.mount_check_interval * 1000))
+        self.mount_timer.timeout.connect(self.check_library_mounts)
+        self.mount_timer.start()
+
+        # Tracks similar to the current one
+        self.suggestions_tab = QVBoxLayout()
+        self.suggestions = QListWidget()
+        self.suggestions.itemActivated.connect(self.on_suggestion_activated)
+        self.suggestions_tab.addWidget(self.suggestions)
+        self.utilities_two.add_tab("Suggest Next", self.suggestions_tab)
+
+        # Energy of the tracks in the table one after the other
+        self.energy_store = energy.EnergyStore()
+        # Checks every file, the table shows the ratings once they are read
+        self.energy_store.defer_loading()
+        self.run_in_background(
+            self.energy_store.load, on_finished=self.on_energy_loaded
+        )
+        self.energy_tab = QVBoxLayout()
+        self.energy_curve = EnergyCurve()
+        self.energy_curve.track_clicked.connect(self.on_energy_track_clicked)
+        self.energy_tab.addWidget(self.energy_curve)
+        self.utilities_two.add_tab("Energy", self.energy_tab)
+        # Built on the first suggestion, see get_recommendation_index
+        self.recommendation_index = None
+        self.building_recommendations = False
+
         # Media buttons
         self.play_button = QPushButton(">")
         self.pause_button = QPushButton("||")
@@ -123,7 +263,29 @@ class UI(QMainWindow):
         self.volume_slider = QSlider(Qt.Orientation.Horizontal)
         self.volume_slider.setMaximum(100)
         self.volume_slider.setValue(50)
-        self.media_player.audioOutput().setVolume(50)
+        # Gain in dB that levels the loudness of the current track
+        self.track_gain = 0.0
+        self.loudness_cache = FileCache("loudness")
+        self.apply_volume()
+
+        # Auditions of tracks in the table on their own output, see audition
+        self.previews = preview.PreviewLoader(self)
+        self.previews.loaded.connect(self.on_preview_loaded)
+        self.preview_player = preview.PreviewPlayer(self)
+        # Track to audition as soon as its preview is decoded
+        self.pending_audition = None
+        # Previews around the visible rows are decoded once the first was auditioned
+        self.prefetch_previews_enabled = False
+        self.preview_timer = QTimer(self)
+        self.preview_timer.setSingleShot(True)
+        self.preview_timer.setInterval(100)
+        self.preview_timer.timeout.connect(self.prefetch_previews)
+        self.track_table.verticalScrollBar().valueChanged.connect(
+            self.schedule_preview_prefetch
+        )
+        self.track_table.itemSelectionChanged.connect(self.schedule_preview_prefetch)
+        self.track_table.filled.connect(self.schedule_preview_prefetch)
+        self.track_table.cellEntered.connect(self.on_track_table_hovered)
 
         # Add labels for time display
         self.time_elapsed_label = QLabel("00:00")
@@ -140,8 +302,10 @@ class UI(QMainWindow):
         layout.addWidget(self.track_label)
         tags_layout = QHBoxLayout()
         tags_layout.addWidget(self.bpm_label)
+        tags_layout.addWidget(self.key_label)
         tags_layout.addWidget(self.genre_label)
         tags_layout.addWidget(self.date_label)
+        tags_layout.addWidget(self.cue_label)
         table_util_layout = QHBoxLayout()
         util_layout = QVBoxLayout()
         util_layout.addWidget(self.utilities_one)
@@ -189,9 +353,22 @@ class UI(QMainWindow):
 
         # Connect media player positionChanged signal
         self.media_player.positionChanged.connect(self.update_time_labels)
+        self.media_player.positionChanged.connect(self.broadcast_position)
+        self.position_due = remote.position_throttle()
 
         self.media_player.sourceChanged.connect(self.update_track)
 
+        self.media_player.loaded.connect(self.on_media_loaded)
+
+        # Hot cues and loops
+        self.cue_store = CueStore()
+        self.active_loop = None
+        # None, "beat" or "bar", seeks and cues snap to the beatgrid, see quantize
+        self.quantize_mode = None
+        self.loop_timer = QTimer(self)
+        self.loop_timer.setInterval(5)
+        self.loop_timer.timeout.connect(self.check_loop)
+
         # File path of the current track
         self.current_track = ""
         self.current_tags = None
@@ -206,6 +383,12 @@ class UI(QMainWindow):
         # Read the saved button texts from the file
         self.load_saved_button_texts()
 
+        # Smart crates follow the changes of the collection
+        self.smart_crates = SmartCrateStore()
+        self.smart_crates.load()
+        self.smart_crates.attach(self.collection)
+        self.init_smart_crate_buttons()
+
     def show_file_in_explorer(self):
         if not self.current_track:
             return
@@ -235,6 +418,9 @@ class UI(QMainWindow):
             self.saved_button_texts.add(button_text)
             # Save the updated list of button texts to the file
             self.save_button_texts()
+            self.journal.record(
+                {"op": "genre_button", "text": button_text, "added": True}
+            )
 
     def create_genre_button(self):
         self.dynamic_buttons("Enter Genre", "Genre:")
@@ -251,27 +437,82 @@ class UI(QMainWindow):
             self.add_dynamic_button(button_text)
 
     def on_genre_button_click(self, button):
+        modifiers = QApplication.keyboardModifiers()
+        if modifiers & Qt.KeyboardModifier.ControlModifier:
+            exclude = bool(modifiers & Qt.KeyboardModifier.AltModifier)
+            self.toggle_genre_filter(button, exclude)
+            return
         button_text = button.text
         if self.current_track and self.current_tags:
-            if "genre" in self.current_tags and len(self.current_tags["genre"]) > 0:
-                genre = list(self.current_tags["genre"][0].split(" / "))
-                if button_text in genre:
-                    genre.remove(button_text)
-                else:
-                    genre += [button_text]
+            genre = split_genres(self.current_track.genre)
+            if button_text in genre:
+                genre.remove(button_text)
             else:
-                genre = [button_text]
-            genre = " / ".join(genre)
-            self.current_tags.update({"genre": genre})
+                genre += [button_text]
+            genre = GENRE_SEPARATOR.join(genre)
+            self.edit_tags(self.current_track, {"genre": genre})
             self.genre_label.setText(f"Genre: {genre}")
-            self.current_tags.save()
+            if self.genre_filter_include or self.genre_filter_exclude:
+                self.apply_genre_filter()
+
+    def toggle_genre_filter(self, button, exclude=False):
+        """Ctrl-click adds the genre to the table filter, Ctrl+Alt-click excludes it.
+        Clicking an active filter genre again removes it from the filter."""
+        genre = button.text
+        if genre in self.genre_filter_include or genre in self.genre_filter_exclude:
+            self.genre_filter_include.discard(genre)
+            self.genre_filter_exclude.discard(genre)
+            button.button.setStyleSheet("")
+        elif exclude:
+            self.genre_filter_exclude.add(genre)
+            button.button.setStyleSheet("text-decoration: line-through;")
+        else:
+            self.genre_filter_include.add(genre)
+            button.button.setStyleSheet("font-weight: bold;")
+        self.apply_genre_filter()
+
+    def table_filter_paths(self, name: str) -> set[str]:
+        if name == "broken":
+            return health.broken_paths(self.health_results)
+        if name == "suspect":
+            return quality.suspect_paths(self.track_table.quality)
+        if name == "available":
+            return set(self.collection.by_path) - self.track_table.unavailable
+        if name == "not_recent":
+            recent = self.play_history.played_in_last_days(HistorySettings.recent_days)
+            return set(self.collection.by_path) - recent
+        raise ValueError(f"Unknown table filter {name}")
+
+    def toggle_table_filter(self, name: str, checked: bool):
+        if checked:
+            self.table_filters.add(name)
+        else:
+            self.table_filters.discard(name)
+        self.apply_genre_filter()
+
+    def apply_genre_filter(self):
+        paths = None
+        if self.genre_filter_include or self.genre_filter_exclude:
+            paths = self.collection.query_genres(
+                all_of=self.genre_filter_include, none_of=self.genre_filter_exclude
+            )
+            log.debug(f"Genre filter matches {len(paths)} tracks")
+        for name in self.table_filters:
+            filter_paths = self.table_filter_paths(name)
+            paths = filter_paths if paths is None else paths & filter_paths
+        self.track_table.filter_rows(paths)
 
     def on_genre_button_remove_click(self, button):
         button_text = button.text
+        if button_text in self.genre_filter_include | self.genre_filter_exclude:
+            self.genre_filter_include.discard(button_text)
+            self.genre_filter_exclude.discard(button_text)
+            self.apply_genre_filter()
         self.saved_button_texts.remove(button_text)
         self.save_button_texts()
         self.genre_buttons.clear_layout()
         self.init_saved_buttons()
+        self.journal.record({"op": "genre_button", "text": button_text, "added": False})
 
     def load_saved_button_texts(self):
         try:
@@ -289,6 +530,7 @@ class UI(QMainWindow):
     def play(self):
         if self.current_track:
             self.media_player.play()
+            self.play_tracker.play(self.current_track.path)
             # Start the timer to update time labels every second
             self.timer.start(1000)
 
@@ -308,19 +550,54 @@ class UI(QMainWindow):
 
     def pause(self):
         self.media_player.pause()
+        self.play_tracker.pause()
         self.timer.stop()
 
     def stop(self):
         self.timer.stop()
         self.media_player.stop()
+        self.finish_play()
+
+    def finish_play(self):
+        if self.play_tracker.finish() and "not_recent" in self.table_filters:
+            self.apply_genre_filter()
 
     def change_volume(self, value):
-        self.media_player.audioOutput().setVolume(value)
+        self.apply_volume()
 
         self.volume_label.setText(str(value) + "%")
 
+    def apply_volume(self):
+        volume = self.volume_slider.value() / 100 * 10 ** (self.track_gain / 20)
+        self.media_player.setVolume(min(volume, 1.0))
+
     def set_position(self, position):
-        self.media_player.setPosition(position)
+        self.media_player.setPosition(self.quantize(position))
+
+    def quantize(self, position: int) -> int:
+        """Snaps a position to the beatgrid of the current track if quantizing is on."""
+        if self.quantize_mode is None or not self.current_track:
+            return position
+        grid = self.current_track.beatgrid
+        if grid is None:
+            return position
+        return grid.snap(position, bar=self.quantize_mode == "bar")
+
+    def set_quantize_mode(self, mode: str, checked: bool):
+        if checked:
+            self.quantize_mode = mode
+        elif self.quantize_mode == mode:
+            self.quantize_mode = None
+
+    def broadcast_position(self):
+        if self.remote_server is not None and self.position_due():
+            self.remote_server.broadcast(
+                "position",
+                {
+                    "position": self.media_player.position(),
+                    "duration": self.media_player.duration(),
+                },
+            )
 
     def update_time_labels(self):
         if self.media_player.duration() > 0:
@@ -348,16 +625,69 @@ class UI(QMainWindow):
         self.media_player.setPosition(0)
         self.seek_slider.setValue(0)
 
+        self.update_tag_labels()
+
+    def update_tag_labels(self):
         current_track = self.current_track
         track_name = f"{current_track.artist} - {current_track.title}"
         self.track_label.setText(f"Track: {track_name}")
 
         self.bpm_label.setText(f"BPM: {current_track.bpm}")
 
+        self.key_label.setText(f"Key: {current_track.camelot} {current_track.key}")
+
         self.genre_label.setText(f"Genre: {current_track.genre}")
 
         self.date_label.setText(f"Date: {current_track.date}")
 
+        self.update_cue_label()
+
+    def get_recommendation_index(self) -> RecommendationIndex:
+        if self.recommendation_index is None:
+            self.recommendation_index = RecommendationIndex(self.collection)
+        return self.recommendation_index
+
+    def update_suggestions(self):
+        self.suggestions.clear()
+        track = self.current_track
+        if track is None or self.building_recommendations:
+            return
+        for path, _ in self.get_recommendation_index().similar(track):
+            suggestion = self.collection.by_path[path]
+            item = QListWidgetItem(
+                f"{suggestion.full_name}  ({suggestion.bpm} BPM, {suggestion.camelot})"
+            )
+            item.setData(Qt.ItemDataRole.UserRole, path)
+            self.suggestions.addItem(item)
+
+    def build_recommendation_index(self):
+        """Builds the index in the background, large libraries take seconds. It reads
+        a snapshot, so edits meanwhile cannot mix into it."""
+        self.building_recommendations = True
+        snapshot_job = self.collection.snapshot_job()
+
+        def build_from_snapshot():
+            snapshot = snapshot_job()
+            return snapshot, RecommendationIndex(self.collection, snapshot)
+
+        self.run_in_background(
+            build_from_snapshot, on_finished=self.on_recommendation_index_built
+        )
+
+    def on_recommendation_index_built(self, result: tuple):
+        snapshot, index = result
+        self.building_recommendations = False
+        index.catch_up(snapshot, self.collection.snapshot())
+        self.recommendation_index = index
+        self.update_suggestions()
+
+    def on_suggestion_activated(self, item: QListWidgetItem):
+        path = item.data(Qt.ItemDataRole.UserRole)
+        if path in self.focused_collection.by_path:
+            self.load_track(path)
+        else:
+            self.load_track(path, self.collection)
+
     def open_files_from_directory(self):
         all_files = self.get_files_from_directory()
         if not all_files:
@@ -372,20 +702,23 @@ class UI(QMainWindow):
         if not directory:
             return
 
-        all_files = glob.glob(os.path.join(directory, "**"), recursive=True)
-        all_files = [
-            os.path.abspath(file)
-            for file in all_files
-            if os.path.isfile(file) and file.endswith((".mp3", ".wav"))
-        ]
-        return all_files
+        return utility.get_audio_files(directory)
 
     def navigate_directory_with_no_genre_tracks(self):
-        all_files = self.open_files_from_directory()
+        all_files = self.get_files_from_directory()
         if not all_files:
             return
 
-        self.open_tracks(TrackCollection(utility.filter_files_by_genre(all_files)))
+        self.collection += TrackCollection(utility.load_tracks(all_files))
+        no_genre = SmartCrate("No Genre", [Rule("genre", "is_empty")])
+        paths = no_genre.evaluate(self.collection)
+        tracks = TrackCollection(
+            [self.collection.by_path[path] for path in all_files if path in paths],
+            name=no_genre.name,
+            parent=True,
+        )
+        if len(tracks):
+            self.open_tracks(tracks)
 
     def select_file_in_file_dialog(self, file_filter: str = "All Files (*.*)"):
         """Allows the user to navigate to a file on the system. Currently the file_filter is not implemented and will be ignored.
@@ -429,7 +762,14 @@ class UI(QMainWindow):
         self.open_playlist_from_file(selected_playlist)
 
     def open_playlist_from_file(self, playlist):
-        self.open_tracks(TrackCollection(self.load_files_from_playlist(playlist)))
+        self.open_tracks(
+            TrackCollection(
+                self.load_files_from_playlist(playlist),
+                name=os.path.splitext(os.path.basename(playlist))[0],
+                parent=True,
+                file=playlist,
+            )
+        )
 
     def open_tracks(self, tracks: TrackCollection):
         self.collection += tracks
@@ -439,25 +779,43 @@ class UI(QMainWindow):
     def load_track(self, identifier, tracks: None | TrackCollection = None):
         if tracks:
             self.selected_tracks = tracks
+            self.focused_collection = tracks
             if isinstance(identifier, str):
                 identifier, _ = self.selected_tracks.get_track_by_path(identifier)
             self.re_init_track_table(tracks, identifier)
         if isinstance(identifier, int):
-            track = self.collection[identifier]
+            track = self.focused_collection[identifier]
             index = identifier
         else:
-            index, track = self.collection.get_track_by_path(identifier)
+            index, track = self.focused_collection.get_track_by_path(identifier)
 
         self.path_label.setText(f"Path: {track.path}")
+        # Off the GUI thread, the result of an unchanged file only costs a stat
+        self.run_in_background(
+            health.check_files,
+            [track.path],
+            1,
+            self.health_cache,
+            on_finished=self.on_track_health_checked,
+        )
         was_playing = self.media_player.isPlaying()
+        self.finish_play()
         self.current_index = index
         self.current_track = track
+        self.energy_curve.set_current(index)
+        self.current_tags = track
+        self.exit_loop()
+        self.track_gain = loudness.playback_gain(track, cache=self.loudness_cache)
+        self.apply_volume()
         log.debug(f"Loading track: {track.full_name}")
         self.media_player.setSource(QUrl.fromLocalFile(track.path))
 
         log.debug(f"Loaded track: {track.full_name}")
+        self.update_suggestions()
         if was_playing:
             self.play()
+        if self.remote_server is not None:
+            self.remote_server.broadcast("track", self.remote_status())
 
     def keyPressEvent(self, event):
         key_sequence = event.key()
@@ -483,14 +841,46 @@ class UI(QMainWindow):
             and event.key() == Qt.Key.Key_O
         ):
             self.navigate_directory()
-
-    def export_to_file_dialog(self):
-        options = QFileDialog.Option.ShowDirsOnly | QFileDialog.Option.ReadOnly
-        return QFileDialog.getSaveFileName(self, "Select target", options=options)
-
-    def export_collection_to_apple_music_dialog(self, path):
-        path = self.export_to_file_dialog()
-        self.collection.export_to_apple_music(path)
+        if Qt.Key.Key_1.value <= event.key() <= Qt.Key.Key_1.value + MAX_CUES - 1:
+            # 1-8 jump to the hot cue, Ctrl sets it and Alt sets the end of its loop
+            index = event.key() - Qt.Key.Key_1.value + 1
+            if event.modifiers() & Qt.KeyboardModifier.ControlModifier:
+                self.set_cue(index)
+            elif event.modifiers() & Qt.KeyboardModifier.AltModifier:
+                self.set_loop_end(index)
+            else:
+                self.jump_to_cue(index)
+        if event.key() == Qt.Key.Key_Z and (
+            event.modifiers() & Qt.KeyboardModifier.ControlModifier
+        ):
+            if event.modifiers() & Qt.KeyboardModifier.ShiftModifier:
+                self.redo()
+            else:
+                self.undo()
+        if event.key() == Qt.Key.Key_0:
+            self.exit_loop()
+
+    def export_library(self, name: str):
+        """Exports the library and its playlists in a worker thread, several exports
+        can run at once."""
+        exporter = exporters.EXPORTERS[name]
+        path, _ = QFileDialog.getSaveFileName(
+            self,
+            f"Export to {exporter.description}",
+            filter=f"{exporter.description} (*{exporter.extension})",
+        )
+        if not path:
+            return
+        # Snapshots, so the export reads a consistent library while it changes
+        playlists = [
+            playlist.snapshot() for playlist in self.collection.playlists.values()
+        ]
+        snapshot_job = self.collection.snapshot_job()
+        log.info(f"Exporting the library to {path}")
+        self.run_in_background(
+            lambda: exporters.export(name, path, snapshot_job(), playlists),
+            on_finished=lambda count: log.info(f"Exported {count} tracks to {path}"),
+        )
 
     def init_menubar(self):
         open_playlist = QAction("&From Playlist", self)
@@ -501,10 +891,6 @@ class UI(QMainWindow):
         open_files_from_dir.setStatusTip("Opens a all files from a certain Directory")
         open_files_from_dir.triggered.connect(self.open_files_from_directory)
 
-        export_to_itunes = QAction("&Export to iTunes", self)
-        export_to_itunes.setStatusTip("Exports the current track collection to Itunes")
-        export_to_itunes.triggered.connect(self.export_collection_to_apple_music_dialog)
-
         menu = self.menuBar()
         self.file_menu = menu.addMenu("&File")
         self.open_menu = self.file_menu.addMenu("&Open")
@@ -512,13 +898,324 @@ class UI(QMainWindow):
         self.open_menu.addAction(open_files_from_dir)
 
         self.export_menu = self.file_menu.addMenu("&Export")
-        self.export_menu.addAction(export_to_itunes)
+        for name, exporter in exporters.EXPORTERS.items():
+            export_action = QAction(f"{exporter.description}...", self)
+            export_action.setStatusTip(
+                f"Exports the library and its playlists to {exporter.description}"
+            )
+            export_action.triggered.connect(
+                lambda _, name=name: self.export_library(name)
+            )
+            self.export_menu.addAction(export_action)
+
+        analyze_keys = QAction("Analyze &Keys", self)
+        analyze_keys.setStatusTip("Detects the keys of the tracks in the table")
+        analyze_keys.triggered.connect(self.analyze_keys)
+
+        analyze_loudness = QAction("Analyze &Loudness", self)
+        analyze_loudness.setStatusTip(
+            "Measures the loudness of the tracks in the table for the volume leveling"
+        )
+        analyze_loudness.triggered.connect(self.analyze_loudness)
+
+        analyze_beatgrids = QAction("Analyze &Beatgrids", self)
+        analyze_beatgrids.setStatusTip(
+            "Detects the tempo and the downbeats of the tracks in the table"
+        )
+        analyze_beatgrids.triggered.connect(self.analyze_beatgrids)
+
+        analyze_energy = QAction("Analyze &Energy", self)
+        analyze_energy.setStatusTip(
+            "Measures the energy curves and ratings of the tracks in the table"
+        )
+        analyze_energy.triggered.connect(self.analyze_energy)
+
+        self.tools_menu = menu.addMenu("&Tools")
+        self.tools_menu.addAction(analyze_keys)
+        self.tools_menu.addAction(analyze_loudness)
+        self.tools_menu.addAction(analyze_beatgrids)
+        self.tools_menu.addAction(analyze_energy)
+
+        self.playback_menu = menu.addMenu("&Playback")
+        self.quantize_actions = QActionGroup(self)
+        self.quantize_actions.setExclusionPolicy(
+            QActionGroup.ExclusionPolicy.ExclusiveOptional
+        )
+        for mode, text in (("beat", "Snap to &Beats"), ("bar", "Snap to B&ars")):
+            action = QAction(text, self)
+            action.setCheckable(True)
+            action.setStatusTip(f"Seeks and cue points land on the nearest {mode}")
+            action.toggled.connect(
+                lambda checked, mode=mode: self.set_quantize_mode(mode, checked)
+            )
+            self.quantize_actions.addAction(action)
+            self.playback_menu.addAction(action)
+
+        remove_cue = QAction("&Remove Cue Point...", self)
+        remove_cue.setStatusTip("Removes a hot cue or loop of the current track")
+        remove_cue.triggered.connect(self.choose_cue_to_remove)
+        self.playback_menu.addAction(remove_cue)
+
+        self.playback_menu.addSeparator()
+        audition = QAction("&Audition Selected Track", self)
+        audition.setShortcut(QKeySequence("A"))
+        audition.setStatusTip(
+            "Plays the drop of the selected track on the preview output, "
+            "the current track keeps playing"
+        )
+        audition.triggered.connect(self.audition_selected_track)
+        self.playback_menu.addAction(audition)
+
+        self.audition_on_hover = QAction("Audition on &Hover", self)
+        self.audition_on_hover.setCheckable(True)
+        self.audition_on_hover.setStatusTip(
+            "Auditions the track under the mouse in the track table"
+        )
+        self.audition_on_hover.toggled.connect(self.set_audition_on_hover)
+        self.playback_menu.addAction(self.audition_on_hover)
+
+        sync_to_drive = QAction("&Sync Playlists to Drive", self)
+        sync_to_drive.setStatusTip(
+            "Copies the playlists and their tracks to a USB stick or another drive"
+        )
+        sync_to_drive.triggered.connect(self.sync_to_drive)
+        self.tools_menu.addAction(sync_to_drive)
+
+        check_health = QAction("Check &Health", self)
+        check_health.setStatusTip(
+            "Finds missing, unreadable and corrupt files of the tracks in the table"
+        )
+        check_health.triggered.connect(self.check_health)
+        self.tools_menu.addAction(check_health)
+
+        self.show_broken = QAction("Show Only &Broken Files", self)
+        self.show_broken.setCheckable(True)
+        self.show_broken.setStatusTip(
+            "Hides the tracks whose last health check passed or that were never checked"
+        )
+        # Enabled once there are results, see update_health_results
+        self.show_broken.setEnabled(bool(self.health_results))
+        self.show_broken.toggled.connect(
+            lambda checked: self.toggle_table_filter("broken", checked)
+        )
+        self.tools_menu.addAction(self.show_broken)
+
+        sequence_playlist = QAction("Seq&uence Playlist", self)
+        sequence_playlist.setStatusTip(
+            "Orders the tracks in the table for smooth BPM and key transitions"
+        )
+        sequence_playlist.triggered.connect(self.sequence_playlist)
+        self.tools_menu.addAction(sequence_playlist)
+
+        analyze_quality = QAction("Analyze &Quality", self)
+        analyze_quality.setStatusTip(
+            "Finds tracks that were transcoded from a lower bitrate"
+        )
+        analyze_quality.triggered.connect(self.analyze_quality)
+        self.tools_menu.addAction(analyze_quality)
+
+        self.show_suspect = QAction("Show Only &Suspect Transcodes", self)
+        self.show_suspect.setCheckable(True)
+        self.show_suspect.setStatusTip(
+            "Hides the tracks whose frequency range fits their bitrate"
+        )
+        self.show_suspect.toggled.connect(
+            lambda checked: self.toggle_table_filter("suspect", checked)
+        )
+        self.tools_menu.addAction(self.show_suspect)
+
+        self.hide_recent = QAction("Hide &Recently Played", self)
+        self.hide_recent.setCheckable(True)
+        self.hide_recent.setStatusTip(
+            f"Hides the tracks played in the last {HistorySettings.recent_days * 24:g} hours"
+        )
+        self.hide_recent.toggled.connect(
+            lambda checked: self.toggle_table_filter("not_recent", checked)
+        )
+        self.tools_menu.addAction(self.hide_recent)
+
+        self.hide_unavailable = QAction("Hide &Unavailable Tracks", self)
+        self.hide_unavailable.setCheckable(True)
+        self.hide_unavailable.setStatusTip(
+            "Hides the tracks of library folders on drives that are not mounted"
+        )
+        self.hide_unavailable.toggled.connect(
+            lambda checked: self.toggle_table_filter("available", checked)
+        )
+        self.tools_menu.addAction(self.hide_unavailable)
+
+        infer_tags = QAction("&Infer Tags from Paths...", self)
+        infer_tags.setStatusTip(
+            "Fills empty tags of the tracks in the table from their file and folder names"
+        )
+        infer_tags.triggered.connect(self.infer_tags)
+        self.tools_menu.addAction(infer_tags)
 
     def re_init_track_table(self, tracks: TrackCollection, index=0):
         self.track_table.clearContents()
         self.track_table.all_tracks = tracks
-        self.track_table.selected_track = tracks[index]
+        self.track_table.selected_track = tracks[index] if len(tracks) else None
         self.track_table.update_table(tracks)
+        self.update_energy_curve()
+
+    def on_track_table_filled(self):
+        if self.genre_filter_include or self.genre_filter_exclude or self.table_filters:
+            self.apply_genre_filter()
+
+    def on_tracks_reordered(self, tracks: TrackCollection, order: list[int]):
+        self.journal.record(reorder_command(tracks, order))
+        self.on_playlist_changed(tracks)
+
+    def on_playlist_changed(self, tracks: TrackCollection):
+        if (
+            tracks is self.focused_collection
+            and self.current_track is not None
+            and tracks.by_path.get(self.current_track.path) is self.current_track
+        ):
+            self.current_index = tracks.tracks.index(self.current_track)
+        if tracks is self.track_table.all_tracks:
+            self.update_energy_curve()
+        if tracks.file is not None:
+            try:
+                tracks.save_playlist()
+            except OSError as e:
+                log.error(f"Could not save the playlist {tracks.file}: {e}")
+
+    def sequence_playlist(self):
+        tracks = self.focused_collection
+        if len(tracks) < 3:
+            return
+        choices = [
+            "Reorder all tracks",
+            "Keep the first track",
+            "Keep the last track",
+            "Keep the first and the last track",
+        ]
+        choice, ok = QInputDialog.getItem(
+            self, "Sequence Playlist", "Opener and closer:", choices, 0, False
+        )
+        if not ok:
+            return
+        keep = choices.index(choice)
+        opener = 0 if keep in (1, 3) else None
+        closer = len(tracks) - 1 if keep in (2, 3) else None
+        order = sequencing.sequence(tracks.tracks, opener, closer)
+        if order == list(range(len(tracks))):
+            return
+        tracks.reorder(order)
+        # One reorder command, a single undo restores the previous order
+        self.on_tracks_reordered(tracks, order)
+        self.track_table.set_sort_fields([])
+        self.re_init_track_table(tracks)
+
+    def add_to_playlist(self, playlist: TrackCollection, tracks: list[AudioTrack]):
+        start = len(playlist)
+        for track in tracks:
+            playlist.add_track(track)
+        if len(playlist) == start:
+            return
+        self.journal.record(insert_command(playlist, range(start, len(playlist))))
+        self.on_playlist_changed(playlist)
+
+    def remove_from_playlist(self, playlist: TrackCollection, tracks: list[AudioTrack]):
+        if playlist is self.collection:
+            # Only playlists can be edited, not the whole collection
+            return
+        removed = set(tracks)
+        indexes = [i for i, track in enumerate(playlist) if track in removed]
+        if not indexes:
+            return
+        command = remove_command(playlist, indexes)
+        for track in tracks:
+            playlist.remove_track(track)
+        self.journal.record(command)
+        self.on_playlist_changed(playlist)
+        if playlist is self.track_table.all_tracks:
+            self.re_init_track_table(playlist)
+
+    def init_journal(self):
+        self.journal = Journal()
+        self.journal.register("tags", self.handle_tags_command)
+        self.journal.register("tags_batch", self.handle_tags_batch_command)
+        for op in ("reorder", "insert", "remove"):
+            self.journal.register(op, self.handle_playlist_command)
+        self.journal.register("genre_button", self.handle_genre_button_command)
+
+    def edit_tags(self, track: AudioTrack, tags: dict[str, str]):
+        """Writes the tags of a track, the edit can be undone."""
+        before = tag_values(track, tags)
+        self.collection.update_track_tags(track, tags)
+        self.journal.record(tags_command(track.path, before, tags))
+
+    def undo(self):
+        command = self.journal.undo()
+        if command is not None:
+            log.info(f"Undone: {command['op']}")
+
+    def redo(self):
+        command = self.journal.redo()
+        if command is not None:
+            log.info(f"Redone: {command['op']}")
+
+    def handle_tags_batch_command(self, command: dict, undo: bool):
+        commands = command["commands"]
+        for tags in reversed(commands) if undo else commands:
+            apply_tags_command(self.collection, tags, undo)
+        paths = {tags["path"] for tags in commands}
+        self.track_table.refresh_tracks(paths)
+        if self.current_track is not None and self.current_track.path in paths:
+            self.update_tag_labels()
+        if self.genre_filter_include or self.genre_filter_exclude:
+            self.apply_genre_filter()
+
+    def handle_tags_command(self, command: dict, undo: bool):
+        apply_tags_command(self.collection, command, undo)
+        self.track_table.refresh_tracks({command["path"]})
+        if (
+            self.current_track is not None
+            and self.current_track.path == command["path"]
+        ):
+            self.update_tag_labels()
+        if self.genre_filter_include or self.genre_filter_exclude:
+            self.apply_genre_filter()
+
+    def find_playlist(self, key: str) -> TrackCollection | None:
+        candidates = [
+            self.track_table.all_tracks,
+            self.focused_collection,
+            *self.collection.playlists.values(),
+        ]
+        for playlist in candidates:
+            if isinstance(playlist, TrackCollection) and playlist_key(playlist) == key:
+                return playlist
+        if os.path.isfile(key):
+            # The playlist file of an earlier session
+            return TrackCollection(
+                self.load_files_from_playlist(key),
+                name=os.path.splitext(os.path.basename(key))[0],
+                parent=True,
+                file=key,
+            )
+        return None
+
+    def handle_playlist_command(self, command: dict, undo: bool):
+        playlist = self.find_playlist(command["playlist"])
+        if playlist is None:
+            raise ValueError(f"The playlist {command['playlist']} is not open")
+        apply_playlist_command(playlist, command, undo, library=self.collection)
+        self.on_playlist_changed(playlist)
+        if playlist is self.track_table.all_tracks:
+            self.re_init_track_table(playlist)
+
+    def handle_genre_button_command(self, command: dict, undo: bool):
+        text = command["text"]
+        if command["added"] != undo:
+            self.saved_button_texts.add(text)
+        else:
+            self.saved_button_texts.discard(text)
+        self.save_button_texts()
+        self.genre_buttons.clear_layout()
+        self.init_saved_buttons()
 
     def create_playlist(self):
         playlist_name, ok = QInputDialog.getText(
@@ -528,3 +1225,905 @@ class UI(QMainWindow):
             self.collection.playlists[playlist_name] = TrackCollection(
                 name=playlist_name, parent=self.collection
             )
+
+    def create_smart_crate(self):
+        crate_name, ok = QInputDialog.getText(
+            self, "Enter Smart Crate Name", "Smart Crate Name:"
+        )
+        if not ok or not crate_name:
+            return
+        rules, ok = QInputDialog.getText(
+            self,
+            "Enter Rules",
+            "Rules separated by ';', e.g. genre is_empty; bpm between 120 128; date >= 2020; artist contains X",
+        )
+        if not ok or not rules:
+            return
+        try:
+            crate = SmartCrate.parse(crate_name, rules)
+        except ValueError as e:
+            QMessageBox.warning(self, "Invalid Smart Crate", str(e))
+            return
+        crate.attach(self.collection)
+        self.smart_crates.add(crate)
+        self.playlist_buttons.clear_layout()
+        self.init_smart_crate_buttons()
+
+    def init_smart_crate_buttons(self):
+        for crate in self.smart_crates:
+            self.add_smart_crate_button(crate)
+
+    def add_smart_crate_button(self, crate: SmartCrate):
+        new_button = RemovableButton(crate.name, self.playlist_buttons)
+        new_button.button.setToolTip(str(crate))
+        new_button.clicked(lambda: self.open_smart_crate(crate))
+        new_button.on_remove(lambda: self.on_smart_crate_remove_click(crate))
+
+    def on_smart_crate_remove_click(self, crate: SmartCrate):
+        self.smart_crates.remove(crate.name)
+        self.playlist_buttons.clear_layout()
+        self.init_smart_crate_buttons()
+
+    def open_smart_crate(self, crate: SmartCrate):
+        tracks = crate.to_collection()
+        log.debug(f"Opening smart crate {crate.name} with {len(tracks)} tracks")
+        if not len(tracks):
+            QMessageBox.information(
+                self, "Empty Smart Crate", f"No tracks match '{crate}'."
+            )
+            return
+        self.load_track(0, tracks)
+
+    def restore_session(self) -> session.Session | None:
+        """Replaces the empty library by the one of the last run, see session.py."""
+        try:
+            restored = session.load_session()
+        except FileNotFoundError:
+            return None
+        except (OSError, session.SnapshotError) as e:
+            log.warning(f"Could not restore the last session: {e}")
+            return None
+        self.collection = restored.library
+        self.focused_collection = restored.library
+        self.session_signatures = restored.signatures
+        return restored
+
+    def show_session(self, restored: session.Session):
+        self.build_recommendation_index()
+        tracks = restored.focused or self.collection
+        if restored.current_path in tracks.by_path:
+            self.load_track(restored.current_path, tracks)
+        elif len(tracks):
+            self.load_track(0, tracks)
+        # The snapshot is used right away, changed files are read again afterwards
+        self.run_in_background(
+            session.changed_paths,
+            self.session_signatures,
+            on_finished=self.on_session_validated,
+        )
+
+    def on_session_validated(self, paths: list[str]):
+        if not paths:
+            return
+        log.info(f"{len(paths)} files changed since the last session")
+        for path in paths:
+            track = self.collection.by_path.get(path)
+            self.session_signatures[path] = session.stat_signature(path)
+            if track is None or not os.path.isfile(path):
+                continue
+            try:
+                self.collection.reload_track(track)
+            except MutagenError as e:
+                log.warning(f"Could not read the tags of {path}: {e}")
+        self.track_table.refresh_tracks(set(paths))
+        if self.current_track and self.current_track.path in paths:
+            self.update_tag_labels()
+
+    def save_session(self):
+        focused = self.focused_collection
+        restored = session.Session(
+            self.collection,
+            None if focused is self.collection else focused,
+            self.current_track.path if self.current_track else None,
+        )
+        try:
+            session.save_session(restored, signatures=self.session_signatures)
+        except OSError as e:
+            log.error(f"Could not save the session: {e}")
+
+    def closeEvent(self, event):
+        self.save_session()
+        self.library_roots.save_indexes()
+        self.play_tracker.finish()
+        self.play_history.close()
+        if self.remote_server is not None:
+            self.remote_server.stop()
+        self.preview_player.stop()
+        self.previews.shutdown()
+        self.track_table.artwork.shutdown()
+        super().closeEvent(event)
+
+    def update_roots_list(self):
+        self.roots_list.clear()
+        for root in self.library_roots:
+            text = f"{root.name} ({len(root.collection)} tracks)"
+            if root.failed:
+                text = f"{text[:-1]}, {len(root.failed)} unreadable)"
+            item = QListWidgetItem(text if root.online else f"{text}, offline")
+            item.setToolTip(
+                "\n".join(
+                    [root.path]
+                    + [
+                        f"{path}: {error}"
+                        for path, error in list(root.failed.items())[:20]
+                    ]
+                )
+            )
+            item.setData(Qt.ItemDataRole.UserRole, root.path)
+            if not root.online:
+                item.setForeground(QColor("gray"))
+            self.roots_list.addItem(item)
+
+    def selected_library_root(self) -> library.LibraryRoot | None:
+        item = self.roots_list.currentItem()
+        if item is None:
+            return None
+        return self.library_roots.roots.get(item.data(Qt.ItemDataRole.UserRole))
+
+    def add_library_root(self):
+        directory = QFileDialog.getExistingDirectory(
+            self, "Add Folder to the Library", options=QFileDialog.Option.ShowDirsOnly
+        )
+        if not directory:
+            return
+        root = self.library_roots.add_root(directory)
+        self.update_roots_list()
+        self.scan_library_root(root)
+
+    def rescan_library_root(self):
+        root = self.selected_library_root()
+        if root is not None:
+            self.scan_library_root(root)
+
+    def remove_library_root(self):
+        root = self.selected_library_root()
+        if root is None:
+            return
+        self.library_roots.detach(root, self.collection)
+        self.library_roots.remove_root(root)
+        self.update_roots_list()
+        self.update_unavailable()
+        if self.track_table.all_tracks is self.collection:
+            self.re_init_track_table(self.collection)
+
+    def scan_library_root(self, root: library.LibraryRoot):
+        if not root.is_mounted():
+            log.warning(f"Cannot scan {root.path}, it is not mounted")
+            return
+        log.info(f"Scanning {root.path}")
+        self.run_in_background(
+            root.scan,
+            on_finished=lambda result: self.on_library_root_scanned(root, *result),
+            on_failed=lambda error: self.statusBar().showMessage(
+                f"Could not scan {root.path}: {error}"
+            ),
+        )
+
+    def on_library_root_scanned(
+        self,
+        root: library.LibraryRoot,
+        tracks: TrackCollection,
+        read: list[str],
+        failed: dict[str, str],
+    ):
+        if self.library_roots.roots.get(root.path) is not root:
+            # Removed during the scan
+            return
+        root.failed = failed
+        if failed:
+            self.statusBar().showMessage(
+                f"Skipped {len(failed)} unreadable files in {root.path}, "
+                "see the tooltip of the folder"
+            )
+        self.library_roots.attach(root, tracks.tracks, self.collection, read)
+        self.update_roots_list()
+        if self.track_table.all_tracks is self.collection:
+            self.re_init_track_table(self.collection)
+        else:
+            self.track_table.refresh_tracks(set(read))
+
+    def on_library_indexes_loaded(self, indexes: dict[str, list[AudioTrack]]):
+        for path, tracks in indexes.items():
+            root = self.library_roots.roots.get(path)
+            if root is not None:
+                self.library_roots.attach(root, tracks, self.collection)
+        self.update_roots_list()
+        self.update_unavailable()
+        if self.track_table.all_tracks is self.collection:
+            self.re_init_track_table(self.collection)
+        self.load_health_results()
+        self.load_quality_results()
+
+    def on_library_root_activated(self, item: QListWidgetItem):
+        root = self.library_roots.roots.get(item.data(Qt.ItemDataRole.UserRole))
+        if root is None:
+            return
+        # Shows the tracks of the root without copying them, they are in the library
+        self.focused_collection = root.collection
+        self.re_init_track_table(root.collection)
+
+    def check_library_mounts(self):
+        changed = self.library_roots.check_mounts()
+        if not changed:
+            return
+        self.update_roots_list()
+        self.update_unavailable()
+        for root in changed:
+            if root.online:
+                # Files may have changed while the drive was elsewhere
+                self.scan_library_root(root)
+
+    def update_unavailable(self):
+        """Greys out the tracks of unmounted roots, only the changed rows are redrawn."""
+        unavailable = self.library_roots.unavailable_paths()
+        changed = unavailable ^ self.track_table.unavailable
+        self.track_table.unavailable = unavailable
+        if changed:
+            self.track_table.refresh_tracks(changed)
+            if "available" in self.table_filters:
+                self.apply_genre_filter()
+
+    def init_remote(self):
+        """Serves the control API of remote.py, its commands run in the GUI thread."""
+        self.command_bridge = CommandBridge(self.handle_remote_command)
+        self.remote_server = remote.RemoteServer(self.command_bridge)
+        try:
+            self.remote_server.start()
+        except OSError as e:
+            log.error(f"Remote control disabled: {e}")
+            self.remote_server = None
+            return
+        self.published_versions = None
+        self.publishing = False
+        # Changes are published at most once per interval instead of on every edit
+        self.publish_timer = QTimer(self)
+        self.publish_timer.timeout.connect(self.publish_snapshots)
+        self.publish_timer.start(1000)
+        self.publish_snapshots()
+
+    def publish_snapshots(self):
+        versions = (
+            self.collection.version,
+            tuple((name, p.version) for name, p in self.collection.playlists.items()),
+        )
+        if self.publishing or versions == self.published_versions:
+            return
+        playlists = {
+            name: playlist.snapshot()
+            for name, playlist in self.collection.playlists.items()
+        }
+        snapshot_job = self.collection.snapshot_job()
+        self.publishing = True
+
+        def publish():
+            # The first snapshot of the library reads every track
+            self.remote_server.publish(snapshot_job(), playlists)
+
+        def published(_):
+            self.publishing = False
+            self.published_versions = versions
+
+        task = self.run_in_background(publish, on_finished=published)
+        task.failed.connect(lambda _: setattr(self, "publishing", False))
+
+    def remote_status(self) -> dict:
+        track = self.current_track
+        return {
+            "track": remote.track_info(track) if track else None,
+            "index": self.current_index if track else None,
+            "collection": self.focused_collection.name,
+            "playing": self.media_player.isPlaying(),
+            "position": self.media_player.position(),
+            "duration": self.media_player.duration(),
+        }
+
+    def handle_remote_command(self, method: str, params: dict):
+        """Runs a player command of a remote client and returns the new status."""
+        if method == "load":
+            path = params["path"]
+            playlist = params.get("playlist")
+            if playlist is not None:
+                if playlist not in self.collection.playlists:
+                    raise remote.RemoteError(f"Unknown playlist {playlist}")
+                tracks = self.collection.playlists[playlist]
+            elif path in self.focused_collection.by_path:
+                tracks = None
+            else:
+                tracks = self.collection
+            if path not in (tracks or self.focused_collection).by_path:
+                raise remote.RemoteError(f"Unknown track {path}")
+            self.load_track(path, tracks)
+        elif method == "play":
+            self.play()
+        elif method == "pause":
+            self.pause()
+        elif method == "stop":
+            self.stop()
+        elif method == "seek":
+            self.set_position(int(params["position"]))
+        elif method == "next":
+            self.forward()
+        elif method == "previous":
+            self.back()
+        return self.remote_status()
+
+    def run_in_background(self, fnc, *args, on_finished=None, on_failed=None):
+        """Runs fnc in a thread, on_finished is called with the result in the GUI thread.
+        If it raises, on_failed is called with the error, which is shown in the status
+        bar by default."""
+        task = BackgroundTask(fnc, *args)
+        self.background_tasks.add(task)
+        if on_finished is not None:
+            task.finished.connect(on_finished)
+        task.failed.connect(
+            on_failed or (lambda error: self.show_task_failure(fnc, error))
+        )
+        task.finished.connect(lambda _: self.background_tasks.discard(task))
+        task.failed.connect(lambda _: self.background_tasks.discard(task))
+        task.start()
+        return task
+
+    def show_task_failure(self, fnc, error: str):
+        name = getattr(fnc, "__name__", "task").strip("<>").replace("_", " ")
+        self.statusBar().showMessage(f"Failed to {name}: {error}")
+
+    def analyze_keys(self):
+        paths = [track.path for track in self.focused_collection]
+        if not paths:
+            return
+        log.info(f"Analyzing the keys of {len(paths)} tracks")
+        self.run_in_background(
+            key_detection.analyze_keys, paths, on_finished=self.on_keys_analyzed
+        )
+
+    def on_keys_analyzed(self, results: dict[str, dict]):
+        self.write_result_tags(results, key_detection.key_tags, "key", self.show_key)
+
+    def show_key(self, paths: set[str]):
+        if self.current_track and self.current_track.path in paths:
+            self.key_label.setText(
+                f"Key: {self.current_track.camelot} {self.current_track.key}"
+            )
+
+    def write_result_tags(
+        self,
+        results: dict[str, dict],
+        to_tags,
+        namespace: str,
+        on_written=None,
+        cache: FileCache | None = None,
+    ):
+        """Saves the tags of analysis results in the background, see
+        audio_analysis.result_tags. Saving many files would block the GUI.
+
+        Args:
+            namespace (str): Cache of the analysis, its entries are renewed because writing the tags changes the files but not the audio.
+            on_written (Callable[[set[str]], None], optional): Called with the paths of the updated tracks.
+        """
+        tags = audio_analysis.result_tags(self.collection, results, to_tags)
+        if not tags:
+            return
+
+        def save():
+            errors = inference.write_tags(tags)
+            with open_cache(namespace, cache) as analysis_cache:
+                analysis_cache.set_many(
+                    {path: results[path] for path in tags if path not in errors}
+                )
+            return errors
+
+        self.run_in_background(
+            save,
+            on_finished=lambda errors: self.on_result_tags_written(
+                tags, errors, on_written
+            ),
+        )
+
+    def on_result_tags_written(
+        self, tags: dict[str, dict[str, str]], errors: dict[str, str], on_written
+    ):
+        # The files are written, only the tracks in memory and the indexes are updated
+        written = set()
+        for path, values in tags.items():
+            track = self.collection.by_path.get(path)
+            if path in errors or track is None:
+                continue
+            self.collection.update_track_tags(track, values, save=False)
+            written.add(path)
+        self.track_table.refresh_tracks(written)
+        if errors:
+            self.statusBar().showMessage(f"Could not write tags to {len(errors)} files")
+        if on_written is not None:
+            on_written(written)
+
+    def analyze_beatgrids(self):
+        paths = [track.path for track in self.focused_collection]
+        if not paths:
+            return
+        log.info(f"Analyzing the beatgrids of {len(paths)} tracks")
+        self.run_in_background(
+            beatgrid.analyze_beatgrids, paths, on_finished=self.on_beatgrids_analyzed
+        )
+
+    def on_beatgrids_analyzed(self, results: dict[str, dict]):
+        self.write_result_tags(results, beatgrid.beatgrid_tags, "beatgrid")
+
+    def analyze_energy(self):
+        paths = [track.path for track in self.focused_collection]
+        if not paths:
+            return
+        log.info(f"Analyzing the energy of {len(paths)} tracks")
+        self.run_in_background(
+            self.energy_store.measure, paths, on_finished=self.on_energy_analyzed
+        )
+
+    def on_energy_loaded(self, entries: dict[str, dict]):
+        self.energy_store.loaded(entries)
+        self.track_table.energy = self.energy_store.ratings()
+        self.track_table.refresh_tracks(set(entries))
+        self.update_energy_curve()
+
+    def on_energy_analyzed(self, results: dict[str, dict]):
+        # The store is only written in the GUI thread, the curves are drawn from it
+        self.energy_store.add(results)
+        self.track_table.energy.update(
+            {path: result["rating"] for path, result in results.items()}
+        )
+        self.track_table.refresh_tracks(set(results))
+        self.update_energy_curve()
+
+    def update_energy_curve(self):
+        tracks = self.track_table.all_tracks
+        self.energy_curve.set_energy(*self.energy_store.playlist_energy(tracks))
+        self.energy_curve.set_current(
+            self.current_index if tracks is self.focused_collection else None
+        )
+
+    def preview_volume(self, track: AudioTrack) -> float:
+        gain = loudness.playback_gain(track, cache=self.loudness_cache)
+        return self.volume_slider.value() / 100 * 10 ** (gain / 20)
+
+    def audition(self, track: AudioTrack):
+        """Plays the preview of a track on the preview output while the main player
+        goes on, stops it if it is playing. Starts as soon as the preview is decoded,
+        right away if it was prefetched."""
+        if self.preview_player.is_playing(track.path):
+            self.preview_player.stop()
+            return
+        self.prefetch_previews_enabled = True
+        segment = self.previews.cache.get(track.path)
+        if segment is None:
+            self.pending_audition = track
+            start = preview.preview_start(self.energy_store.curves(track.path))
+            self.previews.request(track.path, start)
+            self.schedule_preview_prefetch()
+            return
+        self.pending_audition = None
+        pcm, start = segment
+        log.debug(f"Auditioning {track.full_name} from {start / 1000:.1f} s")
+        self.preview_player.play(track.path, pcm, self.preview_volume(track))
+
+    def audition_selected_track(self):
+        row = self.track_table.currentRow()
+        if row >= 0:
+            self.audition(self.track_table.track_at(row))
+
+    def set_audition_on_hover(self, checked: bool):
+        self.track_table.setMouseTracking(checked)
+        if checked:
+            self.prefetch_previews_enabled = True
+            self.schedule_preview_prefetch()
+        else:
+            self.pending_audition = None
+            self.preview_player.stop()
+
+    def on_track_table_hovered(self, row: int, column: int):
+        if not self.audition_on_hover.isChecked():
+            return
+        track = self.track_table.track_at(row)
+        if not self.preview_player.is_playing(track.path):
+            self.audition(track)
+
+    def on_preview_loaded(self, path: str):
+        track = self.pending_audition
+        if track is not None and track.path == path:
+            self.audition(track)
+
+    def schedule_preview_prefetch(self, *args):
+        # Scrolling and selecting are collected into one prefetch
+        if self.prefetch_previews_enabled:
+            self.preview_timer.start()
+
+    def prefetch_previews(self):
+        """Decodes the previews of the visible rows and their neighbours, the ones
+        next to the selected row first, they are the likeliest to be auditioned."""
+        table = self.track_table
+        visible = table.visible_rows()
+        extra = PreviewSettings.prefetch_rows
+        first = max(visible.start - extra, 0)
+        last = min(visible.stop + extra, table.rowCount())
+        selected = table.currentRow() if table.currentRow() >= 0 else visible.start
+        rows = sorted(
+            (row for row in range(first, last) if not table.isRowHidden(row)),
+            key=lambda row: abs(row - selected),
+        )
+        tracks = [table.track_at(row) for row in rows]
+        tracks = [track for track in tracks if track.path not in table.unavailable]
+        wanted = {track.path for track in tracks}
+        if self.pending_audition is not None:
+            wanted.add(self.pending_audition.path)
+        self.previews.set_wanted(wanted)
+        for track in tracks:
+            if track.path not in self.previews.cache:
+                start = preview.preview_start(self.energy_store.curves(track.path))
+                self.previews.request(track.path, start)
+
+    def on_energy_track_clicked(self, index: int):
+        tracks = self.track_table.all_tracks
+        if index < len(tracks):
+            self.load_track(tracks[index].path)
+
+    def analyze_loudness(self):
+        paths = [track.path for track in self.focused_collection]
+        if not paths:
+            return
+        log.info(f"Analyzing the loudness of {len(paths)} tracks")
+        self.run_in_background(
+            loudness.analyze_loudness,
+            paths,
+            None,
+            self.loudness_cache,
+            on_finished=self.on_loudness_analyzed,
+        )
+
+    def on_loudness_analyzed(self, results: dict[str, dict]):
+        # The gain is taken from the cache until the tags are written
+        self.update_track_gain(set(results))
+        self.write_result_tags(
+            results,
+            loudness.loudness_tags,
+            "loudness",
+            self.update_track_gain,
+            self.loudness_cache,
+        )
+
+    def update_track_gain(self, paths: set[str]):
+        if self.current_track and self.current_track.path in paths:
+            self.track_gain = loudness.playback_gain(
+                self.current_track, cache=self.loudness_cache
+            )
+            self.apply_volume()
+
+    def sync_to_drive(self):
+        playlists = [
+            playlist for playlist in self.collection.playlists.values() if len(playlist)
+        ]
+        if (
+            self.focused_collection is not self.collection
+            and self.focused_collection not in playlists
+        ):
+            playlists.append(self.focused_collection)
+        if not playlists:
+            QMessageBox.information(self, "Sync", "There are no playlists to sync.")
+            return
+        target = QFileDialog.getExistingDirectory(self, "Select Drive")
+        if not target:
+            return
+        log.info(f"Syncing {len(playlists)} playlists to {target}")
+        self.run_in_background(
+            sync.sync_playlists,
+            [playlist.snapshot() for playlist in playlists],
+            target,
+            on_finished=self.on_synced,
+        )
+
+    def on_synced(self, report: sync.SyncReport):
+        message = str(report)
+        if report.failed:
+            message += "\n\nFailed:\n" + "\n".join(
+                f"{path}: {error}" for path, error in report.failed.items()
+            )
+        QMessageBox.information(self, "Sync finished", message)
+
+    def infer_tags(self):
+        if not len(self.focused_collection):
+            return
+        # The worker thread only reads the snapshot, never the live tracks
+        snapshot = self.focused_collection.snapshot()
+
+        def propose():
+            inferrer = inference.PathInferrer()
+            current = {
+                track.path: inference.track_tags(track, inferrer.fields)
+                for track in snapshot
+            }
+            return current, inferrer.propose(current.values())
+
+        self.run_in_background(
+            propose, on_finished=lambda result: self.on_tags_inferred(*result)
+        )
+
+    def on_tags_inferred(
+        self, current: dict[str, dict[str, str]], proposals: dict[str, dict[str, str]]
+    ):
+        if not proposals:
+            QMessageBox.information(
+                self, "Infer Tags", "The paths tell nothing new about the tracks."
+            )
+            return
+        preview = [
+            f"{os.path.basename(path)}: "
+            + ", ".join(f"{field}={value}" for field, value in tags.items())
+            for path, tags in list(proposals.items())[:500]
+        ]
+        if len(proposals) > 500:
+            preview.append(f"... and {len(proposals) - 500} more")
+        dialog = QMessageBox(
+            QMessageBox.Icon.Question,
+            "Infer Tags",
+            f"Write the inferred tags of {len(proposals)} tracks?",
+            QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No,
+            self,
+        )
+        dialog.setDetailedText("\n".join(preview))
+        if dialog.exec() != QMessageBox.StandardButton.Yes:
+            return
+        log.info(f"Writing the inferred tags of {len(proposals)} tracks")
+        self.run_in_background(
+            inference.write_tags,
+            proposals,
+            on_finished=lambda errors: self.on_inferred_tags_written(
+                current, proposals, errors
+            ),
+        )
+
+    def on_inferred_tags_written(
+        self,
+        current: dict[str, dict[str, str]],
+        proposals: dict[str, dict[str, str]],
+        errors: dict[str, str],
+    ):
+        # The files are written, only the tracks in memory and the indexes are updated
+        commands = []
+        for path, tags in proposals.items():
+            if path in errors:
+                continue
+            track = self.collection.by_path.get(path)
+            if track is not None:
+                self.collection.update_track_tags(track, tags, save=False)
+            before = {field: current[path].get(field, "") for field in tags}
+            commands.append(tags_command(path, before, tags))
+        # One step undoes the whole inference
+        self.journal.record(tags_batch_command(commands))
+        self.track_table.refresh_tracks(set(proposals))
+        if errors:
+            QMessageBox.warning(
+                self,
+                "Infer Tags",
+                f"Could not tag {len(errors)} files:\n"
+                + "\n".join(
+                    f"{path}: {error}" for path, error in list(errors.items())[:20]
+                ),
+            )
+
+    def on_track_health_checked(self, results: dict[str, dict]):
+        self.update_health_results(results)
+        track = self.current_track
+        result = results.get(track.path) if track else None
+        if result is not None and result["status"] != health.OK:
+            # Tell it right away instead of failing silently when it should play
+            log.warning(f"Loading a {result['status']} file {track.path}")
+            self.path_label.setText(
+                f"Path: {track.path} ({result['status']}: {result['problems'][0]})"
+            )
+
+    def load_health_results(self):
+        """Reads the results of earlier health checks of the library from the cache,
+        the ones of files that changed since are left out."""
+        paths = [
+            path for path in self.collection.by_path if path not in self.health_results
+        ]
+        if paths:
+            self.run_in_background(
+                self.health_cache.get_many,
+                paths,
+                on_finished=self.update_health_results,
+            )
+
+    def update_health_results(self, results: dict[str, dict]):
+        self.health_results.update(results)
+        # Without results the filter would hide every track
+        self.show_broken.setEnabled(bool(self.health_results))
+        if "broken" in self.table_filters:
+            self.apply_genre_filter()
+
+    def check_health(self):
+        paths = [track.path for track in self.focused_collection]
+        if not paths:
+            return
+        log.info(f"Checking the health of {len(paths)} files")
+        self.run_in_background(
+            health.check_files,
+            paths,
+            HealthSettings.workers,
+            self.health_cache,
+            on_finished=self.on_health_checked,
+        )
+
+    def on_health_checked(self, results: dict[str, dict]):
+        self.update_health_results(results)
+        counts = health.summarize(results)
+        message = ", ".join(f"{count} {status}" for status, count in counts.items())
+        broken = health.broken_paths(results)
+        if broken:
+            message += "\n\n" + "\n".join(
+                f"{path}: {results[path]['status']}" for path in sorted(broken)[:20]
+            )
+            if len(broken) > 20:
+                message += f"\n... and {len(broken) - 20} more"
+        QMessageBox.information(self, "Health check finished", message)
+        if broken and not self.show_broken.isChecked():
+            self.show_broken.setChecked(True)
+
+    def analyze_quality(self):
+        paths = [track.path for track in self.focused_collection]
+        if not paths:
+            return
+        log.info(f"Analyzing the quality of {len(paths)} tracks")
+        self.run_in_background(
+            quality.analyze_qualities,
+            paths,
+            None,
+            self.quality_cache,
+            on_finished=self.on_quality_analyzed,
+        )
+
+    def load_quality_results(self):
+        """Reads the quality results of earlier runs from the cache, like
+        load_health_results the ones of files that changed since are left out."""
+        paths = [
+            path
+            for path in self.collection.by_path
+            if path not in self.track_table.quality
+        ]
+        if paths:
+            self.run_in_background(
+                self.quality_cache.get_many,
+                paths,
+                on_finished=self.update_quality_results,
+            )
+
+    def update_quality_results(self, results: dict[str, dict]):
+        self.track_table.quality.update(results)
+        self.track_table.refresh_tracks(set(results))
+        if "suspect" in self.table_filters:
+            self.apply_genre_filter()
+
+    def on_quality_analyzed(self, results: dict[str, dict]):
+        self.track_table.quality.update(results)
+        self.track_table.refresh_tracks(set(results))
+        suspect = quality.suspect_paths(results)
+        log.info(f"{len(suspect)} of {len(results)} tracks are suspect transcodes")
+        if suspect and not self.show_suspect.isChecked():
+            self.show_suspect.setChecked(True)
+        elif "suspect" in self.table_filters:
+            self.apply_genre_filter()
+
+    def on_media_loaded(self):
+        if not self.current_track:
+            return
+        # Pre-position on the first cue, so playing starts where the track was cued
+        if self.current_track.cues and not self.media_player.isPlaying():
+            first_cue = min(self.current_track.cues.values(), key=lambda c: c.index)
+            self.media_player.setPosition(first_cue.position)
+
+    def jump_to_cue(self, index: int):
+        if not self.current_track or index not in self.current_track.cues:
+            return
+        cue = self.current_track.cues[index]
+        self.media_player.setPosition(self.quantize(cue.position))
+        if cue.is_loop:
+            self.active_loop = cue
+            self.loop_timer.start()
+        else:
+            self.exit_loop()
+        if not self.media_player.isPlaying():
+            self.play()
+
+    def set_cue(self, index: int):
+        if not self.current_track:
+            return
+        position = self.quantize(self.media_player.position())
+        before = tag_values(self.current_track, [CUE_TAG])
+        self.cue_store.set_cue(self.collection, self.current_track, index, position)
+        self.journal.record(
+            tags_command(
+                self.current_track.path,
+                before,
+                tag_values(self.current_track, [CUE_TAG]),
+            )
+        )
+        log.debug(f"Set cue {index} at {position} ms")
+        self.update_cue_label()
+
+    def set_loop_end(self, index: int):
+        """Turns the cue into a loop that ends at the current position."""
+        if not self.current_track or index not in self.current_track.cues:
+            return
+        cue = self.current_track.cues[index]
+        position = self.quantize(self.media_player.position())
+        if position <= cue.position:
+            return
+        before = tag_values(self.current_track, [CUE_TAG])
+        cue = self.cue_store.set_cue(
+            self.collection, self.current_track, index, cue.position, position
+        )
+        self.journal.record(
+            tags_command(
+                self.current_track.path,
+                before,
+                tag_values(self.current_track, [CUE_TAG]),
+            )
+        )
+        self.active_loop = cue
+        self.loop_timer.start()
+        self.update_cue_label()
+
+    def remove_cue(self, index: int):
+        if not self.current_track or index not in self.current_track.cues:
+            return
+        if self.active_loop is self.current_track.cues[index]:
+            self.exit_loop()
+        before = tag_values(self.current_track, [CUE_TAG])
+        self.cue_store.remove_cue(self.collection, self.current_track, index)
+        self.journal.record(
+            tags_command(
+                self.current_track.path,
+                before,
+                tag_values(self.current_track, [CUE_TAG]),
+            )
+        )
+        log.debug(f"Removed cue {index}")
+        self.update_cue_label()
+
+    def choose_cue_to_remove(self):
+        if not self.current_track or not self.current_track.cues:
+            return
+        cues = sorted(self.current_track.cues.values(), key=lambda cue: cue.index)
+        items = [
+            f"{cue.index}: {cue.position / 1000:.1f} s"
+            + (" (loop)" if cue.is_loop else "")
+            for cue in cues
+        ]
+        choice, ok = QInputDialog.getItem(
+            self, "Remove Cue Point", "Cue point:", items, 0, False
+        )
+        if ok:
+            self.remove_cue(cues[items.index(choice)].index)
+
+    def exit_loop(self):
+        self.active_loop = None
+        self.loop_timer.stop()
+
+    def check_loop(self):
+        if self.active_loop is None:
+            return
+        if self.media_player.position() >= self.active_loop.loop_end:
+            self.media_player.setPosition(self.active_loop.position)
+
+    def update_cue_label(self):
+        if not self.current_track:
+            return
+        cues = sorted(self.current_track.cues.values(), key=lambda cue: cue.index)
+        text = " ".join(f"{cue.index}{'L' if cue.is_loop else ''}" for cue in cues)
+        self.cue_label.setText(f"Cues: {text}")
@@ -1,10 +1,37 @@
+import gc
+import glob
+import os
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
+from audio_track import AudioTrack
+from mutagen import MutagenError
 from mutagen.easyid3 import EasyID3
 from mutagen.id3._util import ID3NoHeaderError
 
+AUDIO_EXTENSIONS = (".mp3", ".wav")
+
+
+@contextmanager
+def paused_gc():
+    """Pauses the cyclic garbage collector. Building many objects without cycles, e.g.
+    the tracks of a library, triggers collections that only cost time."""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def filter_files_by_genre(all_files, max_workers=None):
+    """Files without a genre, files that cannot be read are skipped.
+
+    Returns:
+        tuple[list[str], dict[str, str]]: The files in the order of all_files and the errors of the skipped files.
+    """
 
-def filter_files_by_genre(all_files):
     def has_no_genre(file):
         try:
             tags = EasyID3(file)
@@ -14,13 +41,74 @@ def filter_files_by_genre(all_files):
                 return True
         except ID3NoHeaderError:
             return True
+        except (MutagenError, OSError) as e:
+            return e
 
-    with ThreadPoolExecutor() as executor:
+    with ThreadPoolExecutor(max_workers) as executor:
         filtered_files = list(executor.map(has_no_genre, all_files))
 
-    return [file for file, include in zip(all_files, filtered_files) if include]
+    files = [
+        file for file, include in zip(all_files, filtered_files) if include is True
+    ]
+    errors = {
+        file: str(result) or type(result).__name__
+        for file, result in zip(all_files, filtered_files)
+        if isinstance(result, Exception)
+    }
+    return files, errors
+
+
+def get_audio_files(directory):
+    all_files = glob.glob(os.path.join(directory, "**"), recursive=True)
+    return [
+        os.path.abspath(file)
+        for file in all_files
+        if os.path.isfile(file) and file.lower().endswith(AUDIO_EXTENSIONS)
+    ]
+
+
+def load_tracks(all_files, max_workers=None):
+    """Reads the tags of all files in parallel.
+
+    Args:
+        all_files (list[str]): Paths of the audio files.
+        max_workers (int, optional): Number of worker threads. Defaults to the ThreadPoolExecutor default.
+
+    Returns:
+        list[AudioTrack]: The loaded tracks in the same order as all_files.
+    """
+    with ThreadPoolExecutor(max_workers) as executor:
+        return list(executor.map(AudioTrack, all_files))
+
+
+def try_load_tracks(all_files, max_workers=None):
+    """Reads the tags of all files in parallel, files that cannot be read are skipped.
+
+    Returns:
+        tuple[list[AudioTrack], dict[str, str]]: The loaded tracks in the order of all_files and the errors of the skipped files.
+    """
+
+    def load(path):
+        try:
+            return AudioTrack(path)
+        except Exception as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers) as executor:
+        results = list(executor.map(load, all_files))
+    tracks = [result for result in results if isinstance(result, AudioTrack)]
+    errors = {
+        path: str(result) or type(result).__name__
+        for path, result in zip(all_files, results)
+        if not isinstance(result, AudioTrack)
+    }
+    return tracks, errors
 
 
 def openPlaylist(playlist):
     with open(playlist, "r") as f:
-        return [line.strip() for line in f.readlines()]
+        return [
+            line.strip()
+            for line in f.readlines()
+            if line.strip() and not line.startswith("#")
+        ]
@@ -1,21 +1,82 @@
 import copy
+import threading
+from bisect import bisect_right
+from concurrent.futures import Future
 
+import numpy as np
+from artwork import ArtworkLoader
 from audio_track import AudioTrack, TrackCollection
 from logger import Logger
 from PyQt6 import QtGui
 from PyQt6.QtCore import (QByteArray, QDataStream, QIODevice, QIODeviceBase,
-                          QMimeData, QModelIndex, Qt)
-from PyQt6.QtGui import QDrag
+                          QItemSelection, QItemSelectionModel, QMimeData,
+                          QModelIndex, QObject, QPointF, QSize, Qt, QTimer,
+                          pyqtSignal)
+from PyQt6.QtGui import QBrush, QColor, QDrag, QIcon, QPainter, QPolygonF
 from PyQt6.QtWidgets import (QAbstractItemView, QApplication, QGridLayout,
                              QHBoxLayout, QLabel, QLayout, QLayoutItem,
                              QLineEdit, QMenu, QPushButton, QTableWidget,
                              QTableWidgetItem, QTabWidget, QVBoxLayout,
                              QWidget)
-from settings import LoggerSettings
+from quality import quality_label
+from settings import ArtworkSettings, LoggerSettings, TableSettings
+from sorting import SORT_FIELDS, SortIndex
 
 log = Logger("Widgets", LoggerSettings.log_level)
 
 
+class BackgroundTask(QObject):
+    """Runs a function in a thread and emits the result in the GUI thread."""
+
+    finished = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, fnc, *args, **kwargs):
+        super().__init__()
+        self.fnc = fnc
+        self.args = args
+        self.kwargs = kwargs
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        try:
+            result = self.fnc(*self.args, **self.kwargs)
+        except Exception as e:
+            log.error(f"Background task {self.fnc.__name__} failed: {e}")
+            self.failed.emit(str(e))
+            return
+        self.finished.emit(result)
+
+
+class CommandBridge(QObject):
+    """Hands commands from other threads to a handler in the GUI thread."""
+
+    requested = pyqtSignal(object, str, object)
+
+    def __init__(self, handler):
+        super().__init__()
+        self.handler = handler
+        # The bridge lives in the GUI thread, so the slot runs there
+        self.requested.connect(self.run)
+
+    def submit(self, method: str, params: dict) -> Future:
+        """Can be called from any thread, the future is done once the handler returned."""
+        future = Future()
+        self.requested.emit(future, method, params)
+        return future
+
+    def run(self, future: Future, method: str, params: dict):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(self.handler(method, params))
+        except Exception as e:
+            log.error(f"Remote command {method} failed: {e}")
+            future.set_exception(e)
+
+
 class TabWidget(QTabWidget):
     def __init__(self, parent=None):
         super().__init__(parent)
@@ -117,19 +178,40 @@ class LimitedGridLayout(QGridLayout):
             item.widget().deleteLater()
 
 
+# Field of the tracks shown in each column, "#" is the position in the collection
+COLUMN_FIELDS = (None, "artist", "title", "bpm", "key", "genre", "date", "quality", "energy")
+
+
 class TrackTable(QTableWidget):
+    # All rows of the last update_table are added
+    filled = pyqtSignal()
+
     def __init__(
         self,
         rows=0,
-        columns=6,
+        columns=9,
         parent=None,
-        horizontal_header_labels=["#", "Artists", "Track", "BPM", "Genre", "Date"],
+        horizontal_header_labels=[
+            "#",
+            "Artists",
+            "Track",
+            "BPM",
+            "Key",
+            "Genre",
+            "Date",
+            "Quality",
+            "Energy",
+        ],
         execute_on_cell_click=None,
         parent_window=None,
     ):
         super().__init__(rows, columns, parent)
         self.parent_window = parent_window
         self.setHorizontalHeaderLabels(horizontal_header_labels)
+        # Hidden column with the position of every row, used to rearrange the rows
+        self.rank_column = columns
+        self.setColumnCount(columns + 1)
+        self.setColumnHidden(self.rank_column, True)
         self.cellDoubleClicked.connect(self.on_cell_clicked)
         self.cellActivated.connect(self.on_cell_clicked)
         self.cellChanged.connect(self.on_cell_changed)
@@ -138,6 +220,9 @@ class TrackTable(QTableWidget):
 
         self.sort_order = Qt.SortOrder.AscendingOrder
         self.sort_column = 0
+        # (field, descending) pairs, the first one has the highest priority
+        self.sort_fields: list[tuple[str, bool]] = []
+        self.sort_index = None
         self.setDragEnabled(True)
         self.setAcceptDrops(True)
         self.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
@@ -146,32 +231,167 @@ class TrackTable(QTableWidget):
         self.setDragDropMode(QAbstractItemView.DragDropMode.DragDrop)
         self.setDropIndicatorShown(True)
         self.all_tracks = TrackCollection()
+        self.dragging_rows = []
+        # Whether row i shows the track i of the collection, i.e. the table is unsorted
+        self.in_collection_order = True
+        # Path -> result of quality.analyze_quality, shown in the quality column
+        self.quality: dict[str, dict] = dict()
+        # Path -> energy rating from 1 to 10, see energy.EnergyStore
+        self.energy: dict[str, int] = dict()
+        # Paths of the tracks on drives that are not mounted, shown greyed out
+        self.unavailable: set[str] = set()
+        # Tracks and first row of an update_table that is still being filled
+        self.pending_tracks: list[AudioTrack] = []
+        self.pending_row = 0
+        self.fill_timer = QTimer(self)
+        self.fill_timer.setSingleShot(True)
+        self.fill_timer.timeout.connect(self.fill_next_batch)
+
+        # Artwork is only loaded for the visible rows
+        self.artwork = ArtworkLoader(self)
+        self.artwork.loaded.connect(self.schedule_artwork_update)
+        size = ArtworkSettings.table_size
+        self.setIconSize(QSize(size, size))
+        self.verticalHeader().setDefaultSectionSize(size + 2)
+        self.artwork_timer = QTimer(self)
+        self.artwork_timer.setSingleShot(True)
+        self.artwork_timer.setInterval(30)
+        self.artwork_timer.timeout.connect(self.update_visible_artwork)
+        self.verticalScrollBar().valueChanged.connect(self.schedule_artwork_update)
 
     def set_row_item(self, item, row: int = None):
-        for i, x in enumerate(
-            [item.index_item, item.artist, item.title, item.bpm, item.genre]
-        ):
+        for i, x in enumerate(item.items()):
             self.setItem(item.index, i, x)
+        self.setItem(item.index, self.rank_column, RankTableWidgetItem(item.index))
 
     def add_track(self, track):
         self.all_tracks.add_track(track)
         self.update_table([track])
 
     def update_table(self, tracks, row=None):
+        """Adds rows for the tracks. Only the first TableSettings.batch_size rows are
+        added right away, the others between events, filled is emitted when all are."""
+        self.finish_filling()
         if row is None:
             row = self.rowCount()
+        tracks = list(tracks)
+        batch = TableSettings.batch_size
+        self.insert_rows(tracks[:batch], row)
+        if len(tracks) > batch:
+            self.pending_tracks = tracks[batch:]
+            self.pending_row = row + batch
+            self.fill_timer.start()
+            return
+        self.on_filled()
+
+    def is_filling(self) -> bool:
+        return bool(self.pending_tracks)
+
+    def fill_next_batch(self):
+        batch = TableSettings.batch_size
+        tracks = self.pending_tracks[:batch]
+        self.pending_tracks = self.pending_tracks[batch:]
+        self.insert_rows(tracks, self.pending_row)
+        self.pending_row += len(tracks)
+        if self.pending_tracks:
+            self.fill_timer.start()
+        else:
+            self.on_filled()
+
+    def finish_filling(self):
+        """Adds the remaining rows of an unfinished update_table at once."""
+        if not self.pending_tracks:
+            return
+        self.fill_timer.stop()
+        tracks, self.pending_tracks = self.pending_tracks, []
+        self.insert_rows(tracks, self.pending_row)
+        self.on_filled()
+
+    def cancel_filling(self):
+        self.fill_timer.stop()
+        self.pending_tracks = []
+
+    def insert_rows(self, tracks: list[AudioTrack], row: int):
+        # Every cellChanged would resize the columns, they are resized once afterwards
+        self.setUpdatesEnabled(False)
+        self.blockSignals(True)
         for track in tracks:
             self.insertRow(row)
             item = TrackTableRow(track, self, row)
             self.set_row_item(item, row)
             row += 1
+        self.blockSignals(False)
+        self.setUpdatesEnabled(True)
+
+    def on_filled(self):
+        if self.sort_fields:
+            # New rows are moved to their place in the current sort order
+            self.apply_sort()
         self.resize_to_fit_content()
+        self.schedule_artwork_update()
+        self.filled.emit()
+
+    def visible_rows(self) -> range:
+        if self.rowCount() == 0:
+            return range(0)
+        first = self.rowAt(0)
+        last = self.rowAt(self.viewport().height() - 1)
+        if first == -1:
+            first = 0
+        if last == -1:
+            last = self.rowCount() - 1
+        return range(first, last + 1)
+
+    def schedule_artwork_update(self, *args):
+        # Scrolling and finished thumbnails are collected into one update
+        self.artwork_timer.start()
+
+    def update_visible_artwork(self):
+        rows = [row for row in self.visible_rows() if not self.isRowHidden(row)]
+        tracks = [self.track_at(row) for row in rows]
+        self.artwork.set_wanted({track.path for track in tracks})
+        for row, track in zip(rows, tracks):
+            item = self.item(row, 0)
+            if item is None or getattr(item, "has_artwork", False):
+                continue
+            pixmap = self.artwork.pixmap(track.path, ArtworkSettings.table_size)
+            if pixmap is not None:
+                item.setIcon(QIcon(pixmap))
+                item.has_artwork = True
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        self.schedule_artwork_update()
 
     def resize_to_fit_content(self):
         # Resize the columns to fit the content
-        for column in range(self.columnCount()):
+        for column in range(self.rank_column):
             self.resizeColumnToContents(column)
 
+    def track_at(self, row: int) -> AudioTrack:
+        index = self.item(row, 0).text()
+        return self.all_tracks[int(index) - 1]
+
+    def refresh_tracks(self, paths: set[str]):
+        """Shows the current tags of the tracks with the given paths."""
+        for row in range(self.rowCount()):
+            track = self.track_at(row)
+            if track.path in paths:
+                index = int(self.item(row, 0).text()) - 1
+                item = TrackTableRow(track, self, index)
+                item.index = row
+                self.set_row_item(item)
+
+    def filter_rows(self, paths: set[str] | None = None):
+        """Hides all rows whose track path is not in paths. None shows all rows."""
+        self.setUpdatesEnabled(False)
+        for row in range(self.rowCount()):
+            hidden = paths is not None and self.track_at(row).path not in paths
+            if self.isRowHidden(row) != hidden:
+                self.setRowHidden(row, hidden)
+        self.setUpdatesEnabled(True)
+        self.schedule_artwork_update()
+
     def on_cell_clicked(self, row, column):
         # Select the whole row
         self.selectRow(row)
@@ -187,44 +407,88 @@ class TrackTable(QTableWidget):
         self.parent_window.load_track(self.selected_track.path)
 
     def dropEvent(self, event):
-        # Get the source and destination rows
-        for row in self.dragging_rows:
-            source_row = row
-
-            destination_row = self.indexAt(event.position().toPoint()).row()
-            log.debug(f"Destination row:{destination_row}")
-            log.debug(f"Source row:{source_row}")
-            # If the source and destination rows are the same, do nothing
-            if source_row == destination_row:
-                return
-
-            # Move the row to the new position
-            if destination_row == -1:
-                log.debug(f"Destination row == -1")
-                destination_row = self.rowCount()
-            elif destination_row < source_row:
-                log.debug(f"Destination row < source row")
-                tmp_row = destination_row + 1
-                source_row += 1
-                self.insertRow(tmp_row)
-                for column in range(self.columnCount()):
-                    self.setItem(
-                        tmp_row, column, self.takeItem(destination_row, column)
-                    )
-                for column in range(self.columnCount()):
-                    self.setItem(
-                        destination_row, column, self.takeItem(source_row, column)
-                    )
-                self.removeRow(source_row)
-                return
-            else:
-                log.debug(f"Destination row > source Row")
-                destination_row += 1
-
-            self.insertRow(destination_row)
-            for column in range(self.columnCount()):
-                self.setItem(destination_row, column, self.takeItem(source_row, column))
-            self.removeRow(source_row)
+        # Rows of an unfinished fill are not in place yet
+        if event.source() is not self or not self.dragging_rows or self.is_filling():
+            event.ignore()
+            return
+        position = event.position().toPoint()
+        destination_row = self.rowAt(position.y())
+        if destination_row == -1:
+            destination_row = self.rowCount()
+        elif position.y() > (self.rowViewportPosition(destination_row)
+                             + self.rowHeight(destination_row) // 2):
+            # Dropping on the lower half of a row inserts below it
+            destination_row += 1
+        log.debug(f"Moving rows {self.dragging_rows} to {destination_row}")
+        self.move_rows(self.dragging_rows, destination_row)
+        # The rows are already moved, the source must not remove anything
+        event.setDropAction(Qt.DropAction.IgnoreAction)
+        event.accept()
+
+    def move_rows(self, rows: list[int], destination_row: int):
+        """Moves the rows in front of destination_row and the tracks of the collection
+        with them. The collection takes the order of the table, so a sorted table
+        becomes the new order of the playlist."""
+        rows = sorted(set(rows))
+        if not rows:
+            return
+        row_count = self.rowCount()
+        moving = set(rows)
+        rest = [row for row in range(row_count) if row not in moving]
+        position = destination_row - sum(1 for row in rows if row < destination_row)
+        new_rows = rest[:position] + rows + rest[position:]
+        # Only the rows between the first and the last changed one are touched
+        first = min(rows[0], position)
+        last = max(rows[-1], position + len(rows) - 1)
+        if new_rows[first : last + 1] == list(range(first, last + 1)):
+            return
+        if self.in_collection_order:
+            order = new_rows
+        else:
+            order = [int(self.item(row, 0).text()) - 1 for row in new_rows]
+        self.all_tracks.reorder(order)
+
+        self.clearSelection()
+        self.setUpdatesEnabled(False)
+        self.blockSignals(True)
+        self.arrange_rows(new_rows, first, last)
+        # The "#" column refers to the collection, which now has the order of the rows
+        renumbered = range(first, last + 1) if self.in_collection_order else range(row_count)
+        for row in renumbered:
+            item = self.item(row, 0)
+            if item.text() != str(row + 1):
+                # Items are replaced instead of edited, Qt searches every edited item
+                # in the whole table once the rows were sorted
+                index_item = NumericTableWidgetItem(str(row + 1))
+                index_item.parent = item.parent
+                if getattr(item, "has_artwork", False):
+                    index_item.setIcon(item.icon())
+                    index_item.has_artwork = True
+                self.setItem(row, 0, index_item)
+        self.in_collection_order = True
+        self.set_sort_fields([])
+        self.blockSignals(False)
+        self.setUpdatesEnabled(True)
+
+        selection = QItemSelection(self.model().index(position, 0),
+                                   self.model().index(position + len(rows) - 1, self.columnCount() - 1))
+        self.selectionModel().select(selection, QItemSelectionModel.SelectionFlag.Select)
+        self.schedule_artwork_update()
+        if self.parent_window is not None:
+            self.parent_window.on_tracks_reordered(self.all_tracks, order)
+
+    def arrange_rows(self, new_rows: list[int], first: int = 0, last: int | None = None):
+        """Moves row new_rows[i] to row i, only the rows first to last change.
+
+        Row i always has the rank i in the hidden rank column. The moved rows get their
+        new rank and Qt's sort brings them into place, much faster than moving the items
+        of every row from Python.
+        """
+        if last is None:
+            last = len(new_rows) - 1
+        for row in range(first, last + 1):
+            self.setItem(new_rows[row], self.rank_column, RankTableWidgetItem(row))
+        self.sortItems(self.rank_column)
 
     def dragEnterEvent(self, event):
         # Accept the event if it has a MIME type of "application/x-qabstractitemmodeldatalist"
@@ -250,8 +514,9 @@ class TrackTable(QTableWidget):
         mime_data = QMimeData()
         data = QByteArray()
         stream = QDataStream(data, QIODeviceBase.OpenModeFlag.WriteOnly)
-        for row in selected_rows:
-            stream.writeInt(row.row())
+        self.dragging_rows = sorted(row.row() for row in selected_rows)
+        for row in self.dragging_rows:
+            stream.writeInt(row)
         mime_data.setData("application/x-qabstractitemmodeldatalist", data)
 
         # Create a drag object and start the drag
@@ -267,7 +532,9 @@ class TrackTable(QTableWidget):
         # info.triggered.connect(self.parent_window.show_track_info)
         delete = menu.addAction("Delete Track from Playlist")
         delete_submenu = QMenu(menu)
-        delete_submenu.addAction("Yes")
+        delete_yes = delete_submenu.addAction("Yes")
+        delete_yes.triggered.connect(
+            lambda: self.parent_window.remove_from_playlist(self.all_tracks, self.selected_tracks()))
         delete_submenu.addAction("No")
         delete.setMenu(delete_submenu)
 
@@ -276,10 +543,11 @@ class TrackTable(QTableWidget):
         to_new = add_submenu.addAction("New Playlist")
         # to_new.triggered.connect(self.parent_window.add_to_new_pl)
 
-        for index, playlist in enumerate(self.parent_window.collection.playlists):
+        for playlist in self.parent_window.collection.playlists.values():
             plm = add_submenu.addAction(playlist.name)
-            # plm.triggered.connect(lambda checked, index=index: self.parent_window.add_to_pl(index))
-            plm.triggered.connect(lambda checked, index=index: print(index))
+            plm.triggered.connect(
+                lambda checked, playlist=playlist: self.parent_window.add_to_playlist(
+                    playlist, self.selected_tracks()))
 
         add_to_pl.setMenu(add_submenu)
 
@@ -288,18 +556,73 @@ class TrackTable(QTableWidget):
         # Show the context menu at the position of the right-click
         menu.exec(self.mapToGlobal(pos))
 
+    def selected_tracks(self) -> list[AudioTrack]:
+        return [self.track_at(index.row()) for index in self.selectionModel().selectedRows()]
+
     def on_header_clicked(self, column):
-        # Sort the table by the clicked column
-        if self.sort_column == column:
-            self.sort_order = (
-                Qt.SortOrder.DescendingOrder
-                if self.sort_order == Qt.SortOrder.AscendingOrder
-                else Qt.SortOrder.AscendingOrder
-            )
+        """Sorts by the clicked column, a second click reverses the order. Shift-click
+        adds the column as further sort level, "#" restores the order of the collection."""
+        field = COLUMN_FIELDS[column]
+        if field is not None and field not in SORT_FIELDS:
+            # Columns of analysis results are filtered, not sorted
+            return
+        if field is None:
+            self.set_sort_fields([])
+            self.apply_sort()
+            return
+        sort_fields = dict(self.sort_fields)
+        descending = not sort_fields[field] if field in sort_fields else False
+        if QApplication.keyboardModifiers() & Qt.KeyboardModifier.ShiftModifier:
+            sort_fields[field] = descending
+            self.set_sort_fields(list(sort_fields.items()))
+        else:
+            if self.sort_fields and self.sort_fields[0][0] != field:
+                descending = False
+            self.set_sort_fields([(field, descending)])
+        self.apply_sort()
+
+    def set_sort_fields(self, sort_fields: list[tuple[str, bool]]):
+        self.sort_fields = sort_fields
+        header = self.horizontalHeader()
+        header.setSortIndicatorShown(bool(sort_fields))
+        if sort_fields:
+            field, descending = sort_fields[0]
+            self.sort_column = COLUMN_FIELDS.index(field)
+            self.sort_order = Qt.SortOrder.DescendingOrder if descending else Qt.SortOrder.AscendingOrder
+            header.setSortIndicator(self.sort_column, self.sort_order)
+
+    def get_sort_index(self) -> SortIndex:
+        if self.sort_index is None or self.sort_index.collection is not self.all_tracks:
+            if self.sort_index is not None:
+                self.sort_index.detach()
+            self.sort_index = SortIndex(self.all_tracks)
+        return self.sort_index
+
+    def apply_sort(self):
+        """Shows the rows in the order of the sort fields, only rows that change their
+        position are touched."""
+        if self.rowCount() != len(self.all_tracks):
+            return
+        if self.sort_fields:
+            indexes = self.get_sort_index().permutation(tuple(self.sort_fields))
         else:
-            self.sort_column = column
-            self.sort_order = Qt.SortOrder.AscendingOrder
-        self.sortItems(column, self.sort_order)
+            indexes = range(self.rowCount())
+        if self.in_collection_order:
+            new_rows = list(indexes)
+        else:
+            row_of_index = [0] * self.rowCount()
+            for row in range(self.rowCount()):
+                row_of_index[int(self.item(row, 0).text()) - 1] = row
+            new_rows = [row_of_index[index] for index in indexes]
+        changed = [row for row, old_row in enumerate(new_rows) if row != old_row]
+        if changed:
+            self.setUpdatesEnabled(False)
+            self.blockSignals(True)
+            self.arrange_rows(new_rows, changed[0], changed[-1])
+            self.blockSignals(False)
+            self.setUpdatesEnabled(True)
+            self.schedule_artwork_update()
+        self.in_collection_order = not self.sort_fields
 
     def on_cell_changed(self, row, column):
         self.resizeColumnToContents(column)
@@ -320,7 +643,9 @@ class TrackTable(QTableWidget):
     #     super().mouseReleaseEvent(event)
 
     def clearContents(self):
+        self.cancel_filling()
         self.setRowCount(0)  # Remove all rows from the table
+        self.in_collection_order = True
         self.all_tracks = []  # Set the all_tracks attribute to an empty list
         super().clearContents()
 
@@ -335,29 +660,122 @@ class TrackTableRow(QTableWidgetItem):
         self.artist = QTableWidgetItem(track.artist)
         self.title = QTableWidgetItem(track.title)
         self.bpm = NumericTableWidgetItem(track.bpm)
+        self.key = QTableWidgetItem(
+            f"{track.camelot} ({track.key})" if track.camelot else track.key
+        )
         self.genre = QTableWidgetItem(track.genre)
-
-        for item in [self.index_item, self.artist, self.title, self.bpm, self.genre]:
+        self.date = QTableWidgetItem(track.date)
+        quality = table.quality.get(track.path)
+        self.quality = QTableWidgetItem(quality_label(quality))
+        if quality is not None and quality["suspect"]:
+            self.quality.setForeground(QBrush(QColor("red")))
+        rating = table.energy.get(track.path)
+        self.energy = NumericTableWidgetItem("" if rating is None else str(rating))
+
+        unavailable = track.path in table.unavailable
+        for item in self.items():
             item.parent = self
+            if unavailable:
+                item.setForeground(QBrush(QColor("gray")))
+
+    def items(self):
+        return [
+            self.index_item,
+            self.artist,
+            self.title,
+            self.bpm,
+            self.key,
+            self.genre,
+            self.date,
+            self.quality,
+            self.energy,
+        ]
+
 
+class EnergyCurve(QWidget):
+    """Energy of the tracks of a collection one after the other, the current track is
+    highlighted. A click on a track emits its index."""
 
-    class NumericTableWidgetItem(QTableWidgetItem):
-        def __init__(self, text):
-            super().__init__(text)
+    track_clicked = pyqtSignal(int)
 
-        def __lt__(self, other):
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.energy = np.zeros(0)
+        # First block of every track in the energy
+        self.starts: list[int] = []
+        self.current: int | None = None
+        self.setMinimumHeight(60)
+
+    def set_energy(self, energy: np.ndarray, starts: list[int]):
+        self.energy = energy
+        self.starts = starts
+        self.update()
+
+    def set_current(self, index: int | None):
+        self.current = index
+        self.update()
+
+    def block_x(self, block: int) -> float:
+        return block * self.width() / max(len(self.energy), 1)
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        width, height = self.width(), self.height()
+        n = len(self.energy)
+        if n == 0 or width == 0:
+            painter.drawText(
+                self.rect(),
+                Qt.AlignmentFlag.AlignCenter,
+                "Analyze the energy of the tracks to see the curve",
+            )
+            return
+        if self.current is not None and self.current < len(self.starts):
+            start = self.starts[self.current]
+            end = self.starts[self.current + 1] if self.current + 1 < len(self.starts) else n
+            left = int(self.block_x(start))
+            right = int(self.block_x(end))
+            painter.fillRect(left, 0, right - left + 1, height, QColor(255, 220, 120))
+        # The loudest block of each pixel column, so short peaks stay visible
+        edges = np.arange(width) * n // width
+        peaks = np.maximum.reduceat(self.energy, edges) / 255
+        points = [QPointF(0, height)]
+        points += [
+            QPointF(x, height * (1 - peak)) for x, peak in enumerate(peaks.tolist())
+        ]
+        points.append(QPointF(width, height))
+        painter.setPen(Qt.PenStyle.NoPen)
+        painter.setBrush(QColor(60, 120, 200))
+        painter.drawPolygon(QPolygonF(points))
+        painter.setPen(QColor(80, 80, 80))
+        for start in self.starts[1:]:
+            x = int(self.block_x(start))
+            painter.drawLine(x, 0, x, height)
+
+    def mousePressEvent(self, event):
+        if not len(self.energy) or not self.starts:
+            return
+        block = event.position().x() * len(self.energy) / max(self.width(), 1)
+        self.track_clicked.emit(max(bisect_right(self.starts, block) - 1, 0))
+
+
+class RankTableWidgetItem(QTableWidgetItem):
+    """Integer item, sorted numerically by Qt without calling back into Python."""
+
+    def __init__(self, rank: int):
+        super().__init__()
+        self.setData(Qt.ItemDataRole.DisplayRole, rank)
+
+
+class NumericTableWidgetItem(QTableWidgetItem):
+    def __init__(self, text):
+        super().__init__(text)
+
+    def setData(self, role, value):
+        if role == Qt.ItemDataRole.EditRole:
             try:
-                return float(self.text()) < float(other.text())
-            except ValueError:
-                return super().__lt__(other)
-
-        def setData(self, role, value):
-            #FIXME: EditRole unknown
-            if role == Qt.EditRole:
-                try:
-                    float(value)
-                    super().setData(role, value)
-                except ValueError:
-                    pass
-            else:
+                float(value)
                 super().setData(role, value)
+            except ValueError:
+                pass
+        else:
+            super().setData(role, value)